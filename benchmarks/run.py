@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+"""Load and latency benchmarks of the NGSI proxy.
+
+Starts the stub Context Broker (stub_orion.py) in a separate process and
+drives ``ProxyNGSIController.proxy_ngsi_resource`` from several threads,
+reporting throughput, latency and time to first byte percentiles and the peak
+RSS of the process. Results are written as JSON and can be compared against
+the results of a previous run.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource as resource_module
+import subprocess
+import sys
+import threading
+import time
+
+import pkg_resources
+from webob import Request, Response
+from webob.exc import HTTPException, status_map
+
+from ckanext.right_time_context import controller as controller_module
+from ckanext.right_time_context.plugin import NgsiView
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_orion.py')
+PERCENTILES = (50, 95, 99)
+
+
+def build_scenarios(broker_url, entities):
+    # Resources proxied by each scenario, as returned by resource_show
+    limit = min(entities, 1000)
+    entity_list = [{'id': 'urn:ngsi-ld:Room:%06d' % index, 'value': 'Room'} for index in range(entities)]
+    return {
+        'v2': {
+            'format': 'fiware-ngsi',
+            'url': '%s/v2/entities?type=Room&limit=%d' % (broker_url, limit),
+        },
+        'v2-paginated': {
+            'format': 'fiware-ngsi',
+            'url': '%s/v2/entities?type=Room' % broker_url,
+            'follow_pagination': 'true',
+        },
+        'v1': {
+            'format': 'fiware-ngsi',
+            'url': '%s/v1/queryContext' % broker_url,
+            'payload': json.dumps({'entities': [{'type': 'Room', 'isPattern': 'true', 'id': '.*'}]}),
+        },
+        'registry': {
+            'format': 'fiware-ngsi-registry',
+            'url': broker_url,
+            'entity': entity_list,
+        },
+    }
+
+
+def abort(status_code, detail='', headers=None, comment=None):
+    raise status_map[status_code](detail=detail, headers=headers, comment=comment)
+
+
+class FakeBase(threading.local):
+    """Stands for ``ckan.lib.base``, with a request and a response per
+    thread as Pylons does.
+    """
+
+    BaseController = object
+    abort = staticmethod(abort)
+
+    def __init__(self):
+        self.c = FakeObject(user='benchmark', author='benchmark')
+        self.model = FakeObject(Session=None)
+        self.reset()
+
+    def reset(self, headers=None):
+        self.request = Request.blank('/', headers=headers or {})
+        self.response = Response()
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeLogic(object):
+    """Stands for ``ckan.logic``, returning the benchmark resources."""
+
+    def __init__(self, resources):
+        self.resources = resources
+
+    def get_action(self, name):
+        return self.resource_show
+
+    def resource_show(self, context, data_dict):
+        return dict(self.resources[data_dict['id']])
+
+    def check_access(self, name, context, data_dict):
+        return True
+
+
+def install_fakes(resources, config):
+    fake_base = FakeBase()
+    controller_module.base = fake_base
+    controller_module.logic = FakeLogic(resources)
+    controller_module.toolkit = FakeObject(config=config, c=FakeObject())
+    return fake_base
+
+
+def percentiles(values):
+    values = sorted(values)
+    result = {}
+    for percentile in PERCENTILES:
+        if values:
+            # Nearest-rank method
+            index = max(int(-(-percentile * len(values) // 100)) - 1, 0)
+            result['p%d' % percentile] = values[index]
+        else:
+            result['p%d' % percentile] = None
+    result['mean'] = sum(values) / len(values) if values else None
+    return result
+
+
+def peak_rss():
+    # Kilobytes on Linux
+    return resource_module.getrusage(resource_module.RUSAGE_SELF).ru_maxrss
+
+
+def run_level(controller, fake_base, resource_id, concurrency, total_requests, headers):
+    lock = threading.Lock()
+    pending = [total_requests]
+    latencies = []
+    ttfbs = []
+    errors = {}
+    sizes = [0]
+
+    def worker():
+        while True:
+            with lock:
+                if pending[0] == 0:
+                    return
+                pending[0] -= 1
+
+            fake_base.reset(headers)
+            started = time.time()
+            first_byte = None
+            size = 0
+            try:
+                body = controller.proxy_ngsi_resource(resource_id)
+                if body is None:
+                    size = len(fake_base.response.body)
+                else:
+                    for chunk in body:
+                        if first_byte is None:
+                            first_byte = time.time()
+                        size += len(chunk)
+                status = fake_base.response.status_int
+            except HTTPException as e:
+                status = e.code
+
+            finished = time.time()
+            with lock:
+                if status >= 400:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+                    continue
+                latencies.append(finished - started)
+                ttfbs.append((first_byte or finished) - started)
+                sizes[0] += size
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'bytes': sizes[0],
+        'latency': percentiles(latencies),
+        'ttfb': percentiles(ttfbs),
+        'peak_rss_kb': peak_rss(),
+    }
+
+
+def start_stub(args):
+    command = [
+        sys.executable, STUB_PATH, '--port', '0',
+        '--entities', str(args.entities),
+        '--attributes', str(args.attributes),
+        '--latency', str(args.latency),
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.wait()
+        raise RuntimeError('The stub Context Broker could not be started')
+    return process, url
+
+
+def get_version():
+    try:
+        return pkg_resources.get_distribution('ckanext-right_time_context').version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def compare(results, baseline, max_regression):
+    # Returns the list of regressions exceeding max_regression (a percentage)
+    previous = dict(((item['scenario'], item['concurrency']), item) for item in baseline['results'])
+    regressions = []
+
+    print('\n%-14s %5s %22s %26s' % ('scenario', 'conc', 'throughput (req/s)', 'p95 latency (ms)'))
+    for item in results:
+        old = previous.get((item['scenario'], item['concurrency']))
+        if old is None or not old['throughput'] or not item['throughput']:
+            continue
+
+        throughput_delta = (item['throughput'] - old['throughput']) * 100.0 / old['throughput']
+        latency_delta = (item['latency']['p95'] - old['latency']['p95']) * 100.0 / old['latency']['p95']
+        print('%-14s %5d %9.1f -> %7.1f %+5.0f%% %9.1f -> %7.1f %+5.0f%%' % (
+            item['scenario'], item['concurrency'],
+            old['throughput'], item['throughput'], throughput_delta,
+            old['latency']['p95'] * 1000, item['latency']['p95'] * 1000, latency_delta,
+        ))
+
+        if max_regression is not None and (-throughput_delta > max_regression or latency_delta > max_regression):
+            regressions.append(item)
+
+    return regressions
+
+
+def parse_settings(values):
+    config = {}
+    for value in values:
+        name, _, setting = value.partition('=')
+        config['ckan.right_time_context.' + name] = setting
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='v2,v2-paginated,v1,registry', help='comma separated list of scenarios (v2, v2-paginated, v1, registry)')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma separated list of concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests made on each concurrency level')
+    parser.add_argument('--warmup', type=int, default=10, help='requests made before measuring each scenario')
+    parser.add_argument('--entities', type=int, default=1000, help='entities returned by the stub Context Broker')
+    parser.add_argument('--attributes', type=int, default=10, help='attributes of each entity')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the stub Context Broker waits before each response')
+    parser.add_argument('--broker', help='url of an existing Context Broker to use instead of the stub')
+    parser.add_argument('--gzip', action='store_true', help='send Accept-Encoding: gzip on each request')
+    parser.add_argument('--setting', action='append', default=[], metavar='NAME=VALUE', help='extension setting, e.g. cache_ttl=5 (can be repeated)')
+    parser.add_argument('--output', default='benchmark-results.json', help='file the results are written to')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--max-regression', type=float, help='exit with an error if throughput or p95 latency regress more than this percentage')
+    args = parser.parse_args(argv)
+
+    process = None
+    broker_url = args.broker
+    if broker_url is None:
+        process, broker_url = start_stub(args)
+
+    try:
+        config = parse_settings(args.setting)
+        NgsiView().configure(config)
+
+        scenarios = build_scenarios(broker_url.rstrip('/'), args.entities)
+        fake_base = install_fakes(scenarios, config)
+        controller = controller_module.ProxyNGSIController()
+        headers = {'Accept-Encoding': 'gzip'} if args.gzip else {}
+
+        results = []
+        for scenario in args.scenarios.split(','):
+            if args.warmup:
+                run_level(controller, fake_base, scenario, 1, args.warmup, headers)
+
+            for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                result = run_level(controller, fake_base, scenario, concurrency, args.requests, headers)
+                result['scenario'] = scenario
+                results.append(result)
+                print('%-14s conc=%-3d %8.1f req/s  p50=%7.1fms  p95=%7.1fms  p99=%7.1fms  ttfb p50=%7.1fms  rss=%dKB  errors=%s' % (
+                    scenario, concurrency, result['throughput'] or 0,
+                    (result['latency']['p50'] or 0) * 1000, (result['latency']['p95'] or 0) * 1000, (result['latency']['p99'] or 0) * 1000,
+                    (result['ttfb']['p50'] or 0) * 1000, result['peak_rss_kb'], result['errors'] or 0,
+                ))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        'version': get_version(),
+        'date': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'entities': args.entities,
+            'attributes': args.attributes,
+            'latency': args.latency,
+            'requests': args.requests,
+            'broker': args.broker or 'stub',
+            'gzip': args.gzip,
+            'settings': config,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.max_regression)
+        if regressions:
+            print('\n%d measurements regressed more than %.0f%%' % (len(regressions), args.max_regression))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
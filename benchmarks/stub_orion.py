@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+"""Minimal Orion Context Broker stub used by the benchmarks.
+
+Serves a fixed set of generated entities through ``GET /v2/entities``,
+``POST /v2/op/query`` (returning the entities matching the posted ones, both
+paginated using the ``limit``, ``offset`` and ``options=count`` parameters,
+as Orion does) and ``POST /v1/queryContext``.
+
+Entities can be retrieved and updated using ``GET /v2/entities/<id>`` and
+``PATCH /v2/entities/<id>/attrs``. Updates are notified to the subscriptions
+managed through ``/v2/subscriptions`` whose entities match the updated one.
+"""
+
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import re
+import SocketServer
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+ORION_MAX_LIMIT = 1000
+ORION_DEFAULT_LIMIT = 20
+
+
+def build_entity(index, attributes):
+    entity = {
+        'id': 'urn:ngsi-ld:Room:%06d' % index,
+        'type': 'Room',
+    }
+    for attribute in range(attributes):
+        entity['attr%d' % attribute] = {
+            'type': 'Number',
+            'value': index * attributes + attribute,
+            'metadata': {},
+        }
+    return entity
+
+
+def build_context_element(entity):
+    attributes = [
+        {'name': name, 'type': value['type'], 'value': value['value']}
+        for name, value in sorted(entity.items()) if name not in ('id', 'type')
+    ]
+    return {
+        'contextElement': {'id': entity['id'], 'type': entity['type'], 'isPattern': 'false', 'attributes': attributes},
+        'statusCode': {'code': '200', 'reasonPhrase': 'OK'},
+    }
+
+
+class StubOrionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, entities=1000, attributes=10, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubOrionHandler)
+        self.latency = latency
+        self.entities = [build_entity(index, attributes) for index in range(entities)]
+        self.entity_index = dict((entity['id'], index) for index, entity in enumerate(self.entities))
+        # Entities are serialized only once, pages are built joining them
+        self.v2_entities = [json.dumps(entity) for entity in self.entities]
+        self.v1_response = json.dumps({
+            'contextResponses': [build_context_element(entity) for entity in self.entities],
+        })
+        self.subscriptions = {}
+        self.subscription_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    def update_entity(self, entity_id, attributes):
+        with self.lock:
+            index = self.entity_index[entity_id]
+            entity = self.entities[index]
+            entity.update(attributes)
+            self.v2_entities[index] = json.dumps(entity)
+            subscriptions = [(subscription_id, subscription) for subscription_id, subscription in self.subscriptions.items() if matches(subscription, entity)]
+
+        for subscription_id, subscription in subscriptions:
+            notification = subscription['notification']
+            data = dict((name, value) for name, value in entity.items() if name in ('id', 'type') or name in attributes)
+            payload = json.dumps({'subscriptionId': subscription_id, 'data': [data]})
+            thread = threading.Thread(target=send_notification, args=(notification['http']['url'], payload))
+            thread.daemon = True
+            thread.start()
+
+    def query(self, patterns):
+        # Returns the serialized entities matching any of the patterns. Exact
+        # ids are looked up instead of being compared with every entity
+        with self.lock:
+            indexes = set()
+            for pattern in patterns:
+                if 'id' in pattern:
+                    index = self.entity_index.get(pattern['id'])
+                    candidates = [index] if index is not None else []
+                else:
+                    candidates = range(len(self.entities))
+                indexes.update(index for index in candidates if matches_any([pattern], self.entities[index]))
+
+            return [self.v2_entities[index] for index in sorted(indexes)]
+
+
+def matches(subscription, entity):
+    return matches_any(subscription['subject']['entities'], entity)
+
+
+def matches_any(patterns, entity):
+    for pattern in patterns:
+        if 'id' in pattern and pattern['id'] != entity['id']:
+            continue
+        if 'idPattern' in pattern and not re.match(pattern['idPattern'], entity['id']):
+            continue
+        if 'type' in pattern and pattern['type'] != entity['type']:
+            continue
+        if 'typePattern' in pattern and not re.match(pattern['typePattern'], entity['type']):
+            continue
+        return True
+
+    return False
+
+
+def send_notification(url, payload):
+    request = urllib2.Request(url, payload, {'Content-Type': 'application/json'})
+    try:
+        urllib2.urlopen(request, timeout=10).close()
+    except Exception as e:
+        sys.stderr.write('Could not send notification to %s: %s\n' % (url, e))
+
+
+class StubOrionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _send(self, status, body, headers=None):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_page(self, query, entities=None):
+        try:
+            limit = int(query.get('limit', [ORION_DEFAULT_LIMIT])[0])
+            offset = int(query.get('offset', ['0'])[0])
+        except ValueError:
+            return self._send(400, json.dumps({'error': 'BadRequest', 'description': 'Bad pagination data'}))
+
+        if limit < 1 or limit > ORION_MAX_LIMIT or offset < 0:
+            return self._send(400, json.dumps({'error': 'BadRequest', 'description': 'Bad pagination data'}))
+
+        if entities is None:
+            entities = self.server.v2_entities
+
+        headers = {}
+        options = ','.join(query.get('options', [])).split(',')
+        if 'count' in options:
+            headers['Fiware-Total-Count'] = str(len(entities))
+
+        page = entities[offset:offset + limit]
+        self._send(200, '[' + ','.join(page) + ']', headers)
+
+    def _send_not_found(self):
+        self._send(404, json.dumps({'error': 'NotFound', 'description': 'The requested entity has not been found'}))
+
+    def _get_subscription_id(self, path):
+        match = re.match(r'^/v2/subscriptions/([^/]+)$', path)
+        if match is None or match.group(1) not in self.server.subscriptions:
+            return None
+
+        return match.group(1)
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        entity = re.match(r'^/v2/entities/([^/]+)$', url.path)
+
+        if url.path.rstrip('/') == '/v2/entities':
+            return self._send_page(urlparse.parse_qs(url.query))
+        elif entity is not None:
+            index = self.server.entity_index.get(urllib.unquote(entity.group(1)))
+            if index is None:
+                return self._send_not_found()
+            return self._send(200, self.server.v2_entities[index])
+        elif url.path.rstrip('/') == '/v2/subscriptions':
+            with self.server.lock:
+                subscriptions = [dict(subscription, id=subscription_id) for subscription_id, subscription in sorted(self.server.subscriptions.items())]
+            return self._send(200, json.dumps(subscriptions))
+
+        self._send_not_found()
+
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        body = self._read_body()
+
+        if url.path == '/v2/op/query':
+            try:
+                patterns = json.loads(body).get('entities', [])
+            except (AttributeError, ValueError):
+                return self._send(400, json.dumps({'error': 'ParseError', 'description': 'Errors found in incoming JSON buffer'}))
+
+            return self._send_page(urlparse.parse_qs(url.query), self.server.query(patterns))
+        elif url.path == '/v1/queryContext':
+            return self._send(200, self.server.v1_response)
+        elif url.path.rstrip('/') == '/v2/subscriptions':
+            with self.server.lock:
+                subscription_id = '%024x' % next(self.server.subscription_ids)
+                self.server.subscriptions[subscription_id] = json.loads(body)
+            return self._send(201, '', {'Location': '/v2/subscriptions/' + subscription_id})
+
+        self._send_not_found()
+
+    def do_PATCH(self):
+        url = urlparse.urlsplit(self.path)
+        body = self._read_body()
+        entity = re.match(r'^/v2/entities/([^/]+)/attrs$', url.path)
+        subscription_id = self._get_subscription_id(url.path)
+
+        if entity is not None:
+            entity_id = urllib.unquote(entity.group(1))
+            if entity_id not in self.server.entity_index:
+                return self._send_not_found()
+            self.server.update_entity(entity_id, json.loads(body))
+            return self._send(204, '')
+        elif subscription_id is not None:
+            with self.server.lock:
+                self.server.subscriptions[subscription_id].update(json.loads(body))
+            return self._send(204, '')
+
+        self._send_not_found()
+
+    def do_DELETE(self):
+        url = urlparse.urlsplit(self.path)
+        self._read_body()
+        subscription_id = self._get_subscription_id(url.path)
+
+        if subscription_id is not None:
+            with self.server.lock:
+                self.server.subscriptions.pop(subscription_id, None)
+            return self._send(204, '')
+
+        self._send_not_found()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1026, help='use 0 for choosing a free port')
+    parser.add_argument('--entities', type=int, default=1000, help='number of entities served')
+    parser.add_argument('--attributes', type=int, default=10, help='number of attributes of each entity')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds waited before each response')
+    args = parser.parse_args(argv)
+
+    server = StubOrionServer((args.host, args.port), entities=args.entities, attributes=args.attributes, latency=args.latency)
+    # The benchmark runner reads the url from the first line of the output
+    sys.stdout.write(server.url + '\n')
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import threading
+
+from .concurrency import unordered_map
+from .utils import get_int_setting
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_RESOURCES = 50
+
+
+def is_json(content_type):
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    return media_type == 'application/json' or media_type.endswith('+json')
+
+
+def format_result(resource_id, content_type, body):
+    # JSON responses are validated and embedded as they are. Line breaks can
+    # only be whitespace between JSON tokens, so they are safely removed to
+    # keep each result in a single line. Other responses are embedded as
+    # strings. Raises ValueError if a JSON response is not valid
+    if body.strip() == b'':
+        data = b'null'
+    elif is_json(content_type):
+        json.loads(body)
+        data = body.replace(b'\r', b' ').replace(b'\n', b' ').strip()
+    else:
+        data = json.dumps(body.decode('utf-8', 'replace')).encode('utf-8')
+
+    prefix = json.dumps({'id': resource_id, 'status': 200, 'content_type': content_type})[:-1]
+    return prefix.encode('utf-8') + b', "data": ' + data + b'}\n'
+
+
+def format_error(resource_id, status, message):
+    return json.dumps({'id': resource_id, 'status': status, 'error': message}).encode('utf-8') + b'\n'
+
+
+class BatchProxy(object):
+    """Settings and statistics of the batch proxy endpoint.
+
+    Batch results are returned as NDJSON, one line per resource, in the
+    order they are completed.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, max_resources=DEFAULT_MAX_RESOURCES):
+        self.concurrency = concurrency
+        self.max_resources = max_resources
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._resources = 0
+        self._errors = 0
+
+    def configure(self, config):
+        self.concurrency = get_int_setting(config, 'batch_concurrency', DEFAULT_CONCURRENCY)
+        self.max_resources = get_int_setting(config, 'batch_max_resources', DEFAULT_MAX_RESOURCES)
+
+    def parse_ids(self, values):
+        # Ids can be provided using several parameters or a comma separated
+        # list. Duplicated ids are ignored
+        resource_ids = []
+        for value in values:
+            for resource_id in value.split(','):
+                resource_id = resource_id.strip()
+                if resource_id != '' and resource_id not in resource_ids:
+                    resource_ids.append(resource_id)
+
+        return resource_ids
+
+    def run(self, jobs, fetch):
+        # Yields a NDJSON line for each job, fetch must return the line of a
+        # job (including errors) instead of raising exceptions
+        with self._lock:
+            self._batches += 1
+            self._resources += len(jobs)
+
+        for line in unordered_map(fetch, jobs, max(self.concurrency, 1)):
+            yield line
+
+    def error(self, resource_id, status, message):
+        with self._lock:
+            self._errors += 1
+
+        return format_error(resource_id, status, message)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'resources': self._resources,
+                'errors': self._errors,
+                'concurrency': self.concurrency,
+                'max_resources': self.max_resources,
+            }
+
+
+batch_proxy = BatchProxy()
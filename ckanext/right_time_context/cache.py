@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+import hashlib
+import json
+from logging import getLogger
+import threading
+import time
+
+import six
+
+from .streaming import response_streamer
+from .utils import get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_TTL = 0
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_ENTRY_SIZE = 4 * 1024 * 1024
+
+# Headers identifying the upstream request in addition to the url and body
+KEY_HEADERS = ('FIWARE-Service', 'FIWARE-ServicePath', 'Authorization', 'X-Auth-Token')
+
+
+def build_cache_key(resource_id, method, url, body, headers):
+    identity = [resource_id, method.upper(), url, body]
+    identity.extend(headers.get(header, '') for header in KEY_HEADERS)
+
+    return hashlib.sha1(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compute_etag(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+def _normalize_etag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(request_headers, etag=None, last_modified=None):
+    # If-Modified-Since is ignored when If-None-Match is present (RFC 7232)
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match:
+        if etag is None:
+            return False
+        elif if_none_match.strip() == '*':
+            return True
+
+        return _normalize_etag(etag) in [_normalize_etag(tag) for tag in if_none_match.split(',')]
+
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+        since = parsedate_tz(if_modified_since)
+        modified = parsedate_tz(last_modified)
+        if since is not None and modified is not None:
+            return mktime_tz(modified) <= mktime_tz(since)
+
+    return False
+
+
+def parse_cache_control(value):
+    directives = {}
+    if not value:
+        return directives
+
+    for directive in value.split(','):
+        name, sep, argument = directive.strip().partition('=')
+        name = name.strip().lower()
+        if name == "":
+            continue
+
+        argument = argument.strip().strip('"')
+        try:
+            directives[name] = int(argument) if sep else True
+        except ValueError:
+            directives[name] = argument
+
+    return directives
+
+
+class CacheEntry(object):
+
+    def __init__(self, body, content_type, charset, headers, ttl, stale_while_revalidate=0, stale_if_error=0):
+        self.body = body
+        self.content_type = content_type
+        self.charset = charset
+        # Validators provided by the Context Broker, used for revalidating
+        # the entry using conditional requests
+        self.headers = headers
+        self.etag = headers.get('ETag') or compute_etag(body)
+        self.last_modified = headers.get('Last-Modified')
+        self.created = time.time()
+        self.fresh_until = self.created + ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        # Gzip version of the body, computed the first time it is requested
+        self.compressed_body = None
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def age(self, now=None):
+        return int((now or time.time()) - self.created)
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.fresh_until
+
+    def can_revalidate_stale(self, now=None):
+        return (now or time.time()) < self.fresh_until + self.stale_while_revalidate
+
+    def can_serve_on_error(self, now=None):
+        return (now or time.time()) < self.fresh_until + self.stale_if_error
+
+    def expires(self):
+        # Entries including validators from the Context Broker are kept
+        # until evicted, as they can be revalidated using conditional requests
+        if self.headers:
+            return float('inf')
+
+        return self.fresh_until + max(self.stale_while_revalidate, self.stale_if_error)
+
+
+class ResponseCache(object):
+    """In-process LRU cache of proxied Context Broker responses.
+
+    Memory usage is bounded by ``max_size`` bytes of cached bodies. Entries
+    are kept after expiring as long as they can still be served while being
+    revalidated or when the Context Broker is failing.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, max_entry_size=DEFAULT_MAX_ENTRY_SIZE, stale_while_revalidate=0, stale_if_error=0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._revalidating = set()
+        self._hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def configure(self, config):
+        self.ttl = get_int_setting(config, 'cache_ttl', DEFAULT_TTL)
+        self.max_size = get_int_setting(config, 'cache_max_size', DEFAULT_MAX_SIZE)
+        self.max_entry_size = get_int_setting(config, 'cache_max_entry_size', DEFAULT_MAX_ENTRY_SIZE)
+        self.stale_while_revalidate = get_int_setting(config, 'cache_stale_while_revalidate', 0)
+        self.stale_if_error = get_int_setting(config, 'cache_stale_if_error', 0)
+        self.clear()
+
+    def get_ttl(self, resource):
+        value = resource.get('cache_ttl', '')
+        if isinstance(value, six.string_types):
+            value = value.strip()
+
+        if value in (None, ''):
+            return self.ttl
+
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return self.ttl
+
+    def is_enabled(self, resource):
+        return self.max_size > 0 and self.get_ttl(resource) > 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+
+            if now >= entry.expires():
+                self._remove(key)
+                self._misses += 1
+                return None
+
+            # Mark as recently used
+            del self._entries[key]
+            self._entries[key] = entry
+
+            if entry.is_fresh(now):
+                self._hits += 1
+            else:
+                self._stale_hits += 1
+
+            return entry
+
+    def peek(self, key):
+        # Returns an entry without updating its position or the statistics
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is None or time.time() >= entry.expires():
+            return None
+
+        return entry
+
+    def get_policy(self, resource, response_headers):
+        # Returns the (ttl, stale_while_revalidate, stale_if_error) tuple to
+        # use for caching a response or None if it cannot be cached
+        directives = parse_cache_control(response_headers.get('Cache-Control'))
+        if 'no-store' in directives or 'no-cache' in directives:
+            return None
+
+        ttl = self.get_ttl(resource)
+        for directive in ('s-maxage', 'max-age'):
+            if isinstance(directives.get(directive), int):
+                ttl = directives[directive]
+                break
+
+        if ttl <= 0:
+            return None
+
+        stale_while_revalidate = directives.get('stale-while-revalidate', self.stale_while_revalidate)
+        stale_if_error = directives.get('stale-if-error', self.stale_if_error)
+        if not isinstance(stale_while_revalidate, int):
+            stale_while_revalidate = self.stale_while_revalidate
+        if not isinstance(stale_if_error, int):
+            stale_if_error = self.stale_if_error
+
+        return ttl, stale_while_revalidate, stale_if_error
+
+    def set(self, key, entry):
+        if entry.size > self.max_entry_size or entry.size > self.max_size:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = entry
+            self._size += entry.size
+
+            while self._size > self.max_size:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self._evictions += 1
+
+        return True
+
+    def store(self, key, resource, response, body):
+        policy = self.get_policy(resource, response.headers)
+        if policy is None:
+            return False
+
+        ttl, stale_while_revalidate, stale_if_error = policy
+        headers = dict((name, response.headers[name]) for name in ('ETag', 'Last-Modified') if name in response.headers)
+        entry = CacheEntry(body, response.headers.get('content-type'), response.encoding, headers, ttl, stale_while_revalidate, stale_if_error)
+
+        return self.set(key, entry)
+
+    def refresh(self, key, resource, entry, response_headers):
+        # Renews an entry after the Context Broker replied with a 304 status
+        # code to a conditional request
+        policy = self.get_policy(resource, response_headers)
+        if policy is None:
+            return entry
+
+        ttl, stale_while_revalidate, stale_if_error = policy
+        headers = dict(entry.headers)
+        headers.update((name, response_headers[name]) for name in ('ETag', 'Last-Modified') if name in response_headers)
+        new_entry = CacheEntry(entry.body, entry.content_type, entry.charset, headers, ttl, stale_while_revalidate, stale_if_error)
+        self.set(key, new_entry)
+
+        return new_entry
+
+    def update(self, key, resource, response):
+        # Stores the response to a (conditional) request made for renewing
+        # an entry. Returns True if the entry was renewed. The body is read
+        # through the streamer as paginated and sharded responses are only
+        # iterable
+        if response.status_code == 200:
+            return self.store(key, resource, response, response_streamer.read(response))
+        elif response.status_code == 304:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is not None:
+                self.refresh(key, resource, entry, response.headers)
+                return True
+        else:
+            log.info('Unable to revalidate cached ngsi response, status code: {0}'.format(response.status_code))
+
+        return False
+
+    def revalidate(self, key, resource, fetch):
+        # Refreshes an entry in a background thread, making sure there is
+        # only one pending revalidation for each entry
+        with self._lock:
+            if key in self._revalidating:
+                return False
+            self._revalidating.add(key)
+
+        def run():
+            try:
+                self.update(key, resource, fetch())
+            except Exception as e:
+                log.info('Unable to revalidate cached ngsi response: {0}'.format(e))
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        thread = threading.Thread(target=run, name='right_time_context-revalidate')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._stale_hits + self._misses
+            return {
+                'hits': self._hits,
+                'stale_hits': self._stale_hits,
+                'misses': self._misses,
+                'hit_ratio': float(self._hits + self._stale_hits) / total if total else 0.0,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+            }
+
+
+response_cache = ResponseCache()
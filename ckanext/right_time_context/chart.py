@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import OrderedDict
+import calendar
+import re
+import threading
+
+import six
+
+from .utils import get_int_setting, get_setting
+
+DEFAULT_MAX_POINTS = 2000
+DEFAULT_POINTS_PER_PIXEL = 1
+DEFAULT_TIME_ATTRIBUTE = 'TimeInstant'
+
+LTTB = 'lttb'
+MINMAX = 'minmax'
+METHODS = (LTTB, MINMAX)
+
+# Metadata used as the timestamp of the values of an entity attribute
+TIME_METADATA = ('TimeInstant', 'dateModified')
+
+_TIMESTAMP = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parse_timestamp(value):
+    # Returns the number of milliseconds since the epoch of an ISO 8601 date,
+    # or None if the value is not a date
+    if not isinstance(value, six.string_types):
+        return None
+
+    match = _TIMESTAMP.match(value.strip())
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second or 0), 0, 0, 0))
+    except ValueError:
+        return None
+
+    if zone not in (None, 'Z'):
+        sign = -1 if zone[0] == '+' else 1
+        zone = zone[1:].replace(':', '')
+        seconds += sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+
+    milliseconds = int((fraction or '0')[:3].ljust(3, '0'))
+    return seconds * 1000 + milliseconds
+
+
+def to_number(value):
+    if isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, float) + six.integer_types):
+        return float(value)
+    elif isinstance(value, six.string_types):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    return None
+
+
+def _get_value(attribute):
+    # Supports both the normalized and the keyValues representations
+    if isinstance(attribute, dict) and 'value' in attribute:
+        return attribute['value']
+
+    return attribute
+
+
+def _get_entity_time(entity, attribute, time_attribute):
+    metadata = attribute.get('metadata', {}) if isinstance(attribute, dict) else {}
+    for name in TIME_METADATA:
+        timestamp = parse_timestamp(_get_value(metadata.get(name)))
+        if timestamp is not None:
+            return timestamp
+
+    return parse_timestamp(_get_value(entity.get(time_attribute)))
+
+
+def _add_points(series, name, times, values):
+    for time, value in zip(times, values):
+        time = parse_timestamp(time)
+        value = to_number(value)
+        if time is not None and value is not None:
+            series.setdefault(name, []).append((time, value))
+
+
+def extract_series(data, time_attribute=DEFAULT_TIME_ATTRIBUTE):
+    """Returns the numeric series found on a NGSI response, indexed by
+    attribute name, as lists of (timestamp, value) tuples sorted by time.
+
+    Supports QuantumLeap and STH-Comet historical responses and NGSIv2
+    entities, using the timestamp metadata of their attributes or their
+    ``time_attribute`` attribute.
+    """
+    series = OrderedDict()
+
+    if isinstance(data, dict) and 'index' in data:
+        # QuantumLeap
+        if 'attributes' in data:
+            for attribute in data['attributes']:
+                _add_points(series, attribute.get('attrName'), data['index'], attribute.get('values', []))
+        else:
+            _add_points(series, data.get('attrName', 'value'), data['index'], data.get('values', []))
+
+    elif isinstance(data, dict) and 'contextResponses' in data:
+        # STH-Comet
+        for response in data['contextResponses']:
+            for attribute in response.get('contextElement', {}).get('attributes', []):
+                values = attribute.get('values', [])
+                _add_points(series, attribute.get('name'), [value.get('recvTime') for value in values], [value.get('attrValue') for value in values])
+
+    else:
+        # NGSIv2 entities
+        entities = data if isinstance(data, list) else [data]
+        for entity in entities:
+            if not isinstance(entity, dict):
+                continue
+
+            for name, attribute in entity.items():
+                if name in ('id', 'type', time_attribute):
+                    continue
+
+                value = to_number(_get_value(attribute))
+                time = _get_entity_time(entity, attribute, time_attribute) if value is not None else None
+                if time is not None:
+                    series.setdefault(name, []).append((time, value))
+
+    for points in series.values():
+        points.sort()
+
+    return series
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets downsampling of a list of (x, y)
+    tuples sorted by x.
+    """
+    length = len(points)
+    if threshold >= length or threshold <= 0:
+        return list(points)
+    elif threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    bucket_size = float(length - 2) / (threshold - 2)
+    selected = 0
+
+    for bucket in six.moves.range(threshold - 2):
+        # Average point of the next bucket
+        next_start = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, length)
+        next_points = points[next_start:next_end]
+        average_x = sum(point[0] for point in next_points) / float(len(next_points))
+        average_y = sum(point[1] for point in next_points) / float(len(next_points))
+
+        # Point of this bucket forming the largest triangle with the
+        # previously selected point and the average of the next bucket
+        selected_x, selected_y = points[selected]
+        max_area = -1
+        for index in six.moves.range(int(bucket * bucket_size) + 1, int((bucket + 1) * bucket_size) + 1):
+            x, y = points[index]
+            area = abs((selected_x - average_x) * (y - selected_y) - (selected_x - x) * (average_y - selected_y))
+            if area > max_area:
+                max_area = area
+                candidate = index
+
+        sampled.append(points[candidate])
+        selected = candidate
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, threshold):
+    """Keeps the minimum and the maximum value of each bucket, preserving
+    spikes. Returns at most ``threshold`` points.
+    """
+    length = len(points)
+    if threshold >= length or threshold <= 0:
+        return list(points)
+    elif threshold < 2:
+        # A bucket needs two points, keep the first one like lttb
+        return [points[0]]
+
+    buckets = threshold // 2
+    bucket_size = float(length) / buckets
+    sampled = []
+
+    for bucket in six.moves.range(buckets):
+        values = points[int(bucket * bucket_size):int((bucket + 1) * bucket_size)]
+        if not values:
+            continue
+
+        low = min(values, key=lambda point: point[1])
+        high = max(values, key=lambda point: point[1])
+        sampled.extend(sorted(set((low, high))))
+
+    return sampled
+
+
+DOWNSAMPLERS = {
+    LTTB: lttb,
+    MINMAX: minmax,
+}
+
+
+class ChartBuilder(object):
+    """Builds the downsampled series of the chart of the ``ngsi_view``.
+
+    Series are returned as columns (timestamps first) sharing the same
+    timestamps, using ``None`` for the timestamps missing on a series, as
+    expected by dygraph once transposed.
+    """
+
+    def __init__(self, max_points=DEFAULT_MAX_POINTS, points_per_pixel=DEFAULT_POINTS_PER_PIXEL, time_attribute=DEFAULT_TIME_ATTRIBUTE):
+        self.max_points = max_points
+        self.points_per_pixel = points_per_pixel
+        self.time_attribute = time_attribute
+
+        self._lock = threading.Lock()
+        self._charts = 0
+        self._points_in = 0
+        self._points_out = 0
+
+    def configure(self, config):
+        self.max_points = get_int_setting(config, 'chart_max_points', DEFAULT_MAX_POINTS)
+        self.points_per_pixel = get_int_setting(config, 'chart_points_per_pixel', DEFAULT_POINTS_PER_PIXEL)
+        self.time_attribute = get_setting(config, 'chart_time_attribute', DEFAULT_TIME_ATTRIBUTE)
+
+    def get_threshold(self, width=None, points=None):
+        # Number of points of each series
+        if points is None and width is not None:
+            points = width * self.points_per_pixel
+
+        if points is None or points <= 0:
+            return self.max_points
+
+        return min(points, self.max_points) if self.max_points > 0 else points
+
+    def build(self, data, attrs=None, threshold=DEFAULT_MAX_POINTS, method=LTTB):
+        series = extract_series(data, self.time_attribute)
+        if attrs:
+            series = OrderedDict((name, series[name]) for name in attrs if name in series)
+
+        downsample = DOWNSAMPLERS[method]
+        sampled = OrderedDict((name, downsample(points, threshold)) for name, points in series.items())
+
+        times = sorted(set(time for points in sampled.values() for time, value in points))
+        columns = [times]
+        for points in sampled.values():
+            values = dict(points)
+            columns.append([values.get(time) for time in times])
+
+        with self._lock:
+            self._charts += 1
+            self._points_in += sum(len(points) for points in series.values())
+            self._points_out += sum(len(points) for points in sampled.values())
+
+        return {
+            'labels': ['time'] + list(sampled.keys()),
+            'columns': columns,
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'charts': self._charts,
+                'points_in': self._points_in,
+                'points_out': self._points_out,
+                'max_points': self.max_points,
+            }
+
+
+chart_builder = ChartBuilder()
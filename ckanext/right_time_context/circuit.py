@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import deque
+from logging import getLogger
+import math
+import threading
+import time
+
+from .utils import get_bool_setting, get_float_setting, get_int_setting
+
+log = getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_WINDOW = 60
+DEFAULT_MIN_REQUESTS = 10
+DEFAULT_FAILURE_RATIO = 0.5
+DEFAULT_OPEN_TIME = 30
+# Maximum number of outcomes kept per host
+MAX_OUTCOMES = 1000
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, host, retry_after):
+        super(CircuitOpenError, self).__init__('Circuit open for {0}'.format(host))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class HostCircuit(object):
+
+    def __init__(self):
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=MAX_OUTCOMES)
+        self.opened_at = 0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+
+
+class CircuitBreaker(object):
+    """Per host circuit breaker for the Context Broker requests.
+
+    The circuit of a host is opened when the ratio of failed requests during
+    the last ``window`` seconds reaches ``failure_ratio`` (with at least
+    ``min_requests`` requests). Requests to open hosts fail immediately until
+    ``open_time`` seconds have passed, then a single probe request is
+    allowed (half-open state) to decide whether to close the circuit again.
+    """
+
+    def __init__(self, enabled=True, window=DEFAULT_WINDOW, min_requests=DEFAULT_MIN_REQUESTS, failure_ratio=DEFAULT_FAILURE_RATIO, open_time=DEFAULT_OPEN_TIME):
+        self.enabled = enabled
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_ratio = failure_ratio
+        self.open_time = open_time
+
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'circuit_breaker', True)
+        self.window = get_float_setting(config, 'circuit_window', DEFAULT_WINDOW)
+        self.min_requests = get_int_setting(config, 'circuit_min_requests', DEFAULT_MIN_REQUESTS)
+        self.failure_ratio = get_float_setting(config, 'circuit_failure_ratio', DEFAULT_FAILURE_RATIO)
+        self.open_time = get_float_setting(config, 'circuit_open_time', DEFAULT_OPEN_TIME)
+        self.clear()
+
+    def _open(self, host, circuit, now):
+        log.warning('Context Broker {0} is failing, rejecting requests during {1} seconds'.format(host, self.open_time))
+        circuit.state = OPEN
+        circuit.opened_at = now
+        circuit.opened += 1
+        circuit.outcomes.clear()
+
+    def check(self, host):
+        # Raises CircuitOpenError if requests to host are not allowed
+        if not self.enabled:
+            return
+
+        host = host.lower()
+        now = time.time()
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return
+
+            if circuit.state == OPEN and now - circuit.opened_at >= self.open_time:
+                circuit.state = HALF_OPEN
+                circuit.probing = False
+
+            if circuit.state == HALF_OPEN and not circuit.probing:
+                circuit.probing = True
+                return
+
+            circuit.rejected += 1
+            retry_after = max(int(math.ceil(circuit.opened_at + self.open_time - now)), 1)
+
+        raise CircuitOpenError(host, retry_after)
+
+    def release(self, host):
+        # Allows a new probe when the current one ended without an outcome
+        # (e.g. the request failed before reaching the Context Broker)
+        if not self.enabled:
+            return
+
+        with self._lock:
+            circuit = self._circuits.get(host.lower())
+            if circuit is not None and circuit.state == HALF_OPEN:
+                circuit.probing = False
+
+    def record(self, host, success):
+        if not self.enabled:
+            return
+
+        host = host.lower()
+        now = time.time()
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None:
+                circuit = self._circuits[host] = HostCircuit()
+
+            if circuit.state == HALF_OPEN:
+                circuit.probing = False
+                if success:
+                    log.info('Context Broker {0} is responding again'.format(host))
+                    circuit.state = CLOSED
+                else:
+                    self._open(host, circuit, now)
+                return
+            elif circuit.state == OPEN:
+                return
+
+            circuit.outcomes.append((now, success))
+            while circuit.outcomes and now - circuit.outcomes[0][0] > self.window:
+                circuit.outcomes.popleft()
+
+            if success or len(circuit.outcomes) < self.min_requests:
+                return
+
+            failures = sum(1 for timestamp, outcome in circuit.outcomes if not outcome)
+            if float(failures) / len(circuit.outcomes) >= self.failure_ratio:
+                self._open(host, circuit, now)
+
+    def clear(self):
+        with self._lock:
+            self._circuits.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'hosts': dict(
+                    (host, {
+                        'state': circuit.state,
+                        'requests': len(circuit.outcomes),
+                        'failures': sum(1 for timestamp, outcome in circuit.outcomes if not outcome),
+                        'opened': circuit.opened,
+                        'rejected': circuit.rejected,
+                    })
+                    for host, circuit in self._circuits.items()
+                ),
+            }
+
+
+circuit_breaker = CircuitBreaker()
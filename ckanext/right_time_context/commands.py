@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from __future__ import print_function
+
+import ckan.lib.cli as cli
+
+from .entities import entity_store
+from .plugin import NGSI_REG_FORMAT
+
+
+class RightTimeContextCommand(cli.CkanCommand):
+    '''Maintenance commands of the right_time_context extension
+
+    Usage:
+
+        migrate-entities - Converts the entities of the fiware-ngsi-registry
+                           resources stored using the flat format (one extra
+                           per entity field) into the compact format.
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def __init__(self, name):
+        super(RightTimeContextCommand, self).__init__(name)
+
+        self.parser.add_option('--dry-run', dest='dry_run',
+                               action='store_true', default=False,
+                               help='Only report the resources to migrate')
+
+    def command(self):
+        if self.args and self.args[0] == 'migrate-entities':
+            self._load_config()
+            self._migrate_entities()
+        else:
+            print(self.usage)
+
+    def _migrate_entities(self):
+        import ckan.model as model
+        from ckan.lib.search import rebuild
+        from sqlalchemy import func
+
+        resources = model.Session.query(model.Resource).filter(
+            model.Resource.state == 'active',
+            func.lower(model.Resource.format) == NGSI_REG_FORMAT,
+        ).all()
+
+        if not self.options.dry_run:
+            rev = model.repo.new_revision()
+            rev.author = 'right_time_context'
+            rev.message = 'Migrate the entities of fiware-ngsi-registry resources to the compact format'
+
+        migrated = 0
+        packages = set()
+        for resource in resources:
+            extras = dict(resource.extras or {})
+            if not entity_store.migrate(extras):
+                continue
+
+            print('Migrating resource {0}'.format(resource.id))
+            migrated += 1
+            packages.add(resource.package_id)
+            if not self.options.dry_run:
+                resource.extras = extras
+
+        if self.options.dry_run:
+            model.Session.rollback()
+            print('{0} resources would be migrated'.format(migrated))
+            return
+
+        model.repo.commit()
+
+        # Cached package dicts include the old extras
+        for package_id in packages:
+            rebuild(package_id)
+
+        print('{0} resources migrated'.format(migrated))
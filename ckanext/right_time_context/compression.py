@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import zlib
+
+import requests
+
+from .streaming import get_content_length
+from .utils import get_bool_setting, get_int_setting
+
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_SIZE = 1024
+# Uncompressed bytes received between the flushes of compressed streams
+STREAM_FLUSH_SIZE = 32 * 1024
+
+# Compression modes
+PASSTHROUGH = 'passthrough'
+COMPRESS = 'compress'
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def accepts_gzip(request_headers):
+    # Returns True if the Accept-Encoding header allows gzip responses
+    accept_encoding = request_headers.get('Accept-Encoding') or ''
+    for coding in accept_encoding.split(','):
+        parts = coding.split(';')
+        name = parts[0].strip().lower()
+        if name not in ('gzip', 'x-gzip', '*'):
+            continue
+
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+
+        return True
+
+    return False
+
+
+def is_gzip_encoded(response):
+    return response.headers.get('Content-Encoding', '').strip().lower() in ('gzip', 'x-gzip')
+
+
+def weaken_etag(etag):
+    # Compressed and uncompressed representations are not byte-for-byte
+    # equivalent, so only a weak validator can be shared between them
+    if etag is None or etag.startswith('W/'):
+        return etag
+
+    return 'W/' + etag
+
+
+def gzip_body(body, level=DEFAULT_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gunzip_body(body):
+    return zlib.decompress(body, GZIP_WBITS)
+
+
+def gzip_stream(chunks, level=DEFAULT_LEVEL, flush_size=None):
+    # When flush_size is set, compressed data is sent to the client once
+    # flush_size bytes have been received since the last flush (0 for every
+    # chunk, e.g. event streams), instead of waiting for zlib to fill its
+    # buffer. Each flush makes the compression less effective
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    pending = 0
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if flush_size is not None and pending >= flush_size:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+class ResponseCompressor(object):
+    """Negotiates the compression of the responses sent to the browser.
+
+    Gzip responses of the Context Broker are passed through as they are
+    received, the rest of responses are compressed on the fly.
+    """
+
+    def __init__(self, enabled=True, level=DEFAULT_LEVEL, min_size=DEFAULT_MIN_SIZE):
+        self.enabled = enabled
+        self.level = level
+        self.min_size = min_size
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'compress_responses', True)
+        self.level = get_int_setting(config, 'compression_level', DEFAULT_LEVEL)
+        self.min_size = get_int_setting(config, 'compression_min_size', DEFAULT_MIN_SIZE)
+
+    def negotiate(self, request_headers, response):
+        # Returns how the response body should be sent to the client: passed
+        # through as received (PASSTHROUGH), compressed by the proxy
+        # (COMPRESS) or uncompressed (None)
+        if not self.enabled or not accepts_gzip(request_headers):
+            return None
+
+        # Only raw upstream responses can be passed through, buffered and
+        # paginated responses are already decoded
+        if is_gzip_encoded(response) and isinstance(response, requests.Response):
+            return PASSTHROUGH
+
+        content_length = get_content_length(response)
+        if content_length is not None and content_length < self.min_size:
+            return None
+
+        return COMPRESS
+
+    def should_compress(self, request_headers, body):
+        return self.enabled and len(body) >= self.min_size and accepts_gzip(request_headers)
+
+
+response_compressor = ResponseCompressor()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import deque
+import sys
+import threading
+import time
+
+import six
+from six.moves import queue
+
+
+class AsyncCall(threading.Thread):
+
+    def __init__(self, fn, item):
+        super(AsyncCall, self).__init__(name='right_time_context-worker')
+        self.daemon = True
+        self.fn = fn
+        self.item = item
+        self.value = None
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.fn(self.item)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def result(self, timeout=None):
+        self.join(timeout)
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+
+        return self.value
+
+
+def ordered_map(fn, items, workers):
+    # Yields fn(item) for each item, keeping the order of items while running
+    # up to workers calls concurrently
+    items = iter(items)
+    pending = deque()
+
+    for item in items:
+        pending.append(AsyncCall(fn, item))
+        if len(pending) >= workers:
+            break
+
+    while pending:
+        call = pending.popleft()
+        value = call.result()
+
+        for item in items:
+            pending.append(AsyncCall(fn, item))
+            break
+
+        yield value
+
+
+def unordered_map(fn, items, workers, timeout=None, on_timeout=None):
+    # Yields fn(item) for each item as soon as it is available, running up to
+    # workers calls concurrently. Calls not finished after timeout seconds
+    # are abandoned (their results are ignored) and reported to on_timeout
+    items = iter(items)
+    results = queue.Queue()
+    running = {}
+
+    def run(call_id, item):
+        try:
+            results.put((call_id, fn(item), None))
+        except Exception:
+            results.put((call_id, None, sys.exc_info()))
+
+    def start_next():
+        for item in items:
+            call_id = object()
+            running[call_id] = (time.time(), item)
+            AsyncCall(lambda item: run(call_id, item), item)
+            return True
+
+        return False
+
+    while len(running) < workers and start_next():
+        pass
+
+    while running:
+        wait = None
+        if timeout is not None:
+            wait = max(min(started for started, item in running.values()) + timeout - time.time(), 0)
+
+        try:
+            call_id, value, exc_info = results.get(timeout=wait)
+        except queue.Empty:
+            now = time.time()
+            for call_id, (started, item) in list(running.items()):
+                if now - started >= timeout:
+                    del running[call_id]
+                    if on_timeout is not None:
+                        on_timeout(item)
+                    start_next()
+            continue
+
+        if call_id not in running:
+            # Result of an abandoned call
+            continue
+
+        del running[call_id]
+        start_next()
+
+        if exc_info is not None:
+            six.reraise(*exc_info)
+
+        yield value
@@ -24,18 +24,47 @@ import json
 from logging import getLogger
 import os
 import urlparse
+import zlib
 
 import ckan.logic as logic
 import ckan.lib.base as base
 from ckan.plugins import toolkit
 import requests
 import six
+from webob.exc import HTTPException
 
-from .plugin import NGSI_REG_FORMAT
+from .batch import batch_proxy, format_result
+from .chart import chart_builder, METHODS as CHART_METHODS
+from .cache import build_cache_key, compute_etag, is_not_modified, response_cache
+from .circuit import circuit_breaker, CircuitOpenError
+from .compression import accepts_gzip, COMPRESS, gunzip_body, gzip_body, gzip_stream, PASSTHROUGH, response_compressor, STREAM_FLUSH_SIZE, weaken_etag
+from .delta import delta_tracker
+from .entities import entity_store
+from .export import resource_exporter
+from .federation import federated_query
+from .live import live_updates, parse_entities
+from .materialized import materialized_store
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, proxy_metrics, render_stats
+from .pagination import is_entities_query, paginator
+from .plans import ProxyPlan, proxy_plans
+from .plugin import build_registration_query, check_query, NGSI_FORMAT, NGSI_REG_FORMAT
+from .pool import session_pool
+from .prewarm import prewarm_scheduler
+from .preview import preview_rewriter
+from .sharding import registry_sharder
+from .singleflight import buffer_response, BufferedResponse, request_coalescer
+from .streaming import get_content_length, response_streamer, TruncatedResponseError
+from .tokens import PROACTIVE, RETRY, token_refresher
 
 log = getLogger(__name__)
 
-CHUNK_SIZE = 512
+
+class ProxyError(Exception):
+
+    def __init__(self, status, detail):
+        super(ProxyError, self).__init__(detail)
+        self.status = status
+        self.detail = detail
 
 
 class ProxyNGSIController(base.BaseController):
@@ -47,74 +76,254 @@ class ProxyNGSIController(base.BaseController):
                 details = 'Please add a payload to complete the query.'
                 base.abort(409, detail=details)
 
-            try:
-                json.loads(resource['payload'])
-            except json.JSONDecodeError:
-                details = "Payload field doesn't contain valid JSON data."
-                base.abort(409, detail=details)
-
             headers['Content-Type'] = "application/json"
-            r = requests.post(resource['url'], headers=headers, data=resource["payload"], stream=True, verify=verify)
+            session = session_pool.get_session(resource['url'], verify=verify)
+            r = session.post(resource['url'], headers=headers, data=resource["payload"], stream=True, verify=verify)
+
+        elif paginator.is_enabled(resource, parsed_url):
+            # Validators of the first page are not valid for the full result
+            for header in ('If-None-Match', 'If-Modified-Since'):
+                headers.pop(header, None)
+
+            url = paginator.first_page_url(resource['url'])
+            session = session_pool.get_session(url, verify=verify)
+            r = session.get(url, headers=headers, stream=True, verify=verify)
+
+            if r.status_code == 200:
+                def fetch_page(page_url):
+                    page = session.get(page_url, headers=headers, verify=verify)
+                    page.raise_for_status()
+                    return page.content
+
+                r = paginator.paginate(r, resource['url'], fetch_page)
 
         else:
-            r = requests.get(resource['url'], headers=headers, stream=True, verify=verify)
+            session = session_pool.get_session(resource['url'], verify=verify)
+            r = session.get(resource['url'], headers=headers, stream=True, verify=verify)
 
         return r
 
-    def _proxy_registration_resource(self, resource, parsed_url, headers, verify=True):
+    def _get_registration_query(self, resource):
+        # Registry queries are compiled when the resource is saved, resources
+        # saved by previous versions of the extension are compiled on demand
+        if resource.get('registry_query', '') != '':
+            return resource['registry_query']
+
+        try:
+            return json.dumps(build_registration_query(resource), sort_keys=True)
+        except ValueError as e:
+            base.abort(422, detail=six.text_type(e))
+
+    def _proxy_registration_resource(self, resource, parsed_url, headers, verify=True, body=None):
         path = parsed_url.path
 
         if path.endswith('/'):
             path = path[:-1]
 
         path = path + '/v2/op/query'
-        attrs = []
 
-        if 'attrs_str' in resource and len(resource['attrs_str']):
-            attrs = resource['attrs_str'].split(',')
-        body = {
-            'entities': [],
-            'attrs': attrs
-        }
+        # body is the list of shards of the query
+        if body is None:
+            body = registry_sharder.shard(self._get_registration_query(resource))
+
+        headers['Content-Type'] = 'application/json'
+        url = urlparse.urljoin(parsed_url.scheme + '://' + parsed_url.netloc, path)
+        session = session_pool.get_session(url, verify=verify)
+
+        # Queries are always paginated, even if they are not sharded, as
+        # Orion only returns the first 20 entities by default. Validators of
+        # the first page are not valid for the full result
+        for header in ('If-None-Match', 'If-Modified-Since'):
+            headers.pop(header, None)
 
-        # Include entity information
-        for entity in resource['entity']:
-            query_entity = {
-                'type': entity['value']
-            }
-            if 'isPattern' in entity and entity['isPattern'] == 'on':
-                query_entity['idPattern'] = entity['id']
+        response = session.post(paginator.first_page_url(url), headers=headers, data=body[0], stream=True, verify=verify)
+        if response.status_code == 200:
+            def fetch_page(page_url, page_body):
+                page = session.post(page_url, headers=headers, data=page_body, verify=verify)
+                page.raise_for_status()
+                return page
+
+            response = registry_sharder.merge(response, url, body, fetch_page)
+
+        return response
+
+    def _proxy_resource(self, resource, parsed_url, headers, verify=True, body=None):
+        # Requests to unhealthy Context Brokers fail fast
+        circuit_breaker.check(parsed_url.netloc)
+
+        try:
+            if resource['format'].lower() == NGSI_REG_FORMAT:
+                r = self._proxy_registration_resource(resource, parsed_url, headers, verify=verify, body=body)
             else:
-                query_entity['id'] = entity['id']
+                r = self._proxy_query_resource(resource, parsed_url, headers, verify=verify)
+        except requests.RequestException:
+            circuit_breaker.record(parsed_url.netloc, False)
+            raise
+        except BaseException:
+            # Errors not caused by the Context Broker (e.g. invalid payloads)
+            # are not failures, but a pending probe must be released
+            circuit_breaker.release(parsed_url.netloc)
+            raise
 
-            body['entities'].append(query_entity)
+        circuit_breaker.record(parsed_url.netloc, r.status_code < 500)
+        return r
 
-        # Parse expression to include georel information
-        if 'expression' in resource and len(resource['expression']):
-            # Separate expresion query strings
-            supported_expressions = ['georel', 'geometry', 'coords']
-            parsed_expression = resource['expression'].split('&')
+    def _coalesced_proxy_resource(self, plan, headers):
+        # Identical concurrent requests share a single upstream call. Only
+        # successful responses not exceeding the maximum size are shared,
+        # other callers are released as soon as that is known and repeat the
+        # request
+        if not request_coalescer.enabled:
+            return self._proxy_resource(plan.resource, plan.parsed_url, headers, verify=plan.verify, body=plan.body)
 
-            expression = {}
-            for exp in parsed_expression:
-                parsed_exp = exp.split('=')
+        key = build_cache_key('', plan.method, plan.url, plan.identity_body, headers)
 
-                if len(parsed_exp) != 2 or not parsed_exp[0] in supported_expressions:
-                    base.abort(422, detail='The expression is not a valid one for NGSI Registration, only georel, geometry, and coords is supported')
-                else:
-                    expression[parsed_exp[0]] = parsed_exp[1]
+        def fetch():
+            r = self._proxy_resource(plan.resource, plan.parsed_url, dict(headers), verify=plan.verify, body=plan.body)
+            content_length = get_content_length(r)
+            if r.status_code != 200 or (content_length is not None and content_length > request_coalescer.max_size):
+                request_coalescer.detach(key)
+                return r
 
-            body['expression'] = expression
+            return buffer_response(r, request_coalescer.max_size, on_exceeded=lambda: request_coalescer.detach(key))
 
-        headers['Content-Type'] = 'application/json'
-        url = urlparse.urljoin(parsed_url.scheme + '://' + parsed_url.netloc, path)
-        response = requests.post(url, headers=headers, json=body, stream=True, verify=verify)
+        r = request_coalescer.do(key, fetch, share=lambda r: isinstance(r, BufferedResponse))
+        if r is None:
+            r = self._proxy_resource(plan.resource, plan.parsed_url, headers, verify=plan.verify, body=plan.body)
 
-        return response
+        return r
+
+    def _get_prewarm_fetch(self, plan, headers):
+        # Runs on the pre-warm thread, so it cannot access the request globals
+        def fetch(entry):
+            request_headers = dict(headers)
+            request_headers.update(self._get_upstream_validators(entry))
+            return self._proxy_resource(plan.resource, plan.parsed_url, request_headers, verify=plan.verify, body=plan.body)
+
+        return fetch
+
+    def _get_request_identity(self, resource, parsed_url, body=None):
+        # Returns the method, url and body identifying the upstream request
+        if resource['format'].lower() == NGSI_REG_FORMAT:
+            return 'POST', resource['url'], body
+        elif parsed_url.path.lower().find('/v1/querycontext') != -1:
+            return 'POST', resource['url'], resource.get('payload', '')
+        elif paginator.is_enabled(resource, parsed_url):
+            return 'GET', paginator.first_page_url(resource['url']), ''
+        else:
+            return 'GET', resource['url'], ''
+
+    def _get_upstream_validators(self, entry=None):
+        # Conditional requests are made using the validators of the cached
+        # copy of the response, or the ones provided by the browser
+        validators = {}
+        if entry is not None:
+            if 'ETag' in entry.headers:
+                validators['If-None-Match'] = entry.headers['ETag']
+            if 'Last-Modified' in entry.headers:
+                validators['If-Modified-Since'] = entry.headers['Last-Modified']
+        else:
+            for header in ('If-None-Match', 'If-Modified-Since'):
+                value = base.request.headers.get(header)
+                if value:
+                    validators[header] = value
+
+        return validators
+
+    def _set_validators(self, etag, last_modified):
+        # Returns True if the browser copy is still valid
+        if etag:
+            base.response.headers['ETag'] = etag
+        if last_modified:
+            base.response.headers['Last-Modified'] = last_modified
+
+        if is_not_modified(base.request.headers, etag, last_modified):
+            base.response.status_int = 304
+            return True
+
+        return False
+
+    def _serve_cached(self, entry, warning=None):
+        base.response.content_type = entry.content_type or 'application/json'
+        base.response.charset = entry.charset
+        base.response.headers['Age'] = str(entry.age())
+        if warning is not None:
+            base.response.headers['Warning'] = warning
+        if response_compressor.enabled:
+            base.response.headers['Vary'] = 'Accept-Encoding'
+
+        compress = response_compressor.should_compress(base.request.headers, entry.body)
+        etag = weaken_etag(entry.etag) if compress else entry.etag
+        if self._set_validators(etag, entry.last_modified):
+            return
+
+        if compress:
+            if entry.compressed_body is None:
+                entry.compressed_body = gzip_body(entry.body, response_compressor.level)
+
+            base.response.headers['Content-Encoding'] = 'gzip'
+            base.response.body_file.write(entry.compressed_body)
+        else:
+            base.response.body_file.write(entry.body)
+
+    def _store_compressed(self, cache_key, resource, r, body):
+        # Responses are cached uncompressed
+        try:
+            response_cache.store(cache_key, resource, r, gunzip_body(body))
+        except zlib.error:
+            log.warning('Could not cache the response of {0}, invalid gzip data'.format(r.url))
+
+    def _write_body(self, r, resource, cache_key=None, compression=None):
+        # Bodies are also collected for caching the response as long as they
+        # don't exceed the maximum entry size
+        on_complete = None
+        if cache_key is not None and compression == PASSTHROUGH:
+            on_complete = lambda body: self._store_compressed(cache_key, resource, r, body)
+        elif cache_key is not None:
+            on_complete = lambda body: response_cache.store(cache_key, resource, r, body)
+
+        body = response_streamer.stream(r, collect_limit=response_cache.max_entry_size, on_complete=on_complete, raw=compression == PASSTHROUGH)
+        if compression == COMPRESS:
+            body = gzip_stream(body, response_compressor.level)
+
+        if response_streamer.enabled:
+            return body
+
+        self._write_chunks(body)
+
+    def _write_chunks(self, body):
+        # Writes a stream into the CKAN response, replacing it by an error if
+        # it cannot be completed
+        try:
+            for chunk in body:
+                base.response.body_file.write(chunk)
+        except TruncatedResponseError as e:
+            base.abort(502, detail=str(e))
+
+    def _refresh_token(self, reason):
+        # Returns whether the token of the current user was refreshed. The
+        # token of the request is replaced by the new one
+        token = toolkit.c.usertoken
+
+        def refresh():
+            toolkit.c.usertoken_refresh()
+            return toolkit.c.usertoken
+
+        new_token = token_refresher.refresh(token, refresh, reason)
+        if new_token is None:
+            return False
+
+        toolkit.c.usertoken = new_token
+        return True
 
     def process_auth_credentials(self, resource, headers):
         auth_method = resource.get('auth_type', 'none')
 
+        if auth_method in ("oauth2", "x-auth-token-fiware") and token_refresher.needs_refresh(toolkit.c.usertoken):
+            # Refresh the token before it expires. The current token is used
+            # if it cannot be refreshed
+            self._refresh_token(PROACTIVE)
+
         if auth_method == "oauth2":
             token = toolkit.c.usertoken['access_token']
             headers['Authorization'] = "Bearer %s" % token
@@ -124,19 +333,32 @@ class ProxyNGSIController(base.BaseController):
             token = toolkit.c.usertoken['access_token']
             headers['X-Auth-Token'] = token
 
-    def proxy_ngsi_resource(self, resource_id):
-        # Chunked proxy for ngsi resources.
-        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+    def _get_verify_conf(self):
+        verify_conf = os.environ.get('CKAN_RIGHT_TIME_CONTEXT_VERIFY_REQUESTS', toolkit.config.get('ckan.right_time_context.verify_requests'))
+        if verify_conf is None or (isinstance(verify_conf, six.string_types) and verify_conf.strip() == ""):
+            verify_conf = os.environ.get('CKAN_VERIFY_REQUESTS', toolkit.config.get('ckan.verify_requests'))
 
-        log.info('Proxify resource {id}'.format(id=resource_id))
-        resource = logic.get_action('resource_show')(context, {'id': resource_id})
+        if isinstance(verify_conf, six.string_types) and verify_conf.strip() != "":
+            compare_env = verify_conf.lower().strip()
+            if compare_env in ("true", "1", "on"):
+                verify = True
+            elif compare_env in ("false", "0", "off"):
+                verify = False
+            else:
+                verify = verify_conf
+        elif isinstance(verify_conf, bool):
+            verify = verify_conf
+        else:
+            verify = True
 
+        return verify
+
+    def _build_plan(self, resource):
         headers = {
             'Accept': 'application/json'
         }
 
         resource.setdefault('auth_type', 'none')
-        self.process_auth_credentials(resource, headers)
 
         if resource.get('tenant', '') != '':
             headers['FIWARE-Service'] = resource['tenant']
@@ -150,45 +372,174 @@ class ProxyNGSIController(base.BaseController):
             base.abort(409, detail='Invalid URL.')
 
         # Process verify configuration
-        verify_conf = os.environ.get('CKAN_RIGHT_TIME_CONTEXT_VERIFY_REQUESTS', toolkit.config.get('ckan.right_time_context.verify_requests'))
-        if verify_conf is None or (isinstance(verify_conf, six.string_types) and verify_conf.strip() == ""):
-            verify_conf = os.environ.get('CKAN_VERIFY_REQUESTS', toolkit.config.get('ckan.verify_requests'))
+        verify = self._get_verify_conf()
 
-        if isinstance(verify_conf, six.string_types) and verify_conf.strip() != "":
-            compare_env = verify_conf.lower().strip()
-            if compare_env in ("true", "1", "on"):
-                verify = True
-            elif compare_env in ("false", "0", "off"):
-                verify = False
-            else:
-                verify = verify_conf
-        elif isinstance(verify_conf, bool):
-            verify = verify_conf
+        query = None
+        body = None
+        if resource['format'].lower() == NGSI_REG_FORMAT:
+            query = self._get_registration_query(resource)
+            body = registry_sharder.shard(query)
+
+        method, upstream_url, identity_body = self._get_request_identity(resource, parsed_url, query)
+        return ProxyPlan(resource, parsed_url, verify, headers, body, method, upstream_url, identity_body)
+
+    def _get_plan(self, resource_id, context):
+        plan = proxy_plans.get(resource_id)
+
+        if plan is None:
+            resource = logic.get_action('resource_show')(context, {'id': resource_id})
+            plan = self._build_plan(resource)
+            proxy_plans.set(resource_id, plan)
         else:
-            verify = True
+            # Permissions are checked on every request
+            logic.check_access('resource_show', context, {'id': resource_id})
 
-        # Make the request to the server
-        try:
-            if resource['format'].lower() == NGSI_REG_FORMAT:
-                r = self._proxy_registration_resource(resource, parsed_url, headers, verify=verify)
+        return plan
+
+    def _get_preview_plan(self, plan):
+        # Preview plans are built once and kept along with the plan
+        if plan.preview is None:
+            resource = plan.resource
+            if resource['format'].lower() == NGSI_FORMAT and preview_rewriter.is_enabled(plan.parsed_url):
+                # Previews never follow pagination
+                preview_resource = dict(resource, url=preview_rewriter.rewrite(resource, plan.parsed_url), follow_pagination='false')
+                plan.preview = self._build_plan(preview_resource)
             else:
-                r = self._proxy_query_resource(resource, parsed_url, headers, verify=verify)
+                plan.preview = plan
 
-        except requests.HTTPError:
-            details = 'Could not proxy ngsi_resource. We are working to resolve this issue as quickly as possible'
-            base.abort(409, detail=details)
-        except requests.ConnectionError:
-            details = 'Could not proxy ngsi_resource because a connection error occurred.'
-            base.abort(502, detail=details)
-        except requests.Timeout:
-            details = 'Could not proxy ngsi_resource because the connection timed out.'
-            base.abort(504, detail=details)
+        return plan.preview
+
+    def _get_export_plan(self, plan):
+        # Exports always retrieve all the pages of NGSIv2 entity queries
+        if plan.export is None:
+            resource = plan.resource
+            if resource['format'].lower() == NGSI_FORMAT and is_entities_query(plan.parsed_url):
+                plan.export = self._build_plan(dict(resource, follow_pagination='true'))
+            else:
+                plan.export = plan
+
+        return plan.export
+
+    def proxy_ngsi_resource(self, resource_id):
+        request_metrics = proxy_metrics.start()
+        try:
+            result = self._proxy_ngsi_resource(resource_id, request_metrics)
+        except HTTPException as e:
+            request_metrics.finish(getattr(e, 'code', 500))
+            raise
+        except Exception:
+            request_metrics.finish(500)
+            raise
+
+        if result is None:
+            request_metrics.finish(base.response.status_int, base.response.content_length or 0)
+            return
+
+        return request_metrics.track(result, base.response.status_int)
+
+    def _proxy_ngsi_resource(self, resource_id, request_metrics):
+        # Chunked proxy for ngsi resources.
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        if 'since' in base.request.params:
+            return self._proxy_delta(resource_id, context, base.request.params['since'], request_metrics)
+
+        log.info('Proxify resource {id}'.format(id=resource_id))
+        plan = base_plan = self._get_plan(resource_id, context)
+        if base.request.params.get('preview') == 'true':
+            plan = self._get_preview_plan(plan)
+
+        resource = plan.resource
+        parsed_url = plan.parsed_url
+        verify = plan.verify
+        request_metrics.set_resource(resource.get('format', '').lower(), parsed_url.netloc.lower())
+
+        headers = dict(plan.headers)
+        self.process_auth_credentials(resource, headers)
+
+        # Materialized resources are served without querying the broker
+        if materialized_store.is_enabled(base_plan.resource, base_plan.parsed_url):
+            entry = materialized_store.get(resource_id, base_plan, plan)
+            if entry is not None:
+                return self._serve_cached(entry)
+
+        # Look for a cached copy of the response
+        cache_key = None
+        entry = None
+        if response_cache.is_enabled(resource):
+            cache_key = build_cache_key(resource_id, plan.method, plan.url, plan.identity_body, headers)
+            entry = response_cache.get(cache_key)
+            prewarm_scheduler.record(resource_id, cache_key, resource, self._get_prewarm_fetch(plan, headers))
+
+            if entry is not None and entry.is_fresh():
+                return self._serve_cached(entry)
+            elif entry is not None and entry.can_revalidate_stale():
+                revalidation_headers = dict(headers)
+                revalidation_headers.update(self._get_upstream_validators(entry))
+                response_cache.revalidate(cache_key, resource, lambda: self._proxy_resource(resource, parsed_url, revalidation_headers, verify=verify, body=plan.body))
+                return self._serve_cached(entry, warning='110 - "Response is Stale"')
+
+        headers.update(self._get_upstream_validators(entry))
+
+        # Make the request to the server. Requests rejected because the
+        # token expired are repeated once using a new token
+        refreshed = None
+        while True:
+            try:
+                request_metrics.upstream_started()
+                r = self._coalesced_proxy_resource(plan, headers)
+                request_metrics.upstream_finished()
+
+            except CircuitOpenError as e:
+                if entry is not None and entry.can_serve_on_error():
+                    return self._serve_cached(entry, warning='111 - "Revalidation Failed"')
+
+                details = 'The Context Broker is temporarily unavailable, please try again later.'
+                base.abort(503, detail=details, headers={'Retry-After': str(e.retry_after)})
+            except requests.HTTPError:
+                details = 'Could not proxy ngsi_resource. We are working to resolve this issue as quickly as possible'
+                base.abort(409, detail=details)
+            except requests.ConnectionError:
+                if entry is not None and entry.can_serve_on_error():
+                    return self._serve_cached(entry, warning='111 - "Revalidation Failed"')
+
+                details = 'Could not proxy ngsi_resource because a connection error occurred.'
+                base.abort(502, detail=details)
+            except requests.Timeout:
+                if entry is not None and entry.can_serve_on_error():
+                    return self._serve_cached(entry, warning='111 - "Revalidation Failed"')
 
+                details = 'Could not proxy ngsi_resource because the connection timed out.'
+                base.abort(504, detail=details)
+
+            if r.status_code != 401 or refreshed is not None or not token_refresher.retry or resource.get('auth_type', 'none') == 'none':
+                break
+
+            r.close()
+            refreshed = self._refresh_token(RETRY)
+            if not refreshed:
+                break
+            self.process_auth_credentials(resource, headers)
+
+            # Responses are cached by token, so the retried request is
+            # cached (and coalesced) using the key of the new one
+            if cache_key is not None:
+                for header in ('If-None-Match', 'If-Modified-Since'):
+                    headers.pop(header, None)
+                cache_key = build_cache_key(resource_id, plan.method, plan.url, plan.identity_body, headers)
+                entry = response_cache.get(cache_key)
+                headers.update(self._get_upstream_validators(entry))
+
+        compression = None
         if r.status_code == 401:
-            if resource.get('auth_type', 'none') != 'none':
+            if resource.get('auth_type', 'none') != 'none' and refreshed is None:
                 details = 'ERROR 401 token expired. Retrieving new token, reload please.'
                 log.info(details)
-                toolkit.c.usertoken_refresh()
+                self._refresh_token(RETRY)
+                base.abort(409, detail=details)
+            elif resource.get('auth_type', 'none') != 'none':
+                details = 'The Context Broker rejected the access token, please log in again.'
+                log.info(details)
                 base.abort(409, detail=details)
             elif resource.get('auth_type', 'none') == 'none':
                 details = 'Authentication requested by server, please check resource configuration.'
@@ -201,10 +552,473 @@ class ProxyNGSIController(base.BaseController):
             log.info(details)
             base.abort(422, detail=details)
 
+        elif r.status_code == 304:
+            r.close()
+            if entry is not None:
+                return self._serve_cached(response_cache.refresh(cache_key, resource, entry, r.headers))
+
+            # The browser validators were forwarded to the Context Broker
+            self._set_validators(r.headers.get('ETag'), r.headers.get('Last-Modified'))
+            base.response.status_int = 304
+            return
+
+        elif r.status_code >= 500 and entry is not None and entry.can_serve_on_error():
+            r.close()
+            return self._serve_cached(entry, warning='111 - "Revalidation Failed"')
+
         else:
             r.raise_for_status()
             base.response.content_type = r.headers['content-type']
             base.response.charset = r.encoding
+            if response_compressor.enabled:
+                base.response.headers['Vary'] = 'Accept-Encoding'
+
+            # Use a strong validator computed from the body if the Context
+            # Broker doesn't provide one and the response is already buffered
+            etag = r.headers.get('ETag')
+            if etag is None and isinstance(r, BufferedResponse):
+                etag = compute_etag(r.content)
+
+            compression = response_compressor.negotiate(base.request.headers, r)
+            if compression is not None:
+                etag = weaken_etag(etag)
+
+            if self._set_validators(etag, r.headers.get('Last-Modified')):
+                if cache_key is not None and isinstance(r, BufferedResponse):
+                    response_cache.store(cache_key, resource, r, r.content)
+                r.close()
+                return
+
+        if response_streamer.exceeds_max_size(r):
+            r.close()
+            base.abort(502, detail='The response of the Context Broker exceeds the maximum allowed size.')
+
+        if compression is not None:
+            base.response.headers['Content-Encoding'] = 'gzip'
+
+        return self._write_body(r, resource, cache_key if r.status_code == 200 else None, compression)
+
+    def _fetch_rewritten_delta(self, job, timestamp):
+        # Returns the entities modified since timestamp, or None if the
+        # Context Broker doesn't support the rewritten query. Responses are
+        # never cached as every cursor produces a different query
+        resource_id, plan, headers = job
+        url = delta_tracker.rewrite(plan.resource['url'], timestamp)
+        delta_plan = self._build_plan(dict(plan.resource, url=url, follow_pagination='true', cache_ttl='0'))
+
+        try:
+            r = self._open_upstream(delta_plan, headers)
+        except ProxyError as e:
+            if e.status == 400:
+                return None
+            raise
+
+        try:
+            body = r.content if isinstance(r, BufferedResponse) else response_streamer.read(r)
+        except requests.RequestException:
+            raise ProxyError(502, 'Could not read the response of the Context Broker.')
+        except (TruncatedResponseError, ValueError) as e:
+            raise ProxyError(502, six.text_type(e))
+
+        return delta_tracker.get_rewrite_result(plan.resource['url'], parse_entities(body), timestamp)
+
+    def _fetch_diff_delta(self, job, snapshot_id):
+        # Compares all the entities with the snapshot of the previous request
+        resource_id, plan, headers = job
+        plan = self._get_export_plan(plan)
+        content_type, body = self._fetch_body((resource_id, plan, headers))
+        owner = build_cache_key(resource_id, plan.method, plan.url, plan.identity_body, headers)
+
+        return delta_tracker.get_diff_result(owner, snapshot_id, parse_entities(body))
+
+    def _proxy_delta(self, resource_id, context, since, request_metrics):
+        # Returns only the entities upserted and removed since a date or a
+        # cursor, along with the cursor to use on the next request
+        try:
+            job = self._resolve_job(resource_id, context)
+        except ProxyError as e:
+            base.abort(e.status, detail=e.detail)
+
+        plan = job[1]
+        request_metrics.set_resource(plan.resource.get('format', '').lower(), plan.parsed_url.netloc.lower())
+        if not delta_tracker.is_supported(plan.resource, plan.parsed_url):
+            base.abort(400, detail='The since parameter is only supported by NGSIv2 resources.')
+
+        try:
+            timestamp, snapshot_id = delta_tracker.parse_since(since)
+        except ValueError:
+            base.abort(400, detail='Invalid since parameter, a date or a cursor is required.')
+
+        def fetch(job):
+            result = None
+            if timestamp is not None and delta_tracker.can_rewrite(plan.resource, plan.parsed_url):
+                result = self._fetch_rewritten_delta(job, timestamp)
+
+            if result is None:
+                result = self._fetch_diff_delta(job, snapshot_id)
+
+            return result
+
+        try:
+            result = self._with_token_retry(job, fetch)
+        except ProxyError as e:
+            base.abort(e.status, detail=e.detail)
+        except ValueError:
+            base.abort(502, detail='The Context Broker returned an invalid JSON document.')
+
+        base.response.content_type = 'application/json'
+        base.response.charset = 'utf-8'
+        base.response.headers['Cache-Control'] = 'no-cache'
+        base.response.body_file.write(json.dumps(result, separators=(',', ':')))
+
+    def _resolve_job(self, resource_id, context, resource=None):
+        # Returns the plan and the headers used for fetching a resource from
+        # a worker thread. Resources already retrieved using package_show
+        # don't require additional permission checks
+        try:
+            if resource is None:
+                plan = self._get_plan(resource_id, context)
+            else:
+                plan = proxy_plans.get(resource_id)
+                if plan is None:
+                    plan = self._build_plan(dict(resource))
+                    proxy_plans.set(resource_id, plan)
+        except logic.NotFound:
+            raise ProxyError(404, 'Resource not found.')
+        except logic.NotAuthorized:
+            raise ProxyError(403, 'Not authorized to read this resource.')
+        except HTTPException as e:
+            raise ProxyError(getattr(e, 'code', 500), getattr(e, 'detail', None) or 'Could not proxy ngsi_resource.')
+
+        headers = dict(plan.headers)
+        try:
+            self.process_auth_credentials(plan.resource, headers)
+        except (AttributeError, KeyError, TypeError):
+            # There is no token available for the current user
+            raise ProxyError(401, 'In order to see this resource properly, you need to be logged in.')
+
+        return resource_id, plan, headers
+
+    def _fetch_body(self, job):
+        # Returns the content type and the full body of a resource, raising
+        # ProxyError on failure. Runs on worker threads, so it cannot access
+        # the request globals
+        resource_id, plan, headers = job
+
+        cache_key = None
+        if response_cache.is_enabled(plan.resource):
+            cache_key = build_cache_key(resource_id, plan.method, plan.url, plan.identity_body, headers)
+            entry = response_cache.get(cache_key)
+            if entry is not None and entry.is_fresh():
+                return entry.content_type, entry.body
+
+        r = self._open_upstream(plan, headers)
+        try:
+            body = r.content if isinstance(r, BufferedResponse) else response_streamer.read(r)
+        except requests.RequestException:
+            raise ProxyError(502, 'Could not read the response of the Context Broker.')
+        except (TruncatedResponseError, ValueError) as e:
+            raise ProxyError(502, six.text_type(e))
+
+        if cache_key is not None:
+            response_cache.store(cache_key, plan.resource, r, body)
+
+        return r.headers.get('content-type'), body
+
+    def _open_upstream(self, plan, headers):
+        # Returns the successful response of the Context Broker, raising
+        # ProxyError on failure
+        try:
+            r = self._coalesced_proxy_resource(plan, headers)
+        except CircuitOpenError:
+            raise ProxyError(503, 'The Context Broker is temporarily unavailable, please try again later.')
+        except requests.ConnectionError:
+            raise ProxyError(502, 'Could not proxy ngsi_resource because a connection error occurred.')
+        except requests.Timeout:
+            raise ProxyError(504, 'Could not proxy ngsi_resource because the connection timed out.')
+        except requests.RequestException:
+            raise ProxyError(502, 'Could not proxy ngsi_resource.')
+        except HTTPException as e:
+            raise ProxyError(getattr(e, 'code', 500), getattr(e, 'detail', None) or 'Could not proxy ngsi_resource.')
+
+        if r.status_code != 200:
+            r.close()
+            if r.status_code == 401:
+                raise ProxyError(401, 'Authentication requested by server, please check resource configuration.')
+
+            raise ProxyError(r.status_code, 'The Context Broker returned a {0} status code.'.format(r.status_code))
+
+        return r
+
+    def _with_token_retry(self, job, fetch):
+        # Repeats fetch(job) once using a new token if the Context Broker
+        # rejects the current one. Runs on the request thread
+        try:
+            return fetch(job)
+        except ProxyError as e:
+            resource_id, plan, headers = job
+            if e.status != 401 or not token_refresher.retry or plan.resource.get('auth_type', 'none') == 'none' or not self._refresh_token(RETRY):
+                raise
+
+        headers = dict(plan.headers)
+        self.process_auth_credentials(plan.resource, headers)
+        return fetch((resource_id, plan, headers))
+
+    def _fetch_batch_item(self, job):
+        try:
+            content_type, body = self._fetch_body(job)
+        except ProxyError as e:
+            return batch_proxy.error(job[0], e.status, e.detail)
+
+        try:
+            return format_result(job[0], content_type, body)
+        except ValueError:
+            return batch_proxy.error(job[0], 502, 'The Context Broker returned an invalid JSON response.')
+
+    def _fetch_federated_source(self, job):
+        try:
+            return self._fetch_body(job)[1]
+        except ProxyError as e:
+            federated_query.record_error(job[0], e.detail)
+
+    def _send_stream(self, body, content_type):
+        # Compressed streams are flushed every few chunks, so the client
+        # receives the data progressively without degrading the compression
+        base.response.content_type = content_type
+        base.response.charset = 'utf-8'
+        if response_compressor.enabled:
+            base.response.headers['Vary'] = 'Accept-Encoding'
+            if accepts_gzip(base.request.headers):
+                base.response.headers['Content-Encoding'] = 'gzip'
+                body = gzip_stream(body, response_compressor.level, flush_size=STREAM_FLUSH_SIZE)
+
+        if response_streamer.enabled:
+            return body
+
+        self._write_chunks(body)
+
+    def proxy_ngsi_batch(self):
+        # Proxies several resources concurrently, returning a NDJSON stream
+        # with the result of each resource as soon as it is available
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        resource_ids = batch_proxy.parse_ids(base.request.params.getall('id'))
+        if len(resource_ids) == 0:
+            base.abort(400, detail='At least one resource id must be provided.')
+        elif batch_proxy.max_resources > 0 and len(resource_ids) > batch_proxy.max_resources:
+            base.abort(400, detail='A maximum of {0} resources can be requested at once.'.format(batch_proxy.max_resources))
+
+        # Permissions and credentials are resolved on the request thread
+        jobs = []
+        errors = []
+        for resource_id in resource_ids:
+            try:
+                jobs.append(self._resolve_job(resource_id, context))
+            except ProxyError as e:
+                errors.append(batch_proxy.error(resource_id, e.status, e.detail))
+
+        def results():
+            for line in errors:
+                yield line
+            for line in batch_proxy.run(jobs, self._fetch_batch_item):
+                yield line
+
+        return self._send_stream(results(), 'application/x-ndjson')
+
+    def proxy_ngsi_package(self, id):
+        # Merges the entities of all the NGSI queries of a dataset
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        try:
+            package = logic.get_action('package_show')(context, {'id': id})
+        except logic.NotFound:
+            base.abort(404, detail='Dataset not found.')
+        except logic.NotAuthorized:
+            base.abort(403, detail='Not authorized to read this dataset.')
+
+        jobs = []
+        for resource in package.get('resources', []):
+            if resource.get('format', '').lower() != NGSI_FORMAT or not check_query(resource):
+                continue
+
+            try:
+                jobs.append(self._resolve_job(resource['id'], context, resource))
+            except ProxyError as e:
+                federated_query.record_error(resource['id'], e.detail)
+
+        dedup = federated_query.is_dedup_enabled(base.request.params.get('dedup'))
+        return self._send_stream(federated_query.run(jobs, self._fetch_federated_source, dedup), 'application/json')
+
+    def export_ngsi_resource(self, resource_id, export_format):
+        # Converts the entities of a resource into CSV or NDJSON while they
+        # are received from the Context Broker
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        content_type = resource_exporter.get_content_type(export_format)
+        if content_type is None:
+            base.abort(404, detail='Unsupported export format.')
+
+        try:
+            resource_id, plan, headers = self._resolve_job(resource_id, context)
+            r = self._with_token_retry((resource_id, self._get_export_plan(plan), headers), lambda job: self._open_upstream(job[1], job[2]))
+        except ProxyError as e:
+            base.abort(e.status, detail=e.detail)
+
+        if response_streamer.exceeds_max_size(r):
+            r.close()
+            base.abort(502, detail='The response of the Context Broker exceeds the maximum allowed size.')
+
+        attrs = [attr.strip() for attr in base.request.params.get('attrs', '').split(',') if attr.strip() != '']
+        base.response.headers['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(resource_id, export_format)
+
+        return self._send_stream(resource_exporter.run(response_streamer.stream(r), export_format, attrs), content_type)
+
+    def _get_int_param(self, name):
+        value = base.request.params.get(name, '').strip()
+        if value == '':
+            return None
+
+        try:
+            return int(value)
+        except ValueError:
+            base.abort(400, detail='The {0} parameter must be a number.'.format(name))
+
+    def chart_ngsi_resource(self, resource_id):
+        # Returns the numeric series of a resource downsampled for the chart
+        # of the view
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        method = base.request.params.get('method', 'lttb')
+        if method not in CHART_METHODS:
+            base.abort(400, detail='Unsupported downsampling method.')
+        threshold = chart_builder.get_threshold(self._get_int_param('width'), self._get_int_param('points'))
+
+        try:
+            job = self._resolve_job(resource_id, context)
+            content_type, body = self._with_token_retry(job, self._fetch_body)
+        except ProxyError as e:
+            base.abort(e.status, detail=e.detail)
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            base.abort(502, detail='The Context Broker returned an invalid JSON document.')
+
+        attrs = base.request.params.get('attrs', job[1].resource.get('chart_attrs', ''))
+        attrs = [attr.strip() for attr in (attrs or '').split(',') if attr.strip() != '']
+
+        base.response.content_type = 'application/json'
+        base.response.charset = 'utf-8'
+        return json.dumps(chart_builder.build(data, attrs, threshold, method), separators=(',', ':'))
+
+    def _fetch_live(self, job, base_plan):
+        # Runs on the polling thread. Materialized resources are read from
+        # memory
+        resource_id, plan, headers = job
+        if materialized_store.is_enabled(base_plan.resource, base_plan.parsed_url):
+            entry = materialized_store.get(resource_id, base_plan, plan)
+            if entry is not None:
+                return entry.body
+
+        return self._fetch_body(job)[1]
+
+    def live_ngsi_resource(self, resource_id):
+        # Server-Sent Events stream with the entities changed since the
+        # previous poll
+        if not live_updates.enabled:
+            base.abort(404, detail='Live updates are disabled.')
+
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+        try:
+            resource_id, base_plan, headers = self._resolve_job(resource_id, context)
+        except ProxyError as e:
+            base.abort(e.status, detail=e.detail)
+
+        plan = base_plan
+        if base.request.params.get('preview') == 'true':
+            plan = self._get_preview_plan(base_plan)
+
+        job = (resource_id, plan, headers)
+        key = build_cache_key(resource_id, plan.method, plan.url, plan.identity_body, headers)
+        subscriber = live_updates.subscribe(key, lambda: self._fetch_live(job, base_plan), base.request.headers.get('Last-Event-ID'))
+        if subscriber is None:
+            base.abort(503, detail='Too many clients are following live updates, please try again later.', headers={'Retry-After': str(live_updates.interval)})
+
+        base.response.content_type = 'text/event-stream'
+        base.response.charset = 'utf-8'
+        base.response.headers['Cache-Control'] = 'no-cache'
+        # Disable proxy buffering (nginx)
+        base.response.headers['X-Accel-Buffering'] = 'no'
+        return live_updates.stream(subscriber)
+
+    def notify_ngsi_resource(self, resource_id):
+        # Notifications of the subscriptions of materialized resources. The
+        # Context Broker authenticates using the token of the resource
+        if base.request.method != 'POST':
+            base.abort(405, detail='Notifications have to be sent using POST.', headers={'Allow': 'POST'})
+
+        try:
+            payload = json.loads(base.request.body)
+        except ValueError:
+            payload = None
+
+        if not isinstance(payload, dict):
+            base.abort(400, detail='Invalid notification.')
+
+        try:
+            accepted = materialized_store.notify(resource_id, base.request.params.get('token'), payload)
+        except ValueError:
+            base.abort(403, detail='Invalid notification token.')
+
+        if not accepted:
+            base.abort(404, detail='Unknown subscription.')
+
+        base.response.status_int = 204
+
+    def _check_sysadmin(self):
+        context = {'model': base.model, 'session': base.model.Session, 'user': base.c.user or base.c.author}
+
+        try:
+            logic.check_access('sysadmin', context, {})
+        except logic.NotAuthorized:
+            base.abort(403, detail='Only sysadmins can access the proxy statistics.')
+
+    def _get_stats(self):
+        return {
+            'pool': session_pool.stats(),
+            'cache': response_cache.stats(),
+            'coalescing': request_coalescer.stats(),
+            'plans': proxy_plans.stats(),
+            'batch': batch_proxy.stats(),
+            'federation': federated_query.stats(),
+            'export': resource_exporter.stats(),
+            'chart': chart_builder.stats(),
+            'prewarm': prewarm_scheduler.stats(),
+            'materialized': materialized_store.stats(),
+            'live': live_updates.stats(),
+            'delta': delta_tracker.stats(),
+            'tokens': token_refresher.stats(),
+            'entities': entity_store.stats(),
+            'circuits': circuit_breaker.stats(),
+        }
+
+    def proxy_stats(self):
+        self._check_sysadmin()
+
+        base.response.content_type = 'application/json'
+        base.response.charset = 'utf-8'
+        return json.dumps(self._get_stats())
+
+    def metrics(self):
+        if not proxy_metrics.enabled:
+            base.abort(404, detail='Metrics are disabled.')
+
+        # Scrapers can authenticate using the configured token
+        if proxy_metrics.token:
+            if not proxy_metrics.is_authorized(base.request.headers.get('Authorization')):
+                base.abort(403, detail='Invalid metrics token.')
+        else:
+            self._check_sysadmin()
 
-        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-            base.response.body_file.write(chunk)
+        base.response.headers['Content-Type'] = METRICS_CONTENT_TYPE
+        return proxy_metrics.render() + render_stats(self._get_stats())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+import six
+
+from .chart import parse_timestamp
+from .pagination import add_options, get_query_params, is_entities_query, update_query
+from .preview import parse_attrs
+from .utils import get_bool_setting, get_int_setting
+
+DEFAULT_MAX_SNAPSHOTS = 100
+
+NGSI_FORMAT = 'fiware-ngsi'
+MODIFIED_ATTRIBUTE = 'dateModified'
+
+
+def format_timestamp(timestamp):
+    # Formats a number of milliseconds since the epoch as used by Orion
+    seconds, milliseconds = divmod(int(timestamp), 1000)
+    return '{0}.{1:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), milliseconds)
+
+
+def encode_cursor(timestamp=None, snapshot_id=None):
+    return base64.urlsafe_b64encode(json.dumps({'t': timestamp, 's': snapshot_id}, separators=(',', ':'))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+        timestamp = data['t']
+        snapshot_id = data['s']
+    except (KeyError, TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+    if timestamp is not None and not isinstance(timestamp, six.integer_types):
+        raise ValueError('Invalid cursor')
+
+    return timestamp, snapshot_id
+
+
+def get_entity_key(entity):
+    return json.dumps([entity.get('id'), entity.get('type')])
+
+
+def get_modified(entity):
+    # Supports both the normalized and the keyValues representations
+    value = entity.get(MODIFIED_ATTRIBUTE)
+    if isinstance(value, dict):
+        value = value.get('value')
+
+    return parse_timestamp(value)
+
+
+class DeltaTracker(object):
+    """Computes the changes of the entities of a NGSIv2 resource since a
+    previous request.
+
+    Entity queries are rewritten for retrieving only the entities modified
+    since the requested date (using the ``dateModified`` builtin attribute),
+    this doesn't report removed entities. Other resources, or all of them if
+    ``rewrite`` is disabled, are compared with the snapshot of the previous
+    request, keeping the hashes of the entities of the last
+    ``max_snapshots`` requests.
+
+    Changes are requested using a date or the cursor returned by the
+    previous request.
+    """
+
+    def __init__(self, rewrite=True, max_snapshots=DEFAULT_MAX_SNAPSHOTS):
+        self.rewrite_enabled = rewrite
+        self.max_snapshots = max_snapshots
+
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()
+        self._rewrites = 0
+        self._diffs = 0
+
+    def configure(self, config):
+        self.rewrite_enabled = get_bool_setting(config, 'delta_rewrite', True)
+        self.max_snapshots = get_int_setting(config, 'delta_max_snapshots', DEFAULT_MAX_SNAPSHOTS)
+        self.clear()
+
+    def is_supported(self, resource, parsed_url):
+        return resource.get('format', '').lower() == NGSI_FORMAT and parsed_url.path.lower().find('/v2/') != -1
+
+    def can_rewrite(self, resource, parsed_url):
+        return self.rewrite_enabled and resource.get('format', '').lower() == NGSI_FORMAT and is_entities_query(parsed_url)
+
+    def parse_since(self, value):
+        # Returns the date (milliseconds since the epoch) and the snapshot id
+        # of a since parameter, that can be a ISO 8601 date or a cursor
+        timestamp = parse_timestamp(value)
+        if timestamp is not None:
+            return timestamp, None
+
+        return decode_cursor(value)
+
+    def rewrite(self, url, timestamp):
+        # Returns the query retrieving all the entities modified after the
+        # given date. Cursors use the date of the last returned entity, so
+        # it has to be excluded for not returning it again
+        params = dict(get_query_params(url))
+        condition = '{0}>{1}'.format(MODIFIED_ATTRIBUTE, format_timestamp(timestamp))
+        changes = {
+            'q': params['q'] + ';' + condition if params.get('q', '') != '' else condition,
+            'limit': None,
+            'offset': None,
+        }
+
+        # Builtin attributes are only returned if they are requested
+        attrs = parse_attrs(params.get('attrs'))
+        if attrs and MODIFIED_ATTRIBUTE not in attrs:
+            changes['attrs'] = ','.join(attrs + [MODIFIED_ATTRIBUTE])
+
+        return add_options(update_query(url, changes), MODIFIED_ATTRIBUTE)
+
+    def get_rewrite_result(self, url, entities, timestamp):
+        # The most recent modification date is used as the cursor, as the
+        # clock of the Context Broker may differ from the local one
+        params = dict(get_query_params(url))
+        keep_modified = MODIFIED_ATTRIBUTE in parse_attrs(params.get('options')) + parse_attrs(params.get('attrs'))
+
+        latest = timestamp
+        result = []
+        for entity in entities:
+            modified = get_modified(entity)
+            if modified is not None and modified > latest:
+                latest = modified
+            if not keep_modified:
+                entity = dict((name, value) for name, value in entity.items() if name != MODIFIED_ATTRIBUTE)
+            result.append(entity)
+
+        with self._lock:
+            self._rewrites += 1
+
+        return {'entities': result, 'removed': [], 'cursor': encode_cursor(latest), 'complete': False}
+
+    def get_diff_result(self, owner, snapshot_id, entities):
+        # Compares the entities with the ones of a previous snapshot. All
+        # the entities are returned if the snapshot is no longer available
+        hashes = OrderedDict((get_entity_key(entity), hashlib.sha1(json.dumps(entity, sort_keys=True)).hexdigest()) for entity in entities)
+
+        with self._lock:
+            self._diffs += 1
+            snapshot = self._snapshots.get(snapshot_id) if snapshot_id is not None else None
+            if snapshot is not None and snapshot[0] != owner:
+                snapshot = None
+
+        if snapshot is None:
+            changed = entities
+            removed = []
+        else:
+            previous = snapshot[1]
+            changed = [entity for entity in entities if previous.get(get_entity_key(entity)) != hashes[get_entity_key(entity)]]
+            removed = [dict(zip(('id', 'type'), json.loads(key))) for key in previous if key not in hashes]
+
+        if snapshot is not None and not changed and not removed:
+            # Nothing changed, the same cursor can be used again
+            new_snapshot_id = snapshot_id
+        else:
+            new_snapshot_id = uuid.uuid4().hex
+            self._store(new_snapshot_id, owner, hashes)
+
+        return {'entities': changed, 'removed': removed, 'cursor': encode_cursor(None, new_snapshot_id), 'complete': snapshot is None}
+
+    def _store(self, snapshot_id, owner, hashes):
+        if self.max_snapshots <= 0:
+            return
+
+        with self._lock:
+            self._snapshots[snapshot_id] = (owner, hashes)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rewrites': self._rewrites,
+                'diffs': self._diffs,
+                'snapshots': len(self._snapshots),
+                'max_snapshots': self.max_snapshots,
+            }
+
+
+delta_tracker = DeltaTracker()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import base64
+import json
+from logging import getLogger
+import threading
+import zlib
+
+from .utils import get_setting
+
+log = getLogger(__name__)
+
+COMPACT = 'compact'
+FLAT = 'flat'
+STORAGE_FORMATS = (COMPACT, FLAT)
+DEFAULT_STORAGE = COMPACT
+
+# Extra storing the compressed JSON list of entities
+COMPACT_FIELD = 'compressed_entities'
+# Entity fields kept by the flat format, one extra per entity and field
+FLAT_FIELDS = ('id', 'value', 'isPattern')
+
+
+def get_prefix(index):
+    return 'entity__' + str(index) + '__'
+
+
+def iter_flat_prefixes(resource):
+    index = 0
+    while get_prefix(index) + 'id' in resource:
+        yield get_prefix(index)
+        index += 1
+
+
+def read_flat(resource):
+    entities = []
+    for prefix in iter_flat_prefixes(resource):
+        entity = {
+            'id': resource[prefix + 'id'],
+            'value': resource[prefix + 'value'],
+        }
+
+        if prefix + 'isPattern' in resource:
+            entity['isPattern'] = resource[prefix + 'isPattern']
+
+        entities.append(entity)
+
+    return entities
+
+
+def remove_flat(resource):
+    # Prefixes are collected first, as removing them ends the iteration
+    for prefix in list(iter_flat_prefixes(resource)):
+        for field in FLAT_FIELDS:
+            resource.pop(prefix + field, None)
+
+
+def write_flat(resource, entities):
+    for index, entity in enumerate(entities):
+        prefix = get_prefix(index)
+        for field in FLAT_FIELDS:
+            if field in entity:
+                resource[prefix + field] = entity[field]
+
+
+def encode_entities(entities):
+    data = json.dumps(list(entities), separators=(',', ':'), sort_keys=True)
+    return base64.b64encode(zlib.compress(data.encode('utf-8'), 9)).decode('ascii')
+
+
+def decode_entities(value):
+    # Raises ValueError on invalid values
+    try:
+        data = zlib.decompress(base64.b64decode(value))
+    except (TypeError, zlib.error):
+        raise ValueError('Invalid compressed entities')
+
+    entities = json.loads(data.decode('utf-8'))
+    if not isinstance(entities, list):
+        raise ValueError('Invalid compressed entities')
+
+    return entities
+
+
+class LazyEntities(list):
+    """List of entities decoded from the compact format the first time it is
+    accessed.
+
+    Pickling and copying return plain lists, and the ``for_json`` method is
+    used by the CKAN API when serializing the resources.
+    """
+
+    def __init__(self, value, decode):
+        super(LazyEntities, self).__init__()
+        self._value = value
+        self._decode = decode
+
+    @property
+    def loaded(self):
+        return self._value is None
+
+    def _load(self):
+        if self._value is not None:
+            value, self._value = self._value, None
+            list.extend(self, self._decode(value))
+
+    def for_json(self):
+        self._load()
+        return list(list.__iter__(self))
+
+    def __reduce__(self):
+        return (list, (self.for_json(),))
+
+    def __repr__(self):
+        self._load()
+        return list.__repr__(self)
+
+
+def _loading(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('__iter__', '__reversed__', '__len__', '__nonzero__', '__contains__', '__getitem__', '__getslice__',
+              '__setitem__', '__setslice__', '__delitem__', '__delslice__', '__eq__', '__ne__', '__lt__', '__le__',
+              '__gt__', '__ge__', '__add__', '__iadd__', '__mul__', '__imul__', 'append', 'extend', 'insert',
+              'remove', 'pop', 'index', 'count', 'sort', 'reverse'):
+    if hasattr(list, _name):
+        setattr(LazyEntities, _name, _loading(_name))
+
+
+class EntityStore(object):
+    """Stores the entities of ``fiware-ngsi-registry`` resources on their
+    extras.
+
+    The ``compact`` format keeps all the entities on a single compressed
+    JSON extra, only decoded when the entities are accessed. The ``flat``
+    format, used by previous versions of the extension, stores each field of
+    each entity on its own extra. Both formats are read.
+    """
+
+    def __init__(self, storage=DEFAULT_STORAGE):
+        self.storage = storage
+
+        self._lock = threading.Lock()
+        self._encoded = 0
+        self._deferred = 0
+        self._decoded = 0
+
+    def configure(self, config):
+        storage = get_setting(config, 'entity_storage', DEFAULT_STORAGE).strip().lower()
+        self.storage = storage if storage in STORAGE_FORMATS else DEFAULT_STORAGE
+
+    def serialize(self, resource, entities):
+        # Replaces the stored entities of the resource
+        remove_flat(resource)
+        resource.pop(COMPACT_FIELD, None)
+
+        if self.storage == FLAT:
+            write_flat(resource, entities)
+            return
+
+        resource[COMPACT_FIELD] = encode_entities(entities)
+        with self._lock:
+            self._encoded += 1
+
+    def deserialize(self, resource):
+        value = resource.get(COMPACT_FIELD, '')
+        if not value:
+            return read_flat(resource)
+
+        with self._lock:
+            self._deferred += 1
+
+        return LazyEntities(value, self._decode)
+
+    def _decode(self, value):
+        with self._lock:
+            self._decoded += 1
+
+        try:
+            return decode_entities(value)
+        except ValueError:
+            log.warning('Could not decode the entities of a fiware-ngsi-registry resource')
+            return []
+
+    def migrate(self, extras):
+        # Converts the entities stored using the flat format into the compact
+        # one. Returns whether the extras were modified
+        if get_prefix(0) + 'id' not in extras:
+            return False
+
+        entities = read_flat(extras)
+        remove_flat(extras)
+        if not extras.get(COMPACT_FIELD, ''):
+            extras[COMPACT_FIELD] = encode_entities(entities)
+
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'storage': self.storage,
+                'encoded': self._encoded,
+                'deferred': self._deferred,
+                'decoded': self._decoded,
+            }
+
+
+entity_store = EntityStore()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import csv
+import io
+import json
+import re
+import threading
+
+import six
+
+from .streaming import TruncatedResponseError
+from .utils import get_int_setting
+
+CSV_FORMAT = 'csv'
+NDJSON_FORMAT = 'ndjson'
+CONTENT_TYPES = {
+    CSV_FORMAT: 'text/csv',
+    NDJSON_FORMAT: 'application/x-ndjson',
+}
+
+DEFAULT_SAMPLE_SIZE = 1000
+
+# NGSIv1 responses wrap the entities on this attribute
+V1_ITEMS_KEY = 'contextResponses'
+
+ENTITY_FIELDS = ('id', 'type')
+
+_SEPARATORS = re.compile(br'[\s,:]*')
+
+# Parser states
+_START = 0
+_ITEMS = 1
+_OBJECT = 2
+_END = 3
+
+
+class JSONItemParser(object):
+    """Incremental parser returning the items of the entity array of a NGSI
+    response as they are received.
+
+    Supports top-level arrays (NGSIv2) and the ``contextResponses`` array of
+    NGSIv1 responses. Items are decoded one by one as soon as they are
+    complete, so only the item being received is kept in memory and memory
+    usage doesn't depend on the size of the response. Top-level objects
+    without that array (e.g. ``/v2/entities/<id>``) are returned as a single
+    item when they describe an entity.
+
+    When ``max_size`` is set, :class:`TruncatedResponseError` is raised once
+    the data kept for an incomplete value exceeds it.
+    """
+
+    def __init__(self, key=V1_ITEMS_KEY, max_size=0):
+        self.key = key
+        self.max_size = max_size
+        self._decoder = json.JSONDecoder()
+        self._state = _START
+        self._buffer = b''
+        self._current_key = None
+        # Attributes of the top-level object, until the items are found
+        self._object = {}
+        self._object_size = 0
+
+    def _decode(self, position):
+        # Returns the value starting at position and the position following
+        # it, or None if the value is not complete yet
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, position)
+        except ValueError:
+            return None
+
+        # Numbers and literals may continue on the next chunk
+        if end == len(self._buffer) and not isinstance(value, (dict, list, six.string_types)):
+            return None
+
+        return value, end
+
+    def feed(self, data):
+        items = []
+        self._buffer += data
+        position = 0
+        length = len(self._buffer)
+
+        while self._state != _END:
+            position = _SEPARATORS.match(self._buffer, position).end()
+            if position == length:
+                break
+
+            char = self._buffer[position:position + 1]
+            if self._state == _START:
+                self._state = _ITEMS if char == b'[' else _OBJECT
+                position += 1
+            elif char in (b']', b'}'):
+                if self._state == _OBJECT and self._is_item(self._object):
+                    items.append(self._object)
+                self._object = {}
+                self._state = _END
+            elif self._state == _OBJECT and self._current_key == self.key and char == b'[':
+                self._object = {}
+                self._object_size = 0
+                self._state = _ITEMS
+                position += 1
+            else:
+                result = self._decode(position)
+                if result is None:
+                    break
+
+                value, end = result
+                if self._state == _ITEMS:
+                    items.append(value)
+                elif self._current_key is None:
+                    self._current_key = value
+                else:
+                    # Other attributes of the top level object are kept
+                    # until knowing whether it wraps the items
+                    self._object[self._current_key] = value
+                    self._object_size += end - position
+                    self._current_key = None
+                position = end
+
+        self._buffer = self._buffer[position:] if self._state != _END else b''
+        if self.max_size > 0 and max(len(self._buffer), self._object_size) > self.max_size:
+            raise TruncatedResponseError('The response of the Context Broker exceeds the maximum allowed size.')
+
+        return items
+
+    def _is_item(self, value):
+        # NGSIv2 entities and NGSIv1 context elements, other objects are
+        # error responses
+        return 'id' in value or 'contextElement' in value
+
+
+def parse_items(chunks, max_size=0):
+    parser = JSONItemParser(max_size=max_size)
+    for chunk in chunks:
+        for item in parser.feed(chunk):
+            yield item
+
+
+def to_entity(item):
+    # Converts NGSIv1 context responses into NGSIv2 entities
+    if 'contextElement' not in item:
+        return item
+
+    element = item['contextElement']
+    entity = {'id': element.get('id'), 'type': element.get('type')}
+    for attribute in element.get('attributes', []):
+        entity[attribute['name']] = {'type': attribute.get('type'), 'value': attribute.get('value')}
+
+    return entity
+
+
+def get_value(attribute):
+    # Supports both the normalized and the keyValues representations
+    if isinstance(attribute, dict) and 'value' in attribute and 'type' in attribute:
+        return attribute['value']
+
+    return attribute
+
+
+def format_cell(value):
+    if value is None:
+        return b''
+    elif isinstance(value, bool):
+        return b'true' if value else b'false'
+    elif isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+    return six.text_type(value).encode('utf-8')
+
+
+def get_attribute_names(entity):
+    return [name for name in entity if name not in ENTITY_FIELDS]
+
+
+class ResourceExporter(object):
+    """Converts the entities returned by the Context Broker into CSV or NDJSON
+    streams.
+
+    CSV columns are the requested attributes or, by default, the ones found
+    on the first ``sample_size`` entities (the first page when following
+    pagination); attributes only present on later entities are left out.
+    """
+
+    def __init__(self, sample_size=DEFAULT_SAMPLE_SIZE, max_size=0):
+        self.sample_size = sample_size
+        # Maximum size of each item, responses are streamed so this only
+        # bounds the data buffered while parsing them
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._exports = 0
+        self._entities = 0
+
+    def configure(self, config):
+        self.sample_size = get_int_setting(config, 'export_sample_size', DEFAULT_SAMPLE_SIZE)
+        self.max_size = get_int_setting(config, 'max_response_size', 0)
+
+    def get_content_type(self, export_format):
+        return CONTENT_TYPES.get(export_format)
+
+    def _count(self, entities):
+        count = 0
+        try:
+            for entity in entities:
+                count += 1
+                yield entity
+        finally:
+            with self._lock:
+                self._entities += count
+
+    def run(self, chunks, export_format, attrs=None):
+        with self._lock:
+            self._exports += 1
+
+        entities = self._count(to_entity(item) for item in parse_items(chunks, self.max_size))
+        if export_format == CSV_FORMAT:
+            return self._csv(entities, attrs)
+
+        return self._ndjson(entities, attrs)
+
+    def _ndjson(self, entities, attrs):
+        for entity in entities:
+            if attrs:
+                entity = dict((name, value) for name, value in entity.items() if name in ENTITY_FIELDS or name in attrs)
+            yield json.dumps(entity, sort_keys=True) + b'\n'
+
+    def _csv(self, entities, attrs):
+        sample = []
+        if not attrs:
+            # Discover the columns using the first entities
+            attrs = []
+            for entity in entities:
+                sample.append(entity)
+                attrs.extend(name for name in sorted(get_attribute_names(entity)) if name not in attrs)
+                if len(sample) >= self.sample_size:
+                    break
+
+        columns = list(ENTITY_FIELDS) + [attr for attr in attrs if attr not in ENTITY_FIELDS]
+        buf = io.BytesIO()
+        writer = csv.writer(buf, lineterminator='\n')
+
+        def format_row(row):
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow(row)
+            return buf.getvalue()
+
+        yield format_row([column.encode('utf-8') for column in columns])
+
+        for group in (sample, entities):
+            for entity in group:
+                yield format_row([format_cell(get_value(entity.get(column))) for column in columns])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'exports': self._exports,
+                'entities': self._entities,
+                'sample_size': self.sample_size,
+            }
+
+
+resource_exporter = ResourceExporter()
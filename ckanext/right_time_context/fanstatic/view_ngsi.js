@@ -2,6 +2,15 @@ ckan.module('right_time_context',function(jQuery,_){
     return{
 		options:{
 	        i18n:{error:_('An error occurred: %(text)s %(error)s')},
+	        // Url of the Web Worker parsing the data (data-module-worker)
+	        worker:null,
+	        rowHeight:18,
+	        maxHeight:600,
+	        // Rows rendered above and below the visible ones
+	        overscan:20,
+	        // Url of the live updates stream (data-module-live), empty when
+	        // disabled
+	        live:'',
 			parameters:{contentType:'application/json',
 			            dataType:'json',
 			            dataConverter:function(data){return JSON.stringify(data,null,2);},
@@ -17,12 +26,23 @@ ckan.module('right_time_context',function(jQuery,_){
 			        resource_url = preload_resource['url']
 			    }
 			    if(view_enable[0]){
+                    if(this.options.worker && typeof(Worker) != 'undefined'){
+                        this.renderTree(resource_url);
+                        return;
+                    }
                     jQuery.ajax(resource_url,{type:p.type,contentType:p.contentType,dataType:p.dataType,success:function(data,textStatus,jqXHR){
-                        data=p.dataConverter?p.dataConverter(data):data;
-                        var highlighted;
-                        if(p.language){highlighted=hljs.highlight(p.language,data,true).value;}
-                        else{highlighted='<pre>'+data+'</pre>';}
-                        self.el.html(highlighted);
+                        var render=function(){
+                            var text=p.dataConverter?p.dataConverter(data):data;
+                            var highlighted;
+                            if(p.language){highlighted=hljs.highlight(p.language,text,true).value;}
+                            else{highlighted='<pre>'+text+'</pre>';}
+                            self.el.html(highlighted);
+                        };
+                        render();
+                        self.followChanges(function(changes){
+                            data=self.patchData(data,changes);
+                            render();
+                        });
                     },
                     error:function(jqXHR,textStatus,errorThrown){
                         if(textStatus=='error'&&jqXHR.responseText.length){self.el.html(jqXHR.responseText);}
@@ -32,4 +52,139 @@ ckan.module('right_time_context',function(jQuery,_){
                     self.el.html("\n\n\n"+view_enable[1]+"\n\n\n");
                 }
 
+            },
+            // Renders the data as a collapsible tree. The worker downloads,
+            // parses and highlights the data, and only the visible rows are
+            // added to the page, starting as soon as the first entities arrive
+            renderTree:function(url){
+                var self=this;
+                var o=this.options;
+                var worker=new Worker(o.worker);
+                var viewport=jQuery('<div class="ngsi-viewport"></div>');
+                var spacer=jQuery('<div class="ngsi-spacer"></div>');
+                var content=jQuery('<div class="ngsi-content"></div>');
+                var total=0;
+                var started=false;
+                var scheduled=false;
+                var following=false;
+
+                var requestRows=function(){
+                    scheduled=false;
+                    var first=Math.floor(viewport.scrollTop()/o.rowHeight);
+                    var visible=Math.ceil((viewport.height()||o.maxHeight)/o.rowHeight);
+                    var start=Math.max(first-o.overscan,0);
+                    worker.postMessage({cmd:'rows',start:start,count:visible+2*o.overscan});
+                };
+                var scheduleRows=function(){
+                    if(!scheduled){
+                        scheduled=true;
+                        if(window.requestAnimationFrame){window.requestAnimationFrame(requestRows);}
+                        else{window.setTimeout(requestRows,16);}
+                    }
+                };
+
+                worker.onmessage=function(event){
+                    var message=event.data;
+                    if(message.type=='progress'){
+                        if(!started){
+                            started=true;
+                            self.el.empty().append(viewport.append(spacer.append(content)));
+                        }
+                        if(message.complete&&!following){
+                            following=true;
+                            self.followChanges(function(changes){
+                                worker.postMessage({cmd:'patch',entities:changes.entities,removed:changes.removed,complete:changes.complete});
+                            });
+                        }
+                        total=message.total;
+                        spacer.css('height',total*o.rowHeight);
+                        viewport.css('height',Math.min(total*o.rowHeight,o.maxHeight)+20);
+                        scheduleRows();
+                    }
+                    else if(message.type=='rows'){
+                        content.css('top',message.start*o.rowHeight).html(message.html.join(''));
+                    }
+                    else if(message.type=='error'){
+                        worker.terminate();
+                        if(message.status&&message.text.length){self.el.html(message.text);}
+                        else{self.el.html(self.i18n('error',{text:'error',error:message.text}));}
+                    }
+                };
+
+                viewport.on('scroll',scheduleRows);
+                viewport.on('click','.ngsi-toggle',function(){
+                    worker.postMessage({cmd:'toggle',row:parseInt(jQuery(this).attr('data-row'),10)});
+                });
+
+                worker.postMessage({cmd:'load',url:url});
+            },
+            // Receives the entities changed since the data was loaded
+            followChanges:function(onChange){
+                if(!this.options.live || typeof(EventSource) == 'undefined'){
+                    return;
+                }
+                var source=new EventSource(this.options.live);
+                source.addEventListener('change',function(event){
+                    onChange(JSON.parse(event.data));
+                });
+                source.addEventListener('reset',function(){
+                    // Some changes were lost, reload the full data
+                    source.close();
+                    window.location.reload();
+                });
+            },
+            // Applies the changes to the data of the ajax fallback, complete
+            // changes contain every entity and drop the missing ones
+            patchData:function(data,changes){
+                var key=function(entity){return JSON.stringify([entity.id,entity.type===undefined?null:entity.type]);};
+                var entities=jQuery.isArray(data)?data:[data];
+                var updated={};
+                var removed={};
+                jQuery.each(changes.entities,function(i,entity){updated[key(entity)]=entity;});
+                jQuery.each(changes.removed,function(i,entity){removed[key(entity)]=true;});
+                var result=[];
+                jQuery.each(entities,function(i,entity){
+                    var k=key(entity);
+                    if(removed[k]||(changes.complete&&!updated[k])){return;}
+                    if(updated[k]){result.push(updated[k]);delete updated[k];}
+                    else{result.push(entity);}
+                });
+                if(!jQuery.isArray(data)){
+                    return result.length?result[0]:data;
+                }
+                jQuery.each(updated,function(k,entity){result.push(entity);});
+                return result;
             }};});
+
+ckan.module('ngsiviewchart',function(jQuery,_){
+    return{
+        options:{
+            // Url of the chart data (data-module-url), empty when disabled
+            url:'',
+            height:300
+        },
+        initialize:function(){
+            var self=this;
+            var o=this.options;
+            if(!o.url || typeof(Dygraph) == 'undefined'){
+                return;
+            }
+            // Points are downsampled by the server to the chart width
+            var width=Math.max(this.el.width()||jQuery(window).width(),100);
+            jQuery.ajax(o.url,{type:'GET',dataType:'json',data:{width:width},success:function(data){
+                var columns=data.columns;
+                if(data.labels.length < 2 || columns[0].length === 0){
+                    return;
+                }
+                // Columns are transposed into the rows expected by dygraph
+                var rows=new Array(columns[0].length);
+                for(var i=0;i<rows.length;i++){
+                    var row=new Array(columns.length);
+                    row[0]=new Date(columns[0][i]);
+                    for(var j=1;j<columns.length;j++){row[j]=columns[j][i];}
+                    rows[i]=row;
+                }
+                self.el.css('height',o.height);
+                new Dygraph(self.el[0],rows,{labels:data.labels,connectSeparatedPoints:true});
+            }});
+        }};});
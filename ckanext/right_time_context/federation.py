@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+from logging import getLogger
+import threading
+
+import six
+
+from .concurrency import unordered_map
+from .live import parse_entities
+from .pagination import strip_array
+from .utils import get_bool_setting, get_float_setting, get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 10
+
+
+class FederatedQuery(object):
+    """Merges the entities returned by the NGSI resources of a dataset.
+
+    Sources are queried concurrently and their entities are streamed as a
+    single JSON array as soon as each source completes. Sources failing or
+    not completing in ``timeout`` seconds are left out of the response.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT, dedup=False):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.dedup = dedup
+
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._sources = 0
+        self._errors = 0
+        self._timeouts = 0
+        self._duplicates = 0
+
+    def configure(self, config):
+        self.concurrency = get_int_setting(config, 'federation_concurrency', DEFAULT_CONCURRENCY)
+        self.timeout = get_float_setting(config, 'federation_timeout', DEFAULT_TIMEOUT)
+        self.dedup = get_bool_setting(config, 'federation_dedup', False)
+
+    def is_dedup_enabled(self, value):
+        if isinstance(value, six.string_types) and value.strip() != '':
+            return value.strip().lower() in ('true', 'on', '1', 'yes')
+
+        return self.dedup
+
+    def record_error(self, resource_id, message):
+        log.warning('Leaving resource {0} out of the federated query: {1}'.format(resource_id, message))
+        with self._lock:
+            self._errors += 1
+
+    def _record_timeout(self, job):
+        log.warning('Leaving resource {0} out of the federated query: timed out'.format(job[0]))
+        with self._lock:
+            self._timeouts += 1
+
+    def _parse_entities(self, body):
+        # Returns the entities of a source, normalizing NGSIv1 responses and
+        # single entity retrievals
+        try:
+            return parse_entities(body)
+        except ValueError:
+            log.warning('Ignoring a source of the federated query, it did not return entities')
+            return []
+
+    def _iter_entities(self, bodies, dedup):
+        # Yields the serialized entities of each body, separated by commas
+        seen = set()
+        for body in bodies:
+            if body is None:
+                continue
+
+            if not dedup:
+                # Entity arrays are passed through without parsing them
+                try:
+                    entities = strip_array(body)
+                except ValueError:
+                    entities = b','.join(json.dumps(entity).encode('utf-8') for entity in self._parse_entities(body))
+
+                if entities != b'':
+                    yield entities
+                continue
+
+            for entity in self._parse_entities(body):
+                key = (entity.get('id'), entity.get('type'))
+                if key in seen:
+                    with self._lock:
+                        self._duplicates += 1
+                    continue
+
+                seen.add(key)
+                yield json.dumps(entity).encode('utf-8')
+
+    def run(self, jobs, fetch, dedup=False):
+        # Yields the merged JSON array. fetch must return the body of a job or
+        # None if the source is not available
+        with self._lock:
+            self._queries += 1
+            self._sources += len(jobs)
+
+        bodies = unordered_map(fetch, jobs, max(self.concurrency, 1), self.timeout if self.timeout > 0 else None, self._record_timeout)
+
+        yield b'['
+        empty = True
+        for entities in self._iter_entities(bodies, dedup):
+            yield entities if empty else b',' + entities
+            empty = False
+
+        yield b']'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queries': self._queries,
+                'sources': self._sources,
+                'errors': self._errors,
+                'timeouts': self._timeouts,
+                'duplicates': self._duplicates,
+                'concurrency': self.concurrency,
+                'timeout': self.timeout,
+            }
+
+
+federated_query = FederatedQuery()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import OrderedDict
+import hashlib
+import json
+from logging import getLogger
+import threading
+import time
+
+from six.moves import queue
+
+from .export import to_entity, V1_ITEMS_KEY
+from .utils import get_bool_setting, get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+DEFAULT_HEARTBEAT = 15
+DEFAULT_MAX_DURATION = 300
+# Each client keeps a worker thread busy, so only a few of the threads of
+# a process (e.g. 10 on the default Paste server) are used by default
+DEFAULT_MAX_CLIENTS = 4
+
+# Maximum number of events waiting to be sent to a client
+MAX_PENDING_EVENTS = 100
+# Milliseconds browsers wait before reconnecting
+RECONNECTION_DELAY = 5000
+
+
+def parse_entities(body):
+    # Returns the entities of a NGSIv1 or NGSIv2 response
+    data = json.loads(body)
+    if isinstance(data, dict) and V1_ITEMS_KEY in data:
+        data = [to_entity(item) for item in data[V1_ITEMS_KEY]]
+    elif isinstance(data, dict):
+        data = [data]
+    elif not isinstance(data, list):
+        raise ValueError('The response does not contain entities')
+
+    return [entity for entity in data if isinstance(entity, dict) and 'id' in entity]
+
+
+def format_event(event, data, event_id=None):
+    # Browsers send the id of the last event received when reconnecting
+    prefix = 'id: {0}\n'.format(event_id) if event_id is not None else ''
+    return '{0}event: {1}\ndata: {2}\n\n'.format(prefix, event, json.dumps(data, separators=(',', ':')))
+
+
+class Subscriber(object):
+
+    def __init__(self, feed, version=None):
+        self.feed = feed
+        self.events = queue.Queue(MAX_PENDING_EVENTS)
+        # Version of the entities the client has, None if unknown. Clients
+        # are synced once they receive the changes since that version
+        self.version = version
+        self.synced = False
+        # Set when events had to be discarded, the client has to reload the
+        # full resource
+        self.lagging = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.lagging = True
+
+
+class ResourceFeed(object):
+    """Polls a resource on behalf of all the clients following it, sending
+    them the entities changed since the previous poll.
+
+    Each poll is identified by a version computed from its entities. Clients
+    joining the feed receive the changes since the version they have (the
+    id of the last event received before reconnecting) or, if it is not
+    known, all the entities, so changes made since they loaded the resource
+    are not lost.
+    """
+
+    def __init__(self, key, fetch):
+        self.key = key
+        self.fetch = fetch
+        self.subscribers = set()
+        # Serialized entities, indexed by id and type
+        self.snapshot = None
+        self.version = None
+        self.previous_version = None
+
+    def diff(self, entities):
+        current = OrderedDict(((entity['id'], entity.get('type')), (json.dumps(entity, sort_keys=True), entity)) for entity in entities)
+        previous = self.snapshot
+        self.snapshot = dict((key, serialized) for key, (serialized, entity) in current.items())
+        self.previous_version = self.version
+        self.version = hashlib.sha1(json.dumps(sorted(self.snapshot.items()))).hexdigest()
+        if previous is None:
+            return None
+
+        changed = [entity for key, (serialized, entity) in current.items() if previous.get(key) != serialized]
+        removed = [{'id': key[0], 'type': key[1]} for key in previous if key not in current]
+        if not changed and not removed:
+            return None
+
+        return {'entities': changed, 'removed': removed, 'complete': False}
+
+    def get_changes(self, subscriber, entities, changes):
+        # Returns the event to send to a subscriber after a poll, or None
+        if subscriber.synced or (subscriber.version is not None and subscriber.version == self.previous_version):
+            result = changes
+        elif subscriber.version == self.version:
+            result = None
+        else:
+            # Clients replace their entities by the complete list
+            result = {'entities': entities, 'removed': [], 'complete': True}
+
+        subscriber.synced = True
+        return result
+
+
+class EventStream(object):
+    # Unsubscribes the client when the server closes the response, even if
+    # the stream was never iterated
+
+    def __init__(self, live, subscriber):
+        self.live = live
+        self.subscriber = subscriber
+
+    def __iter__(self):
+        return self.live.iter_events(self.subscriber)
+
+    def close(self):
+        self.live.unsubscribe(self.subscriber)
+
+
+class LiveUpdates(object):
+    """Server-Sent Events streams notifying the changes of the entities of a
+    resource.
+
+    Each resource is polled every ``interval`` seconds by a single thread
+    shared by all the clients following it (clients of resources requiring
+    user credentials are only shared by the same user), and polling stops
+    when the last client disconnects. Streams are closed after
+    ``max_duration`` seconds, browsers reconnect automatically.
+    """
+
+    def __init__(self, enabled=False, interval=DEFAULT_INTERVAL, heartbeat=DEFAULT_HEARTBEAT, max_duration=DEFAULT_MAX_DURATION, max_clients=DEFAULT_MAX_CLIENTS):
+        self.enabled = enabled
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.max_duration = max_duration
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._feeds = {}
+        self._clients = 0
+        self._polls = 0
+        self._events = 0
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'live', False)
+        self.interval = get_int_setting(config, 'live_interval', DEFAULT_INTERVAL)
+        self.heartbeat = get_int_setting(config, 'live_heartbeat', DEFAULT_HEARTBEAT)
+        self.max_duration = get_int_setting(config, 'live_max_duration', DEFAULT_MAX_DURATION)
+        self.max_clients = get_int_setting(config, 'live_max_clients', DEFAULT_MAX_CLIENTS)
+
+    def subscribe(self, key, fetch, version=None):
+        # Returns None if the maximum number of clients has been reached.
+        # version is the id of the last event received by the client
+        with self._lock:
+            if self.max_clients > 0 and self._clients >= self.max_clients:
+                return None
+
+            feed = self._feeds.get(key)
+            start = feed is None
+            if start:
+                feed = self._feeds[key] = ResourceFeed(key, fetch)
+
+            subscriber = Subscriber(feed, version)
+            feed.subscribers.add(subscriber)
+            self._clients += 1
+
+        if start:
+            thread = threading.Thread(target=self._run, args=(feed,), name='right_time_context-live')
+            thread.daemon = True
+            thread.start()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in subscriber.feed.subscribers:
+                subscriber.feed.subscribers.discard(subscriber)
+                self._clients -= 1
+
+    def poll(self, feed):
+        try:
+            entities = parse_entities(feed.fetch())
+        except Exception as e:
+            log.info('Unable to poll resource for live updates: {0}'.format(e))
+            return
+
+        # Feeds are only polled by their thread
+        changes = feed.diff(entities)
+        with self._lock:
+            self._polls += 1
+            events = [(subscriber, feed.get_changes(subscriber, entities, changes)) for subscriber in feed.subscribers]
+            events = [(subscriber, event) for subscriber, event in events if event is not None]
+            self._events += len(events)
+            version = feed.version
+
+        for subscriber, event in events:
+            subscriber.put((version, event))
+
+    def _run(self, feed):
+        while True:
+            with self._lock:
+                if not feed.subscribers:
+                    if self._feeds.get(feed.key) is feed:
+                        del self._feeds[feed.key]
+                    return
+
+            self.poll(feed)
+            time.sleep(self.interval)
+
+    def stream(self, subscriber):
+        return EventStream(self, subscriber)
+
+    def iter_events(self, subscriber):
+        # Yields the events of a client, sending comments as heartbeats so
+        # proxies don't close idle connections
+        try:
+            yield 'retry: {0}\n\n'.format(RECONNECTION_DELAY)
+            end = time.time() + self.max_duration if self.max_duration > 0 else None
+            while end is None or time.time() < end:
+                if subscriber.lagging:
+                    yield format_event('reset', {})
+                    return
+
+                timeout = self.heartbeat if end is None else max(min(self.heartbeat, end - time.time()), 0)
+                try:
+                    version, changes = subscriber.events.get(timeout=timeout)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+
+                yield format_event('change', changes, version)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'feeds': len(self._feeds),
+                'clients': self._clients,
+                'polls': self._polls,
+                'events': self._events,
+            }
+
+
+live_updates = LiveUpdates()
@@ -0,0 +1,734 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import binascii
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+from logging import getLogger
+import os
+import threading
+import time
+import urllib
+import urlparse
+
+from ckan.lib.redis import connect_to_redis
+from redis.exceptions import RedisError
+import six
+
+from .cache import CacheEntry
+from .pagination import add_options, get_query_params, is_entities_query, paginator, parse_query, update_query
+from .pool import session_pool
+from .utils import get_bool_setting, get_int_setting, get_setting
+
+log = getLogger(__name__)
+
+NGSI_FORMAT = 'fiware-ngsi'
+
+DEFAULT_DURATION = 3600
+DEFAULT_THROTTLING = 0
+DEFAULT_MAX_ENTITIES = 10000
+DEFAULT_RETRY_INTERVAL = 60
+
+# Number of entities returned by Orion when no limit is provided
+ORION_DEFAULT_LIMIT = 20
+PAGE_SIZE = 1000
+
+# Query parameters of NGSIv2 entity queries translated into the condition
+# expression of the subscription
+EXPRESSION_PARAMS = ('q', 'mq', 'georel', 'geometry', 'coords')
+REPRESENTATION_OPTIONS = ('keyValues', 'values', 'unique')
+# Query parameters and options whose result cannot be computed locally. The
+# Context Broker doesn't notify entities that stop matching a condition, so
+# queries filtering entities by their attributes are not supported either
+UNSUPPORTED_PARAMS = ('orderBy',) + EXPRESSION_PARAMS
+UNSUPPORTED_OPTIONS = ('values', 'unique')
+
+ENTITY_FIELDS = ('id', 'type')
+
+# Views are shared by all the CKAN processes through Redis
+KEY_PREFIX = 'ckanext-right_time_context:materialized:'
+STATE_FIELDS = ('url', 'headers', 'verify', 'subscription', 'loaded', 'version', 'renew_at', 'retry_at')
+# Number of notified changes kept for updating the copies of each process
+MAX_CHANGES = 100
+# Seconds after which an unfinished activation can be started again
+LOCK_TIMEOUT = 600
+
+
+def split_param(value):
+    return [item.strip() for item in value.split(',') if item.strip() != '']
+
+
+def get_entities_path(parsed_url):
+    # Returns the path prefix of the NGSIv2 API and the id of the requested
+    # entity (None for entity queries)
+    path = parsed_url.path.rstrip('/')
+    index = path.lower().find('/v2/entities')
+    if index == -1:
+        return None, None
+
+    prefix = path[:index]
+    rest = path[index + len('/v2/entities'):]
+    if rest == '':
+        return prefix, None
+    elif rest.count('/') == 1:
+        return prefix, urllib.unquote(rest[1:])
+
+    return None, None
+
+
+def is_supported(parsed_url):
+    # Entity queries and single entity retrievals of NGSIv2
+    prefix, entity_id = get_entities_path(parsed_url)
+    if prefix is None:
+        return False
+
+    params = dict(parse_query(parsed_url.query))
+    options = split_param(params.get('options', ''))
+    return not any(params.get(param, '') != '' for param in UNSUPPORTED_PARAMS) and not any(option in options for option in UNSUPPORTED_OPTIONS)
+
+
+def build_subscription(url, notification_url, expires=None, throttling=0, description=None):
+    """Returns the NGSIv2 subscription notifying the changes of the entities
+    returned by a ``/v2/entities`` url.
+    """
+    parsed_url = urlparse.urlsplit(url)
+    params = dict(parse_query(parsed_url.query))
+    prefix, entity_id = get_entities_path(parsed_url)
+
+    if entity_id is not None:
+        ids = [{'id': entity_id}]
+    elif params.get('id', '') != '':
+        ids = [{'id': value} for value in split_param(params['id'])]
+    else:
+        ids = [{'idPattern': params.get('idPattern') or '.*'}]
+
+    if params.get('type', '') != '':
+        types = [{'type': value} for value in split_param(params['type'])]
+    elif params.get('typePattern', '') != '':
+        types = [{'typePattern': params['typePattern']}]
+    else:
+        types = [{}]
+
+    # Entities matching any of the ids and any of the types
+    entities = [dict(entity_id, **entity_type) for entity_id in ids for entity_type in types]
+
+    subject = {'entities': entities}
+    expression = dict((name, params[name]) for name in EXPRESSION_PARAMS if params.get(name, '') != '')
+    if expression:
+        subject['condition'] = {'expression': expression}
+
+    notification = {'http': {'url': notification_url}, 'attrsFormat': 'normalized'}
+    attrs = split_param(params.get('attrs', ''))
+    if attrs:
+        notification['attrs'] = attrs
+    if params.get('metadata', '') != '':
+        notification['metadata'] = split_param(params['metadata'])
+
+    subscription = {'subject': subject, 'notification': notification}
+    if description is not None:
+        subscription['description'] = description
+    if expires is not None:
+        subscription['expires'] = format_date(expires)
+    if throttling > 0:
+        subscription['throttling'] = throttling
+
+    return subscription
+
+
+def to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, six.text_type) else value
+
+
+def to_text(value):
+    return value.decode('utf-8') if isinstance(value, six.binary_type) else value
+
+
+def format_date(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(timestamp))
+
+
+def get_entity_key(entity):
+    return entity.get('id'), entity.get('type')
+
+
+def encode_key(key):
+    return json.dumps(list(key))
+
+
+def decode_key(value):
+    return tuple(json.loads(value))
+
+
+def apply_change(entities, change):
+    # Changes include the current state of the notified entities, entities
+    # missing from it were removed or no longer match the query
+    current = dict((get_entity_key(entity), entity) for entity in change['entities'])
+    for key in change['keys']:
+        key = tuple(key)
+        if key in current:
+            entities[key] = current[key]
+        else:
+            entities.pop(key, None)
+
+
+def to_key_values(entity):
+    return dict((name, value if name in ENTITY_FIELDS or not isinstance(value, dict) else value.get('value')) for name, value in entity.items())
+
+
+def filter_attrs(entity, attrs):
+    return dict((name, value) for name, value in entity.items() if name in ENTITY_FIELDS or name in attrs)
+
+
+class MaterializedView(object):
+    """Copy of the entities of a materialized resource kept by a CKAN
+    process, identified by the version of the shared view it reflects.
+    """
+
+    def __init__(self, resource_id, url, headers, verify):
+        self.resource_id = resource_id
+        self.url = url
+        self.parsed_url = urlparse.urlsplit(url)
+        # FIWARE headers used for managing the subscription
+        self.headers = headers
+        self.verify = verify
+
+        self.version = None
+        self.entities = OrderedDict()
+        # Serialized responses, indexed by request url
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.version is not None
+
+    def matches(self, url, headers):
+        return self.url == url and self.headers == headers
+
+    def reset(self, entities, version):
+        self.entities = entities
+        self.version = version
+        self.responses = {}
+
+    def apply(self, changes, version):
+        for change in changes:
+            apply_change(self.entities, change)
+
+        self.version = version
+        self.responses = {}
+
+
+class MaterializedStore(object):
+    """Copies of the entities of ``fiware-ngsi`` resources, kept up to date
+    using NGSIv2 subscriptions instead of querying the Context Broker on
+    every request.
+
+    Views are activated by the first request of a resource: a subscription
+    derived from the resource url is created (expiring after ``duration``
+    seconds), the matching entities are loaded and, from then on, requests
+    are served from memory. Subscriptions are renewed and entities reloaded
+    once half of ``duration`` has elapsed, removing the entities that no
+    longer match the query. Until a view is ready, or if it cannot be
+    activated, requests are proxied as usual.
+
+    The subscription and the entities of each view are stored in Redis, so
+    notifications can be received by any CKAN process and views are only
+    activated by one of them. Each process serves a copy of the entities
+    kept in memory, updated using the changes recorded by the notifications
+    (or reloaded from Redis if too many changes were missed).
+    """
+
+    def __init__(self, enabled=False, notification_url=None, secret='', duration=DEFAULT_DURATION, throttling=DEFAULT_THROTTLING,
+                 max_entities=DEFAULT_MAX_ENTITIES, retry_interval=DEFAULT_RETRY_INTERVAL, redis=None):
+        self.enabled = enabled
+        self.notification_url = notification_url
+        self.secret = secret
+        self.duration = duration
+        self.throttling = throttling
+        self.max_entities = max_entities
+        self.retry_interval = retry_interval
+        self.redis = redis
+
+        self._lock = threading.Lock()
+        self._views = {}
+        self._hits = 0
+        self._notifications = 0
+        self._activations = 0
+        self._failures = 0
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'materialize', False)
+        self.notification_url = get_setting(config, 'materialize_notification_url', config.get('ckan.site_url'))
+        self.secret = get_setting(config, 'materialize_secret', config.get('beaker.session.secret', ''))
+        self.duration = get_int_setting(config, 'materialize_duration', DEFAULT_DURATION)
+        self.throttling = get_int_setting(config, 'materialize_throttling', DEFAULT_THROTTLING)
+        self.max_entities = get_int_setting(config, 'materialize_max_entities', DEFAULT_MAX_ENTITIES)
+        self.retry_interval = get_int_setting(config, 'materialize_retry_interval', DEFAULT_RETRY_INTERVAL)
+        # The connection is established on first use
+        self.redis = connect_to_redis() if self.enabled else None
+        self.clear()
+
+    def is_enabled(self, resource, parsed_url):
+        if not self.notification_url or self.duration <= 0 or self.redis is None:
+            return False
+        elif resource.get('format', '').lower() != NGSI_FORMAT or resource.get('auth_type', 'none') != 'none':
+            # Responses depending on the user cannot be shared
+            return False
+
+        # Resources can only opt out of materialization
+        value = resource.get('materialize', '')
+        if isinstance(value, six.string_types):
+            value = value.strip().lower()
+
+        if value not in (None, '') and value not in (True, 'true', 'on', '1', 'yes'):
+            return False
+
+        return self.enabled and is_supported(parsed_url)
+
+    def get_token(self, resource_id):
+        return hmac.new(to_bytes(self.secret or ''), to_bytes(resource_id), hashlib.sha256).hexdigest()
+
+    def get_notification_url(self, resource_id):
+        return '{0}/right_time_context/notify/{1}?token={2}'.format(self.notification_url.rstrip('/'), resource_id, self.get_token(resource_id))
+
+    def _key(self, resource_id, name=None):
+        key = KEY_PREFIX + resource_id
+        return key if name is None else '{0}:{1}'.format(key, name)
+
+    def _get_state(self, resource_id):
+        state = dict(zip(STATE_FIELDS, self.redis.hmget(self._key(resource_id), STATE_FIELDS)))
+        return {
+            'url': to_text(state['url']),
+            'headers': json.loads(state['headers']) if state['headers'] is not None else None,
+            'verify': json.loads(state['verify']) if state['verify'] is not None else True,
+            'subscription': to_text(state['subscription']),
+            'loaded': state['loaded'] is not None,
+            'version': int(state['version'] or 0),
+            'renew_at': float(state['renew_at'] or 0),
+            'retry_at': float(state['retry_at'] or 0),
+        }
+
+    def get(self, resource_id, base_plan, plan):
+        """Returns the response to a request as a ``CacheEntry``, or None if
+        the Context Broker has to be queried.
+
+        ``base_plan`` is the plan of the resource, used for activating the
+        view, and ``plan`` the one used by the request (e.g. a preview).
+        """
+        headers = self._get_headers(base_plan)
+        url = base_plan.resource['url']
+
+        try:
+            state = self._get_state(resource_id)
+            # Views of a previous url are replaced once the resource is updated
+            matches = state['url'] == url and state['headers'] == headers
+            ready = matches and state['loaded']
+            if not matches or time.time() >= (state['renew_at'] if ready else state['retry_at']):
+                self._start_activation(MaterializedView(resource_id, url, headers, base_plan.verify))
+
+            if not ready:
+                return None
+
+            view = self._get_view(resource_id, url, headers, base_plan.verify)
+            with view.lock:
+                if view.version != state['version']:
+                    self._sync(view, state['version'])
+
+                request_url = plan.resource['url']
+                entry = view.responses.get(request_url)
+                if entry is None:
+                    paginate = paginator.is_enabled(plan.resource, plan.parsed_url)
+                    body = self._select(view, request_url, paginate)
+                    if body is None:
+                        return None
+                    entry = view.responses[request_url] = CacheEntry(body, 'application/json', 'utf-8', {}, 0)
+        except RedisError as e:
+            log.warning('Could not read the materialized view of resource {0}: {1}'.format(resource_id, e))
+            return None
+
+        with self._lock:
+            self._hits += 1
+
+        return entry
+
+    def _get_view(self, resource_id, url, headers, verify):
+        with self._lock:
+            view = self._views.get(resource_id)
+            if view is None or not view.matches(url, headers):
+                view = self._views[resource_id] = MaterializedView(resource_id, url, headers, verify)
+
+            return view
+
+    def _read_changes(self, client, resource_id):
+        return [json.loads(change) for change in client.lrange(self._key(resource_id, 'changes'), 0, -1)]
+
+    def _sync(self, view, version):
+        # Applies the changes notified since the version of the copy, or
+        # reloads all the entities if some of them are no longer recorded
+        if view.version is not None and version > view.version:
+            changes = dict((change['version'], change) for change in self._read_changes(self.redis, view.resource_id))
+            missed = six.moves.range(view.version + 1, version + 1)
+            if all(number in changes for number in missed):
+                view.apply([changes[number] for number in missed], version)
+                return
+
+        pipe = self.redis.pipeline()
+        pipe.hget(self._key(view.resource_id), 'version')
+        pipe.hgetall(self._key(view.resource_id, 'entities'))
+        pipe.zrange(self._key(view.resource_id, 'order'), 0, -1)
+        version, data, order = pipe.execute()
+
+        entities = OrderedDict((decode_key(field), json.loads(data[field])) for field in order if field in data)
+        view.reset(entities, int(version or 0))
+
+    def _get_headers(self, plan):
+        return dict((name, value) for name, value in plan.headers.items() if name.startswith('FIWARE-'))
+
+    def _select(self, view, url, paginate):
+        # Computes the response of the Context Broker to the given url
+        parsed_url = urlparse.urlsplit(url)
+        params = dict(get_query_params(url))
+        options = split_param(params.get('options', ''))
+        attrs = split_param(params.get('attrs', ''))
+
+        entities = list(view.entities.values())
+        if attrs:
+            entities = [filter_attrs(entity, attrs) for entity in entities]
+        if 'keyValues' in options:
+            entities = [to_key_values(entity) for entity in entities]
+
+        if not is_entities_query(parsed_url):
+            # Missing entities are left to the Context Broker
+            return json.dumps(entities[0]) if len(entities) > 0 else None
+
+        try:
+            offset = max(int(params.get('offset', 0)), 0)
+        except ValueError:
+            offset = 0
+
+        limit = paginator.max_entities if paginate else ORION_DEFAULT_LIMIT
+        try:
+            limit = min(int(params['limit']), limit) if limit > 0 else int(params['limit'])
+        except (KeyError, ValueError):
+            pass
+
+        return json.dumps(entities[offset:offset + limit] if limit > 0 else entities[offset:])
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, name='right_time_context-materialize')
+        thread.daemon = True
+        thread.start()
+
+    def _start_activation(self, view):
+        # Only one process activates each view at a time
+        token = binascii.hexlify(os.urandom(8))
+        if self.redis.set(self._key(view.resource_id, 'lock'), token, nx=True, ex=LOCK_TIMEOUT):
+            self._start(self._activate, view, token)
+
+    def _release(self, resource_id, token):
+        lock = self._key(resource_id, 'lock')
+        if self.redis.get(lock) == token:
+            self.redis.delete(lock)
+
+    def _request(self, view, method, url, **kwargs):
+        headers = dict(view.headers, Accept='application/json')
+        if 'json' in kwargs:
+            headers['Content-Type'] = 'application/json'
+            kwargs['data'] = json.dumps(kwargs.pop('json'))
+
+        session = session_pool.get_session(url, verify=view.verify)
+        return session.request(method, url, headers=headers, verify=view.verify, **kwargs)
+
+    def _get_subscriptions_url(self, view):
+        prefix, entity_id = get_entities_path(view.parsed_url)
+        return urlparse.urlunsplit((view.parsed_url.scheme, view.parsed_url.netloc, prefix + '/v2/subscriptions', '', ''))
+
+    def _subscribe(self, view, subscription_id):
+        # Renews the subscription of the view, creating it if needed. Returns
+        # the id of the subscription and the time it expires
+        expires = time.time() + self.duration
+        subscriptions_url = self._get_subscriptions_url(view)
+
+        if subscription_id is not None:
+            r = self._request(view, 'PATCH', '{0}/{1}'.format(subscriptions_url, subscription_id), json={'expires': format_date(expires)})
+            if r.status_code != 404:
+                r.raise_for_status()
+                return subscription_id, expires
+
+        subscription = build_subscription(view.url, self.get_notification_url(view.resource_id), expires, self.throttling, 'ckanext-right_time_context resource {0}'.format(view.resource_id))
+        r = self._request(view, 'POST', subscriptions_url, json=subscription)
+        r.raise_for_status()
+        return r.headers['Location'].rstrip('/').rsplit('/', 1)[-1], expires
+
+    def _load(self, view, ids=None):
+        # Returns the entities currently matching the query of the view,
+        # using the normalized representation. ids restricts the query to
+        # the given entities
+        params = dict(get_query_params(view.url))
+        options = [option for option in split_param(params.get('options', '')) if option not in REPRESENTATION_OPTIONS + ('count',)]
+        url = update_query(view.url, {'limit': None, 'offset': None, 'options': ','.join(options) or None})
+        if ids is not None and is_entities_query(view.parsed_url):
+            url = update_query(url, {'id': ','.join(ids), 'idPattern': None})
+
+        entities = OrderedDict()
+        if not is_entities_query(view.parsed_url):
+            r = self._request(view, 'GET', url)
+            if r.status_code != 404:
+                r.raise_for_status()
+                entity = r.json()
+                entities[get_entity_key(entity)] = entity
+            return entities
+
+        offset = 0
+        while True:
+            page_url = add_options(update_query(url, {'offset': six.text_type(offset), 'limit': six.text_type(PAGE_SIZE)}), 'count')
+            r = self._request(view, 'GET', page_url)
+            r.raise_for_status()
+
+            total = int(r.headers.get('Fiware-Total-Count', 0))
+            if self.max_entities > 0 and total > self.max_entities:
+                raise ValueError('The query returns {0} entities, more than the {1} allowed'.format(total, self.max_entities))
+
+            page = r.json()
+            for entity in page:
+                entities[get_entity_key(entity)] = entity
+
+            offset += PAGE_SIZE
+            if len(page) == 0 or offset >= total:
+                return entities
+
+    def _activate(self, view, token):
+        key = self._key(view.resource_id)
+        try:
+            state = self._get_state(view.resource_id)
+            if state['url'] is not None and (state['url'] != view.url or state['headers'] != view.headers):
+                # The resource has been updated
+                if state['subscription'] is not None:
+                    self._delete_subscription(MaterializedView(view.resource_id, state['url'], state['headers'], state['verify']), state['subscription'])
+                self._delete_view(view.resource_id)
+                state['subscription'] = None
+
+            subscription_id, expires = self._subscribe(view, state['subscription'])
+            # Notifications are accepted from now on, they are applied on top
+            # of the loaded entities
+            self.redis.hmset(key, {'url': view.url, 'headers': json.dumps(view.headers, sort_keys=True), 'verify': json.dumps(view.verify), 'subscription': subscription_id})
+            version = int(self.redis.hget(key, 'version') or 0)
+            self._store(view, self._load(view), version, expires)
+        except Exception as e:
+            log.warning('Could not materialize resource {0}: {1}'.format(view.resource_id, e))
+            # A view that failed to renew keeps serving its entities
+            retry_at = time.time() + self.retry_interval
+            try:
+                self.redis.hmset(key, {'url': view.url, 'headers': json.dumps(view.headers, sort_keys=True), 'verify': json.dumps(view.verify), 'renew_at': retry_at, 'retry_at': retry_at})
+            except RedisError:
+                pass
+            with self._lock:
+                self._failures += 1
+        else:
+            with self._lock:
+                self._activations += 1
+        finally:
+            try:
+                self._release(view.resource_id, token)
+            except RedisError:
+                pass
+
+    def _store(self, view, entities, version, expires):
+        # Replaces the shared entities, applying the changes notified since
+        # the given version
+        key = self._key(view.resource_id)
+        entities_key = self._key(view.resource_id, 'entities')
+        order_key = self._key(view.resource_id, 'order')
+
+        def write(pipe):
+            current = int(pipe.hget(key, 'version') or 0)
+            merged = OrderedDict(entities)
+            for change in self._read_changes(pipe, view.resource_id):
+                if change['version'] > version:
+                    apply_change(merged, change)
+
+            pipe.multi()
+            pipe.delete(entities_key, order_key)
+            if merged:
+                pipe.hmset(entities_key, dict((encode_key(entity_key), json.dumps(entity)) for entity_key, entity in merged.items()))
+                pipe.zadd(order_key, **dict((encode_key(entity_key), index) for index, entity_key in enumerate(merged)))
+            # Processes reload the entities, as this version is not a change
+            pipe.hmset(key, {'loaded': '1', 'version': current + 1, 'renew_at': expires - self.duration / 2.0, 'retry_at': 0})
+
+        self.redis.transaction(write, key)
+
+    def _record_change(self, resource_id, keys, notified, current):
+        # Stores the notified entities, recording the change so the copies of
+        # every process can apply it. current is None if the entities could
+        # not be queried again, notified attributes are merged then
+        key = self._key(resource_id)
+        entities_key = self._key(resource_id, 'entities')
+        order_key = self._key(resource_id, 'order')
+        changes_key = self._key(resource_id, 'changes')
+
+        def write(pipe):
+            version = int(pipe.hget(key, 'version') or 0) + 1
+            existing = dict((entity_key, pipe.hget(entities_key, encode_key(entity_key))) for entity_key in keys)
+            if current is None:
+                entities = OrderedDict()
+                for entity in notified:
+                    entity_key = get_entity_key(entity)
+                    merged = entities.get(entity_key) or json.loads(existing[entity_key] or '{}')
+                    merged.update(entity)
+                    entities[entity_key] = merged
+            else:
+                entities = OrderedDict((entity_key, current[entity_key]) for entity_key in keys if entity_key in current)
+
+            removed = [encode_key(entity_key) for entity_key in keys if entity_key not in entities]
+            added = [encode_key(entity_key) for entity_key in entities if existing[entity_key] is None]
+
+            pipe.multi()
+            if removed:
+                pipe.hdel(entities_key, *removed)
+                pipe.zrem(order_key, *removed)
+            if entities:
+                pipe.hmset(entities_key, dict((encode_key(entity_key), json.dumps(entity)) for entity_key, entity in entities.items()))
+            if added:
+                # New entities are appended in the order they are notified
+                now = time.time()
+                pipe.zadd(order_key, **dict((field, now + index * 1e-6) for index, field in enumerate(added)))
+            pipe.hset(key, 'version', version)
+            pipe.rpush(changes_key, json.dumps({'version': version, 'keys': keys, 'entities': list(entities.values())}))
+            pipe.ltrim(changes_key, -MAX_CHANGES, -1)
+
+        self.redis.transaction(write, key, entities_key)
+
+    def _delete_subscription(self, view, subscription_id):
+        try:
+            r = self._request(view, 'DELETE', '{0}/{1}'.format(self._get_subscriptions_url(view), subscription_id))
+            if r.status_code != 404:
+                r.raise_for_status()
+        except Exception as e:
+            log.info('Could not remove the subscription {0} of resource {1}: {2}'.format(subscription_id, view.resource_id, e))
+
+    def _delete_view(self, resource_id):
+        self.redis.delete(*[self._key(resource_id, name) for name in (None, 'entities', 'order', 'changes')])
+
+    def notify(self, resource_id, token, payload):
+        """Applies a notification. Returns False if it doesn't belong to the
+        current subscription of the resource.
+
+        Raises ValueError if the token is not valid.
+        """
+        if not hmac.compare_digest(to_bytes(token or ''), to_bytes(self.get_token(resource_id))):
+            raise ValueError('Invalid token')
+
+        try:
+            state = self._get_state(resource_id)
+        except RedisError as e:
+            log.warning('Could not apply a notification of resource {0}: {1}'.format(resource_id, e))
+            return False
+
+        if state['subscription'] is None or payload.get('subscriptionId') != state['subscription']:
+            return False
+
+        notified = [entity for entity in payload.get('data', []) if isinstance(entity, dict) and 'id' in entity]
+        keys = list(OrderedDict.fromkeys(get_entity_key(entity) for entity in notified))
+
+        # The notified entities are queried again, as the Context Broker
+        # doesn't notify the entities that are removed
+        view = MaterializedView(resource_id, state['url'], state['headers'], state['verify'])
+        try:
+            current = self._load(view, sorted(set(key[0] for key in keys)))
+        except Exception as e:
+            log.info('Could not refresh the notified entities of resource {0}: {1}'.format(resource_id, e))
+            current = None
+
+        try:
+            self._record_change(resource_id, keys, notified, current)
+        except RedisError as e:
+            log.warning('Could not apply a notification of resource {0}: {1}'.format(resource_id, e))
+            return False
+
+        with self._lock:
+            self._notifications += 1
+
+        return True
+
+    def update(self, resource_id, resource):
+        # Renews the view of an updated resource, or removes it if the
+        # resource is no longer materialized
+        if self.redis is None:
+            return
+
+        try:
+            state = self._get_state(resource_id)
+        except RedisError as e:
+            log.warning('Could not update the materialized view of resource {0}: {1}'.format(resource_id, e))
+            return
+
+        if state['url'] is None:
+            return
+
+        parsed_url = urlparse.urlsplit(resource.get('url', ''))
+        headers = {}
+        if resource.get('tenant', '') != '':
+            headers['FIWARE-Service'] = resource['tenant']
+        if resource.get('service_path', '') != '':
+            headers['FIWARE-ServicePath'] = resource['service_path']
+
+        if self.is_enabled(resource, parsed_url) and state['url'] == resource['url'] and state['headers'] == headers:
+            self._start_activation(MaterializedView(resource_id, state['url'], headers, state['verify']))
+        else:
+            self.remove(resource_id)
+
+    def remove(self, resource_id):
+        with self._lock:
+            self._views.pop(resource_id, None)
+
+        if self.redis is None:
+            return
+
+        try:
+            state = self._get_state(resource_id)
+            self._delete_view(resource_id)
+        except RedisError as e:
+            log.warning('Could not remove the materialized view of resource {0}: {1}'.format(resource_id, e))
+            return
+
+        if state['subscription'] is not None:
+            view = MaterializedView(resource_id, state['url'], state['headers'], state['verify'])
+            self._start(self._delete_subscription, view, state['subscription'])
+
+    def clear(self):
+        # Only the copies of this process are removed
+        with self._lock:
+            self._views.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'views': len(self._views),
+                'ready': sum(1 for view in self._views.values() if view.ready),
+                'hits': self._hits,
+                'notifications': self._notifications,
+                'activations': self._activations,
+                'failures': self._failures,
+            }
+
+
+materialized_store = MaterializedStore()
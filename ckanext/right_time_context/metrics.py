@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from bisect import bisect_left
+import hmac
+import threading
+import time
+
+import six
+
+from .utils import get_bool_setting, get_setting
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, six.text_type) else value
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    elif value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else six.text_type(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    labels = ('{0}="{1}"'.format(name, six.text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values))
+    return '{' + ','.join(labels) + '}'
+
+
+def format_metric(name, metric_type, description, samples, label_names=()):
+    # samples is a list of (label values, value) tuples
+    lines = ['# HELP {0} {1}'.format(name, description), '# TYPE {0} {1}'.format(name, metric_type)]
+    for labels, value in samples:
+        lines.append('{0}{1} {2}'.format(name, format_labels(label_names, labels), format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Counter(object):
+    """Monotonic counter, optionally split by label values.
+
+    Each update takes a single uncontended lock, keeping instrumentation
+    cheap compared to the proxied requests.
+    """
+
+    metric_type = 'counter'
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        return format_metric(self.name, self.metric_type, self.description, self.samples(), self.label_names)
+
+
+class Gauge(Counter):
+
+    metric_type = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(object):
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self):
+        with self._lock:
+            counts = list(self._counts)
+            total_sum = self._sum
+
+        lines = ['# HELP {0} {1}'.format(self.name, self.description), '# TYPE {0} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, format_value(bound), cumulative))
+        lines.append('{0}_sum {1}'.format(self.name, format_value(total_sum)))
+        lines.append('{0}_count {1}'.format(self.name, cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+
+class RequestMetrics(object):
+    """Timings of a single proxied request."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.time()
+        self.format = 'unknown'
+        self.host = ''
+        self._upstream_started = None
+        self._finished = False
+
+    def set_resource(self, resource_format, host):
+        self.format = resource_format
+        self.host = host
+        self.metrics.lookup_seconds.observe(time.time() - self.started)
+
+    def upstream_started(self):
+        self._upstream_started = time.time()
+
+    def upstream_finished(self):
+        # Requests are made in streaming mode, so this is the time to first
+        # byte of the response
+        if self._upstream_started is not None:
+            self.metrics.upstream_seconds.observe(time.time() - self._upstream_started)
+
+    def finish(self, status, size=0):
+        if self._finished:
+            return
+
+        self._finished = True
+        self.metrics.in_flight.dec()
+        self.metrics.requests.inc(labels=(self.format, self.host, six.text_type(status)))
+        if size:
+            self.metrics.response_bytes.inc(size, labels=(self.format,))
+
+    def track(self, body, status):
+        # Wraps a streamed body for measuring the time spent sending it
+        return TrackedBody(self, body, status)
+
+
+class TrackedBody(object):
+    # Finishes the request when the server closes the response, even if the
+    # body was not fully iterated (e.g. the client disconnected)
+
+    def __init__(self, request_metrics, body, status):
+        self.request_metrics = request_metrics
+        self.body = body
+        self.status = status
+        self.size = 0
+        self._started = None
+        self._closed = False
+
+    def __iter__(self):
+        self._started = time.time()
+        try:
+            for chunk in self.body:
+                self.size += len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            if self._started is not None:
+                self.request_metrics.metrics.streaming_seconds.observe(time.time() - self._started)
+            self.request_metrics.finish(self.status, self.size)
+
+
+class ProxyMetrics(object):
+
+    def __init__(self, enabled=True, token=None):
+        self.enabled = enabled
+        self.token = token
+
+        self.requests = Counter('ngsi_proxy_requests_total', 'Proxied requests by resource format, Context Broker host and status code.', ('format', 'host', 'status'))
+        self.in_flight = Gauge('ngsi_proxy_in_flight_requests', 'Proxied requests currently being processed.')
+        self.response_bytes = Counter('ngsi_proxy_response_bytes_total', 'Bytes sent to the clients by resource format.', ('format',))
+        self.lookup_seconds = Histogram('ngsi_proxy_lookup_seconds', 'Time spent resolving the proxied resource.')
+        self.upstream_seconds = Histogram('ngsi_proxy_upstream_ttfb_seconds', 'Time until the Context Broker starts sending the response.')
+        self.streaming_seconds = Histogram('ngsi_proxy_streaming_seconds', 'Time spent streaming the response body to the client.')
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'metrics', True)
+        self.token = get_setting(config, 'metrics_token')
+
+    def is_authorized(self, authorization):
+        # Checks the Authorization header sent by a scraper
+        expected = 'Bearer ' + self.token
+        return hmac.compare_digest(to_bytes(authorization or ''), to_bytes(expected))
+
+    def start(self):
+        self.in_flight.inc()
+        return RequestMetrics(self)
+
+    def render(self):
+        collectors = (self.requests, self.in_flight, self.response_bytes, self.lookup_seconds, self.upstream_seconds, self.streaming_seconds)
+        return ''.join(collector.render() for collector in collectors)
+
+
+def render_stats(stats):
+    # Exposes the statistics of the proxy components
+    pool = stats['pool']
+    cache = stats['cache']
+    coalescing = stats['coalescing']
+    plans = stats['plans']
+    prewarm = stats['prewarm']
+    circuits = stats['circuits']['hosts']
+
+    return ''.join((
+        format_metric('ngsi_proxy_pool_requests_total', 'counter', 'Upstream session lookups by result.', [(('hit',), pool['hits']), (('miss',), pool['misses'])], ('result',)),
+        format_metric('ngsi_proxy_pool_sessions', 'gauge', 'Upstream sessions kept open.', [((), pool['size'])]),
+        format_metric('ngsi_proxy_cache_requests_total', 'counter', 'Response cache lookups by result.', [(('hit',), cache['hits']), (('stale',), cache['stale_hits']), (('miss',), cache['misses'])], ('result',)),
+        format_metric('ngsi_proxy_cache_entries', 'gauge', 'Responses kept in the cache.', [((), cache['entries'])]),
+        format_metric('ngsi_proxy_cache_size_bytes', 'gauge', 'Bytes used by the response cache.', [((), cache['size'])]),
+        format_metric('ngsi_proxy_coalesced_requests_total', 'counter', 'Upstream requests by coalescing role.', [(('leader',), coalescing['leaders']), (('follower',), coalescing['followers'])], ('role',)),
+        format_metric('ngsi_proxy_plan_requests_total', 'counter', 'Proxy plan lookups by result.', [(('hit',), plans['hits']), (('miss',), plans['misses'])], ('result',)),
+        format_metric('ngsi_proxy_prewarm_refreshes_total', 'counter', 'Background refreshes of cached responses by result.', [(('success',), prewarm['refreshes']), (('failure',), prewarm['failures'])], ('result',)),
+        format_metric('ngsi_proxy_circuit_open', 'gauge', 'Whether requests to a Context Broker are being rejected.', [((host,), circuit['state'] != 'closed') for host, circuit in sorted(circuits.items())], ('host',)),
+    ))
+
+
+proxy_metrics = ProxyMetrics()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from logging import getLogger
+import urllib
+import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+import six
+
+from .circuit import circuit_breaker
+from .concurrency import ordered_map
+from .streaming import TruncatedResponseError
+from .utils import get_bool_setting, get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_ENTITIES = 20000
+
+# Headers describing only the first page of the response
+PAGE_HEADERS = ('content-length', 'etag', 'last-modified')
+
+
+def parse_query(query):
+    # Unlike parse_qsl, semicolons are not used as separators, as they are
+    # part of some NGSI parameters (e.g. georel=near;maxDistance:1000)
+    params = []
+    for field in query.split('&'):
+        if field == '':
+            continue
+
+        name, sep, value = field.partition('=')
+        params.append((urllib.unquote_plus(name), urllib.unquote_plus(value)))
+
+    return params
+
+
+def get_query_params(url):
+    return parse_query(urlparse.urlsplit(url).query)
+
+
+def update_query(url, params):
+    # Replaces (or adds) the given query parameters keeping the rest of them
+    parsed_url = urlparse.urlsplit(url)
+    query = [(name, value) for name, value in parse_query(parsed_url.query) if name not in params]
+    query.extend((name, params[name]) for name in sorted(params) if params[name] is not None)
+
+    return urlparse.urlunsplit(parsed_url._replace(query=urllib.urlencode(query)))
+
+
+def add_options(url, *options):
+    current = []
+    for name, value in get_query_params(url):
+        if name == 'options':
+            current.extend(option for option in value.split(',') if option != '')
+
+    current.extend(option for option in options if option not in current)
+    return update_query(url, {'options': ','.join(current)})
+
+
+def is_entities_query(parsed_url):
+    return parsed_url.path.lower().rstrip('/').endswith('/v2/entities')
+
+
+def strip_array(body):
+    # Returns the elements of a serialized JSON array without the brackets
+    body = body.strip()
+    if not body.startswith(b'[') or not body.endswith(b']'):
+        raise ValueError('The Context Broker returned an unexpected response')
+
+    return body[1:-1].strip()
+
+
+class PaginatedResponse(object):
+    """Merges all the pages of a NGSIv2 entity query into a single response.
+
+    Provides the subset of the ``requests.Response`` API used by the proxy.
+    Pages are fetched ``concurrency`` at a time and streamed in order as a
+    single JSON array, so only a bounded number of pages is kept in memory.
+    """
+
+    status_code = 200
+
+    def __init__(self, response, page_urls, fetch_page, concurrency=DEFAULT_CONCURRENCY):
+        self.headers = CaseInsensitiveDict((name, value) for name, value in response.headers.items() if name.lower() not in PAGE_HEADERS)
+        self.encoding = response.encoding
+        self.url = response.url
+        self.page_urls = page_urls
+        self._response = response
+        self._fetch_page = fetch_page
+        self._concurrency = concurrency
+
+    def _guard(self, bodies):
+        # Pages are fetched while the response is being streamed, so failed
+        # requests can only truncate it. They are recorded as failures of
+        # the Context Broker, as the first page was
+        try:
+            for body in bodies:
+                yield body
+        except requests.RequestException as e:
+            log.warning('Aborting ngsi response from {0}, could not retrieve all the pages: {1}'.format(self.url, e))
+            circuit_breaker.record(urlparse.urlsplit(self.url or '').netloc, False)
+            raise TruncatedResponseError('Could not retrieve the full response of the Context Broker.')
+
+    def _iter_pages(self):
+        yield self._response.content
+        for body in self._guard(ordered_map(self._fetch_page, self.page_urls, self._concurrency)):
+            yield body
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        yield b'['
+        empty = True
+        for body in self._iter_pages():
+            entities = strip_array(body)
+            if entities == b'':
+                continue
+
+            yield entities if empty else b',' + entities
+            empty = False
+
+        yield b']'
+
+    def json(self, **kwargs):
+        return self._response.json(**kwargs)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        self._response.close()
+
+
+class Paginator(object):
+
+    def __init__(self, enabled=False, page_size=DEFAULT_PAGE_SIZE, concurrency=DEFAULT_CONCURRENCY, max_entities=DEFAULT_MAX_ENTITIES):
+        self.enabled = enabled
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.max_entities = max_entities
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'follow_pagination', False)
+        self.page_size = get_int_setting(config, 'pagination_page_size', DEFAULT_PAGE_SIZE)
+        self.concurrency = get_int_setting(config, 'pagination_concurrency', DEFAULT_CONCURRENCY)
+        self.max_entities = get_int_setting(config, 'pagination_max_entities', DEFAULT_MAX_ENTITIES)
+
+    def is_enabled(self, resource, parsed_url):
+        value = resource.get('follow_pagination', '')
+        if isinstance(value, six.string_types):
+            value = value.strip().lower()
+
+        if value in (None, ''):
+            enabled = self.enabled
+        else:
+            enabled = value in (True, 'true', 'on', '1', 'yes')
+
+        return enabled and is_entities_query(parsed_url)
+
+    def _get_range(self, url):
+        # Returns the offset of the first entity and the maximum number of
+        # entities to retrieve
+        params = dict(get_query_params(url))
+        try:
+            offset = max(int(params.get('offset', 0)), 0)
+        except ValueError:
+            offset = 0
+
+        max_entities = self.max_entities
+        try:
+            limit = int(params['limit'])
+            max_entities = min(limit, max_entities) if max_entities > 0 else limit
+        except (KeyError, ValueError):
+            pass
+
+        return offset, max_entities
+
+    def get_max_entities(self, url):
+        # Maximum number of entities returned for a query, 0 for no limit
+        return self._get_range(url)[1]
+
+    def first_page_url(self, url):
+        offset, max_entities = self._get_range(url)
+        limit = min(self.page_size, max_entities) if max_entities > 0 else self.page_size
+        return add_options(update_query(url, {'offset': six.text_type(offset), 'limit': six.text_type(limit)}), 'count')
+
+    def page_urls(self, url, total_count):
+        offset, max_entities = self._get_range(url)
+        end = total_count if max_entities <= 0 else min(total_count, offset + max_entities)
+
+        # Count is only needed on the first page
+        urls = []
+        for page_offset in six.moves.range(offset + self.page_size, end, self.page_size):
+            limit = min(self.page_size, end - page_offset)
+            urls.append(update_query(url, {'offset': six.text_type(page_offset), 'limit': six.text_type(limit)}))
+
+        return urls
+
+    def paginate(self, response, url, fetch_page):
+        try:
+            total_count = int(response.headers.get('Fiware-Total-Count'))
+        except (TypeError, ValueError):
+            log.info('The Context Broker did not return the total count of entities, returning only the first page')
+            return response
+
+        page_urls = self.page_urls(url, total_count)
+        if len(page_urls) == 0:
+            return response
+
+        return PaginatedResponse(response, page_urls, fetch_page, max(self.concurrency, 1))
+
+
+paginator = Paginator()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import OrderedDict
+import threading
+import time
+
+from .utils import get_int_setting
+
+DEFAULT_MAX_PLANS = 1000
+DEFAULT_TTL = 60
+
+
+class ProxyPlan(object):
+    """Everything needed for proxying a resource that doesn't depend on the
+    current request: the resource data, the parsed target url, the verify
+    setting, the static headers and the pre-built request body.
+    """
+
+    def __init__(self, resource, parsed_url, verify, headers, body, method, url, identity_body):
+        self.resource = resource
+        self.parsed_url = parsed_url
+        self.verify = verify
+        self.headers = headers
+        self.body = body
+        # Method, url and body identifying the upstream request
+        self.method = method
+        self.url = url
+        self.identity_body = identity_body
+        # Plans used by the view iframe and by exports, built on demand
+        self.preview = None
+        self.export = None
+        self.created = time.time()
+
+
+class PlanCache(object):
+    """LRU cache of proxy plans indexed by resource id.
+
+    Plans are invalidated by the plugin when resources are updated. As other
+    CKAN workers are not notified, plans also expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, max_plans=DEFAULT_MAX_PLANS, ttl=DEFAULT_TTL):
+        self.max_plans = max_plans
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def configure(self, config):
+        self.max_plans = get_int_setting(config, 'plan_cache_size', DEFAULT_MAX_PLANS)
+        self.ttl = get_int_setting(config, 'plan_cache_ttl', DEFAULT_TTL)
+        self.clear()
+
+    def get(self, resource_id):
+        with self._lock:
+            plan = self._plans.pop(resource_id, None)
+            if plan is None or time.time() - plan.created >= self.ttl:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            self._plans[resource_id] = plan
+            return plan
+
+    def set(self, resource_id, plan):
+        if self.max_plans <= 0 or self.ttl <= 0:
+            return
+
+        with self._lock:
+            self._plans.pop(resource_id, None)
+            self._plans[resource_id] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+
+    def invalidate(self, resource_id):
+        with self._lock:
+            self._plans.pop(resource_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': float(self._hits) / total if total else 0.0,
+                'size': len(self._plans),
+                'max_size': self.max_plans,
+                'ttl': self.ttl,
+            }
+
+
+proxy_plans = PlanCache()
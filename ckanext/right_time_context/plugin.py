@@ -21,10 +21,34 @@
 # along with CKAN NGSI View extension. If not, see http://www.gnu.org/licenses/.
 
 import logging
+import urlparse
 
 from ckan.common import _, json
 import ckan.plugins as p
 import ckan.lib.helpers as h
+import six
+
+from .batch import batch_proxy
+from .cache import response_cache
+from .chart import chart_builder
+from .circuit import circuit_breaker
+from .compression import response_compressor
+from .delta import delta_tracker
+from .entities import entity_store
+from .export import resource_exporter
+from .federation import federated_query
+from .live import live_updates
+from .materialized import materialized_store
+from .metrics import proxy_metrics
+from .pagination import paginator
+from .plans import proxy_plans
+from .pool import session_pool
+from .prewarm import prewarm_scheduler
+from .preview import preview_rewriter
+from .sharding import registry_sharder
+from .singleflight import request_coalescer
+from .streaming import response_streamer
+from .tokens import token_refresher
 
 log = logging.getLogger(__name__)
 
@@ -38,6 +62,53 @@ def check_query(resource):
     return parsedurl.find('/v2/entities') != -1 or parsedurl.find('/v1/querycontext') != -1 or parsedurl.find('/v1/contextentities/') != -1
 
 
+def build_registration_query(resource):
+    # Builds the body of the /v2/op/query request used for retrieving the
+    # registrations of a resource. Raises ValueError on invalid expressions
+    attrs = []
+
+    if 'attrs_str' in resource and len(resource['attrs_str']):
+        attrs = resource['attrs_str'].split(',')
+    body = {
+        'entities': [],
+        'attrs': attrs
+    }
+
+    # Include entity information
+    for entity in resource['entity']:
+        if 'delete' in entity and entity['delete'] == 'on':
+            continue
+
+        query_entity = {
+            'type': entity['value']
+        }
+        if 'isPattern' in entity and entity['isPattern'] == 'on':
+            query_entity['idPattern'] = entity['id']
+        else:
+            query_entity['id'] = entity['id']
+
+        body['entities'].append(query_entity)
+
+    # Parse expression to include georel information
+    if 'expression' in resource and len(resource['expression']):
+        # Separate expresion query strings
+        supported_expressions = ['georel', 'geometry', 'coords']
+        parsed_expression = resource['expression'].split('&')
+
+        expression = {}
+        for exp in parsed_expression:
+            parsed_exp = exp.split('=')
+
+            if len(parsed_exp) != 2 or not parsed_exp[0] in supported_expressions:
+                raise ValueError('The expression is not a valid one for NGSI Registration, only georel, geometry, and coords is supported')
+            else:
+                expression[parsed_exp[0]] = parsed_exp[1]
+
+        body['expression'] = expression
+
+    return body
+
+
 class NgsiView(p.SingletonPlugin):
 
     p.implements(p.IRoutes, inherit=True)
@@ -53,6 +124,46 @@ class NgsiView(p.SingletonPlugin):
             controller='ckanext.right_time_context.controller:ProxyNGSIController',
             action='proxy_ngsi_resource'
         )
+        m.connect(
+            '/dataset/{id}/resource/{resource_id}/ngsiexport.{export_format}',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='export_ngsi_resource'
+        )
+        m.connect(
+            '/dataset/{id}/resource/{resource_id}/ngsichart',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='chart_ngsi_resource'
+        )
+        m.connect(
+            '/dataset/{id}/resource/{resource_id}/ngsilive',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='live_ngsi_resource'
+        )
+        m.connect(
+            '/dataset/{id}/ngsiproxy',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='proxy_ngsi_package'
+        )
+        m.connect(
+            '/right_time_context/batch',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='proxy_ngsi_batch'
+        )
+        m.connect(
+            '/right_time_context/notify/{resource_id}',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='notify_ngsi_resource'
+        )
+        m.connect(
+            '/right_time_context/metrics',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='metrics'
+        )
+        m.connect(
+            '/right_time_context/stats',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            action='proxy_stats'
+        )
         return m
 
     def get_helpers(self):
@@ -74,19 +185,60 @@ class NgsiView(p.SingletonPlugin):
             "right_time_context_get_available_auth_methods": get_available_auth_methods,
         }
 
-    def get_proxified_ngsi_url(self, data_dict):
+    def get_proxified_ngsi_url(self, data_dict, preview=False):
+        params = {'preview': 'true'} if preview else {}
         url = h.url_for(
             action='proxy_ngsi_resource',
             controller='ckanext.right_time_context.controller:ProxyNGSIController',
             id=data_dict['package']['name'],
-            resource_id=data_dict['resource']['id']
+            resource_id=data_dict['resource']['id'],
+            **params
         )
         log.info('Proxified url is {0}'.format(url))
         return url
 
+    def get_chart_url(self, data_dict):
+        return h.url_for(
+            action='chart_ngsi_resource',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            id=data_dict['package']['name'],
+            resource_id=data_dict['resource']['id']
+        )
+
+    def get_live_url(self, data_dict, preview=False):
+        params = {'preview': 'true'} if preview else {}
+        return h.url_for(
+            action='live_ngsi_resource',
+            controller='ckanext.right_time_context.controller:ProxyNGSIController',
+            id=data_dict['package']['name'],
+            resource_id=data_dict['resource']['id'],
+            **params
+        )
+
     def configure(self, config):
         self.proxy_is_enabled = p.plugin_loaded('resource_proxy')
         self.oauth2_is_enabled = p.plugin_loaded('oauth2')
+        session_pool.configure(config)
+        response_cache.configure(config)
+        request_coalescer.configure(config)
+        response_streamer.configure(config)
+        response_compressor.configure(config)
+        paginator.configure(config)
+        proxy_plans.configure(config)
+        batch_proxy.configure(config)
+        federated_query.configure(config)
+        registry_sharder.configure(config)
+        circuit_breaker.configure(config)
+        proxy_metrics.configure(config)
+        preview_rewriter.configure(config)
+        resource_exporter.configure(config)
+        chart_builder.configure(config)
+        prewarm_scheduler.configure(config)
+        materialized_store.configure(config)
+        live_updates.configure(config)
+        delta_tracker.configure(config)
+        entity_store.configure(config)
+        token_refresher.configure(config)
 
     def update_config(self, config):
         p.toolkit.add_template_directory(config, 'templates')
@@ -121,6 +273,8 @@ class NgsiView(p.SingletonPlugin):
         resource.setdefault('auth_type', 'none')
 
         url = resource['url']
+        chart_url = ''
+        live_url = ''
         if not self.proxy_is_enabled:
             details = "</br></br>Enable resource_proxy</br></br></br>"
             f_details = "Enable resource_proxy."
@@ -142,8 +296,18 @@ class NgsiView(p.SingletonPlugin):
             h.flash_error(f_details, allow_html=False)
             view_enable = [False, details]
         else:
-            # All checks passed
-            url = self.get_proxified_ngsi_url(data_dict)
+            # All checks passed, the view only renders a preview of NGSIv2
+            # queries
+            preview = format_lower == NGSI_FORMAT and preview_rewriter.is_enabled(urlparse.urlsplit(url))
+            url = self.get_proxified_ngsi_url(data_dict, preview=preview)
+
+            # The chart is only displayed for resources configuring the
+            # attributes to plot
+            if resource.get('chart_attrs', '').strip() != '':
+                chart_url = self.get_chart_url(data_dict)
+
+            if live_updates.enabled:
+                live_url = self.get_live_url(data_dict, preview=preview)
 
             data_dict['resource']['url'] = url
             view_enable = [True, 'OK']
@@ -151,25 +315,43 @@ class NgsiView(p.SingletonPlugin):
         return {
             'resource_json': json.dumps(data_dict['resource']),
             'resource_url': json.dumps(url),
-            'view_enable': json.dumps(view_enable)
+            'view_enable': json.dumps(view_enable),
+            'chart_url': chart_url,
+            'live_url': live_url,
         }
 
     def view_template(self, context, data_dict):
         return 'ngsi.html'
 
-    def _iterate_serialized(self, resource, handler):
-        pending_entities = True
-        index = 0
-        while pending_entities:
-            prefix = 'entity__' + str(index) + '__'
+    def _validate_non_negative(self, resource, field, message):
+        value = resource.get(field, '')
+        if value is None or six.text_type(value).strip() == '':
+            return
 
-            if prefix + 'id' in resource:
-                handler(prefix)
-                index = index + 1
-            else:
-                pending_entities = False
+        try:
+            if int(value) < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise p.toolkit.ValidationError({field: [message]})
+
+    def _validate_payload(self, resource):
+        payload = resource.get('payload', '')
+        if payload is None or payload.strip() == '':
+            return
+
+        try:
+            json.loads(payload)
+        except ValueError:
+            raise p.toolkit.ValidationError({'payload': ["Payload field doesn't contain valid JSON data"]})
 
     def _serialize_resource(self, resource):
+        if resource.get('format', '').lower() in (NGSI_FORMAT, NGSI_REG_FORMAT):
+            self._validate_non_negative(resource, 'cache_ttl', 'Cache TTL must be a non-negative number of seconds')
+            self._validate_non_negative(resource, 'preview_limit', 'Preview limit must be a non-negative number of entities')
+
+        if resource.get('format', '').lower() == NGSI_FORMAT and resource.get('url', '').lower().find('/v1/querycontext') != -1:
+            self._validate_payload(resource)
+
         # Check if NGSI resource is being created
         serialized_resource = resource
         if resource['format'] == NGSI_REG_FORMAT:
@@ -178,34 +360,30 @@ class NgsiView(p.SingletonPlugin):
                 # Raise an error, al least one entity must be provided
                 raise p.toolkit.ValidationError({'NGSI Data': ['At least one NGSI entity must be provided']})
 
-            # Remove all serialized entries from the resource
-            def remove_serialized(prefix):
-                del resource[prefix + 'id']
-                del resource[prefix + 'value']
-
-                if prefix + 'isPattern' in resource:
-                    del resource[prefix + 'isPattern']
+            # Store the ready to send registry query
+            try:
+                resource['registry_query'] = json.dumps(build_registration_query(resource), sort_keys=True)
+            except ValueError as e:
+                raise p.toolkit.ValidationError({'expression': [six.text_type(e)]})
 
-            self._iterate_serialized(resource, remove_serialized)
-
-            index = 0
             # Serialize entity information to support custom field saving
-            entities = {}
+            entities = []
             for entity in resource['entity']:
                 if 'delete' in entity and entity['delete'] == 'on':
                     continue
 
-                prefix = 'entity__' + str(index) + '__'
-                entities[prefix + 'id'] = entity['id']
-                entities[prefix + 'value'] = entity['value']
+                stored_entity = {
+                    'id': entity['id'],
+                    'value': entity['value'],
+                }
 
                 # Check if there is an isPattern field
                 if 'isPattern' in entity and entity['isPattern'] == 'on':
-                    entities[prefix + 'isPattern'] = entity['isPattern']
-                index = index + 1
+                    stored_entity['isPattern'] = entity['isPattern']
+                entities.append(stored_entity)
 
             del serialized_resource['entity']
-            serialized_resource.update(entities)
+            entity_store.serialize(serialized_resource, entities)
 
         return serialized_resource
 
@@ -214,31 +392,25 @@ class NgsiView(p.SingletonPlugin):
 
     def after_create(self, context, resource):
         # Create entry in the NGSI registry
-        pass
+        proxy_plans.invalidate(resource['id'])
+        prewarm_scheduler.forget(resource['id'])
 
     def before_update(self, context, current, resource):
         return self._serialize_resource(resource)
 
     def after_update(self, context, resource):
-        pass
-
-    def before_show(self, resource):
-        # Deserialize resource information
-        entities = []
-
-        def deserilize_handler(prefix):
-            entity = {
-                'id': resource[prefix + 'id'],
-                'value': resource[prefix + 'value'],
-            }
+        proxy_plans.invalidate(resource['id'])
+        prewarm_scheduler.forget(resource['id'])
+        materialized_store.update(resource['id'], resource)
 
-            if prefix + 'isPattern' in resource:
-                entity['isPattern'] = resource[prefix + 'isPattern']
+    def before_delete(self, context, resource, resources):
+        proxy_plans.invalidate(resource['id'])
+        prewarm_scheduler.forget(resource['id'])
+        materialized_store.remove(resource['id'])
 
-            entities.append(entity)
-
-        self._iterate_serialized(resource, deserilize_handler)
-
-        resource['entity'] = entities
+    def before_show(self, resource):
+        # Deserialize resource information. Compact entities are only decoded
+        # when accessed
+        resource['entity'] = entity_store.deserialize(resource)
 
         return resource
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from collections import OrderedDict
+from logging import getLogger
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+import six
+
+from .utils import get_float_setting, get_int_setting, get_setting, parse_host_sizes
+
+log = getLogger(__name__)
+
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_MAX_SESSIONS = 100
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter applying a default timeout to every request."""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+class PoolEntry(object):
+
+    def __init__(self, session, maxsize):
+        self.session = session
+        self.maxsize = maxsize
+        self.created = time.time()
+        self.last_used = self.created
+        self.requests = 0
+
+
+class SessionPool(object):
+    """Keep-alive ``requests.Session`` objects shared by the proxy.
+
+    Sessions are keyed by broker scheme, host and verify setting so TCP
+    connections and TLS sessions can be reused between proxied requests.
+    Sessions are removed from the pool when they are not requested during
+    ``idle_timeout`` seconds, when there are too many of them or when the
+    pool is reconfigured. Removed sessions may still be streaming a response
+    on other threads, so they are only dropped from the pool and their
+    connections are released once they are no longer referenced.
+    """
+
+    def __init__(self, pool_maxsize=DEFAULT_POOL_MAXSIZE, host_maxsize=None, max_sessions=DEFAULT_MAX_SESSIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool_maxsize = pool_maxsize
+        self.host_maxsize = host_maxsize or {}
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # Upstream timeouts, 0 disables them
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def configure(self, config):
+        self.pool_maxsize = get_int_setting(config, 'pool_maxsize', DEFAULT_POOL_MAXSIZE)
+        self.host_maxsize = parse_host_sizes(get_setting(config, 'pool_host_maxsize'))
+        self.max_sessions = get_int_setting(config, 'pool_max_sessions', DEFAULT_MAX_SESSIONS)
+        self.idle_timeout = get_int_setting(config, 'pool_idle_timeout', DEFAULT_IDLE_TIMEOUT)
+        self.connect_timeout = get_float_setting(config, 'connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        self.read_timeout = get_float_setting(config, 'read_timeout', DEFAULT_READ_TIMEOUT)
+        self.clear()
+
+    def get_timeout(self):
+        return (self.connect_timeout or None, self.read_timeout or None)
+
+    def _get_maxsize(self, parsed_url):
+        netloc = parsed_url.netloc.lower()
+        if netloc in self.host_maxsize:
+            return self.host_maxsize[netloc]
+
+        return self.host_maxsize.get((parsed_url.hostname or "").lower(), self.pool_maxsize)
+
+    def _create_session(self, parsed_url, verify, maxsize):
+        session = requests.Session()
+        session.verify = verify
+
+        adapter = TimeoutHTTPAdapter(timeout=self.get_timeout(), pool_connections=1, pool_maxsize=maxsize)
+        session.mount(parsed_url.scheme + '://', adapter)
+
+        return session
+
+    def _retire(self, key, entry):
+        self._evictions += 1
+        log.debug('Retiring upstream session for {0}://{1}'.format(key[0], key[1]))
+
+    def _evict_idle(self, now):
+        # Entries are kept in least recently used order
+        while len(self._sessions) > 0:
+            key, entry = next(six.iteritems(self._sessions))
+            if now - entry.last_used < self.idle_timeout:
+                break
+
+            del self._sessions[key]
+            self._retire(key, entry)
+
+    def get_session(self, url, verify=True):
+        parsed_url = urlparse.urlsplit(url)
+        key = (parsed_url.scheme, parsed_url.netloc.lower(), verify)
+        now = time.time()
+
+        with self._lock:
+            self._evict_idle(now)
+
+            entry = self._sessions.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                maxsize = self._get_maxsize(parsed_url)
+                entry = PoolEntry(self._create_session(parsed_url, verify, maxsize), maxsize)
+
+                while len(self._sessions) >= self.max_sessions > 0:
+                    old_key, old_entry = self._sessions.popitem(last=False)
+                    self._retire(old_key, old_entry)
+            else:
+                self._hits += 1
+
+            entry.last_used = now
+            entry.requests += 1
+            self._sessions[key] = entry
+
+        return entry.session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            sessions = [
+                {
+                    'scheme': key[0],
+                    'host': key[1],
+                    'verify': key[2],
+                    'maxsize': entry.maxsize,
+                    'requests': entry.requests,
+                    'age': now - entry.created,
+                    'idle': now - entry.last_used,
+                }
+                for key, entry in self._sessions.items()
+            ]
+
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': float(self._hits) / total if total else 0.0,
+                'evictions': self._evictions,
+                'size': len(sessions),
+                'max_sessions': self.max_sessions,
+                'idle_timeout': self.idle_timeout,
+                'connect_timeout': self.connect_timeout,
+                'read_timeout': self.read_timeout,
+                'sessions': sessions,
+            }
+
+
+session_pool = SessionPool()
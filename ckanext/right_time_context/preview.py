@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import six
+
+from .pagination import add_options, get_query_params, is_entities_query, update_query
+from .utils import get_bool_setting, get_int_setting, get_setting
+
+DEFAULT_LIMIT = 20
+
+# Orion representation modes, only one of them can be used
+REPRESENTATION_OPTIONS = ('keyValues', 'values', 'unique')
+
+
+def parse_attrs(value):
+    if not value:
+        return []
+
+    return [attr.strip() for attr in value.split(',') if attr.strip() != '']
+
+
+class PreviewRewriter(object):
+    """Shrinks the NGSIv2 queries made for rendering the ``ngsi_view``.
+
+    Preview requests retrieve at most ``limit`` entities using the
+    ``keyValues`` representation and, optionally, only the attributes of an
+    allow-list. Every setting can be overridden for each resource.
+    """
+
+    def __init__(self, enabled=True, limit=DEFAULT_LIMIT, key_values=True, attrs=None):
+        self.enabled = enabled
+        self.limit = limit
+        self.key_values = key_values
+        self.attrs = attrs or []
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'preview', True)
+        self.limit = get_int_setting(config, 'preview_limit', DEFAULT_LIMIT)
+        self.key_values = get_bool_setting(config, 'preview_key_values', True)
+        self.attrs = parse_attrs(get_setting(config, 'preview_attrs', ''))
+
+    def is_enabled(self, parsed_url):
+        return self.enabled and parsed_url.path.lower().find('/v2/entities') != -1
+
+    def get_limit(self, resource):
+        value = resource.get('preview_limit', '')
+        if isinstance(value, six.string_types):
+            value = value.strip()
+
+        if value in (None, ''):
+            return self.limit
+
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return self.limit
+
+    def get_key_values(self, resource):
+        value = resource.get('preview_key_values', '')
+        if isinstance(value, six.string_types):
+            value = value.strip().lower()
+
+        if value in (None, ''):
+            return self.key_values
+
+        return value in (True, 'true', 'on', '1', 'yes')
+
+    def get_attrs(self, resource):
+        value = resource.get('preview_attrs', '')
+        if value is None or value.strip() == '':
+            return self.attrs
+
+        return parse_attrs(value)
+
+    def rewrite(self, resource, parsed_url):
+        # Returns the url used for previewing the resource
+        url = resource['url']
+        params = dict(get_query_params(url))
+        changes = {}
+
+        limit = self.get_limit(resource)
+        if limit > 0 and is_entities_query(parsed_url):
+            try:
+                current = int(params.get('limit', ''))
+            except ValueError:
+                current = None
+
+            changes['limit'] = str(limit if current is None else min(current, limit))
+
+        allowed = self.get_attrs(resource)
+        if len(allowed) > 0:
+            # Attributes requested by the resource are restricted to the
+            # allow-list, resources requesting none of them are kept as they
+            # are instead of showing unrelated attributes
+            original = parse_attrs(params.get('attrs', ''))
+            requested = [attr for attr in original if attr in allowed]
+            if len(original) == 0 or len(requested) > 0:
+                changes['attrs'] = ','.join(requested or allowed)
+
+        if changes:
+            url = update_query(url, changes)
+
+        options = params.get('options', '').split(',')
+        if self.get_key_values(resource) and not any(option in options for option in REPRESENTATION_OPTIONS):
+            url = add_options(url, 'keyValues')
+
+        return url
+
+
+preview_rewriter = PreviewRewriter()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from logging import getLogger
+import os
+import random
+import threading
+import time
+
+from .cache import response_cache
+from .concurrency import unordered_map
+from .utils import get_float_setting, get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_TOP = 0
+DEFAULT_INTERVAL = 5
+DEFAULT_LEAD = 10
+DEFAULT_CONCURRENCY = 2
+DEFAULT_JITTER = 2
+DEFAULT_HALF_LIFE = 300
+DEFAULT_MAX_TRACKED = 1000
+
+# Tracked requests whose score drops below this value are forgotten
+MIN_SCORE = 0.05
+
+
+class TrackedRequest(object):
+
+    def __init__(self, resource_id, resource, fetch):
+        self.resource_id = resource_id
+        self.resource = resource
+        # Function making the upstream request, receives the cached entry
+        # used for making a conditional request
+        self.fetch = fetch
+        self.hits = 0
+        self.score = 0.0
+
+
+class PrewarmScheduler(object):
+    """Refreshes the cached responses of the most requested resources before
+    they expire, so visitors don't have to wait for the Context Broker.
+
+    Request frequency is tracked for each cached request (resource and view
+    mode) using an exponentially decayed counter with a half-life of
+    ``half_life`` seconds. Every ``interval`` seconds, the entries of the
+    ``top`` most requested ones expiring in less than ``lead`` seconds are
+    refreshed in the background, making up to ``concurrency`` requests at a
+    time, each one delayed by a random amount of up to ``jitter`` seconds.
+
+    Only resources using the ``none`` auth type are refreshed, as their
+    responses don't depend on the user.
+    """
+
+    def __init__(self, top=DEFAULT_TOP, interval=DEFAULT_INTERVAL, lead=DEFAULT_LEAD, concurrency=DEFAULT_CONCURRENCY,
+                 jitter=DEFAULT_JITTER, half_life=DEFAULT_HALF_LIFE, max_tracked=DEFAULT_MAX_TRACKED):
+        self.top = top
+        self.interval = interval
+        self.lead = lead
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+
+        self._lock = threading.Lock()
+        self._tracked = {}
+        self._last_decay = time.time()
+        self._thread = None
+        self._pid = None
+        self._refreshes = 0
+        self._failures = 0
+
+    def configure(self, config):
+        self.top = get_int_setting(config, 'prewarm_top', DEFAULT_TOP)
+        self.interval = get_float_setting(config, 'prewarm_interval', DEFAULT_INTERVAL)
+        self.lead = get_float_setting(config, 'prewarm_lead', DEFAULT_LEAD)
+        self.concurrency = get_int_setting(config, 'prewarm_concurrency', DEFAULT_CONCURRENCY)
+        self.jitter = get_float_setting(config, 'prewarm_jitter', DEFAULT_JITTER)
+        self.half_life = get_float_setting(config, 'prewarm_half_life', DEFAULT_HALF_LIFE)
+        self.max_tracked = get_int_setting(config, 'prewarm_max_tracked', DEFAULT_MAX_TRACKED)
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.top > 0 and self.concurrency > 0 and self.interval > 0
+
+    def record(self, resource_id, key, resource, fetch):
+        if not self.enabled or resource.get('auth_type', 'none') != 'none':
+            return False
+
+        with self._lock:
+            tracked = self._tracked.get(key)
+            if tracked is None:
+                if len(self._tracked) >= self.max_tracked:
+                    # Forget the least requested one
+                    del self._tracked[min(self._tracked, key=lambda k: self._tracked[k].score + self._tracked[k].hits)]
+                tracked = self._tracked[key] = TrackedRequest(resource_id, resource, fetch)
+
+            # Use the latest version of the resource
+            tracked.resource = resource
+            tracked.fetch = fetch
+            tracked.hits += 1
+
+        self._ensure_running()
+        return True
+
+    def forget(self, resource_id):
+        with self._lock:
+            for key in [key for key, tracked in self._tracked.items() if tracked.resource_id == resource_id]:
+                del self._tracked[key]
+
+    def _ensure_running(self):
+        # The thread is started on the first request instead of on
+        # configure, so it runs on every CKAN worker process
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='right_time_context-prewarm')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                log.exception('Unexpected error pre-warming ngsi responses')
+
+    def select(self, now=None):
+        # Returns the (key, tracked request) tuples to refresh, most
+        # requested first
+        now = now or time.time()
+        with self._lock:
+            decay = 0.5 ** ((now - self._last_decay) / self.half_life) if self.half_life > 0 else 0
+            self._last_decay = now
+            for key, tracked in list(self._tracked.items()):
+                tracked.score = tracked.score * decay + tracked.hits
+                tracked.hits = 0
+                if tracked.score < MIN_SCORE:
+                    del self._tracked[key]
+
+            ranking = sorted(self._tracked.items(), key=lambda item: item[1].score, reverse=True)[:self.top]
+
+        return [(key, tracked) for key, tracked in ranking if self._is_due(response_cache.peek(key), now)]
+
+    def _is_due(self, entry, now):
+        # Missing entries are left to the next visitor
+        return entry is not None and entry.fresh_until - now <= self.lead
+
+    def _refresh(self, item):
+        key, tracked = item
+        time.sleep(random.uniform(0, self.jitter))
+
+        # The entry could have been refreshed by a visitor meanwhile
+        entry = response_cache.peek(key)
+        if not self._is_due(entry, time.time()):
+            return None
+
+        try:
+            return response_cache.update(key, tracked.resource, tracked.fetch(entry))
+        except Exception as e:
+            log.info('Unable to pre-warm the ngsi response of {0}: {1}'.format(tracked.resource_id, e))
+            return False
+
+    def run_once(self):
+        for refreshed in unordered_map(self._refresh, self.select(), self.concurrency):
+            if refreshed is None:
+                continue
+
+            with self._lock:
+                if refreshed:
+                    self._refreshes += 1
+                else:
+                    self._failures += 1
+
+    def clear(self):
+        with self._lock:
+            self._tracked.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked': len(self._tracked),
+                'refreshes': self._refreshes,
+                'failures': self._failures,
+                'top': self.top,
+            }
+
+
+prewarm_scheduler = PrewarmScheduler()
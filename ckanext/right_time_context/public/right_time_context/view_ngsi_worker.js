@@ -0,0 +1,478 @@
+/*
+ * Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+ *
+ * This file is part of ckanext-right_time_context.
+ *
+ * Ckanext-right_time_context is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation, either version 3 of the
+ * License, or (at your option) any later version.
+ *
+ * Ckanext-right_time_context is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+ * General Public License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+ */
+
+/*
+ * Web Worker used by the NGSI view. Downloads and parses the proxied
+ * response, keeps the resulting tree and returns the highlighted HTML of the
+ * rows requested by the view, so the page only renders the visible rows.
+ *
+ * Messages received:
+ *   {cmd: 'load', url: url}
+ *   {cmd: 'rows', start: index, count: count}
+ *   {cmd: 'toggle', row: index}
+ *   {cmd: 'patch', entities: [entity, ...], removed: [{id: id, type: type}, ...], complete: boolean}
+ *
+ * Messages sent:
+ *   {type: 'progress', total: rows, complete: boolean}
+ *   {type: 'rows', start: index, html: [row, ...]}
+ *   {type: 'error', status: status, text: text}
+ */
+(function () {
+    "use strict";
+
+    // Entities of top-level arrays are sent to the view in batches
+    var BATCH_INTERVAL = 100;
+
+    var root = null;
+    var rows = [];
+    var complete = false;
+
+    var escapeHTML = function escapeHTML(text) {
+        return text.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;");
+    };
+
+    var createNode = function createNode(key, value, parent, index) {
+        var node = {key: key, parent: parent, index: index, expanded: true, children: null, isArray: false, value: value};
+
+        if (Array.isArray(value)) {
+            node.isArray = true;
+            node.children = value.map(function (item, i) {
+                return createNode(null, item, node, i);
+            });
+            node.value = null;
+        } else if (value !== null && typeof value === "object") {
+            node.children = Object.keys(value).map(function (name, i) {
+                return createNode(name, value[name], node, i);
+            });
+            node.value = null;
+        }
+
+        return node;
+    };
+
+    // Nodes replaced by the last patch, highlighted until the next one
+    var changed = [];
+
+    var flatten = function flatten(node, depth, result) {
+        result.push({node: node, depth: depth, close: false});
+        if (node.children !== null && node.expanded) {
+            node.children.forEach(function (child) {
+                flatten(child, depth + 1, result);
+            });
+            result.push({node: node, depth: depth, close: true});
+        }
+        return result;
+    };
+
+    var renderValue = function renderValue(value) {
+        if (typeof value === "string") {
+            return '<span class="string">' + escapeHTML(JSON.stringify(value)) + '</span>';
+        } else if (typeof value === "number") {
+            return '<span class="number">' + value + '</span>';
+        }
+        return '<span class="literal">' + String(value) + '</span>';
+    };
+
+    var renderRow = function renderRow(row, index) {
+        var node = row.node;
+        var html = '<div class="ngsi-row' + (isChanged(node) ? ' ngsi-changed' : '') + '" style="padding-left:' + (row.depth * 2 + 2) + 'ch">';
+        var isLast = node.parent === null || node.index === node.parent.children.length - 1;
+        var open = node.isArray ? "[" : "{";
+        var close = node.isArray ? "]" : "}";
+
+        if (row.close) {
+            // Elements may still be added to the root array while loading
+            var pending = node === root && !complete ? '<span class="comment">  loading…</span>' : "";
+            return html + pending + close + (isLast ? "" : ",") + "</div>";
+        }
+
+        if (node.children !== null) {
+            html += '<span class="ngsi-toggle" data-row="' + index + '">' + (node.expanded ? "▾" : "▸") + "</span>";
+        }
+        if (node.key !== null) {
+            html += '<span class="attribute">' + escapeHTML(JSON.stringify(node.key)) + "</span>: ";
+        }
+
+        if (node.children === null) {
+            html += renderValue(node.value) + (isLast ? "" : ",");
+        } else if (node.expanded) {
+            html += open;
+        } else {
+            var count = node.children.length;
+            html += open + " … " + close + (isLast ? "" : ",");
+            html += '<span class="comment"> // ' + count + (node.isArray ? " items" : " attributes") + "</span>";
+        }
+
+        return html + "</div>";
+    };
+
+    var isChanged = function isChanged(node) {
+        while (node !== null) {
+            if (changed.indexOf(node) !== -1) {
+                return true;
+            }
+            node = node.parent;
+        }
+        return false;
+    };
+
+    var getEntityKey = function getEntityKey(value) {
+        return JSON.stringify([value.id, value.type === undefined ? null : value.type]);
+    };
+
+    var getNodeKey = function getNodeKey(node) {
+        // Entities are identified using their id and type attributes
+        var value = {};
+        if (node.children === null || node.isArray) {
+            return null;
+        }
+        node.children.forEach(function (child) {
+            if ((child.key === "id" || child.key === "type") && child.children === null) {
+                value[child.key] = child.value;
+            }
+        });
+        return value.id === undefined ? null : getEntityKey(value);
+    };
+
+    var getNodeValue = function getNodeValue(node) {
+        var value;
+        if (node.children === null) {
+            return node.value;
+        }
+        if (node.isArray) {
+            return node.children.map(getNodeValue);
+        }
+        value = {};
+        node.children.forEach(function (child) {
+            value[child.key] = getNodeValue(child);
+        });
+        return value;
+    };
+
+    var patch = function patch(entities, removed, complete) {
+        // Replaces the changed entities of the tree, keeping their expanded
+        // state, appends the new ones and removes the deleted ones. Complete
+        // patches contain every entity, so the missing ones are removed too
+        var nodes = root.isArray ? root.children : [root];
+        var index = {};
+        var removedKeys = {};
+        var currentKeys = {};
+
+        nodes.forEach(function (node, i) {
+            var key = getNodeKey(node);
+            if (key !== null) {
+                index[key] = i;
+            }
+        });
+        removed.forEach(function (entity) {
+            removedKeys[getEntityKey(entity)] = true;
+        });
+
+        changed = [];
+        entities.forEach(function (entity) {
+            var key = getEntityKey(entity);
+            var position = index[key];
+            var node;
+
+            currentKeys[key] = true;
+            if (position !== undefined) {
+                if (complete && JSON.stringify(getNodeValue(nodes[position])) === JSON.stringify(entity)) {
+                    return;
+                }
+                node = createNode(nodes[position].key, entity, nodes[position].parent, position);
+                node.expanded = nodes[position].expanded;
+                if (nodes[position] === root) {
+                    root = node;
+                }
+                nodes[position] = node;
+            } else if (root.isArray) {
+                node = createNode(null, entity, root, nodes.length);
+                index[key] = nodes.length;
+                nodes.push(node);
+            } else {
+                return;
+            }
+            changed.push(node);
+        });
+
+        if (root.isArray) {
+            root.children = nodes.filter(function (node) {
+                var key = getNodeKey(node);
+                return key === null || (removedKeys[key] !== true && (!complete || currentKeys[key] === true));
+            });
+            root.children.forEach(function (node, i) {
+                node.index = i;
+            });
+        }
+
+        rows = flatten(root, 0, []);
+        notify();
+    };
+
+    var notify = function notify() {
+        self.postMessage({type: "progress", total: rows.length, complete: complete});
+    };
+
+    var appendItems = function appendItems(items) {
+        // Appends new elements to the root array, before its closing row
+        var closing = root.expanded ? rows.pop() : null;
+        items.forEach(function (item) {
+            var child = createNode(null, item, root, root.children.length);
+            root.children.push(child);
+            if (root.expanded) {
+                flatten(child, 1, rows);
+            }
+        });
+        if (closing !== null) {
+            rows.push(closing);
+        }
+    };
+
+    /*
+     * Incremental parser extracting the elements of top-level arrays. Other
+     * documents are parsed once fully received.
+     */
+    var ArrayParser = function ArrayParser() {
+        this.buffer = "";
+        this.position = 0;
+        this.depth = 0;
+        this.inString = false;
+        this.escape = false;
+        this.itemStart = -1;
+        this.isArray = null;
+    };
+
+    ArrayParser.prototype.feed = function feed(text) {
+        var items = [];
+        var buffer, i, c;
+
+        this.buffer += text;
+        buffer = this.buffer;
+
+        if (this.isArray === null) {
+            var first = buffer.search(/\S/);
+            if (first === -1) {
+                return items;
+            }
+            this.isArray = buffer.charAt(first) === "[";
+        }
+
+        if (!this.isArray) {
+            this.buffer = "";
+            return items;
+        }
+
+        for (i = this.position; i < buffer.length; i++) {
+            c = buffer.charAt(i);
+            if (this.inString) {
+                if (this.escape) {
+                    this.escape = false;
+                } else if (c === "\\") {
+                    this.escape = true;
+                } else if (c === '"') {
+                    this.inString = false;
+                }
+                continue;
+            }
+
+            if (c === '"') {
+                this.inString = true;
+                if (this.depth === 1 && this.itemStart === -1) {
+                    this.itemStart = i;
+                }
+            } else if (c === "[" || c === "{") {
+                if (this.depth === 1 && this.itemStart === -1) {
+                    this.itemStart = i;
+                }
+                this.depth++;
+            } else if (c === "]" || c === "}") {
+                this.depth--;
+                if (this.depth === 1 && this.itemStart !== -1) {
+                    items.push(JSON.parse(buffer.substring(this.itemStart, i + 1)));
+                    this.itemStart = -1;
+                } else if (this.depth === 0 && this.itemStart !== -1) {
+                    // Last scalar element
+                    items.push(JSON.parse(buffer.substring(this.itemStart, i)));
+                    this.itemStart = -1;
+                }
+            } else if (c === "," && this.depth === 1 && this.itemStart !== -1) {
+                // Scalar elements
+                items.push(JSON.parse(buffer.substring(this.itemStart, i)));
+                this.itemStart = -1;
+            } else if (this.depth === 1 && this.itemStart === -1 && /[^\s,]/.test(c)) {
+                this.itemStart = i;
+            }
+        }
+
+        // Only the element being received is kept
+        var keep = this.itemStart !== -1 ? this.itemStart : buffer.length;
+        this.buffer = buffer.substring(keep);
+        this.itemStart = this.itemStart !== -1 ? 0 : -1;
+        this.position = this.buffer.length;
+
+        return items;
+    };
+
+    var load = function load(url) {
+        var parser = new ArrayParser();
+        var text = "";
+        var pending = [];
+        var lastBatch = 0;
+
+        var flush = function flush(force) {
+            var now = Date.now();
+            if (pending.length === 0 || (!force && root !== null && now - lastBatch < BATCH_INTERVAL)) {
+                return;
+            }
+            lastBatch = now;
+
+            if (root === null) {
+                root = createNode(null, [], null, 0);
+                rows = flatten(root, 0, []);
+            }
+            appendItems(pending);
+            pending = [];
+            notify();
+        };
+
+        var onText = function onText(chunk) {
+            var items = parser.feed(chunk);
+            if (parser.isArray) {
+                Array.prototype.push.apply(pending, items);
+                flush(false);
+            } else {
+                text += chunk;
+            }
+        };
+
+        var onEnd = function onEnd() {
+            complete = true;
+            if (parser.isArray === false) {
+                root = createNode(null, JSON.parse(text), null, 0);
+                rows = flatten(root, 0, []);
+            } else if (root === null) {
+                flush(true);
+                if (root === null) {
+                    root = createNode(null, [], null, 0);
+                    rows = flatten(root, 0, []);
+                }
+            } else {
+                flush(true);
+            }
+            notify();
+        };
+
+        var onError = function onError(status, responseText) {
+            self.postMessage({type: "error", status: status, text: responseText});
+        };
+
+        var handle = function handle(fn) {
+            return function () {
+                try {
+                    fn.apply(this, arguments);
+                } catch (e) {
+                    onError(0, String(e));
+                }
+            };
+        };
+
+        if (typeof fetch === "function" && typeof TextDecoder === "function") {
+            fetch(url, {credentials: "same-origin", headers: {Accept: "application/json"}}).then(function (response) {
+                if (!response.ok || !response.body) {
+                    return response.text().then(function (body) {
+                        if (!response.ok) {
+                            return onError(response.status, body);
+                        }
+                        handle(onText)(body);
+                        handle(onEnd)();
+                    });
+                }
+
+                var reader = response.body.getReader();
+                var decoder = new TextDecoder("utf-8");
+                var read = function read() {
+                    return reader.read().then(function (result) {
+                        if (result.done) {
+                            handle(onText)(decoder.decode());
+                            return handle(onEnd)();
+                        }
+                        handle(onText)(decoder.decode(result.value, {stream: true}));
+                        return read();
+                    });
+                };
+                return read();
+            }).catch(function (e) {
+                onError(0, String(e));
+            });
+        } else {
+            var xhr = new XMLHttpRequest();
+            var offset = 0;
+            var consume = function consume() {
+                var chunk = xhr.responseText.substring(offset);
+                offset = xhr.responseText.length;
+                onText(chunk);
+            };
+
+            xhr.open("GET", url);
+            xhr.setRequestHeader("Accept", "application/json");
+            xhr.onprogress = handle(function () {
+                if (xhr.status === 200) {
+                    consume();
+                }
+            });
+            xhr.onload = handle(function () {
+                if (xhr.status !== 200) {
+                    return onError(xhr.status, xhr.responseText);
+                }
+                consume();
+                onEnd();
+            });
+            xhr.onerror = function () {
+                onError(xhr.status, xhr.responseText);
+            };
+            xhr.send();
+        }
+    };
+
+    self.onmessage = function (event) {
+        var message = event.data;
+
+        if (message.cmd === "load") {
+            load(message.url);
+        } else if (message.cmd === "rows") {
+            var html = [];
+            var end = Math.min(message.start + message.count, rows.length);
+            for (var i = message.start; i < end; i++) {
+                html.push(renderRow(rows[i], i));
+            }
+            self.postMessage({type: "rows", start: message.start, html: html});
+        } else if (message.cmd === "patch") {
+            if (root !== null && complete) {
+                patch(message.entities, message.removed, message.complete === true);
+            }
+        } else if (message.cmd === "toggle") {
+            var row = rows[message.row];
+            if (row !== undefined && row.node.children !== null) {
+                row.node.expanded = !row.node.expanded;
+                rows = flatten(root, 0, []);
+                notify();
+            }
+        }
+    };
+})();
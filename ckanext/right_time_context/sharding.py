@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+
+import six
+
+from .concurrency import unordered_map
+from .pagination import PaginatedResponse, paginator, strip_array
+from .utils import get_int_setting
+
+DEFAULT_SHARD_SIZE = 100
+DEFAULT_CONCURRENCY = 4
+
+
+class ShardedResponse(PaginatedResponse):
+    """Merges the results of several ``/v2/op/query`` shards.
+
+    Shards are retrieved concurrently and their entities are streamed as soon
+    as each shard is completed. Entities returned by several shards are only
+    included once, and at most ``max_entities`` entities are returned.
+    """
+
+    def __init__(self, response, jobs, fetch_shard, concurrency=DEFAULT_CONCURRENCY, max_entities=0):
+        super(ShardedResponse, self).__init__(response, [], None, concurrency)
+        self.jobs = jobs
+        self.max_entities = max_entities
+        self._fetch_shard = fetch_shard
+
+    def _iter_pages(self):
+        for body in self._guard(unordered_map(self._fetch_shard, self.jobs, self._concurrency)):
+            yield body
+
+    def _iter_entities(self):
+        seen = set()
+        for body in self._iter_pages():
+            for entity in json.loads(body):
+                key = (entity.get('id'), entity.get('type'))
+                if key in seen:
+                    continue
+
+                seen.add(key)
+                yield entity
+
+                if self.max_entities > 0 and len(seen) >= self.max_entities:
+                    return
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        yield b'['
+        separator = b''
+        for entity in self._iter_entities():
+            yield separator + json.dumps(entity).encode('utf-8')
+            separator = b','
+
+        yield b']'
+
+
+class RegistrySharder(object):
+    """Splits registry queries with long entity lists into several queries.
+
+    Each shard is paginated independently, following the pagination
+    settings, and shards are run concurrently. The maximum number of
+    entities applies to the merged response.
+    """
+
+    def __init__(self, shard_size=DEFAULT_SHARD_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+
+    def configure(self, config):
+        self.shard_size = get_int_setting(config, 'registry_shard_size', DEFAULT_SHARD_SIZE)
+        self.concurrency = get_int_setting(config, 'registry_shard_concurrency', DEFAULT_CONCURRENCY)
+
+    def shard(self, body):
+        # Returns the list of serialized queries to send
+        if self.shard_size <= 0:
+            return [body]
+
+        query = json.loads(body)
+        entities = query.get('entities', [])
+        if len(entities) <= self.shard_size:
+            return [body]
+
+        shards = []
+        for offset in six.moves.range(0, len(entities), self.shard_size):
+            shard = dict(query, entities=entities[offset:offset + self.shard_size])
+            shards.append(json.dumps(shard, sort_keys=True))
+
+        return shards
+
+    def fetch_shard(self, url, body, fetch_page, first_page=None):
+        # Returns all the entities matching a shard as a serialized array
+        if first_page is None:
+            first_page = fetch_page(paginator.first_page_url(url), body)
+
+        pages = [first_page.content]
+        try:
+            total_count = int(first_page.headers.get('Fiware-Total-Count'))
+        except (TypeError, ValueError):
+            total_count = 0
+
+        for page_url in paginator.page_urls(url, total_count):
+            pages.append(fetch_page(page_url, body).content)
+
+        entities = [strip_array(page) for page in pages]
+        return b'[' + b','.join(page for page in entities if page != b'') + b']'
+
+    def merge(self, response, url, shards, fetch_page):
+        # response is the first page of the first shard
+        jobs = [(shards[0], response)] + [(shard, None) for shard in shards[1:]]
+        fetch_shard = lambda job: self.fetch_shard(url, job[0], fetch_page, job[1])
+
+        return ShardedResponse(response, jobs, fetch_shard, max(self.concurrency, 1), paginator.get_max_entities(url))
+
+
+registry_sharder = RegistrySharder()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import sys
+import threading
+
+import six
+
+from .utils import get_bool_setting, get_float_setting, get_int_setting
+
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+
+class BufferedResponse(object):
+    """Fully read upstream response that can be shared between threads.
+
+    Provides the subset of the ``requests.Response`` API used by the proxy.
+    """
+
+    def __init__(self, response, content=None):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.encoding = response.encoding
+        self.url = getattr(response, 'url', None)
+        if content is not None:
+            self.content = content
+            return
+
+        try:
+            self.content = b''.join(response.iter_content(chunk_size=READ_CHUNK_SIZE))
+        finally:
+            response.close()
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for offset in six.moves.range(0, len(self.content), chunk_size):
+            yield self.content[offset:offset + chunk_size]
+
+    def json(self, **kwargs):
+        return json.loads(self.content, **kwargs)
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayedResponse(object):
+    """Response partially read while trying to buffer it. The chunks already
+    read are returned again before the rest of the body, and read errors are
+    raised once the body is consumed up to the point they happened.
+    """
+
+    def __init__(self, response, chunks, remaining=None, exc_info=None):
+        self._response = response
+        self._chunks = chunks
+        self._remaining = remaining
+        self._exc_info = exc_info
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunks, self._chunks = self._chunks, []
+        for chunk in chunks:
+            yield chunk
+
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
+        elif self._remaining is not None:
+            for chunk in self._remaining:
+                yield chunk
+
+    def close(self):
+        self._response.close()
+
+
+def buffer_response(response, max_size, on_exceeded=None):
+    # Reads the body of a response into a BufferedResponse unless it
+    # exceeds max_size bytes, calling on_exceeded in that case. Responses
+    # that cannot be buffered can still be streamed using the returned
+    # ReplayedResponse
+    chunks = []
+    size = 0
+    body = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+    try:
+        for chunk in body:
+            size += len(chunk)
+            chunks.append(chunk)
+            if size > max_size:
+                if on_exceeded is not None:
+                    on_exceeded()
+                return ReplayedResponse(response, chunks, remaining=body)
+    except Exception:
+        if on_exceeded is not None:
+            on_exceeded()
+        return ReplayedResponse(response, chunks, exc_info=sys.exc_info())
+
+    response.close()
+    return BufferedResponse(response, b''.join(chunks))
+
+
+class Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.shared = False
+        self.detached = False
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls sharing the same key.
+
+    Only the first caller (the leader) runs the provided function, the rest
+    of callers wait for it to finish and receive the same result (or
+    exception). Results not accepted by the ``share`` predicate are only
+    returned to the leader, the rest of callers receive ``None``. Leaders
+    can also ``detach`` their call as soon as they know the result cannot be
+    shared, so the rest of callers don't wait for it.
+    """
+
+    def __init__(self, enabled=True, timeout=None, max_size=DEFAULT_MAX_SIZE):
+        self.enabled = enabled
+        self.timeout = timeout
+        # Maximum size of the responses buffered for being shared
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._leaders = 0
+        self._followers = 0
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'coalesce_requests', True)
+        self.timeout = get_float_setting(config, 'coalesce_timeout')
+        self.max_size = get_int_setting(config, 'coalesce_max_size', DEFAULT_MAX_SIZE)
+
+    def do(self, key, fn, share=None):
+        if not self.enabled:
+            return fn()
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self._leaders += 1
+            else:
+                self._followers += 1
+
+        if not leader:
+            if not call.event.wait(self.timeout):
+                return None
+            elif call.detached:
+                return None
+            elif call.exc_info is not None:
+                six.reraise(*call.exc_info)
+
+            return call.result if call.shared else None
+
+        try:
+            call.result = fn()
+            call.shared = not call.detached and (share is None or share(call.result))
+            return call.result
+        except Exception:
+            if not call.detached:
+                call.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._release(key, call)
+
+    def detach(self, key):
+        # Releases the callers waiting for the call in progress, they
+        # receive None. Only to be called by the leader of the call
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return
+
+            call.detached = True
+
+        self._release(key, call)
+
+    def _release(self, key, call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.event.set()
+
+    def stats(self):
+        with self._lock:
+            total = self._leaders + self._followers
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self._calls),
+                'leaders': self._leaders,
+                'followers': self._followers,
+                'coalesced_ratio': float(self._followers) / total if total else 0.0,
+            }
+
+
+request_coalescer = SingleFlight()
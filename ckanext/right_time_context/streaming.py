@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+from logging import getLogger
+import time
+
+from .utils import get_bool_setting, get_float_setting, get_int_setting
+
+log = getLogger(__name__)
+
+MIN_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def get_content_length(response):
+    try:
+        return int(response.headers.get('content-length'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TruncatedResponseError(Exception):
+    # Raised while streaming a body that cannot be sent completely, so the
+    # connection is aborted instead of finishing the response normally
+    pass
+
+
+class ResponseStreamer(object):
+    """Passes Context Broker response bodies through to the client.
+
+    When ``enabled``, bodies are returned to the WSGI server as an iterator
+    instead of being buffered into the CKAN response.
+    """
+
+    def __init__(self, enabled=True, chunk_size=None, max_size=0, timeout=0):
+        self.enabled = enabled
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        # Maximum number of seconds spent transferring a body
+        self.timeout = timeout
+
+    def configure(self, config):
+        self.enabled = get_bool_setting(config, 'stream_responses', True)
+        self.chunk_size = get_int_setting(config, 'stream_chunk_size')
+        self.max_size = get_int_setting(config, 'max_response_size', 0)
+        self.timeout = get_float_setting(config, 'stream_timeout', 0)
+
+    def _timed_out(self, started):
+        return self.timeout > 0 and time.time() - started > self.timeout
+
+    def get_chunk_size(self, response):
+        if self.chunk_size:
+            return self.chunk_size
+
+        # Use small chunks for small responses, to avoid waiting for the full
+        # response, and bigger chunks for big responses to reduce overhead
+        content_length = get_content_length(response)
+        if content_length is None:
+            return DEFAULT_CHUNK_SIZE
+
+        return min(max(content_length // 16, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    def exceeds_max_size(self, response):
+        content_length = get_content_length(response)
+        return self.max_size > 0 and content_length is not None and content_length > self.max_size
+
+    def read(self, response):
+        # Reads the full body, raising ValueError if it exceeds the maximum
+        # response size
+        chunks = []
+        size = 0
+        started = time.time()
+
+        try:
+            if self.exceeds_max_size(response):
+                raise ValueError('The response of the Context Broker exceeds the maximum allowed size.')
+
+            for chunk in response.iter_content(chunk_size=self.get_chunk_size(response)):
+                size += len(chunk)
+                if self.max_size > 0 and size > self.max_size:
+                    raise ValueError('The response of the Context Broker exceeds the maximum allowed size.')
+                elif self._timed_out(started):
+                    raise ValueError('The Context Broker took too long to send the response.')
+
+                chunks.append(chunk)
+        finally:
+            response.close()
+
+        return b''.join(chunks)
+
+    def stream(self, response, collect_limit=0, on_complete=None, raw=False):
+        # Chunks are also collected, up to collect_limit bytes, for being
+        # passed to on_complete once the body has been fully streamed. Raw
+        # streams return the body without decoding its content encoding
+        chunks = [] if on_complete is not None else None
+        size = 0
+        started = time.time()
+
+        chunk_size = self.get_chunk_size(response)
+        if raw:
+            body = response.raw.stream(chunk_size, decode_content=False)
+        else:
+            body = response.iter_content(chunk_size=chunk_size)
+
+        try:
+            for chunk in body:
+                size += len(chunk)
+                if self.max_size > 0 and size > self.max_size:
+                    log.warning('Aborting ngsi response from {0}, maximum response size exceeded'.format(response.url))
+                    raise TruncatedResponseError('The response of the Context Broker exceeds the maximum allowed size.')
+                elif self._timed_out(started):
+                    log.warning('Aborting ngsi response from {0}, maximum transfer time exceeded'.format(response.url))
+                    raise TruncatedResponseError('The Context Broker took too long to send the response.')
+
+                if chunks is not None:
+                    if size > collect_limit:
+                        chunks = None
+                    else:
+                        chunks.append(chunk)
+
+                yield chunk
+
+            if chunks is not None:
+                on_complete(b''.join(chunks))
+        finally:
+            # Release the upstream connection as soon as the stream ends
+            response.close()
+
+
+response_streamer = ResponseStreamer()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import threading
+import time
+import unittest
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.batch import BatchProxy, format_error, format_result
+from ckanext.right_time_context.concurrency import unordered_map
+
+
+class BatchProxyTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ([], []),
+        (['a'], ['a']),
+        (['a,b', 'c'], ['a', 'b', 'c']),
+        (['a, b,,', 'a'], ['a', 'b']),
+    ])
+    def test_parse_ids(self, values, expected):
+        self.assertEqual(BatchProxy().parse_ids(values), expected)
+
+    def test_format_result(self):
+        line = format_result('a', 'application/json', b'[\n  {"id": "Room1", "name": "a\\nb"}\n]\n')
+
+        self.assertTrue(line.endswith(b'\n'))
+        self.assertEqual(line.count(b'\n'), 1)
+        self.assertEqual(json.loads(line), {'id': 'a', 'status': 200, 'content_type': 'application/json', 'data': [{'id': 'Room1', 'name': 'a\nb'}]})
+
+    def test_format_empty_result(self):
+        self.assertIsNone(json.loads(format_result('a', 'application/json', b''))['data'])
+
+    def test_format_text_result(self):
+        self.assertEqual(json.loads(format_result('a', 'text/plain; charset=utf-8', b'line 1\n"line 2"'))['data'], 'line 1\n"line 2"')
+
+    @parameterized.expand([
+        (b'{"id": "Room1"',),
+        (b'[1]\n{"injected": true}',),
+    ])
+    def test_format_invalid_result(self, body):
+        with self.assertRaises(ValueError):
+            format_result('a', 'application/json', body)
+
+    def test_format_error(self):
+        self.assertEqual(json.loads(format_error('a', 404, 'Not found')), {'id': 'a', 'status': 404, 'error': 'Not found'})
+
+    def test_run(self):
+        batch = BatchProxy(concurrency=2)
+
+        lines = list(batch.run(['a', 'b', 'c'], lambda job: job))
+        batch.error('d', 404, 'Not found')
+
+        self.assertEqual(sorted(lines), ['a', 'b', 'c'])
+        stats = batch.stats()
+        self.assertEqual(stats['batches'], 1)
+        self.assertEqual(stats['resources'], 3)
+        self.assertEqual(stats['errors'], 1)
+
+    def test_unordered_map(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fn(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02 * max(3 - item, 0))
+            with lock:
+                running[0] -= 1
+            return item
+
+        # Results are returned as soon as they are completed
+        self.assertEqual(list(unordered_map(fn, range(3), 3)), [2, 1, 0])
+        self.assertEqual(sorted(unordered_map(fn, range(5), 2)), [0, 1, 2, 3, 4])
+        self.assertLessEqual(running[1], 3)
+
+    def test_unordered_map_error(self):
+        def fn(item):
+            raise ValueError()
+
+        self.assertRaises(ValueError, list, unordered_map(fn, range(3), 2))
+
+    def test_configure(self):
+        batch = BatchProxy()
+
+        batch.configure({
+            'ckan.right_time_context.batch_concurrency': '4',
+            'ckan.right_time_context.batch_max_resources': '10',
+        })
+
+        self.assertEqual(batch.concurrency, 4)
+        self.assertEqual(batch.max_resources, 10)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+from ckanext.right_time_context.cache import build_cache_key, CacheEntry, compute_etag, is_not_modified, parse_cache_control, ResponseCache
+from ckanext.right_time_context.pagination import PaginatedResponse
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def _entry(self, body="{}", ttl=10, stale_while_revalidate=0, stale_if_error=0):
+        return CacheEntry(body, "application/json", "utf-8", {}, ttl, stale_while_revalidate, stale_if_error)
+
+    def _response(self, status_code, body='{"new": "body"}'):
+        return MagicMock(status_code=status_code, headers={'content-type': 'application/json'}, iter_content=MagicMock(return_value=[body]), encoding='utf-8')
+
+    @parameterized.expand([
+        ({"FIWARE-Service": "b"},),
+        ({"FIWARE-ServicePath": "/b"},),
+        ({"Authorization": "Bearer other-token"},),
+        ({"X-Auth-Token": "other-token"},),
+    ])
+    def test_cache_key_headers(self, headers):
+        base_headers = {"Accept": "application/json", "FIWARE-Service": "a", "FIWARE-ServicePath": "/a", "Authorization": "Bearer token"}
+        other_headers = dict(base_headers)
+        other_headers.update(headers)
+
+        key1 = build_cache_key("resource", "GET", "http://cb.example.org/v2/entities", "", base_headers)
+        key2 = build_cache_key("resource", "GET", "http://cb.example.org/v2/entities", "", other_headers)
+        self.assertNotEqual(key1, key2)
+        self.assertEqual(key1, build_cache_key("resource", "get", "http://cb.example.org/v2/entities", "", dict(base_headers)))
+
+    @parameterized.expand([
+        (None, {}),
+        ("max-age=60", {"max-age": 60}),
+        ("public, max-age=60, stale-while-revalidate=30", {"public": True, "max-age": 60, "stale-while-revalidate": 30}),
+        ("No-Store", {"no-store": True}),
+        ('private="x", max-age=a', {"private": "x", "max-age": "a"}),
+    ])
+    def test_parse_cache_control(self, value, expected):
+        self.assertEqual(parse_cache_control(value), expected)
+
+    @parameterized.expand([
+        ({}, {}, 30, (30, 5, 60)),
+        ({'cache_ttl': '10'}, {}, 30, (10, 5, 60)),
+        ({'cache_ttl': '0'}, {}, 30, None),
+        ({'cache_ttl': ''}, {}, 0, None),
+        ({}, {'Cache-Control': 'max-age=120'}, 30, (120, 5, 60)),
+        ({}, {'Cache-Control': 's-maxage=100, max-age=120, stale-while-revalidate=1, stale-if-error=2'}, 30, (100, 1, 2)),
+        ({}, {'Cache-Control': 'no-store'}, 30, None),
+        ({}, {'Cache-Control': 'no-cache'}, 30, None),
+        ({}, {'Cache-Control': 'max-age=0'}, 30, None),
+    ])
+    def test_get_policy(self, resource, headers, ttl, expected):
+        cache = ResponseCache(ttl=ttl, stale_while_revalidate=5, stale_if_error=60)
+        self.assertEqual(cache.get_policy(resource, headers), expected)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(ttl=10, max_size=10)
+
+        cache.set("a", self._entry("1234"))
+        cache.set("b", self._entry("1234"))
+        cache.get("a")
+        cache.set("c", self._entry("1234"))
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.stats()['size'], 8)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_max_entry_size(self):
+        cache = ResponseCache(ttl=10, max_entry_size=3)
+
+        self.assertFalse(cache.set("a", self._entry("1234")))
+        self.assertIsNone(cache.get("a"))
+
+    @patch("ckanext.right_time_context.cache.time")
+    def test_expiration(self, time):
+        cache = ResponseCache()
+        time.time.return_value = 1000
+        cache.set("a", self._entry(ttl=10, stale_while_revalidate=5, stale_if_error=20))
+
+        time.time.return_value = 1009
+        entry = cache.get("a")
+        self.assertTrue(entry.is_fresh())
+
+        time.time.return_value = 1014
+        entry = cache.get("a")
+        self.assertFalse(entry.is_fresh())
+        self.assertTrue(entry.can_revalidate_stale())
+
+        time.time.return_value = 1029
+        entry = cache.get("a")
+        self.assertFalse(entry.can_revalidate_stale())
+        self.assertTrue(entry.can_serve_on_error())
+
+        time.time.return_value = 1030
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_revalidate(self):
+        cache = ResponseCache(ttl=10)
+        response = self._response(200)
+
+        with patch("ckanext.right_time_context.cache.threading.Thread") as thread_mock:
+            self.assertTrue(cache.revalidate("a", {}, lambda: response))
+            self.assertFalse(cache.revalidate("a", {}, lambda: response))
+            thread_mock.call_args[1]['target']()
+
+        self.assertEqual(cache.get("a").body, '{"new": "body"}')
+        self.assertTrue(cache.revalidate("a", {}, lambda: response))
+
+    @patch("ckanext.right_time_context.cache.time")
+    def test_peek(self, time):
+        cache = ResponseCache()
+        time.time.return_value = 1000
+        cache.set("a", self._entry(ttl=10))
+
+        self.assertIsNotNone(cache.peek("a"))
+        self.assertIsNone(cache.peek("b"))
+        self.assertEqual(cache.stats()['hits'] + cache.stats()['misses'], 0)
+
+        time.time.return_value = 1010
+        self.assertIsNone(cache.peek("a"))
+
+    @parameterized.expand([
+        (200, '{"new": "body"}', True),
+        (304, '{}', True),
+        (500, '{}', False),
+    ])
+    def test_update(self, status_code, body, expected):
+        cache = ResponseCache(ttl=10)
+        cache.set("a", CacheEntry("{}", "application/json", "utf-8", {'ETag': '"a"'}, -1))
+        response = self._response(status_code)
+
+        self.assertEqual(cache.update("a", {}, response), expected)
+        self.assertEqual(cache.get("a").body, body)
+        self.assertEqual(cache.get("a").is_fresh(), expected)
+
+    def test_update_paginated(self):
+        cache = ResponseCache(ttl=10)
+        first_page = MagicMock(status_code=200, headers={'content-type': 'application/json'}, content=b'[{"id": "1"}]', encoding='utf-8')
+        response = PaginatedResponse(first_page, ["page2"], lambda url: b'[{"id": "2"}]')
+
+        with patch("ckanext.right_time_context.cache.threading.Thread") as thread_mock:
+            self.assertTrue(cache.revalidate("a", {}, lambda: response))
+            thread_mock.call_args[1]['target']()
+
+        self.assertEqual(cache.get("a").body, b'[{"id": "1"},{"id": "2"}]')
+        first_page.close.assert_called_once_with()
+
+    @parameterized.expand([
+        ({}, '"a"', None, False),
+        ({'If-None-Match': '"a"'}, '"a"', None, True),
+        ({'If-None-Match': '"b", "a"'}, '"a"', None, True),
+        ({'If-None-Match': 'W/"a"'}, '"a"', None, True),
+        ({'If-None-Match': '*'}, '"a"', None, True),
+        ({'If-None-Match': '"b"'}, '"a"', None, False),
+        ({'If-None-Match': '"a"'}, None, None, False),
+        ({'If-None-Match': '"b"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}, '"a"', 'Wed, 21 Oct 2015 07:28:00 GMT', False),
+        ({'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}, '"a"', 'Wed, 21 Oct 2015 07:28:00 GMT', True),
+        ({'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}, '"a"', 'Wed, 21 Oct 2015 07:28:01 GMT', False),
+        ({'If-Modified-Since': 'invalid'}, '"a"', 'Wed, 21 Oct 2015 07:28:01 GMT', False),
+    ])
+    def test_is_not_modified(self, request_headers, etag, last_modified, expected):
+        self.assertEqual(is_not_modified(request_headers, etag, last_modified), expected)
+
+    def test_refresh(self):
+        cache = ResponseCache(ttl=10)
+        entry = CacheEntry("{}", "application/json", "utf-8", {'ETag': '"a"'}, -1)
+        cache.set("a", entry)
+
+        new_entry = cache.refresh("a", {}, entry, {'ETag': '"b"'})
+
+        self.assertTrue(new_entry.is_fresh())
+        self.assertEqual(new_entry.body, "{}")
+        self.assertEqual(new_entry.etag, '"b"')
+        self.assertIs(cache.get("a"), new_entry)
+        self.assertEqual(CacheEntry("{}", None, None, {}, 10).etag, compute_etag("{}"))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.chart import ChartBuilder, extract_series, lttb, minmax, parse_timestamp
+
+
+class ChartTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ("2018-01-01T00:00:00Z", 1514764800000),
+        ("2018-01-01T00:00:00.5Z", 1514764800500),
+        ("2018-01-01T00:00:00.123456", 1514764800123),
+        ("2018-01-01 01:00", 1514768400000),
+        ("2018-01-01T01:00:00+01:00", 1514764800000),
+        ("2018-01-01T00:00:00-0130", 1514770200000),
+        ("2018-13-01T00:00:00Z", None),
+        ("yesterday", None),
+        (12, None),
+    ])
+    def test_parse_timestamp(self, value, expected):
+        self.assertEqual(parse_timestamp(value), expected)
+
+    def test_extract_quantumleap(self):
+        data = {
+            "entityId": "Room1",
+            "index": ["2018-01-01T00:00:02Z", "2018-01-01T00:00:01Z", "2018-01-01T00:00:03Z"],
+            "attributes": [
+                {"attrName": "temperature", "values": [22, 21.5, None]},
+                {"attrName": "name", "values": ["a", "b", "c"]},
+            ],
+        }
+
+        self.assertEqual(extract_series(data), {'temperature': [(1514764801000, 21.5), (1514764802000, 22.0)]})
+
+    def test_extract_quantumleap_single(self):
+        data = {"attrName": "pressure", "index": ["2018-01-01T00:00:00Z"], "values": ["720"]}
+
+        self.assertEqual(extract_series(data), {'pressure': [(1514764800000, 720.0)]})
+
+    def test_extract_sth(self):
+        data = {"contextResponses": [{"contextElement": {"attributes": [{"name": "temperature", "values": [
+            {"recvTime": "2018-01-01T00:00:00.000Z", "attrValue": "21"},
+            {"recvTime": "2018-01-01T00:00:01.000Z", "attrValue": "22"},
+        ]}], "id": "Room1", "type": "Room"}}]}
+
+        self.assertEqual(extract_series(data), {'temperature': [(1514764800000, 21.0), (1514764801000, 22.0)]})
+
+    def test_extract_entities(self):
+        data = [
+            {"id": "Room1", "type": "Room", "temperature": {"type": "Number", "value": 21, "metadata": {"TimeInstant": {"type": "DateTime", "value": "2018-01-01T00:00:01Z"}}}},
+            {"id": "Room2", "type": "Room", "TimeInstant": "2018-01-01T00:00:00Z", "temperature": 20, "open": True},
+            {"id": "Room3", "type": "Room", "temperature": 23},
+        ]
+
+        self.assertEqual(extract_series(data), {'temperature': [(1514764800000, 20.0), (1514764801000, 21.0)]})
+
+    def test_lttb(self):
+        points = [(x, float(x % 10 == 5) * 100) for x in range(100)]
+
+        sampled = lttb(points, 22)
+
+        self.assertEqual(len(sampled), 22)
+        self.assertEqual(sampled[0], points[0])
+        self.assertEqual(sampled[-1], points[-1])
+        self.assertEqual(sampled, sorted(sampled))
+        # Every spike is kept
+        self.assertEqual(len([point for point in sampled if point[1] == 100]), 10)
+
+    @parameterized.expand([
+        (0, 10),
+        (10, 10),
+        (20, 10),
+        (2, 2),
+        (1, 1),
+    ])
+    def test_lttb_threshold(self, threshold, expected):
+        self.assertEqual(len(lttb([(x, x) for x in range(10)], threshold)), expected)
+
+    @parameterized.expand([
+        (0, 10),
+        (10, 10),
+        (3, 2),
+        (2, 2),
+        (1, 1),
+    ])
+    def test_minmax_threshold(self, threshold, expected):
+        self.assertEqual(len(minmax([(x, x % 3) for x in range(10)], threshold)), expected)
+
+    def test_minmax(self):
+        points = [(x, 0.0) for x in range(100)]
+        points[37] = (37, -5.0)
+        points[38] = (38, 9.0)
+
+        sampled = minmax(points, 10)
+
+        self.assertLessEqual(len(sampled), 10)
+        self.assertIn((37, -5.0), sampled)
+        self.assertIn((38, 9.0), sampled)
+        self.assertEqual(sampled, sorted(sampled))
+
+    @parameterized.expand([
+        (None, None, 2000),
+        (500, None, 500),
+        (None, 300, 300),
+        (500, 300, 300),
+        (5000, None, 2000),
+    ])
+    def test_get_threshold(self, width, points, expected):
+        self.assertEqual(ChartBuilder().get_threshold(width, points), expected)
+
+    def test_build(self):
+        builder = ChartBuilder()
+        data = {
+            "index": ["2018-01-01T00:00:00Z", "2018-01-01T00:00:01Z", "2018-01-01T00:00:02Z"],
+            "attributes": [
+                {"attrName": "temperature", "values": [21, None, 22]},
+                {"attrName": "pressure", "values": [720, 721, 722]},
+                {"attrName": "humidity", "values": [50, 51, 52]},
+            ],
+        }
+
+        result = builder.build(data, ['pressure', 'temperature', 'missing'], 3, 'lttb')
+
+        self.assertEqual(result, {
+            'labels': ['time', 'pressure', 'temperature'],
+            'columns': [[1514764800000, 1514764801000, 1514764802000], [720, 721, 722], [21, None, 22]],
+        })
+        self.assertEqual(builder.stats()['points_in'], 5)
+
+    def test_configure(self):
+        builder = ChartBuilder()
+
+        builder.configure({
+            'ckan.right_time_context.chart_max_points': '100',
+            'ckan.right_time_context.chart_points_per_pixel': '2',
+            'ckan.right_time_context.chart_time_attribute': 'dateObserved',
+        })
+
+        self.assertEqual(builder.get_threshold(40), 80)
+        self.assertEqual(builder.time_attribute, 'dateObserved')
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from mock import patch
+
+from ckanext.right_time_context.circuit import CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def _breaker(self, **kwargs):
+        kwargs.setdefault('min_requests', 4)
+        kwargs.setdefault('failure_ratio', 0.5)
+        kwargs.setdefault('open_time', 30)
+        return CircuitBreaker(**kwargs)
+
+    def _record(self, breaker, outcomes, host='cb.example.org'):
+        for outcome in outcomes:
+            breaker.record(host, outcome)
+
+    def test_closed(self):
+        breaker = self._breaker()
+        self._record(breaker, [True, True, False, True, False])
+
+        breaker.check('cb.example.org')
+        self.assertEqual(breaker.stats()['hosts']['cb.example.org']['state'], 'closed')
+
+    def test_min_requests(self):
+        breaker = self._breaker()
+        self._record(breaker, [False, False, False])
+
+        breaker.check('cb.example.org')
+
+    @patch("ckanext.right_time_context.circuit.time")
+    def test_open(self, time):
+        time.time.return_value = 1000
+        breaker = self._breaker()
+        self._record(breaker, [True, False, True, False])
+
+        with self.assertRaises(CircuitOpenError) as cm:
+            breaker.check('CB.example.org')
+
+        self.assertEqual(cm.exception.retry_after, 30)
+        # Other hosts are not affected
+        breaker.check('other.example.org')
+
+        stats = breaker.stats()['hosts']['cb.example.org']
+        self.assertEqual(stats['state'], 'open')
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+    @patch("ckanext.right_time_context.circuit.time")
+    def test_window(self, time):
+        breaker = self._breaker(window=60)
+        time.time.return_value = 1000
+        self._record(breaker, [False, False, False])
+
+        time.time.return_value = 1061
+        self._record(breaker, [True, True, True, False])
+
+        breaker.check('cb.example.org')
+
+    @patch("ckanext.right_time_context.circuit.time")
+    def test_half_open(self, time):
+        time.time.return_value = 1000
+        breaker = self._breaker()
+        self._record(breaker, [False] * 4)
+
+        time.time.return_value = 1030
+        # A single probe is allowed
+        breaker.check('cb.example.org')
+        self.assertRaises(CircuitOpenError, breaker.check, 'cb.example.org')
+
+        # Failed probe
+        breaker.record('cb.example.org', False)
+        self.assertRaises(CircuitOpenError, breaker.check, 'cb.example.org')
+
+        time.time.return_value = 1060
+        breaker.check('cb.example.org')
+        breaker.record('cb.example.org', True)
+
+        breaker.check('cb.example.org')
+        breaker.check('cb.example.org')
+        self.assertEqual(breaker.stats()['hosts']['cb.example.org']['state'], 'closed')
+
+    @patch("ckanext.right_time_context.circuit.time")
+    def test_release_probe(self, time):
+        time.time.return_value = 1000
+        breaker = self._breaker()
+        self._record(breaker, [False] * 4)
+
+        time.time.return_value = 1030
+        breaker.check('cb.example.org')
+        self.assertRaises(CircuitOpenError, breaker.check, 'cb.example.org')
+
+        # The probe ended without an outcome, a new one is allowed
+        breaker.release('cb.example.org')
+        breaker.check('cb.example.org')
+        self.assertEqual(breaker.stats()['hosts']['cb.example.org']['state'], 'half-open')
+
+    def test_disabled(self):
+        breaker = self._breaker(enabled=False)
+        self._record(breaker, [False] * 10)
+
+        breaker.check('cb.example.org')
+        self.assertEqual(breaker.stats()['hosts'], {})
+
+    def test_configure(self):
+        breaker = self._breaker()
+        self._record(breaker, [False] * 4)
+
+        breaker.configure({
+            'ckan.right_time_context.circuit_window': '10',
+            'ckan.right_time_context.circuit_min_requests': '20',
+            'ckan.right_time_context.circuit_failure_ratio': '0.8',
+            'ckan.right_time_context.circuit_open_time': '5',
+        })
+
+        breaker.check('cb.example.org')
+        self.assertEqual((breaker.window, breaker.min_requests, breaker.failure_ratio, breaker.open_time), (10, 20, 0.8, 5))
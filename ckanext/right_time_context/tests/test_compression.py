@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from mock import MagicMock
+from parameterized import parameterized
+import requests
+
+from ckanext.right_time_context.compression import accepts_gzip, COMPRESS, gunzip_body, gzip_body, gzip_stream, PASSTHROUGH, ResponseCompressor, weaken_etag
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def _response(self, headers):
+        response = requests.Response()
+        response.headers.update(headers)
+        return response
+
+    @parameterized.expand([
+        ({}, False),
+        ({'Accept-Encoding': ''}, False),
+        ({'Accept-Encoding': 'gzip'}, True),
+        ({'Accept-Encoding': 'deflate, gzip;q=1.0, br'}, True),
+        ({'Accept-Encoding': 'gzip;q=0'}, False),
+        ({'Accept-Encoding': '*'}, True),
+        ({'Accept-Encoding': 'identity'}, False),
+    ])
+    def test_accepts_gzip(self, headers, expected):
+        self.assertEqual(accepts_gzip(headers), expected)
+
+    @parameterized.expand([
+        (None, None),
+        ('"abc"', 'W/"abc"'),
+        ('W/"abc"', 'W/"abc"'),
+    ])
+    def test_weaken_etag(self, etag, expected):
+        self.assertEqual(weaken_etag(etag), expected)
+
+    def test_gzip_stream(self):
+        chunks = [b'{"id": "%d"}' % i for i in range(1000)]
+
+        compressed = b''.join(gzip_stream(iter(chunks)))
+
+        self.assertEqual(gunzip_body(compressed), b''.join(chunks))
+        self.assertEqual(gunzip_body(gzip_body(b''.join(chunks))), b''.join(chunks))
+        self.assertLess(len(compressed), len(b''.join(chunks)))
+
+    @parameterized.expand([
+        (None, 0),
+        (0, 10),
+        (16, 2),
+    ])
+    def test_gzip_stream_flush(self, flush_size, flushes):
+        chunks = [b'abcd'] * 10
+
+        compressed = b''.join(gzip_stream(iter(chunks), flush_size=flush_size))
+
+        # Each sync flush ends with an empty stored block
+        self.assertEqual(compressed.count(b'\x00\x00\xff\xff'), flushes)
+        self.assertEqual(gunzip_body(compressed), b''.join(chunks))
+
+    @parameterized.expand([
+        (True, {}, {'Content-Length': '2048'}, None),
+        (False, {'Accept-Encoding': 'gzip'}, {'Content-Length': '2048'}, None),
+        (True, {'Accept-Encoding': 'gzip'}, {'Content-Length': '2048'}, COMPRESS),
+        (True, {'Accept-Encoding': 'gzip'}, {}, COMPRESS),
+        (True, {'Accept-Encoding': 'gzip'}, {'Content-Length': '100'}, None),
+        (True, {'Accept-Encoding': 'gzip'}, {'Content-Length': '100', 'Content-Encoding': 'gzip'}, PASSTHROUGH),
+    ])
+    def test_negotiate(self, enabled, request_headers, response_headers, expected):
+        compressor = ResponseCompressor(enabled=enabled, min_size=1024)
+
+        self.assertEqual(compressor.negotiate(request_headers, self._response(response_headers)), expected)
+
+    def test_negotiate_decoded_response(self):
+        # Buffered responses are already decoded so they must be compressed
+        compressor = ResponseCompressor(min_size=0)
+        response = MagicMock(headers={'Content-Encoding': 'gzip'})
+
+        self.assertEqual(compressor.negotiate({'Accept-Encoding': 'gzip'}, response), COMPRESS)
+
+    def test_configure(self):
+        compressor = ResponseCompressor()
+
+        compressor.configure({
+            'ckan.right_time_context.compress_responses': 'false',
+            'ckan.right_time_context.compression_level': '9',
+            'ckan.right_time_context.compression_min_size': '0',
+        })
+
+        self.assertFalse(compressor.enabled)
+        self.assertEqual(compressor.level, 9)
+        self.assertEqual(compressor.min_size, 0)
@@ -17,12 +17,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
 
+import json
+import time
 import unittest
 
-from mock import ANY, DEFAULT, patch
+from mock import ANY, DEFAULT, MagicMock, patch
 from parameterized import parameterized
+from requests import ConnectionError, Response, Timeout
+from webob.exc import HTTPNotFound
 
+from ckan.logic import NotAuthorized, NotFound
+
+from ckanext.right_time_context.batch import BatchProxy
+from ckanext.right_time_context.cache import build_cache_key, CacheEntry, compute_etag, ResponseCache
+from ckanext.right_time_context.circuit import circuit_breaker, CircuitBreaker
+from ckanext.right_time_context.compression import gunzip_body, gzip_body, ResponseCompressor
 from ckanext.right_time_context.controller import ProxyNGSIController
+from ckanext.right_time_context.delta import decode_cursor, DeltaTracker
+from ckanext.right_time_context.metrics import ProxyMetrics
+from ckanext.right_time_context.pagination import get_query_params, Paginator
+from ckanext.right_time_context.plans import proxy_plans
+from ckanext.right_time_context.sharding import RegistrySharder
+from ckanext.right_time_context.singleflight import BufferedResponse, SingleFlight
+from ckanext.right_time_context.streaming import ResponseStreamer
+from ckanext.right_time_context.tokens import token_refresher
 
 
 class NgsiViewControllerTestCase(unittest.TestCase):
@@ -50,6 +68,11 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         super(NgsiViewControllerTestCase, cls).setUpClass()
         cls.controller = ProxyNGSIController()
 
+    def setUp(self):
+        proxy_plans.clear()
+        circuit_breaker.clear()
+        token_refresher.clear()
+
     def _mock_response(self, req_method):
         body = '{"json": "body"}'
         response = req_method
@@ -67,11 +90,12 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         ({"service_path": "/a", 'format': 'fiware-ngsi'}, {"FIWARE-ServicePath": "/a"}),
         ({"tenant": "a", "service_path": "/a,/b", 'format': 'fiware-ngsi'}, {"FIWARE-Service": "a", "FIWARE-ServicePath": "/a,/b"}),
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_basic_request(self, resource, headers, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_basic_request(self, resource, headers, base, logic, requests, toolkit, os, session_pool):
         resource['url'] = "http://cb.example.org/v2/entites"
         logic.get_action('resource_show').return_value = resource
-        response, body = self._mock_response(requests.get())
+        response, body = self._mock_response(session_pool.get_session().get())
+        base.request.headers = {}
         os.environ = {
             "CKAN_VERIFY_REQUESTS": "true",
         }
@@ -85,10 +109,11 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         }
         expected_headers.update(headers)
 
-        self.controller.proxy_ngsi_resource("resource_id")
+        result = self.controller.proxy_ngsi_resource("resource_id")
 
-        requests.get.assert_called_with(resource['url'], headers=expected_headers, stream=True, verify=True)
-        base.response.body_file.write.assert_called_with(body)
+        session_pool.get_session.assert_called_with(resource['url'], verify=True)
+        session_pool.get_session().get.assert_called_with(resource['url'], headers=expected_headers, stream=True, verify=True)
+        self.assertEqual(b''.join(result), body)
 
     @parameterized.expand([
         (REGISTRY_RESOURCE, REGISTRY_QUERY, {}),
@@ -101,12 +126,23 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         }, {
             'entities': [{'id': 'vehicle1', 'type': 'Vehicle'}],
             'attrs': [],
+        }, {}),
+        ({
+            'format': 'fiware-ngsi-registry',
+            'url': 'http://cb.example.org',
+            'entity': [{'id': 'vehicle1', 'value': 'Vehicle'}],
+            'registry_query': '{"attrs": [], "entities": [{"id": "vehicle2", "type": "Vehicle"}]}'
+        }, {
+            'entities': [{'id': 'vehicle2', 'type': 'Vehicle'}],
+            'attrs': [],
         }, {})
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_registration_request(self, resource, query, headers, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_registration_request(self, resource, query, headers, base, logic, requests, toolkit, os, session_pool):
         logic.get_action('resource_show').return_value = resource
-        response, body = self._mock_response(requests.post())
+        body = '[{"id": "vehicle1", "type": "Vehicle"}]'
+        session_pool.get_session().post.return_value = MagicMock(status_code=200, headers={'content-type': 'application/json', 'Fiware-Total-Count': '1'}, content=body)
+        base.request.headers = {}
         os.environ = {
             "CKAN_VERIFY_REQUESTS": "true",
         }
@@ -121,14 +157,16 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         }
         expected_headers.update(headers)
 
-        self.controller.proxy_ngsi_resource("resource_id")
+        result = self.controller.proxy_ngsi_resource("resource_id")
 
-        url = resource['url'] + '/v2/op/query'
-        requests.post.assert_called_with(url, headers=expected_headers, json=query, stream=True, verify=True)
-        base.response.body_file.write.assert_called_with(body)
+        # Queries are paginated even if they are not sharded
+        url = resource['url'] + '/v2/op/query?limit=1000&offset=0&options=count'
+        session_pool.get_session().post.assert_called_once_with(url, headers=expected_headers, data=ANY, stream=True, verify=True)
+        self.assertEqual(json.loads(session_pool.get_session().post.call_args[1]['data']), query)
+        self.assertEqual(json.loads(b''.join(result)), json.loads(body))
 
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_invalid_expression(self, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_invalid_expression(self, base, logic, requests, toolkit, os, session_pool):
         resource = {
             'format': 'fiware-ngsi-registry',
             'url': 'http://cb.example.org',
@@ -145,14 +183,16 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         }
 
         logic.get_action('resource_show').return_value = resource
+        base.abort.side_effect = TypeError
 
-        self.controller.proxy_ngsi_resource("resource_id")
+        with self.assertRaises(TypeError):
+            self.controller.proxy_ngsi_resource("resource_id")
         base.abort.assert_called_with(422, detail='The expression is not a valid one for NGSI Registration, only georel, geometry, and coords is supported')
 
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_invalid_reg_query(self, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_invalid_reg_query(self, base, logic, requests, toolkit, os, session_pool):
         logic.get_action('resource_show').return_value = self.REGISTRY_RESOURCE
-        response, body = self._mock_response(requests.post())
+        response, body = self._mock_response(session_pool.get_session().post())
         os.environ = {
             "CKAN_VERIFY_REQUESTS": "true",
         }
@@ -171,8 +211,8 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         ("ftp://example.com",),
         ("tatata:///da",),
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_invalid_url_request(self, url, base, logic, requests, toolkit, os=DEFAULT):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_invalid_url_request(self, url, base, logic, requests, toolkit, os=DEFAULT, session_pool=DEFAULT):
         resource = {
             'url': url,
         }
@@ -183,23 +223,23 @@ class NgsiViewControllerTestCase(unittest.TestCase):
             self.controller.proxy_ngsi_resource("resource_id")
 
         base.abort.assert_called_with(409, detail=ANY)
-        requests.get.assert_not_called()
+        session_pool.get_session().get.assert_not_called()
 
     @parameterized.expand([
         (True,),
         (False,),
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_auth_required_request(self, auth_configured, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_auth_required_request(self, auth_configured, base, logic, requests, toolkit, os, session_pool):
         resource = {
             'url': "http://cb.example.org/v2/entites",
             'auth_type': 'oauth2' if auth_configured else 'none',
             'format': 'fiware-ngsi'
         }
         logic.get_action('resource_show').return_value = resource
-        response = requests.get()
+        response = session_pool.get_session().get()
         response.status_code = 401
-        requests.get.reset_mock()
+        session_pool.get_session().get.reset_mock()
         base.abort.side_effect = TypeError
         os.environ = {
             "CKAN_VERIFY_REQUESTS": "true",
@@ -209,33 +249,163 @@ class NgsiViewControllerTestCase(unittest.TestCase):
             self.controller.proxy_ngsi_resource("resource_id")
 
         base.abort.assert_called_once_with(409, detail=ANY)
-        requests.get.assert_called_once_with(resource['url'], headers=ANY, stream=True, verify=True)
+        session_pool.get_session().get.assert_called_with(resource['url'], headers=ANY, stream=True, verify=True)
         if auth_configured:
-            toolkit.c.usertoken_refresh.assert_called_with()
+            # The request is repeated once using a new token
+            self.assertEqual(session_pool.get_session().get.call_count, 2)
+            toolkit.c.usertoken_refresh.assert_called_once_with()
         else:
+            session_pool.get_session().get.assert_called_once_with(resource['url'], headers=ANY, stream=True, verify=True)
             toolkit.c.usertoken_refresh.assert_not_called()
 
+    @parameterized.expand([
+        ('oauth2', 'Authorization', 'Bearer new-token'),
+        ('x-auth-token-fiware', 'X-Auth-Token', 'new-token'),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_token_retry(self, auth_type, header, value, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'auth_type': auth_type,
+            'format': 'fiware-ngsi'
+        }
+        logic.get_action('resource_show').return_value = resource
+        rejected = MagicMock(status_code=401)
+        response = MagicMock(status_code=200, headers={'content-type': 'application/json'})
+        response.iter_content.return_value = ('[]',)
+        session_pool.get_session().get.side_effect = [rejected, response]
+        base.request.headers = {}
+        os.environ = {}
+        toolkit.c.usertoken = {'access_token': 'expired-token'}
+
+        def refresh():
+            toolkit.c.usertoken = {'access_token': 'new-token'}
+        toolkit.c.usertoken_refresh.side_effect = refresh
+
+        result = self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertEqual(b''.join(result), b'[]')
+        base.abort.assert_not_called()
+        rejected.close.assert_called_once_with()
+        self.assertEqual(session_pool.get_session().get.call_args[1]['headers'][header], value)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, token_refresher=DEFAULT)
+    def test_token_retry_disabled(self, base, logic, requests, toolkit, os, session_pool, token_refresher):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'auth_type': 'oauth2',
+            'format': 'fiware-ngsi'
+        }
+        session_pool.get_session().get.return_value = MagicMock(status_code=401)
+        base.abort.side_effect = TypeError
+        os.environ = {}
+        token_refresher.retry = False
+        token_refresher.needs_refresh.return_value = False
+
+        with self.assertRaises(TypeError):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        base.abort.assert_called_once_with(409, detail='ERROR 401 token expired. Retrieving new token, reload please.')
+        self.assertEqual(session_pool.get_session().get.call_count, 1)
+        token_refresher.refresh.assert_called_once_with(ANY, ANY, 'retry')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_token_proactive_refresh(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'auth_type': 'oauth2',
+            'format': 'fiware-ngsi'
+        }
+        self._mock_response(session_pool.get_session().get())
+        base.request.headers = {}
+        os.environ = {}
+        toolkit.c.usertoken = {'access_token': 'expiring-token', 'expires_at': time.time() + 10}
+
+        def refresh():
+            toolkit.c.usertoken = {'access_token': 'new-token', 'expires_at': time.time() + 3600}
+        toolkit.c.usertoken_refresh.side_effect = refresh
+
+        self.controller.proxy_ngsi_resource("resource_id")
+
+        toolkit.c.usertoken_refresh.assert_called_once_with()
+        self.assertEqual(session_pool.get_session().get.call_args[1]['headers']['Authorization'], 'Bearer new-token')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_token_retry_cache_key(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'auth_type': 'oauth2',
+            'format': 'fiware-ngsi'
+        }
+        logic.get_action('resource_show').return_value = resource
+        response = MagicMock(status_code=200, headers={'content-type': 'application/json'})
+        response.iter_content.return_value = ('[]',)
+        session_pool.get_session().get.side_effect = [MagicMock(status_code=401), response]
+        base.request.headers = {}
+        base.response.headers = {}
+        os.environ = {}
+        toolkit.c.usertoken = {'access_token': 'expired-token'}
+
+        def refresh():
+            toolkit.c.usertoken = {'access_token': 'new-token'}
+        toolkit.c.usertoken_refresh.side_effect = refresh
+
+        cache = ResponseCache(ttl=60)
+        with patch("ckanext.right_time_context.controller.response_cache", cache):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            self.assertEqual(b''.join(result), b'[]')
+
+        expired_key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json", "Authorization": "Bearer expired-token"})
+        new_key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json", "Authorization": "Bearer new-token"})
+        self.assertIsNone(cache.get(expired_key))
+        self.assertEqual(cache.get(new_key).body, '[]')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_chart_token_retry(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities/Room1",
+            'auth_type': 'oauth2',
+            'format': 'fiware-ngsi',
+            'cache_ttl': '0',
+        }
+        response = MagicMock(status_code=200, headers={'Content-Type': 'application/json'})
+        response.iter_content.return_value = ('{"id": "Room1"}',)
+        session_pool.get_session().get.side_effect = [MagicMock(status_code=401), response]
+        base.request.headers = {}
+        base.request.params = {}
+        os.environ = {}
+        toolkit.c.usertoken = {'access_token': 'expired-token'}
+
+        def refresh():
+            toolkit.c.usertoken = {'access_token': 'new-token'}
+        toolkit.c.usertoken_refresh.side_effect = refresh
+
+        result = self.controller.chart_ngsi_resource("resource_id")
+
+        self.assertEqual(json.loads(result), {'labels': ['time'], 'columns': [[]]})
+        self.assertEqual(session_pool.get_session().get.call_args[1]['headers']['Authorization'], 'Bearer new-token')
+
     @parameterized.expand([
         ("HTTPError", 409),
         ("ConnectionError", 502),
         ("Timeout", 504),
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_auth_required_request(self, exception, status_code, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_auth_required_request(self, exception, status_code, base, logic, requests, toolkit, os, session_pool):
         resource = {
             'url': "http://cb.example.org/v2/entites",
             'format': 'fiware-ngsi'
         }
         logic.get_action('resource_show').return_value = resource
         setattr(requests, exception, ValueError)
-        requests.get.side_effect = getattr(requests, exception)
+        session_pool.get_session().get.side_effect = getattr(requests, exception)
         base.abort.side_effect = TypeError
 
         with self.assertRaises(TypeError):
             self.controller.proxy_ngsi_resource("resource_id")
 
         base.abort.assert_called_once_with(status_code, detail=ANY)
-        requests.get.assert_called_once_with(resource['url'], headers=ANY, stream=True, verify=True)
+        session_pool.get_session().get.assert_called_once_with(resource['url'], headers=ANY, stream=True, verify=True)
 
     @parameterized.expand([
         ({}, {}, True),
@@ -256,8 +426,8 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         ({"CKAN_RIGHT_TIME_CONTEXT_VERIFY_REQUESTS": " "}, {"ckan.verify_requests": False}, False),
         ({"CKAN_VERIFY_REQUESTS": "/path/A/b"}, {"ckan.verify_requests": "path/2"}, "/path/A/b"),
     ])
-    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT)
-    def test_verify_requests(self, env, config, expected_value, base, logic, requests, toolkit, os):
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_verify_requests(self, env, config, expected_value, base, logic, requests, toolkit, os, session_pool):
         logic.get_action('resource_show').return_value = {
             'url': "https://cb.example.org/v2/entites",
             'format': 'fiware-ngsi'
@@ -268,3 +438,975 @@ class NgsiViewControllerTestCase(unittest.TestCase):
         with patch.object(self.controller, '_proxy_query_resource') as query_mock:
             self.controller.proxy_ngsi_resource("resource_id")
             query_mock.assert_called_once_with(ANY, ANY, ANY, verify=expected_value)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_cached_request(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+            'cache_ttl': '60',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.headers = {'content-type': 'application/json', 'Cache-Control': 'max-age=30'}
+        session_pool.get_session().get.reset_mock()
+        base.response.headers = {}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.response_cache", ResponseCache()):
+            self.assertEqual(b''.join(self.controller.proxy_ngsi_resource("resource_id")), body)
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_called_once_with(resource['url'], headers=ANY, stream=True, verify=True)
+        base.response.body_file.write.assert_called_once_with(body)
+        self.assertEqual(base.response.headers['Age'], '0')
+
+    @parameterized.expand([
+        ("ConnectionError",),
+        ("Timeout",),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_stale_cached_request_on_error(self, exception, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        setattr(requests, exception, ValueError)
+        session_pool.get_session().get.side_effect = getattr(requests, exception)
+        base.response.headers = {}
+        os.environ = {}
+
+        cache = ResponseCache(ttl=60, stale_if_error=60)
+        key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json"})
+        cache.set(key, CacheEntry('{"stale": "body"}', "application/json", "utf-8", {}, -1, 0, 60))
+
+        with patch("ckanext.right_time_context.controller.response_cache", cache):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        base.abort.assert_not_called()
+        self.assertEqual(base.response.headers['Warning'], '111 - "Revalidation Failed"')
+        base.response.body_file.write.assert_called_once_with('{"stale": "body"}')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_not_modified_computed_etag(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.headers = {'content-type': 'application/json', 'content-length': str(len(body))}
+        base.request.headers = {'If-None-Match': compute_etag(body)}
+        base.response.headers = {}
+        os.environ = {}
+
+        self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_called_with(resource['url'], headers={'Accept': 'application/json', 'If-None-Match': compute_etag(body)}, stream=True, verify=True)
+        self.assertEqual(base.response.status_int, 304)
+        self.assertEqual(base.response.headers['ETag'], compute_etag(body))
+        base.response.body_file.write.assert_not_called()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_not_modified_upstream(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response = session_pool.get_session().get()
+        response.status_code = 304
+        response.headers = {'ETag': '"upstream"'}
+        base.request.headers = {'If-None-Match': '"upstream"'}
+        base.response.headers = {}
+        os.environ = {}
+
+        self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertEqual(base.response.status_int, 304)
+        self.assertEqual(base.response.headers['ETag'], '"upstream"')
+        base.response.body_file.write.assert_not_called()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_conditional_revalidation(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response = session_pool.get_session().get()
+        response.status_code = 304
+        response.headers = {'ETag': '"upstream"'}
+        base.request.headers = {}
+        base.response.headers = {}
+        os.environ = {}
+
+        cache = ResponseCache(ttl=60)
+        key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json"})
+        cache.set(key, CacheEntry('{"cached": "body"}', "application/json", "utf-8", {'ETag': '"upstream"'}, -1))
+
+        with patch("ckanext.right_time_context.controller.response_cache", cache):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_called_with(resource['url'], headers={'Accept': 'application/json', 'If-None-Match': '"upstream"'}, stream=True, verify=True)
+        base.response.body_file.write.assert_called_once_with('{"cached": "body"}')
+        self.assertTrue(cache.get(key).is_fresh())
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_buffered_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.response_streamer", ResponseStreamer(enabled=False)):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertIsNone(result)
+        base.response.body_file.write.assert_called_once_with(body)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_max_response_size(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.headers = {'content-type': 'application/json', 'content-length': str(2 * 1024 * 1024)}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.response_streamer", ResponseStreamer(max_size=1024 * 1024)):
+            with self.assertRaises(TypeError):
+                self.controller.proxy_ngsi_resource("resource_id")
+
+        base.abort.assert_called_once_with(502, detail=ANY)
+        response.close.assert_called_with()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_max_response_size_unknown_length(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.iter_content.return_value = ('[{"id": "1"}', ', {"id": "2"}]')
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        # Responses exceeding the maximum size while being buffered are
+        # replaced by an error instead of being truncated
+        with patch("ckanext.right_time_context.controller.response_streamer", ResponseStreamer(enabled=False, max_size=20)):
+            with self.assertRaises(TypeError):
+                self.controller.proxy_ngsi_resource("resource_id")
+
+        base.abort.assert_called_once_with(502, detail='The response of the Context Broker exceeds the maximum allowed size.')
+        response.close.assert_called_with()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_paginated_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room",
+            'format': 'fiware-ngsi',
+            'follow_pagination': 'true',
+        }
+        first_page = MagicMock(status_code=200, headers={'content-type': 'application/json', 'Fiware-Total-Count': '3'}, content='[{"id": "1"}, {"id": "2"}]')
+        second_page = MagicMock(status_code=200, content='[{"id": "3"}]')
+        session = session_pool.get_session()
+        session.get.side_effect = [first_page, second_page]
+        base.request.headers = {'If-None-Match': '"etag"'}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.paginator", Paginator(page_size=2)):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            self.assertEqual(json.loads(b''.join(result)), [{"id": "1"}, {"id": "2"}, {"id": "3"}])
+
+        session.get.assert_any_call("http://cb.example.org/v2/entities?type=Room&limit=2&offset=0&options=count", headers={'Accept': 'application/json'}, stream=True, verify=True)
+        session.get.assert_called_with("http://cb.example.org/v2/entities?type=Room&limit=1&offset=2", headers={'Accept': 'application/json'}, verify=True)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_cached_plan(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+            'tenant': 'a',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response, body = self._mock_response(session_pool.get_session().get())
+        base.request.headers = {}
+        os.environ = {}
+
+        self.controller.proxy_ngsi_resource("resource_id")
+        logic.check_access.assert_not_called()
+        logic.get_action('resource_show').reset_mock()
+
+        result = self.controller.proxy_ngsi_resource("resource_id")
+
+        logic.get_action('resource_show').assert_not_called()
+        logic.check_access.assert_called_once_with('resource_show', ANY, {'id': 'resource_id'})
+        session_pool.get_session().get.assert_called_with(resource['url'], headers={'Accept': 'application/json', 'FIWARE-Service': 'a'}, stream=True, verify=True)
+        self.assertEqual(b''.join(result), body)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_cached_plan_not_authorized(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        self._mock_response(session_pool.get_session().get())
+        base.request.headers = {}
+        os.environ = {}
+
+        self.controller.proxy_ngsi_resource("resource_id")
+        session_pool.get_session().get.reset_mock()
+        logic.check_access.side_effect = TypeError
+
+        with self.assertRaises(TypeError):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_not_called()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_v1_query_request(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v1/queryContext",
+            'format': 'fiware-ngsi',
+            'payload': '{"entities": [{"type": "Room", "isPattern": "true", "id": ".*"}]}',
+        }
+        logic.get_action('resource_show').return_value = resource
+        response, body = self._mock_response(session_pool.get_session().post())
+        base.request.headers = {}
+        os.environ = {}
+
+        result = self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().post.assert_called_with(resource['url'], headers={'Accept': 'application/json', 'Content-Type': 'application/json'}, data=resource['payload'], stream=True, verify=True)
+        self.assertEqual(b''.join(result), body)
+
+    @parameterized.expand([
+        ('true', "http://cb.example.org/v2/entities?type=Room&limit=20&options=keyValues"),
+        (None, "http://cb.example.org/v2/entities?type=Room"),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_preview_request(self, preview, expected_url, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room",
+            'format': 'fiware-ngsi',
+            'follow_pagination': 'true',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.headers['Fiware-Total-Count'] = '1'
+        base.request.headers = {}
+        base.request.params = {'preview': preview} if preview else {}
+        os.environ = {}
+
+        for i in range(2):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            self.assertEqual(b''.join(result), body)
+
+        if preview is None:
+            expected_url += "&limit=1000&offset=0&options=count"
+        session_pool.get_session().get.assert_called_with(expected_url, headers={'Accept': 'application/json'}, stream=True, verify=True)
+        logic.get_action('resource_show').assert_called_once_with(ANY, {'id': 'resource_id'})
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_export_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room",
+            'format': 'fiware-ngsi',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = 200
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = ('[{"id": "Room1", "type": "Room", "temp', 'erature": {"type": "Number", "value": 21}}]')
+        base.request.headers = {}
+        base.request.params = {}
+        base.response.headers = {}
+        os.environ = {}
+
+        result = self.controller.export_ngsi_resource("resource_id", "csv")
+
+        self.assertEqual(b''.join(result), 'id,type,temperature\nRoom1,Room,21\n')
+        self.assertEqual(base.response.content_type, 'text/csv')
+        self.assertEqual(base.response.headers['Content-Disposition'], 'attachment; filename="resource_id.csv"')
+        # Exports follow pagination
+        session_pool.get_session().get.assert_called_once_with("http://cb.example.org/v2/entities?type=Room&limit=1000&offset=0&options=count", headers={'Accept': 'application/json'}, stream=True, verify=True)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_export_max_response_size(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities/Room1",
+            'format': 'fiware-ngsi',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = 200
+        response.headers = {'content-type': 'application/json', 'content-length': '2048'}
+        base.request.headers = {}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.response_streamer", ResponseStreamer(max_size=1024)):
+            with self.assertRaises(TypeError):
+                self.controller.export_ngsi_resource("resource_id", "csv")
+
+        base.abort.assert_called_once_with(502, detail=ANY)
+        response.close.assert_called_with()
+
+    @parameterized.expand([
+        ('xml', 200, 404),
+        ('csv', 404, 404),
+        ('ndjson', 500, 500),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_export_request_error(self, export_format, upstream_status, status, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities/Room1",
+            'format': 'fiware-ngsi',
+        }
+        session_pool.get_session().get.return_value.status_code = upstream_status
+        base.request.headers = {}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with self.assertRaises(TypeError):
+            self.controller.export_ngsi_resource("resource_id", export_format)
+
+        base.abort.assert_called_once_with(status, detail=ANY)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_chart_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://ql.example.org/v2/entities/Room1",
+            'format': 'fiware-ngsi',
+            'chart_attrs': 'temperature',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = 200
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = (json.dumps({
+            "index": ["2018-01-01T00:00:00Z", "2018-01-01T00:00:01Z", "2018-01-01T00:00:02Z"],
+            "attributes": [{"attrName": "temperature", "values": [21, 25, 22]}, {"attrName": "pressure", "values": [1, 2, 3]}],
+        }),)
+        base.request.headers = {}
+        base.request.params = {'points': '2'}
+        os.environ = {}
+
+        result = self.controller.chart_ngsi_resource("resource_id")
+
+        self.assertEqual(json.loads(result), {'labels': ['time', 'temperature'], 'columns': [[1514764800000, 1514764802000], [21, 22]]})
+        self.assertEqual(base.response.content_type, 'application/json')
+
+    @parameterized.expand([
+        ({'method': 'avg'}, 200, '[]', 400),
+        ({'width': 'wide'}, 200, '[]', 400),
+        ({}, 404, '', 404),
+        ({}, 200, '{invalid', 502),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_chart_request_error(self, params, upstream_status, body, status, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://ql.example.org/v2/entities/Room1",
+            'format': 'fiware-ngsi',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = upstream_status
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = (body,)
+        base.request.headers = {}
+        base.request.params = params
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with self.assertRaises(TypeError):
+            self.controller.chart_ngsi_resource("resource_id")
+
+        base.abort.assert_called_once_with(status, detail=ANY)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_compressed_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        response.headers = {'content-type': 'application/json', 'ETag': '"upstream"'}
+        base.request.headers = {'Accept-Encoding': 'gzip'}
+        base.response.headers = {}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.response_compressor", ResponseCompressor(min_size=0)):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertEqual(gunzip_body(b''.join(result)), body)
+        self.assertEqual(base.response.headers, {'Content-Encoding': 'gzip', 'ETag': 'W/"upstream"', 'Vary': 'Accept-Encoding'})
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_compressed_passthrough(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+            'cache_ttl': '60',
+        }
+        body = b'[{"id": "1"}]'
+        response = Response()
+        response.status_code = 200
+        response.headers.update({'content-type': 'application/json', 'content-encoding': 'gzip'})
+        response.raw = MagicMock()
+        response.raw.stream.return_value = iter([gzip_body(body)])
+        session_pool.get_session().get.return_value = response
+        base.request.headers = {'Accept-Encoding': 'gzip'}
+        base.response.headers = {}
+        os.environ = {}
+
+        cache = ResponseCache(ttl=60)
+        # Coalesced responses are buffered, so they are already decoded
+        with patch.multiple("ckanext.right_time_context.controller", response_compressor=ResponseCompressor(), response_cache=cache, request_coalescer=SingleFlight(enabled=False)):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            self.assertEqual(gunzip_body(b''.join(result)), body)
+
+        response.raw.stream.assert_called_once_with(ANY, decode_content=False)
+        self.assertEqual(base.response.headers['Content-Encoding'], 'gzip')
+        # The response is cached uncompressed
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(next(iter(cache._entries.values())).body, body)
+
+    @parameterized.expand([
+        (200, {}, ['[{"id": ', '"1"}]'], True),
+        (200, {}, ['[{"id": ', '"1"}, ', '{"id": "2"}]'], False),
+        (200, {'content-length': '100'}, ['[]'], False),
+        (404, {}, ['{}'], False),
+    ])
+    def test_coalesced_response(self, status_code, headers, chunks, shared):
+        response = MagicMock(status_code=status_code, headers=headers)
+        response.iter_content.return_value = iter(chunks)
+        plan = self.controller._build_plan({'url': "http://cb.example.org/v2/entities", 'format': 'fiware-ngsi'})
+
+        # Responses are buffered while reading them, even if they don't
+        # declare their size
+        with patch.multiple("ckanext.right_time_context.controller", request_coalescer=SingleFlight(max_size=15)):
+            with patch.object(self.controller, '_proxy_resource', return_value=response):
+                r = self.controller._coalesced_proxy_resource(plan, {})
+
+        self.assertEqual(isinstance(r, BufferedResponse), shared)
+        self.assertEqual(b''.join(r.iter_content(chunk_size=4)), b''.join(chunks))
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, prewarm_scheduler=DEFAULT)
+    def test_prewarm_record(self, base, logic, requests, toolkit, os, session_pool, prewarm_scheduler):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        base.request.headers = {}
+        os.environ = {}
+
+        cache = ResponseCache(ttl=60)
+        key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json"})
+        entry = CacheEntry('{"cached": "body"}', "application/json", "utf-8", {'ETag': '"a"'}, 60)
+        cache.set(key, entry)
+
+        with patch.multiple("ckanext.right_time_context.controller", response_compressor=ResponseCompressor(), response_cache=cache):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        prewarm_scheduler.record.assert_called_once_with("resource_id", key, resource, ANY)
+
+        # Refreshes use conditional requests
+        fetch = prewarm_scheduler.record.call_args[0][3]
+        fetch(entry)
+        session_pool.get_session().get.assert_called_once_with(resource['url'], headers={'Accept': 'application/json', 'If-None-Match': '"a"'}, stream=True, verify=True)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, materialized_store=DEFAULT)
+    def test_materialized_request(self, base, logic, requests, toolkit, os, session_pool, materialized_store):
+        resource = {
+            'url': "http://cb.example.org/v2/entities",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        base.request.headers = {}
+        base.request.params = {}
+        base.response.headers = {}
+        os.environ = {}
+        materialized_store.is_enabled.return_value = True
+        materialized_store.get.return_value = CacheEntry('[{"id": "Room1"}]', "application/json", "utf-8", {}, 0)
+
+        with patch.multiple("ckanext.right_time_context.controller", response_compressor=ResponseCompressor()):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        plan = proxy_plans.get("resource_id")
+        materialized_store.get.assert_called_once_with("resource_id", plan, plan)
+        session_pool.get_session().get.assert_not_called()
+        base.response.body_file.write.assert_called_once_with('[{"id": "Room1"}]')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, live_updates=DEFAULT)
+    def test_live_request(self, base, logic, requests, toolkit, os, session_pool, live_updates):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room",
+            'format': 'fiware-ngsi',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = 200
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = ('[{"id": "Room1"}]',)
+        base.request.headers = {'Last-Event-ID': 'version'}
+        base.request.params = {'preview': 'true'}
+        base.response.headers = {}
+        os.environ = {}
+
+        result = self.controller.live_ngsi_resource("resource_id")
+
+        self.assertEqual(result, live_updates.stream.return_value)
+        live_updates.stream.assert_called_once_with(live_updates.subscribe.return_value)
+        self.assertEqual(base.response.content_type, 'text/event-stream')
+        self.assertEqual(base.response.headers['Cache-Control'], 'no-cache')
+
+        # Polls use the preview query, reconnecting clients resume from the
+        # last event they received
+        key, fetch, version = live_updates.subscribe.call_args[0]
+        self.assertEqual(version, 'version')
+        self.assertEqual(fetch(), '[{"id": "Room1"}]')
+        url = session_pool.get_session().get.call_args[0][0]
+        self.assertIn('options=keyValues', url)
+        self.assertEqual(key, build_cache_key("resource_id", "GET", url, "", {"Accept": "application/json"}))
+
+    @parameterized.expand([
+        (False, MagicMock(), 404),
+        (True, None, 503),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, live_updates=DEFAULT)
+    def test_live_request_error(self, enabled, subscriber, status, base, logic, requests, toolkit, os, session_pool, live_updates):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room",
+            'format': 'fiware-ngsi',
+        }
+        base.request.params = {}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+        live_updates.enabled = enabled
+        live_updates.subscribe.return_value = subscriber
+
+        with self.assertRaises(TypeError):
+            self.controller.live_ngsi_resource("resource_id")
+
+        self.assertEqual(base.abort.call_args[0][0], status)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT, response_cache=DEFAULT)
+    def test_delta_request(self, base, logic, requests, toolkit, os, session_pool, response_cache):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entities?type=Room&limit=10",
+            'format': 'fiware-ngsi',
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = 200
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = ('[{"id": "Room1", "dateModified": {"type": "DateTime", "value": "2018-01-01T00:00:05.000Z"}}]',)
+        base.request.headers = {}
+        base.request.params = {'since': '2018-01-01T00:00:00Z'}
+        base.response.headers = {}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.delta_tracker", DeltaTracker()):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        result = json.loads(base.response.body_file.write.call_args[0][0])
+        self.assertEqual(result['entities'], [{'id': 'Room1'}])
+        self.assertEqual(result['removed'], [])
+        self.assertEqual(decode_cursor(result['cursor']), (1514764805000, None))
+        self.assertEqual(base.response.content_type, 'application/json')
+
+        # The query is rewritten and never cached
+        url = session_pool.get_session().get.call_args[0][0]
+        params = dict(get_query_params(url))
+        self.assertEqual(params['q'], 'dateModified>2018-01-01T00:00:00.000Z')
+        self.assertIn('dateModified', params['options'].split(','))
+        self.assertEqual(params['type'], 'Room')
+        response_cache.store.assert_not_called()
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities/Room1",),
+        ("http://cb.example.org/v2/entities",),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_delta_request_diff(self, url, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': url,
+            'format': 'fiware-ngsi',
+            'cache_ttl': '0',
+        }
+        bodies = ['{"id": "Room1", "temperature": 21}', '{"id": "Room1", "temperature": 22}']
+
+        def get(url, *args, **kwargs):
+            # The Context Broker rejects rewritten queries
+            response = MagicMock(status_code=400 if 'dateModified' in url else 200, headers={'Content-Type': 'application/json'})
+            if response.status_code == 200:
+                response.iter_content.return_value = (bodies.pop(0),)
+            return response
+
+        session_pool.get_session().get.side_effect = get
+        base.request.headers = {}
+        base.request.params = {'since': '2018-01-01T00:00:00Z'}
+        base.response.headers = {}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.delta_tracker", DeltaTracker()):
+            self.controller.proxy_ngsi_resource("resource_id")
+            result = json.loads(base.response.body_file.write.call_args[0][0])
+            self.assertEqual(result['entities'], [{'id': 'Room1', 'temperature': 21}])
+            self.assertTrue(result['complete'])
+
+            base.request.params = {'since': result['cursor']}
+            self.controller.proxy_ngsi_resource("resource_id")
+            result = json.loads(base.response.body_file.write.call_args[0][0])
+            self.assertEqual(result['entities'], [{'id': 'Room1', 'temperature': 22}])
+            self.assertFalse(result['complete'])
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", 'fiware-ngsi', 'yesterday', 200, '[]', 400),
+        ("http://cb.example.org/v1/contextEntities", 'fiware-ngsi', '2018-01-01T00:00:00Z', 200, '[]', 400),
+        ("http://cb.example.org/v2/entities", 'fiware-ngsi', '2018-01-01T00:00:00Z', 500, '', 500),
+        ("http://cb.example.org/v2/entities", 'fiware-ngsi', '2018-01-01T00:00:00Z', 200, '{invalid', 502),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_delta_request_error(self, url, format, since, upstream_status, body, status, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': url,
+            'format': format,
+        }
+        response = session_pool.get_session().get.return_value
+        response.status_code = upstream_status
+        response.headers = {'Content-Type': 'application/json'}
+        response.iter_content.return_value = (body,)
+        base.request.headers = {}
+        base.request.params = {'since': since}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with self.assertRaises(TypeError):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        base.abort.assert_called_once_with(status, detail=ANY)
+
+    @parameterized.expand([
+        (True, None, 204),
+        (False, None, 404),
+        (None, ValueError, 403),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, materialized_store=DEFAULT)
+    def test_notify_request(self, accepted, error, status, base, materialized_store):
+        base.request.method = 'POST'
+        base.request.body = '{"subscriptionId": "sub1", "data": []}'
+        base.request.params = {'token': 'token'}
+        base.abort.side_effect = TypeError
+        materialized_store.notify.return_value = accepted
+        materialized_store.notify.side_effect = error
+
+        if status == 204:
+            self.controller.notify_ngsi_resource("resource_id")
+            self.assertEqual(base.response.status_int, 204)
+        else:
+            with self.assertRaises(TypeError):
+                self.controller.notify_ngsi_resource("resource_id")
+            base.abort.assert_called_once_with(status, detail=ANY)
+
+        materialized_store.notify.assert_called_once_with("resource_id", "token", {"subscriptionId": "sub1", "data": []})
+
+    @parameterized.expand([
+        ('GET', '{}', 405),
+        ('POST', '{invalid', 400),
+        ('POST', '[]', 400),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, materialized_store=DEFAULT)
+    def test_notify_request_invalid(self, method, body, status, base, materialized_store):
+        base.request.method = method
+        base.request.body = body
+        base.abort.side_effect = TypeError
+
+        with self.assertRaises(TypeError):
+            self.controller.notify_ngsi_resource("resource_id")
+
+        self.assertEqual(base.abort.call_args[0][0], status)
+        materialized_store.notify.assert_not_called()
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_compressed_cached_response(self, base, logic, requests, toolkit, os, session_pool):
+        resource = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        logic.get_action('resource_show').return_value = resource
+        base.request.headers = {'Accept-Encoding': 'gzip'}
+        base.response.headers = {}
+        os.environ = {}
+
+        cache = ResponseCache(ttl=60)
+        key = build_cache_key("resource_id", "GET", resource['url'], "", {"Accept": "application/json"})
+        cache.set(key, CacheEntry('{"cached": "body"}', "application/json", "utf-8", {}, 60))
+
+        with patch.multiple("ckanext.right_time_context.controller", response_compressor=ResponseCompressor(min_size=0), response_cache=cache):
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_not_called()
+        self.assertEqual(base.response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gunzip_body(base.response.body_file.write.call_args[0][0]), '{"cached": "body"}')
+
+    def _batch_resources(self, resources):
+        def resource_show(context, data_dict):
+            if data_dict['id'] not in resources:
+                raise NotFound()
+            return dict(resources[data_dict['id']])
+
+        return resource_show
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_batch_request(self, base, logic, toolkit, os, session_pool):
+        logic.NotFound = NotFound
+        logic.get_action.return_value = self._batch_resources({
+            'a': {'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi'},
+            'b': {'url': "http://cb.example.org/v2/entities?type=Car", 'format': 'fiware-ngsi'},
+            'c': {'url': "http://cb.example.org/v2/entities?type=Bus", 'format': 'fiware-ngsi'},
+            'd': {'url': "http://other.example.org/v2/entities", 'format': 'fiware-ngsi'},
+            'f': {'url': "http://cb.example.org/v2/entities?type=Bike", 'format': 'fiware-ngsi'},
+        })
+
+        def get(url, **kwargs):
+            if 'Room' in url:
+                return MagicMock(status_code=200, headers={'content-type': 'application/json'}, iter_content=MagicMock(return_value=['[{"id": "Room1"}]']))
+            elif 'Car' in url:
+                return MagicMock(status_code=500, headers={})
+            elif 'Bus' in url:
+                raise ConnectionError()
+            elif 'Bike' in url:
+                return MagicMock(status_code=200, headers={'content-type': 'application/json'}, iter_content=MagicMock(return_value=['[{"id": "Bike1"}']))
+            raise Timeout()
+
+        session_pool.get_session().get.side_effect = get
+        base.request.params.getall.return_value = ['a,b', 'c', 'd', 'e', 'f']
+        base.request.headers = {}
+        os.environ = {}
+
+        result = self.controller.proxy_ngsi_batch()
+        lines = [json.loads(line) for line in b''.join(result).splitlines()]
+
+        base.request.params.getall.assert_called_once_with('id')
+        self.assertEqual(base.response.content_type, 'application/x-ndjson')
+        self.assertEqual(sorted(lines, key=lambda line: line['id']), [
+            {'id': 'a', 'status': 200, 'content_type': 'application/json', 'data': [{'id': 'Room1'}]},
+            {'id': 'b', 'status': 500, 'error': ANY},
+            {'id': 'c', 'status': 502, 'error': ANY},
+            {'id': 'd', 'status': 504, 'error': ANY},
+            {'id': 'e', 'status': 404, 'error': ANY},
+            {'id': 'f', 'status': 502, 'error': 'The Context Broker returned an invalid JSON response.'},
+        ])
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_batch_request_not_authorized(self, base, logic, toolkit, os, session_pool):
+        logic.NotFound = NotFound
+        logic.NotAuthorized = NotAuthorized
+        logic.get_action.return_value.side_effect = NotAuthorized
+        base.request.params.getall.return_value = ['a']
+        base.request.headers = {}
+        os.environ = {}
+
+        result = self.controller.proxy_ngsi_batch()
+
+        self.assertEqual(json.loads(b''.join(result)), {'id': 'a', 'status': 403, 'error': ANY})
+        session_pool.get_session().get.assert_not_called()
+
+    @parameterized.expand([
+        ([],),
+        (['a,b,c'],),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_batch_invalid_ids(self, ids, base, logic, toolkit, os, session_pool):
+        base.request.params.getall.return_value = ids
+        base.abort.side_effect = TypeError
+
+        with patch("ckanext.right_time_context.controller.batch_proxy", BatchProxy(max_resources=2)):
+            with self.assertRaises(TypeError):
+                self.controller.proxy_ngsi_batch()
+
+        base.abort.assert_called_once_with(400, detail=ANY)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_package_request(self, base, logic, toolkit, os, session_pool):
+        logic.get_action('package_show').return_value = {
+            'resources': [
+                {'id': 'a', 'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi', 'tenant': 'a'},
+                {'id': 'b', 'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi', 'tenant': 'b'},
+                {'id': 'c', 'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi', 'tenant': 'c'},
+                {'id': 'd', 'url': "http://cb.example.org/v2/entities", 'format': 'CSV'},
+            ]
+        }
+
+        def get(url, headers, **kwargs):
+            tenant = headers['FIWARE-Service']
+            if tenant == 'c':
+                return MagicMock(status_code=500, headers={})
+
+            body = '[{"id": "Room1", "type": "Room"}, {"id": "Room-%s", "type": "Room"}]' % tenant
+            return MagicMock(status_code=200, headers={'content-type': 'application/json'}, iter_content=MagicMock(return_value=[body]))
+
+        session_pool.get_session().get.side_effect = get
+        base.request.params = {'dedup': 'true'}
+        base.request.headers = {}
+        os.environ = {}
+
+        result = self.controller.proxy_ngsi_package('dataset')
+        entities = json.loads(b''.join(result))
+
+        logic.get_action('package_show').assert_called_with(ANY, {'id': 'dataset'})
+        # Resources are not retrieved again
+        self.assertEqual(logic.get_action.return_value.call_count, 1)
+        self.assertEqual(session_pool.get_session().get.call_count, 3)
+        self.assertEqual(sorted(entity['id'] for entity in entities), ['Room-a', 'Room-b', 'Room1'])
+        self.assertEqual(base.response.content_type, 'application/json')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_package_request_not_found(self, base, logic, toolkit, os, session_pool):
+        logic.NotFound = NotFound
+        logic.get_action('package_show').side_effect = NotFound
+        base.abort.side_effect = TypeError
+
+        with self.assertRaises(TypeError):
+            self.controller.proxy_ngsi_package('dataset')
+
+        base.abort.assert_called_once_with(404, detail=ANY)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_sharded_registration_request(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'format': 'fiware-ngsi-registry',
+            'url': 'http://cb.example.org',
+            'entity': [{'id': 'vehicle%d' % i, 'value': 'Vehicle'} for i in range(3)],
+        }
+
+        def post(url, headers, data, **kwargs):
+            ids = [entity['id'] for entity in json.loads(data)['entities']]
+            return MagicMock(status_code=200, headers={'content-type': 'application/json', 'Fiware-Total-Count': str(len(ids))}, content=json.dumps([{'id': i} for i in ids]))
+
+        session_pool.get_session().post.side_effect = post
+        base.request.headers = {}
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.registry_sharder", RegistrySharder(shard_size=2)):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            entities = json.loads(b''.join(result))
+
+        self.assertEqual(sorted(entity['id'] for entity in entities), ['vehicle0', 'vehicle1', 'vehicle2'])
+        self.assertEqual(session_pool.get_session().post.call_count, 2)
+        session_pool.get_session().post.assert_any_call('http://cb.example.org/v2/op/query?limit=1000&offset=0&options=count', headers=ANY, data=ANY, stream=True, verify=True)
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_circuit_open(self, base, logic, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        session_pool.get_session().get.side_effect = ConnectionError
+        base.request.headers = {}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+
+        with patch("ckanext.right_time_context.controller.circuit_breaker", CircuitBreaker(min_requests=2, open_time=30)):
+            for i in range(2):
+                with self.assertRaises(TypeError):
+                    self.controller.proxy_ngsi_resource("resource_id")
+                base.abort.assert_called_with(502, detail=ANY)
+
+            session_pool.get_session().get.reset_mock()
+            with self.assertRaises(TypeError):
+                self.controller.proxy_ngsi_resource("resource_id")
+
+        session_pool.get_session().get.assert_not_called()
+        base.abort.assert_called_with(503, detail=ANY, headers={'Retry-After': '30'})
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_circuit_probe_unexpected_error(self, base, logic, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://cb.example.org/v2/entites",
+            'format': 'fiware-ngsi',
+        }
+        base.request.headers = {}
+        base.abort.side_effect = TypeError
+        os.environ = {}
+        breaker = CircuitBreaker(min_requests=1, open_time=30)
+
+        with patch("ckanext.right_time_context.controller.circuit_breaker", breaker), patch("ckanext.right_time_context.circuit.time") as time:
+            time.time.return_value = 1000
+            breaker.record('cb.example.org', False)
+            time.time.return_value = 1030
+
+            # The probe fails with an error not caused by the Context Broker
+            session_pool.get_session().get.side_effect = ValueError
+            with self.assertRaises(ValueError):
+                self.controller.proxy_ngsi_resource("resource_id")
+
+            # The next request can probe again
+            session_pool.get_session().get.side_effect = None
+            self._mock_response(session_pool.get_session().get.return_value)
+            self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertEqual(session_pool.get_session().get.call_count, 2)
+        self.assertEqual(breaker.stats()['hosts']['cb.example.org']['state'], 'closed')
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_request_metrics(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').return_value = {
+            'url': "http://CB.example.org/v2/entites",
+            'format': 'FIWARE-ngsi',
+        }
+        response, body = self._mock_response(session_pool.get_session().get())
+        base.request.headers = {}
+        base.response.status_int = 200
+        os.environ = {}
+
+        metrics = ProxyMetrics()
+        with patch("ckanext.right_time_context.controller.proxy_metrics", metrics):
+            result = self.controller.proxy_ngsi_resource("resource_id")
+            self.assertEqual(metrics.in_flight.get(), 1)
+            b''.join(result)
+
+        self.assertEqual(metrics.in_flight.get(), 0)
+        self.assertEqual(metrics.requests.samples(), [(('fiware-ngsi', 'cb.example.org', '200'), 1)])
+        self.assertEqual(metrics.response_bytes.get(('fiware-ngsi',)), len(body))
+
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT, requests=DEFAULT, toolkit=DEFAULT, os=DEFAULT, session_pool=DEFAULT)
+    def test_request_metrics_error(self, base, logic, requests, toolkit, os, session_pool):
+        logic.get_action('resource_show').side_effect = HTTPNotFound()
+
+        metrics = ProxyMetrics()
+        with patch("ckanext.right_time_context.controller.proxy_metrics", metrics):
+            with self.assertRaises(HTTPNotFound):
+                self.controller.proxy_ngsi_resource("resource_id")
+
+        self.assertEqual(metrics.in_flight.get(), 0)
+        self.assertEqual(metrics.requests.samples(), [(('unknown', '', '404'), 1)])
+
+    @parameterized.expand([
+        (None, {}, None),
+        ('secret', {'Authorization': 'Bearer secret'}, None),
+        ('secret', {'Authorization': 'Bearer other'}, 403),
+    ])
+    @patch.multiple("ckanext.right_time_context.controller", base=DEFAULT, logic=DEFAULT)
+    def test_metrics(self, token, headers, error, base, logic):
+        base.request.headers = headers
+        base.response.headers = {}
+        base.abort.side_effect = TypeError
+
+        with patch("ckanext.right_time_context.controller.proxy_metrics", ProxyMetrics(token=token)):
+            if error is not None:
+                self.assertRaises(TypeError, self.controller.metrics)
+                base.abort.assert_called_once_with(error, detail=ANY)
+                return
+
+            output = self.controller.metrics()
+
+        if token is None:
+            logic.check_access.assert_called_once_with('sysadmin', ANY, {})
+        else:
+            logic.check_access.assert_not_called()
+        self.assertEqual(base.response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('# TYPE ngsi_proxy_requests_total counter', output)
+        self.assertIn('ngsi_proxy_cache_requests_total', output)
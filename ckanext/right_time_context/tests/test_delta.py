@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import unittest
+import urlparse
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.delta import decode_cursor, DeltaTracker, encode_cursor, format_timestamp
+from ckanext.right_time_context.pagination import get_query_params
+
+ENTITIES = [
+    {'id': 'Room1', 'type': 'Room', 'temperature': 21},
+    {'id': 'Room2', 'type': 'Room', 'temperature': 23},
+]
+
+
+class DeltaTrackerTestCase(unittest.TestCase):
+
+    def test_configure(self):
+        tracker = DeltaTracker()
+        tracker.configure({
+            'ckan.right_time_context.delta_rewrite': 'false',
+            'ckan.right_time_context.delta_max_snapshots': '5',
+        })
+
+        self.assertFalse(tracker.rewrite_enabled)
+        self.assertEqual(tracker.max_snapshots, 5)
+
+    def test_format_timestamp(self):
+        self.assertEqual(format_timestamp(1514764800123), '2018-01-01T00:00:00.123Z')
+
+    @parameterized.expand([
+        (1514764800000, None),
+        (None, 'abc'),
+        (1514764800000, 'abc'),
+    ])
+    def test_cursor(self, timestamp, snapshot_id):
+        self.assertEqual(decode_cursor(encode_cursor(timestamp, snapshot_id)), (timestamp, snapshot_id))
+
+    @parameterized.expand([
+        ('invalid',),
+        ('e30',),
+        ('eyJ0IjoiYSIsInMiOm51bGx9',),
+    ])
+    def test_invalid_cursor(self, cursor):
+        with self.assertRaises(ValueError):
+            decode_cursor(cursor)
+
+    def test_parse_since_date(self):
+        self.assertEqual(DeltaTracker().parse_since('2018-01-01T00:00:00Z'), (1514764800000, None))
+
+    def test_parse_since_cursor(self):
+        self.assertEqual(DeltaTracker().parse_since(encode_cursor(1, 'abc')), (1, 'abc'))
+
+    @parameterized.expand([
+        ('fiware-ngsi', 'http://cb.example.org/v2/entities', True, True),
+        ('fiware-ngsi', 'http://cb.example.org/v2/entities/Room1', True, False),
+        ('fiware-ngsi', 'http://cb.example.org/v1/contextEntities', False, False),
+        ('csv', 'http://cb.example.org/v2/entities', False, False),
+    ])
+    def test_is_supported(self, format, url, supported, rewrite):
+        tracker = DeltaTracker()
+        resource = {'format': format, 'url': url}
+
+        self.assertEqual(tracker.is_supported(resource, urlparse.urlsplit(url)), supported)
+        self.assertEqual(tracker.can_rewrite(resource, urlparse.urlsplit(url)), rewrite)
+
+    def test_can_rewrite_disabled(self):
+        url = 'http://cb.example.org/v2/entities'
+        self.assertFalse(DeltaTracker(rewrite=False).can_rewrite({'format': 'fiware-ngsi'}, urlparse.urlsplit(url)))
+
+    @parameterized.expand([
+        ('http://cb.example.org/v2/entities', {'q': 'dateModified>2018-01-01T00:00:00.000Z', 'options': 'dateModified'}),
+        ('http://cb.example.org/v2/entities?q=temperature>20&limit=10&offset=20&options=keyValues', {'q': 'temperature>20;dateModified>2018-01-01T00:00:00.000Z', 'options': 'keyValues,dateModified'}),
+        ('http://cb.example.org/v2/entities?attrs=temperature', {'q': 'dateModified>2018-01-01T00:00:00.000Z', 'attrs': 'temperature,dateModified', 'options': 'dateModified'}),
+    ])
+    def test_rewrite(self, url, expected):
+        result = DeltaTracker().rewrite(url, 1514764800000)
+
+        self.assertEqual(dict(get_query_params(result)), expected)
+
+    def test_rewrite_result(self):
+        tracker = DeltaTracker()
+        entities = [
+            {'id': 'Room1', 'temperature': 21, 'dateModified': {'type': 'DateTime', 'value': '2018-01-01T00:00:05.000Z'}},
+            {'id': 'Room2', 'temperature': 23, 'dateModified': '2018-01-01T00:00:03.000Z'},
+        ]
+
+        result = tracker.get_rewrite_result('http://cb.example.org/v2/entities', entities, 1514764800000)
+
+        self.assertEqual(result['entities'], [{'id': 'Room1', 'temperature': 21}, {'id': 'Room2', 'temperature': 23}])
+        self.assertEqual(result['removed'], [])
+        self.assertFalse(result['complete'])
+        self.assertEqual(decode_cursor(result['cursor']), (1514764805000, None))
+        self.assertEqual(tracker.stats()['rewrites'], 1)
+
+    def test_rewrite_result_requested_attribute(self):
+        entity = {'id': 'Room1', 'dateModified': '2018-01-01T00:00:05.000Z'}
+
+        result = DeltaTracker().get_rewrite_result('http://cb.example.org/v2/entities?options=dateModified', [entity], 1514764800000)
+
+        self.assertEqual(result['entities'], [entity])
+
+    def test_rewrite_result_empty(self):
+        result = DeltaTracker().get_rewrite_result('http://cb.example.org/v2/entities', [], 1514764800000)
+
+        self.assertEqual(result['entities'], [])
+        self.assertEqual(decode_cursor(result['cursor']), (1514764800000, None))
+
+    def test_diff_without_snapshot(self):
+        tracker = DeltaTracker()
+
+        result = tracker.get_diff_result('key', None, ENTITIES)
+
+        self.assertEqual(result['entities'], ENTITIES)
+        self.assertEqual(result['removed'], [])
+        self.assertTrue(result['complete'])
+        self.assertEqual(tracker.stats()['snapshots'], 1)
+
+    def test_diff(self):
+        tracker = DeltaTracker()
+        snapshot_id = decode_cursor(tracker.get_diff_result('key', None, ENTITIES)['cursor'])[1]
+        entities = [
+            {'id': 'Room2', 'type': 'Room', 'temperature': 25},
+            {'id': 'Room3', 'type': 'Room', 'temperature': 20},
+        ]
+
+        result = tracker.get_diff_result('key', snapshot_id, entities)
+
+        self.assertEqual(result['entities'], entities)
+        self.assertEqual(result['removed'], [{'id': 'Room1', 'type': 'Room'}])
+        self.assertFalse(result['complete'])
+        self.assertNotEqual(decode_cursor(result['cursor'])[1], snapshot_id)
+
+    def test_diff_unchanged(self):
+        tracker = DeltaTracker()
+        cursor = tracker.get_diff_result('key', None, ENTITIES)['cursor']
+
+        result = tracker.get_diff_result('key', decode_cursor(cursor)[1], list(ENTITIES))
+
+        self.assertEqual(result['entities'], [])
+        self.assertEqual(result['removed'], [])
+        self.assertEqual(result['cursor'], cursor)
+        self.assertEqual(tracker.stats()['snapshots'], 1)
+
+    def test_diff_other_owner(self):
+        tracker = DeltaTracker()
+        snapshot_id = decode_cursor(tracker.get_diff_result('key', None, ENTITIES)['cursor'])[1]
+
+        result = tracker.get_diff_result('other', snapshot_id, ENTITIES[:1])
+
+        self.assertEqual(result['entities'], ENTITIES[:1])
+        self.assertTrue(result['complete'])
+
+    def test_diff_evicted_snapshot(self):
+        tracker = DeltaTracker(max_snapshots=1)
+        snapshot_id = decode_cursor(tracker.get_diff_result('key', None, ENTITIES)['cursor'])[1]
+        tracker.get_diff_result('other', None, ENTITIES)
+
+        result = tracker.get_diff_result('key', snapshot_id, ENTITIES)
+
+        self.assertTrue(result['complete'])
+        self.assertEqual(tracker.stats()['snapshots'], 1)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import copy
+import json
+import pickle
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+import simplejson
+
+from ckanext.right_time_context.commands import RightTimeContextCommand
+from ckanext.right_time_context.entities import COMPACT_FIELD, decode_entities, encode_entities, EntityStore, LazyEntities
+
+ENTITIES = [
+    {'id': '.*', 'value': 'Room', 'isPattern': 'on'},
+    {'id': 'vehicle1', 'value': 'Vehicle'},
+]
+
+FLAT_EXTRAS = {
+    'entity__0__id': '.*', 'entity__0__value': 'Room', 'entity__0__isPattern': 'on',
+    'entity__1__id': 'vehicle1', 'entity__1__value': 'Vehicle',
+}
+
+
+class EntityStoreTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ('compact', 'compact'),
+        ('FLAT', 'flat'),
+        ('other', 'compact'),
+    ])
+    def test_configure(self, value, expected):
+        store = EntityStore()
+        store.configure({'ckan.right_time_context.entity_storage': value})
+
+        self.assertEqual(store.storage, expected)
+
+    def test_encode_entities(self):
+        self.assertEqual(decode_entities(encode_entities(ENTITIES)), ENTITIES)
+
+    def test_encode_entities_size(self):
+        entities = [{'id': 'urn:ngsi-ld:Vehicle:{0}'.format(index), 'value': 'Vehicle'} for index in range(1000)]
+
+        self.assertLess(len(encode_entities(entities)), len(json.dumps(entities)) / 4)
+
+    @parameterized.expand([
+        ('invalid',),
+        (encode_entities([])[:-4],),
+        ('eJyrVgIAAK4AfQ==',),
+    ])
+    def test_decode_invalid_entities(self, value):
+        with self.assertRaises(ValueError):
+            decode_entities(value)
+
+    def test_serialize(self):
+        store = EntityStore()
+        resource = dict(FLAT_EXTRAS, format='fiware-ngsi-registry')
+
+        store.serialize(resource, ENTITIES[1:])
+
+        self.assertEqual(resource, {'format': 'fiware-ngsi-registry', COMPACT_FIELD: encode_entities(ENTITIES[1:])})
+        self.assertEqual(store.stats()['encoded'], 1)
+
+    def test_serialize_flat(self):
+        store = EntityStore(storage='flat')
+        resource = {'format': 'fiware-ngsi-registry', COMPACT_FIELD: encode_entities(ENTITIES)}
+
+        store.serialize(resource, ENTITIES)
+
+        self.assertEqual(resource, dict(FLAT_EXTRAS, format='fiware-ngsi-registry'))
+
+    def test_deserialize_flat(self):
+        self.assertEqual(EntityStore().deserialize(FLAT_EXTRAS), ENTITIES)
+
+    def test_deserialize(self):
+        store = EntityStore()
+
+        entities = store.deserialize(dict(FLAT_EXTRAS, **{COMPACT_FIELD: encode_entities(ENTITIES[1:])}))
+
+        self.assertEqual(store.stats()['decoded'], 0)
+        self.assertEqual(list(entities), ENTITIES[1:])
+        self.assertEqual(store.stats()['deferred'], 1)
+        self.assertEqual(store.stats()['decoded'], 1)
+
+    def test_deserialize_invalid(self):
+        self.assertEqual(EntityStore().deserialize({COMPACT_FIELD: 'invalid'}), [])
+
+    @parameterized.expand([
+        (FLAT_EXTRAS, True, {COMPACT_FIELD: encode_entities(ENTITIES)}),
+        (dict(FLAT_EXTRAS, **{COMPACT_FIELD: encode_entities(ENTITIES[1:])}), True, {COMPACT_FIELD: encode_entities(ENTITIES[1:])}),
+        ({COMPACT_FIELD: encode_entities(ENTITIES)}, False, {COMPACT_FIELD: encode_entities(ENTITIES)}),
+        ({'tenant': 'service'}, False, {'tenant': 'service'}),
+    ])
+    def test_migrate(self, extras, changed, expected):
+        extras = dict(extras)
+
+        self.assertEqual(EntityStore().migrate(extras), changed)
+        self.assertEqual(extras, expected)
+
+
+class LazyEntitiesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.decode = MagicMock(side_effect=decode_entities)
+        self.entities = LazyEntities(encode_entities(ENTITIES), self.decode)
+
+    def test_not_accessed(self):
+        self.assertFalse(self.entities.loaded)
+        self.decode.assert_not_called()
+
+    @parameterized.expand([
+        (len, 2),
+        (bool, True),
+        (list, ENTITIES),
+        (lambda entities: entities[1], ENTITIES[1]),
+        (lambda entities: entities[:1], ENTITIES[:1]),
+        (lambda entities: ENTITIES[1] in entities, True),
+        (lambda entities: entities == ENTITIES, True),
+        (lambda entities: [entity['id'] for entity in entities], ['.*', 'vehicle1']),
+        (json.dumps, json.dumps(ENTITIES)),
+        (lambda entities: simplejson.dumps(entities, for_json=True), json.dumps(ENTITIES)),
+        (copy.deepcopy, ENTITIES),
+        (lambda entities: pickle.loads(pickle.dumps(entities, 2)), ENTITIES),
+    ])
+    def test_access(self, access, expected):
+        self.assertEqual(access(self.entities), expected)
+        self.assertTrue(self.entities.loaded)
+        self.decode.assert_called_once_with(encode_entities(ENTITIES))
+
+    def test_modify(self):
+        self.entities.append({'id': 'vehicle2', 'value': 'Vehicle'})
+
+        self.assertEqual(len(self.entities), 3)
+        self.assertEqual(self.entities[:2], ENTITIES)
+        self.decode.assert_called_once_with(encode_entities(ENTITIES))
+
+
+class RightTimeContextCommandTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Options are added to the parser shared by all the instances
+        cls.command = RightTimeContextCommand('right_time_context')
+
+    def setUp(self):
+        self.command.options = MagicMock(dry_run=False)
+        self.resources = [
+            MagicMock(id='resource1', package_id='package1', extras=dict(FLAT_EXTRAS)),
+            MagicMock(id='resource2', package_id='package1', extras={COMPACT_FIELD: encode_entities(ENTITIES)}),
+        ]
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    @patch('ckan.lib.search.rebuild')
+    @patch('ckan.model.repo')
+    @patch('ckan.model.Session')
+    def test_migrate_entities(self, dry_run, session, repo, rebuild):
+        self.command.options.dry_run = dry_run
+        session.query().filter().all.return_value = self.resources
+
+        self.command._migrate_entities()
+
+        if dry_run:
+            self.assertEqual(self.resources[0].extras, FLAT_EXTRAS)
+            repo.commit.assert_not_called()
+            rebuild.assert_not_called()
+        else:
+            self.assertEqual(self.resources[0].extras, {COMPACT_FIELD: encode_entities(ENTITIES)})
+            repo.commit.assert_called_once_with()
+            rebuild.assert_called_once_with('package1')
+
+        self.assertEqual(self.resources[1].extras, {COMPACT_FIELD: encode_entities(ENTITIES)})
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import unittest
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.export import JSONItemParser, ResourceExporter
+from ckanext.right_time_context.streaming import TruncatedResponseError
+
+V2_ENTITIES = [
+    {"id": "Room1", "type": "Room", "temperature": {"type": "Number", "value": 21.5, "metadata": {}}, "name": {"type": "Text", "value": "a \"quoted\" [name], {x}\\"}},
+    {"id": "Room2", "type": "Room", "pressure": {"type": "Number", "value": 720, "metadata": {}}, "location": {"type": "geo:json", "value": {"type": "Point", "coordinates": [1, 2]}}},
+]
+
+V1_RESPONSE = {
+    "contextResponses": [
+        {
+            "contextElement": {"attributes": [{"name": "temperature", "type": "float", "value": "23"}], "id": "Room1", "isPattern": "false", "type": "Room"},
+            "statusCode": {"code": "200", "reasonPhrase": "OK"},
+        },
+        {
+            "contextElement": {"attributes": [{"name": "pressure", "type": "integer", "value": "720"}], "id": "Room2", "isPattern": "false", "type": "Room"},
+            "statusCode": {"code": "200", "reasonPhrase": "OK"},
+        },
+    ],
+}
+
+
+def split(body, size):
+    return [body[offset:offset + size] for offset in range(0, len(body), size)]
+
+
+class ExportTestCase(unittest.TestCase):
+
+    @parameterized.expand([(size,) for size in (1, 2, 3, 7, 1000)])
+    def test_parse_v2(self, chunk_size):
+        parser = JSONItemParser()
+        body = json.dumps(V2_ENTITIES, indent=1)
+
+        items = [item for chunk in split(body, chunk_size) for item in parser.feed(chunk)]
+
+        self.assertEqual(items, V2_ENTITIES)
+
+    @parameterized.expand([(size,) for size in (1, 2, 5, 1000)])
+    def test_parse_v1(self, chunk_size):
+        parser = JSONItemParser()
+        body = '{"count": 12, "other": [{"ignored": true}], ' + json.dumps(V1_RESPONSE)[1:]
+
+        items = [item for chunk in split(body, chunk_size) for item in parser.feed(chunk)]
+
+        self.assertEqual(items, V1_RESPONSE['contextResponses'])
+
+    @parameterized.expand([
+        ('[]',),
+        ('{"errorCode": {"code": "404", "reasonPhrase": "No context element found"}}',),
+        ('{"contextResponses": []}',),
+    ])
+    def test_parse_empty(self, body):
+        self.assertEqual(JSONItemParser().feed(body), [])
+
+    @parameterized.expand([(size,) for size in (1, 3, 1000)])
+    def test_parse_entity(self, chunk_size):
+        parser = JSONItemParser()
+        body = json.dumps(V2_ENTITIES[1], indent=1)
+
+        items = [item for chunk in split(body, chunk_size) for item in parser.feed(chunk)]
+
+        self.assertEqual(items, [V2_ENTITIES[1]])
+
+    def test_parse_context_element(self):
+        body = json.dumps(V1_RESPONSE['contextResponses'][0])
+
+        self.assertEqual(JSONItemParser().feed(body), [V1_RESPONSE['contextResponses'][0]])
+
+    @parameterized.expand([
+        ('[{"id": "Room1", "name": "' + 'a' * 100,),
+        ('[' + 'x' * 100,),
+        ('{"other": [' + '1, ' * 40 + '1], "count": "' + 'a' * 60 + '"',),
+    ])
+    def test_parse_max_size(self, body):
+        parser = JSONItemParser(max_size=64)
+
+        with self.assertRaises(TruncatedResponseError):
+            for chunk in split(body, 10):
+                parser.feed(chunk)
+
+    def test_csv(self):
+        exporter = ResourceExporter()
+
+        result = b''.join(exporter.run(split(json.dumps(V2_ENTITIES), 10), 'csv'))
+
+        self.assertEqual(result.splitlines(), [
+            'id,type,name,temperature,location,pressure',
+            'Room1,Room,"a ""quoted"" [name], {x}\\",21.5,,',
+            'Room2,Room,,,"{""coordinates"":[1,2],""type"":""Point""}",720',
+        ])
+        self.assertEqual(exporter.stats()['entities'], 2)
+
+    def test_csv_sample_size(self):
+        exporter = ResourceExporter(sample_size=1)
+
+        result = b''.join(exporter.run([json.dumps(V2_ENTITIES)], 'csv'))
+
+        self.assertEqual(result.splitlines(), ['id,type,name,temperature', 'Room1,Room,"a ""quoted"" [name], {x}\\",21.5', 'Room2,Room,,'])
+
+    def test_csv_attrs_v1(self):
+        exporter = ResourceExporter()
+
+        result = b''.join(exporter.run([json.dumps(V1_RESPONSE)], 'csv', ['pressure', 'humidity']))
+
+        self.assertEqual(result.splitlines(), ['id,type,pressure,humidity', 'Room1,Room,,', 'Room2,Room,720,'])
+
+    def test_csv_key_values(self):
+        entities = [{"id": "Room1", "type": "Room", "temperature": 21, "open": True, "name": u"Sal\xf3n"}]
+
+        result = b''.join(ResourceExporter().run([json.dumps(entities)], 'csv'))
+
+        self.assertEqual(result.splitlines(), ['id,type,name,open,temperature', 'Room1,Room,Sal\xc3\xb3n,true,21'])
+
+    def test_ndjson(self):
+        result = b''.join(ResourceExporter().run(split(json.dumps(V1_RESPONSE), 3), 'ndjson', ['temperature']))
+
+        self.assertEqual([json.loads(line) for line in result.splitlines()], [
+            {"id": "Room1", "type": "Room", "temperature": {"type": "float", "value": "23"}},
+            {"id": "Room2", "type": "Room"},
+        ])
+
+    def test_configure(self):
+        exporter = ResourceExporter()
+
+        exporter.configure({'ckan.right_time_context.export_sample_size': '10'})
+
+        self.assertEqual(exporter.sample_size, 10)
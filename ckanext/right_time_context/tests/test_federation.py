@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import threading
+import unittest
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.concurrency import unordered_map
+from ckanext.right_time_context.federation import FederatedQuery
+
+
+class FederatedQueryTestCase(unittest.TestCase):
+
+    SOURCES = {
+        'a': b'[{"id": "Room1", "type": "Room"}, {"id": "Room2", "type": "Room"}]',
+        'b': b'[{"id": "Room1", "type": "Room"}, {"id": "Room1", "type": "Car"}]',
+        'c': b'[]',
+        'd': b'{"error": "NotFound"}',
+        'e': None,
+    }
+
+    def _fetch(self, job):
+        return self.SOURCES[job[0]]
+
+    @parameterized.expand([
+        (False, ['Car:Room1', 'Room:Room1', 'Room:Room1', 'Room:Room2']),
+        (True, ['Car:Room1', 'Room:Room1', 'Room:Room2']),
+    ])
+    def test_run(self, dedup, expected):
+        query = FederatedQuery()
+
+        body = b''.join(query.run([(name,) for name in sorted(self.SOURCES)], self._fetch, dedup))
+
+        entities = json.loads(body)
+        self.assertEqual(sorted('{type}:{id}'.format(**entity) for entity in entities), expected)
+        self.assertEqual(query.stats()['duplicates'], 1 if dedup else 0)
+
+    @parameterized.expand([
+        (False,),
+        (True,),
+    ])
+    def test_run_normalized_sources(self, dedup):
+        sources = {
+            'v1': b'{"contextResponses": [{"contextElement": {"id": "Room1", "type": "Room", "attributes": [{"name": "temperature", "type": "Number", "value": 21}]}, "statusCode": {"code": "200"}}]}',
+            'v2': b'[{"id": "Room2", "type": "Room"}]',
+            'entity': b'{"id": "Room3", "type": "Room"}',
+        }
+        query = FederatedQuery()
+
+        body = b''.join(query.run([(name,) for name in sorted(sources)], lambda job: sources[job[0]], dedup))
+
+        entities = sorted(json.loads(body), key=lambda entity: entity['id'])
+        self.assertEqual([entity['id'] for entity in entities], ['Room1', 'Room2', 'Room3'])
+        self.assertEqual(entities[0]['temperature'], {'type': 'Number', 'value': 21})
+
+    def test_run_empty(self):
+        self.assertEqual(json.loads(b''.join(FederatedQuery().run([], self._fetch))), [])
+
+    def test_run_timeout(self):
+        event = threading.Event()
+        query = FederatedQuery(timeout=0.05)
+
+        def fetch(job):
+            if job[0] == 'slow':
+                event.wait(5)
+            return b'[{"id": "%s"}]' % job[0]
+
+        try:
+            body = b''.join(query.run([('slow',), ('fast',)], fetch))
+        finally:
+            event.set()
+
+        self.assertEqual(json.loads(body), [{'id': 'fast'}])
+        self.assertEqual(query.stats()['timeouts'], 1)
+
+    def test_unordered_map_timeout(self):
+        event = threading.Event()
+        timed_out = []
+
+        def fn(item):
+            if item == 0:
+                event.wait(5)
+            return item
+
+        try:
+            results = list(unordered_map(fn, range(4), 2, timeout=0.05, on_timeout=timed_out.append))
+        finally:
+            event.set()
+
+        self.assertEqual(sorted(results), [1, 2, 3])
+        self.assertEqual(timed_out, [0])
+
+    @parameterized.expand([
+        (None, False, False),
+        ('', True, True),
+        ('true', False, True),
+        ('false', True, False),
+    ])
+    def test_is_dedup_enabled(self, value, default, expected):
+        self.assertEqual(FederatedQuery(dedup=default).is_dedup_enabled(value), expected)
+
+    def test_configure(self):
+        query = FederatedQuery()
+
+        query.configure({
+            'ckan.right_time_context.federation_concurrency': '2',
+            'ckan.right_time_context.federation_timeout': '2.5',
+            'ckan.right_time_context.federation_dedup': 'true',
+        })
+
+        self.assertEqual(query.concurrency, 2)
+        self.assertEqual(query.timeout, 2.5)
+        self.assertTrue(query.dedup)
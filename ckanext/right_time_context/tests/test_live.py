@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import json
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+from six.moves import queue
+
+from ckanext.right_time_context.live import LiveUpdates, parse_entities, ResourceFeed
+
+ENTITIES = [
+    {'id': 'Room1', 'type': 'Room', 'temperature': 21},
+    {'id': 'Room2', 'type': 'Room', 'temperature': 23},
+]
+
+
+class LiveUpdatesTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        (json.dumps(ENTITIES), ENTITIES),
+        (json.dumps(ENTITIES[0]), ENTITIES[:1]),
+        (json.dumps({'contextResponses': [{'contextElement': {'id': 'Room1', 'type': 'Room', 'attributes': [{'name': 'temperature', 'type': 'Number', 'value': 21}]}}]}),
+            [{'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 21}}]),
+        (json.dumps([{'value': 1}, 1] + ENTITIES), ENTITIES),
+    ])
+    def test_parse_entities(self, body, expected):
+        self.assertEqual(parse_entities(body), expected)
+
+    def test_parse_entities_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_entities('1')
+
+    def test_diff(self):
+        feed = ResourceFeed('key', None)
+
+        # The first poll is used as the baseline
+        self.assertIsNone(feed.diff(ENTITIES))
+        self.assertIsNone(feed.diff(ENTITIES))
+
+        # Versions don't depend on the order of the entities
+        version = feed.version
+        other = ResourceFeed('other', None)
+        other.diff(ENTITIES[::-1])
+        self.assertEqual(other.version, version)
+
+        changes = feed.diff([dict(ENTITIES[0], temperature=25), {'id': 'Room3', 'type': 'Room'}])
+        self.assertEqual(changes, {
+            'entities': [dict(ENTITIES[0], temperature=25), {'id': 'Room3', 'type': 'Room'}],
+            'removed': [{'id': 'Room2', 'type': 'Room'}],
+            'complete': False,
+        })
+        self.assertEqual(feed.previous_version, version)
+        self.assertNotEqual(feed.version, version)
+
+    @patch("ckanext.right_time_context.live.threading")
+    def test_subscribe(self, threading):
+        live = LiveUpdates(enabled=True, max_clients=2)
+        fetch = MagicMock()
+
+        first = live.subscribe('key', fetch)
+        second = live.subscribe('key', MagicMock())
+
+        # Clients of the same resource share the feed
+        self.assertIs(first.feed, second.feed)
+        self.assertIs(first.feed.fetch, fetch)
+        threading.Thread.assert_called_once_with(target=live._run, args=(first.feed,), name='right_time_context-live')
+        self.assertIsNone(live.subscribe('other', MagicMock()))
+        self.assertEqual(live.stats()['clients'], 2)
+
+        live.unsubscribe(first)
+        live.unsubscribe(first)
+        self.assertEqual(live.stats()['clients'], 1)
+
+    @patch("ckanext.right_time_context.live.threading")
+    def test_poll(self, threading):
+        live = LiveUpdates(enabled=True)
+        fetch = MagicMock(side_effect=[json.dumps(ENTITIES), ValueError('invalid'), json.dumps(ENTITIES[:1])])
+        subscribers = [live.subscribe('key', fetch) for i in range(2)]
+        feed = subscribers[0].feed
+
+        live.poll(feed)
+        version = feed.version
+        live.poll(feed)
+        live.poll(feed)
+
+        # Clients receive all the entities first, as they may have changed
+        # since the clients loaded them
+        for subscriber in subscribers:
+            self.assertEqual(subscriber.events.get_nowait(), (version, {'entities': ENTITIES, 'removed': [], 'complete': True}))
+            self.assertEqual(subscriber.events.get_nowait(), (feed.version, {'entities': [], 'removed': [{'id': 'Room2', 'type': 'Room'}], 'complete': False}))
+            self.assertTrue(subscriber.events.empty())
+        self.assertEqual(live.stats()['polls'], 2)
+        self.assertEqual(live.stats()['events'], 4)
+
+    @patch("ckanext.right_time_context.live.threading")
+    def test_poll_known_version(self, threading):
+        live = LiveUpdates(enabled=True)
+        fetch = MagicMock(side_effect=[json.dumps(ENTITIES), json.dumps(ENTITIES[:1]), json.dumps(ENTITIES[:1])])
+        feed = live.subscribe('key', fetch).feed
+        live.poll(feed)
+
+        # Reconnecting clients only receive the changes since the last event
+        # they received
+        previous = live.subscribe('key', fetch, feed.version)
+        live.poll(feed)
+        current = live.subscribe('key', fetch, feed.version)
+        live.poll(feed)
+
+        self.assertEqual(previous.events.get_nowait(), (feed.version, {'entities': [], 'removed': [{'id': 'Room2', 'type': 'Room'}], 'complete': False}))
+        self.assertTrue(previous.events.empty())
+        self.assertTrue(current.events.empty())
+        self.assertTrue(current.synced)
+
+    @patch("ckanext.right_time_context.live.time")
+    @patch("ckanext.right_time_context.live.threading")
+    def test_run(self, threading, time):
+        live = LiveUpdates(enabled=True)
+        subscriber = live.subscribe('key', MagicMock(return_value='[]'))
+
+        # Polling stops once the last client disconnects
+        time.sleep.side_effect = lambda interval: live.unsubscribe(subscriber)
+        live._run(subscriber.feed)
+
+        subscriber.feed.fetch.assert_called_once_with()
+        self.assertEqual(live.stats()['feeds'], 0)
+
+    @patch("ckanext.right_time_context.live.time")
+    @patch("ckanext.right_time_context.live.threading")
+    def test_stream(self, threading, time):
+        live = LiveUpdates(enabled=True, heartbeat=15, max_duration=60)
+        time.time.return_value = 1000
+        subscriber = live.subscribe('key', MagicMock())
+        subscriber.put(('version', {'entities': ENTITIES[:1], 'removed': []}))
+
+        stream = live.stream(subscriber)
+        events = iter(stream)
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        event = next(events)
+        self.assertTrue(event.startswith('id: version\nevent: change\ndata: '))
+        self.assertEqual(json.loads(event[len('id: version\nevent: change\ndata: '):]), {'entities': ENTITIES[:1], 'removed': []})
+
+        subscriber.events = MagicMock()
+        subscriber.events.get.side_effect = queue.Empty
+        self.assertEqual(next(events), ': keepalive\n\n')
+        subscriber.events.get.assert_called_once_with(timeout=15)
+
+        # Streams are closed after max_duration seconds
+        time.time.return_value = 1060
+        self.assertEqual(list(events), [])
+        self.assertEqual(live.stats()['clients'], 0)
+
+    @patch("ckanext.right_time_context.live.threading")
+    def test_stream_lagging(self, threading):
+        live = LiveUpdates(enabled=True)
+        subscriber = live.subscribe('key', MagicMock())
+        for i in range(101):
+            subscriber.put(('version', {'entities': [], 'removed': []}))
+
+        events = list(live.stream(subscriber))
+
+        self.assertEqual(events[-1], 'event: reset\ndata: {}\n\n')
+
+    @patch("ckanext.right_time_context.live.threading")
+    def test_stream_close(self, threading):
+        live = LiveUpdates(enabled=True)
+        subscriber = live.subscribe('key', MagicMock())
+
+        # Clients disconnecting before receiving any event
+        live.stream(subscriber).close()
+
+        self.assertEqual(live.stats()['clients'], 0)
+
+    def test_configure(self):
+        live = LiveUpdates()
+
+        live.configure({
+            'ckan.right_time_context.live': 'true',
+            'ckan.right_time_context.live_interval': '5',
+            'ckan.right_time_context.live_max_clients': '10',
+        })
+
+        self.assertTrue(live.enabled)
+        self.assertEqual(live.interval, 5)
+        self.assertEqual(live.heartbeat, 15)
+        self.assertEqual(live.max_clients, 10)
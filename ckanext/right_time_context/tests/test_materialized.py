@@ -0,0 +1,649 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import BaseHTTPServer
+from collections import OrderedDict
+import copy
+import imp
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+from redis.exceptions import RedisError
+
+from ckanext.right_time_context.materialized import build_subscription, get_entity_key, is_supported, MAX_CHANGES, MaterializedStore, MaterializedView
+from ckanext.right_time_context.plans import ProxyPlan
+
+STUB_ORION = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'benchmarks', 'stub_orion.py')
+
+
+def build_plan(url, headers=None, resource=None):
+    resource = dict(resource or {}, url=url, format='fiware-ngsi')
+    return ProxyPlan(resource, urlparse.urlsplit(url), True, dict(headers or {}, Accept='application/json'), None, 'GET', url, '')
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timeout waiting for condition')
+        time.sleep(0.01)
+
+
+def to_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class FakeRedis(object):
+    # In-memory replacement of the subset of the Redis client used by the
+    # store, commands are atomic and transactions are serialized
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.RLock()
+
+    def _call(self, name, *args, **kwargs):
+        with self.lock:
+            return getattr(self, '_' + name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(self, '_' + name):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+    def _get(self, key):
+        return self.data.get(key)
+
+    def _set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = to_value(value)
+        return True
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def _hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def _hmget(self, key, fields):
+        return [self._hget(key, field) for field in fields]
+
+    def _hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def _hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = to_value(value)
+
+    def _hmset(self, key, mapping):
+        for field, value in mapping.items():
+            self._hset(key, field, value)
+        return True
+
+    def _hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def _zadd(self, key, **members):
+        self.data.setdefault(key, {}).update(members)
+
+    def _zrem(self, key, *members):
+        self._hdel(key, *members)
+
+    def _zrange(self, key, start, end):
+        members = sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+        return [member for member, score in members][start:end + 1 if end != -1 else None]
+
+    def _lrange(self, key, start, end):
+        return list(self.data.get(key, []))[start:end + 1 if end != -1 else None]
+
+    def _rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(to_value(value) for value in values)
+
+    def _ltrim(self, key, start, end):
+        self.data[key] = self._lrange(key, start, end)
+
+    def pipeline(self):
+        return FakePipeline(self, queued=True)
+
+    def transaction(self, func, *keys):
+        with self.lock:
+            pipe = FakePipeline(self, queued=False)
+            func(pipe)
+            return pipe.execute()
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis, queued):
+        self.redis = redis
+        self.queued = queued
+        self.commands = []
+
+    def multi(self):
+        self.queued = True
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        if not self.queued:
+            return method
+        return lambda *args, **kwargs: self.commands.append((method, args, kwargs))
+
+    def execute(self):
+        with self.redis.lock:
+            return [method(*args, **kwargs) for method, args, kwargs in self.commands]
+
+
+class MaterializedStoreTestCase(unittest.TestCase):
+
+    URL = "http://cb.example.org/v2/entities?type=Room"
+    ENTITIES = [
+        {'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 21, 'metadata': {}}, 'pressure': {'type': 'Number', 'value': 720, 'metadata': {}}},
+        {'id': 'Room2', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 23, 'metadata': {}}, 'pressure': {'type': 'Number', 'value': 711, 'metadata': {}}},
+    ]
+
+    def _store(self, **kwargs):
+        kwargs.setdefault('redis', FakeRedis())
+        return MaterializedStore(**dict({'enabled': True, 'notification_url': 'http://ckan.example.org', 'secret': 'secret'}, **kwargs))
+
+    def _view(self, store, url=URL, entities=None, expires=None):
+        # Stores a view as activated by any CKAN process
+        view = MaterializedView('resource_id', url, {}, True)
+        store.redis.hmset(store._key('resource_id'), {'url': url, 'headers': '{}', 'verify': 'true', 'subscription': 'sub1'})
+        store._store(view, OrderedDict((get_entity_key(entity), entity) for entity in copy.deepcopy(self.ENTITIES if entities is None else entities)), 0, expires or time.time() + store.duration)
+        return view
+
+    def _state(self, store):
+        return store._get_state('resource_id')
+
+    def _entities(self, store, url=URL):
+        plan = build_plan(url)
+        return json.loads(store.get('resource_id', plan, plan).body)
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", True),
+        ("http://cb.example.org/orion/v2/entities/?type=Room&options=keyValues", True),
+        ("http://cb.example.org/v2/entities/Room1", True),
+        ("http://cb.example.org/v2/entities/Room1/attrs", False),
+        ("http://cb.example.org/v2/entities?orderBy=temperature", False),
+        ("http://cb.example.org/v2/entities?options=values", False),
+        ("http://cb.example.org/v2/entities?q=temperature>20", False),
+        ("http://cb.example.org/v2/entities?georel=near;maxDistance:1000&geometry=point&coords=40.4,-3.7", False),
+        ("http://cb.example.org/v2/entities?q=", True),
+        ("http://cb.example.org/v1/queryContext", False),
+        ("http://ql.example.org/v2/types", False),
+    ])
+    def test_is_supported(self, url, expected):
+        self.assertEqual(is_supported(urlparse.urlsplit(url)), expected)
+
+    @parameterized.expand([
+        ({}, True),
+        ({'materialize': 'false'}, False),
+        ({'auth_type': 'oauth2'}, False),
+        ({'format': 'fiware-ngsi-registry'}, False),
+    ])
+    def test_is_enabled(self, resource, expected):
+        store = self._store()
+        resource = dict({'format': 'fiware-ngsi', 'url': 'http://cb.example.org/v2/entities'}, **resource)
+
+        self.assertEqual(store.is_enabled(resource, urlparse.urlsplit(resource['url'])), expected)
+
+    def test_is_enabled_per_resource(self):
+        resource = {'format': 'fiware-ngsi', 'url': 'http://cb.example.org/v2/entities', 'materialize': 'true'}
+
+        # Resources cannot be materialized if it is disabled globally
+        self.assertTrue(self._store().is_enabled(resource, urlparse.urlsplit(resource['url'])))
+        self.assertFalse(self._store(enabled=False).is_enabled(resource, urlparse.urlsplit(resource['url'])))
+        self.assertFalse(self._store(notification_url=None).is_enabled(resource, urlparse.urlsplit(resource['url'])))
+        self.assertFalse(self._store(redis=None).is_enabled(resource, urlparse.urlsplit(resource['url'])))
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", {'entities': [{'idPattern': '.*'}]}, {}),
+        ("http://cb.example.org/v2/entities?id=Room1,Room2&type=Room", {'entities': [{'id': 'Room1', 'type': 'Room'}, {'id': 'Room2', 'type': 'Room'}]}, {}),
+        ("http://cb.example.org/v2/entities?idPattern=Room.*&typePattern=R.*", {'entities': [{'idPattern': 'Room.*', 'typePattern': 'R.*'}]}, {}),
+        ("http://cb.example.org/v2/entities/Room%201?type=Room", {'entities': [{'id': 'Room 1', 'type': 'Room'}]}, {}),
+        (
+            "http://cb.example.org/v2/entities?q=temperature>20&georel=near;maxDistance:1000&geometry=point&coords=40.4,-3.7&attrs=temperature&limit=10",
+            {'entities': [{'idPattern': '.*'}], 'condition': {'expression': {'q': 'temperature>20', 'georel': 'near;maxDistance:1000', 'geometry': 'point', 'coords': '40.4,-3.7'}}},
+            {'attrs': ['temperature']},
+        ),
+    ])
+    def test_build_subscription(self, url, subject, notification):
+        subscription = build_subscription(url, 'http://ckan.example.org/notify', expires=0, throttling=5, description='test')
+
+        self.assertEqual(subscription, {
+            'description': 'test',
+            'subject': subject,
+            'notification': dict({'http': {'url': 'http://ckan.example.org/notify'}, 'attrsFormat': 'normalized'}, **notification),
+            'expires': '1970-01-01T00:00:00.000Z',
+            'throttling': 5,
+        })
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities?type=Room", {}, ['Room1', 'Room2']),
+        ("http://cb.example.org/v2/entities?type=Room&limit=1&offset=1", {}, ['Room2']),
+        ("http://cb.example.org/v2/entities?type=Room&offset=5", {}, []),
+    ])
+    def test_get(self, url, resource, expected):
+        store = self._store()
+        self._view(store)
+
+        entry = store.get('resource_id', build_plan(self.URL), build_plan(url, resource=resource))
+
+        self.assertEqual([entity['id'] for entity in json.loads(entry.body)], expected)
+        self.assertEqual(entry.content_type, 'application/json')
+        self.assertEqual(store.stats()['hits'], 1)
+        self.assertEqual(store.stats()['ready'], 1)
+
+    def test_get_preview(self):
+        store = self._store()
+        self._view(store)
+        plan = build_plan(self.URL)
+
+        entry = store.get('resource_id', plan, build_plan("http://cb.example.org/v2/entities?type=Room&attrs=temperature&options=keyValues&limit=1"))
+
+        self.assertEqual(json.loads(entry.body), [{'id': 'Room1', 'type': 'Room', 'temperature': 21}])
+        # Responses are reused until the entities change
+        self.assertIs(store.get('resource_id', plan, build_plan("http://cb.example.org/v2/entities?type=Room&attrs=temperature&options=keyValues&limit=1")), entry)
+
+    def test_get_entity(self):
+        store = self._store()
+        url = "http://cb.example.org/v2/entities/Room1"
+        self._view(store, url, self.ENTITIES[:1])
+        plan = build_plan(url)
+
+        self.assertEqual(self._entities(store, url)['id'], 'Room1')
+
+        # Missing entities are requested to the Context Broker
+        self._view(store, url, [])
+        self.assertIsNone(store.get('resource_id', plan, plan))
+
+    def test_get_redis_error(self):
+        store = self._store(redis=MagicMock(**{'hmget.side_effect': RedisError}))
+        plan = build_plan(self.URL)
+
+        self.assertIsNone(store.get('resource_id', plan, plan))
+
+    @patch("ckanext.right_time_context.materialized.threading")
+    def test_get_activation(self, threading):
+        store = self._store()
+        other = self._store(redis=store.redis)
+        plan = build_plan(self.URL, {'FIWARE-Service': 'tenant'})
+
+        self.assertIsNone(store.get('resource_id', plan, plan))
+        self.assertIsNone(other.get('resource_id', plan, plan))
+
+        # Only one process starts the activation
+        threading.Thread.assert_called_once()
+        view = threading.Thread.call_args[1]['args'][0]
+        self.assertEqual(threading.Thread.call_args[1]['target'], store._activate)
+        self.assertEqual(view.headers, {'FIWARE-Service': 'tenant'})
+
+    @patch("ckanext.right_time_context.materialized.threading")
+    def test_get_changed_resource(self, threading):
+        store = self._store()
+        self._view(store)
+        plan = build_plan("http://cb.example.org/v2/entities?type=Building")
+
+        self.assertIsNone(store.get('resource_id', plan, plan))
+
+        self.assertEqual(threading.Thread.call_args[1]['target'], store._activate)
+        self.assertEqual(threading.Thread.call_args[1]['args'][0].url, "http://cb.example.org/v2/entities?type=Building")
+
+    @patch("ckanext.right_time_context.materialized.threading")
+    def test_get_renewal(self, threading):
+        store = self._store()
+        self._view(store, expires=time.time())
+        plan = build_plan(self.URL)
+
+        # Entities are served while renewing
+        self.assertIsNotNone(store.get('resource_id', plan, plan))
+        self.assertEqual(threading.Thread.call_args[1]['target'], store._activate)
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_notify(self, session_pool):
+        store = self._store()
+        other = self._store(redis=store.redis)
+        self._view(store)
+        self.assertEqual(len(self._entities(store)), 2)
+        # Room2 was removed, notifications only include the changed attributes
+        session = self._mock_session(session_pool, [
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '2'}, 'json.return_value': [
+                dict(self.ENTITIES[0], temperature={'type': 'Number', 'value': 30, 'metadata': {}}),
+                {'id': 'Room3', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 19, 'metadata': {}}},
+            ]},
+        ])
+
+        notification = {'subscriptionId': 'sub1', 'data': [
+            {'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 30, 'metadata': {}}},
+            {'id': 'Room2', 'type': 'Room'},
+            {'id': 'Room3', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 19, 'metadata': {}}},
+        ]}
+        # Notifications can be received by any process
+        self.assertTrue(other.notify('resource_id', other.get_token('resource_id'), notification))
+
+        for entities in (self._entities(store), self._entities(other)):
+            self.assertEqual([entity['id'] for entity in entities], ['Room1', 'Room3'])
+            self.assertEqual(entities[0]['temperature']['value'], 30)
+            self.assertEqual(entities[0]['pressure']['value'], 720)
+        self.assertEqual(other.stats()['notifications'], 1)
+        self.assertEqual(session.request.call_args[0], ('GET', 'http://cb.example.org/v2/entities?type=Room&id=Room1%2CRoom2%2CRoom3&limit=1000&offset=0&options=count'))
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_notify_refresh_error(self, session_pool):
+        store = self._store()
+        self._view(store)
+        session_pool.get_session.return_value.request.side_effect = ValueError
+
+        # Notified changes are applied if the entities cannot be queried
+        notification = {'subscriptionId': 'sub1', 'data': [{'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 30, 'metadata': {}}}]}
+        self.assertTrue(store.notify('resource_id', store.get_token('resource_id'), notification))
+
+        entities = self._entities(store)
+        self.assertEqual([entity['temperature']['value'] for entity in entities], [30, 23])
+        self.assertEqual(entities[0]['pressure']['value'], 720)
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_notify_missed_changes(self, session_pool):
+        store = self._store()
+        other = self._store(redis=store.redis)
+        self._view(store)
+        self._entities(store)
+        session_pool.get_session.return_value.request.side_effect = ValueError
+
+        # Copies are reloaded if the changes are no longer recorded
+        for value in range(MAX_CHANGES + 1):
+            notification = {'subscriptionId': 'sub1', 'data': [{'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': value, 'metadata': {}}}]}
+            other.notify('resource_id', other.get_token('resource_id'), notification)
+
+        self.assertEqual(self._entities(store)[0]['temperature']['value'], MAX_CHANGES)
+
+    def test_notify_invalid(self):
+        store = self._store()
+        self._view(store)
+
+        with self.assertRaises(ValueError):
+            store.notify('resource_id', 'invalid', {'subscriptionId': 'sub1', 'data': []})
+        with self.assertRaises(ValueError):
+            store.notify('resource_id', self._store(secret='other').get_token('resource_id'), {'subscriptionId': 'sub1', 'data': []})
+
+        self.assertFalse(store.notify('resource_id', store.get_token('resource_id'), {'subscriptionId': 'sub2', 'data': []}))
+        self.assertFalse(store.notify('other_id', store.get_token('other_id'), {'subscriptionId': 'sub1', 'data': []}))
+
+    def _mock_session(self, session_pool, responses):
+        session = session_pool.get_session.return_value
+        session.request.side_effect = [MagicMock(**response) for response in responses]
+        return session
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate(self, session_pool):
+        store = self._store(duration=100)
+        view = MaterializedView('resource_id', "http://cb.example.org/orion/v2/entities?type=Room&options=keyValues,count&limit=5", {'FIWARE-Service': 'tenant'}, False)
+        store.redis.set(store._key('resource_id', 'lock'), 'token')
+        session = self._mock_session(session_pool, [
+            {'status_code': 201, 'headers': {'Location': '/v2/subscriptions/sub1'}},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '2'}, 'json.return_value': copy.deepcopy(self.ENTITIES)},
+        ])
+        # Notifications received while loading are applied after the entities
+        session.request.side_effect = self._notify_while_loading(store, session.request.side_effect)
+
+        store._activate(view, 'token')
+
+        state = self._state(store)
+        self.assertTrue(state['loaded'])
+        self.assertEqual(state['subscription'], 'sub1')
+        self.assertEqual(state['headers'], {'FIWARE-Service': 'tenant'})
+        self.assertFalse(state['verify'])
+        self.assertAlmostEqual(state['renew_at'], time.time() + 50, delta=5)
+        self.assertIsNone(store.redis.get(store._key('resource_id', 'lock')))
+        self.assertEqual(store.stats()['activations'], 1)
+
+        plan = build_plan(view.url, {'FIWARE-Service': 'tenant'})
+        entities = json.loads(store.get('resource_id', plan, plan).body)
+        self.assertEqual([entity['id'] for entity in entities], ['Room1', 'Room2'])
+        self.assertEqual(entities[0]['temperature'], 30)
+
+        subscribe, load = session.request.call_args_list[:2]
+        self.assertEqual(subscribe[0][:2], ('POST', 'http://cb.example.org/orion/v2/subscriptions'))
+        self.assertEqual(subscribe[1]['headers'], {'FIWARE-Service': 'tenant', 'Accept': 'application/json', 'Content-Type': 'application/json'})
+        self.assertEqual(json.loads(subscribe[1]['data'])['notification']['http']['url'], store.get_notification_url('resource_id'))
+        self.assertEqual(load[0], ('GET', 'http://cb.example.org/orion/v2/entities?type=Room&limit=1000&offset=0&options=count'))
+
+    def _notify_while_loading(self, store, responses):
+        responses = iter(responses)
+        notified = []
+
+        def request(method, url, **kwargs):
+            if method == 'GET' and not notified:
+                # Notified entities cannot be queried again
+                notified.append(True)
+                store.notify('resource_id', store.get_token('resource_id'), {'subscriptionId': 'sub1', 'data': [{'id': 'Room1', 'type': 'Room', 'temperature': {'type': 'Number', 'value': 30}}]})
+            elif method == 'GET' and 'id=' in url:
+                raise ValueError
+            return next(responses)
+
+        return request
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate_renewal(self, session_pool):
+        store = self._store(duration=100)
+        view = self._view(store)
+        session = self._mock_session(session_pool, [
+            {'status_code': 204},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '1'}, 'json.return_value': copy.deepcopy(self.ENTITIES[1:])},
+        ])
+
+        store._activate(view, 'token')
+
+        self.assertEqual(session.request.call_args_list[0][0], ('PATCH', 'http://cb.example.org/v2/subscriptions/sub1'))
+        # Entities no longer matching the query are removed
+        self.assertEqual([entity['id'] for entity in self._entities(store)], ['Room2'])
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate_renewal_failure(self, session_pool):
+        store = self._store(retry_interval=60)
+        view = self._view(store, expires=time.time())
+        session = self._mock_session(session_pool, [
+            {'status_code': 204},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '1'}, 'json.side_effect': ValueError},
+        ])
+        session.request.side_effect = self._notify_while_loading(store, session.request.side_effect)
+
+        store._activate(view, 'token')
+
+        # The view keeps serving its entities, including the notified changes,
+        # and is not renewed again until the retry interval elapses
+        self.assertTrue(self._state(store)['loaded'])
+        self.assertGreater(self._state(store)['renew_at'], time.time() + 30)
+        self.assertEqual(store.stats()['failures'], 1)
+
+        with patch("ckanext.right_time_context.materialized.threading") as threading:
+            self.assertEqual(self._entities(store)[0]['temperature']['value'], 30)
+            threading.Thread.assert_not_called()
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate_expired_subscription(self, session_pool):
+        store = self._store(duration=100)
+        view = self._view(store)
+        session = self._mock_session(session_pool, [
+            {'status_code': 404},
+            {'status_code': 201, 'headers': {'Location': '/v2/subscriptions/sub2'}},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '0'}, 'json.return_value': []},
+        ])
+
+        store._activate(view, 'token')
+
+        self.assertEqual(session.request.call_args_list[1][0][0], 'POST')
+        self.assertEqual(self._state(store)['subscription'], 'sub2')
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate_changed_resource(self, session_pool):
+        store = self._store()
+        self._view(store)
+        view = MaterializedView('resource_id', "http://cb.example.org/v2/entities?type=Building", {}, True)
+        session = self._mock_session(session_pool, [
+            {'status_code': 204},
+            {'status_code': 201, 'headers': {'Location': '/v2/subscriptions/sub2'}},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '0'}, 'json.return_value': []},
+        ])
+
+        store._activate(view, 'token')
+
+        # The subscription of the previous url is removed
+        self.assertEqual(session.request.call_args_list[0][0], ('DELETE', 'http://cb.example.org/v2/subscriptions/sub1'))
+        self.assertEqual(self._state(store)['subscription'], 'sub2')
+        self.assertEqual(self._entities(store, view.url), [])
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_activate_too_many_entities(self, session_pool):
+        store = self._store(max_entities=1)
+        view = MaterializedView('resource_id', "http://cb.example.org/v2/entities", {}, True)
+        self._mock_session(session_pool, [
+            {'status_code': 201, 'headers': {'Location': '/v2/subscriptions/sub1'}},
+            {'status_code': 200, 'headers': {'Fiware-Total-Count': '2'}, 'json.return_value': copy.deepcopy(self.ENTITIES)},
+        ])
+
+        store._activate(view, 'token')
+
+        self.assertFalse(self._state(store)['loaded'])
+        self.assertGreater(self._state(store)['retry_at'], time.time())
+        self.assertEqual(store.stats()['failures'], 1)
+
+    @parameterized.expand([
+        ({'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi'}, '_activate', True),
+        ({'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi', 'materialize': 'false'}, '_delete_subscription', False),
+        ({'url': "http://cb.example.org/v2/entities?type=Building", 'format': 'fiware-ngsi'}, '_delete_subscription', False),
+        ({'url': "http://cb.example.org/v2/entities?type=Room", 'format': 'fiware-ngsi', 'tenant': 'other'}, '_delete_subscription', False),
+    ])
+    @patch("ckanext.right_time_context.materialized.threading")
+    def test_update(self, resource, target, kept, threading):
+        store = self._store()
+        self._view(store)
+
+        store.update('resource_id', resource)
+
+        self.assertEqual(threading.Thread.call_args[1]['target'], getattr(store, target))
+        self.assertEqual(self._state(store)['loaded'], kept)
+
+    @patch("ckanext.right_time_context.materialized.threading")
+    def test_update_not_materialized(self, threading):
+        store = self._store()
+
+        store.update('resource_id', {'url': self.URL, 'format': 'fiware-ngsi'})
+
+        threading.Thread.assert_not_called()
+
+    @patch("ckanext.right_time_context.materialized.session_pool")
+    def test_remove(self, session_pool):
+        store = self._store()
+        self._view(store)
+        self._entities(store)
+        session = self._mock_session(session_pool, [{'status_code': 204}])
+
+        with patch("ckanext.right_time_context.materialized.threading") as threading:
+            store.remove('resource_id')
+            threading.Thread.call_args[1]['target'](*threading.Thread.call_args[1]['args'])
+
+        session.request.assert_called_once_with('DELETE', 'http://cb.example.org/v2/subscriptions/sub1', headers={'Accept': 'application/json'}, verify=True)
+        self.assertEqual(store.stats()['views'], 0)
+        self.assertEqual(store.redis.data, {})
+
+    @patch("ckanext.right_time_context.materialized.connect_to_redis")
+    def test_configure(self, connect_to_redis):
+        store = MaterializedStore()
+
+        store.configure({
+            'ckan.site_url': 'http://ckan.example.org',
+            'beaker.session.secret': 'secret',
+            'ckan.right_time_context.materialize': 'true',
+            'ckan.right_time_context.materialize_duration': '600',
+            'ckan.right_time_context.materialize_throttling': '1',
+        })
+
+        self.assertTrue(store.enabled)
+        self.assertIs(store.redis, connect_to_redis.return_value)
+        self.assertEqual(store.notification_url, 'http://ckan.example.org')
+        self.assertEqual(store.secret, 'secret')
+        self.assertEqual(store.duration, 600)
+        self.assertEqual(store.throttling, 1)
+        self.assertEqual(store.get_notification_url('resource_id'), 'http://ckan.example.org/right_time_context/notify/resource_id?token=' + store.get_token('resource_id'))
+
+
+@unittest.skipUnless(os.path.exists(STUB_ORION), 'Orion stub not available')
+class MaterializedStoreStubTestCase(unittest.TestCase):
+    # Uses the Context Broker stub of the benchmarks
+
+    def setUp(self):
+        stub_orion = imp.load_source('stub_orion', STUB_ORION)
+        self.broker = stub_orion.StubOrionServer(('127.0.0.1', 0), entities=30, attributes=2)
+        self._serve(self.broker)
+
+        store = self.store = MaterializedStore(enabled=True, secret='secret', redis=FakeRedis())
+
+        class NotificationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                # Equivalent to the notify_ngsi_resource action
+                url = urlparse.urlsplit(self.path)
+                resource_id = url.path.rsplit('/', 1)[-1]
+                token = urlparse.parse_qs(url.query)['token'][0]
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                accepted = store.notify(resource_id, token, json.loads(body))
+                self.send_response(204 if accepted else 404)
+                self.end_headers()
+
+        self.receiver = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), NotificationHandler)
+        self._serve(self.receiver)
+        store.notification_url = 'http://127.0.0.1:%d' % self.receiver.server_address[1]
+
+    def _serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_subscription(self):
+        plan = build_plan(self.broker.url + '/v2/entities?limit=5')
+
+        # The first request activates the view
+        self.assertIsNone(self.store.get('resource_id', plan, plan))
+        wait_for(lambda: self.store.get('resource_id', plan, plan) is not None)
+        self.assertEqual(len(self.broker.subscriptions), 1)
+
+        entities = json.loads(self.store.get('resource_id', plan, plan).body)
+        self.assertEqual([entity['id'] for entity in entities], ['urn:ngsi-ld:Room:%06d' % index for index in range(5)])
+
+        # Updates are notified by the Context Broker
+        self.broker.update_entity('urn:ngsi-ld:Room:000001', {'attr0': {'type': 'Number', 'value': -1, 'metadata': {}}})
+        wait_for(lambda: json.loads(self.store.get('resource_id', plan, plan).body)[1]['attr0']['value'] == -1)
+        self.assertEqual(json.loads(self.store.get('resource_id', plan, plan).body)[1]['attr1']['value'], 3)
+
+        # Removing the resource deletes the subscription
+        self.store.remove('resource_id')
+        wait_for(lambda: len(self.broker.subscriptions) == 0)
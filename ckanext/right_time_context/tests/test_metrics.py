@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.metrics import Counter, format_labels, Gauge, Histogram, ProxyMetrics, render_stats
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_counter(self):
+        counter = Counter('requests_total', 'Requests.', ('format', 'status'))
+
+        counter.inc(labels=('fiware-ngsi', '200'))
+        counter.inc(2, labels=('fiware-ngsi', '200'))
+        counter.inc(labels=('fiware-ngsi-registry', '502'))
+
+        self.assertEqual(counter.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{format="fiware-ngsi",status="200"} 3',
+            'requests_total{format="fiware-ngsi-registry",status="502"} 1',
+        ]) + '\n')
+
+    def test_gauge(self):
+        gauge = Gauge('in_flight', 'In flight.')
+
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual(gauge.get(), 1)
+        self.assertIn('# TYPE in_flight gauge\nin_flight 1\n', gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.render().splitlines()[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            'latency_seconds_sum 3.65',
+            'latency_seconds_count 4',
+        ])
+
+    @parameterized.expand([
+        ((), (), ''),
+        (('host',), ('cb.example.org',), '{host="cb.example.org"}'),
+        (('a', 'b'), ('x"y', 'z\\'), '{a="x\\"y",b="z\\\\"}'),
+    ])
+    def test_format_labels(self, names, values, expected):
+        self.assertEqual(format_labels(names, values), expected)
+
+    def test_request_metrics(self):
+        metrics = ProxyMetrics()
+
+        request = metrics.start()
+        self.assertEqual(metrics.in_flight.get(), 1)
+        request.set_resource('fiware-ngsi', 'cb.example.org')
+        request.upstream_started()
+        request.upstream_finished()
+
+        self.assertEqual(list(request.track(iter(['1234', '56']), 200)), ['1234', '56'])
+        request.finish(500)
+
+        self.assertEqual(metrics.in_flight.get(), 0)
+        self.assertEqual(metrics.requests.samples(), [(('fiware-ngsi', 'cb.example.org', '200'), 1)])
+        self.assertEqual(metrics.response_bytes.get(('fiware-ngsi',)), 6)
+        output = metrics.render()
+        for name in ('ngsi_proxy_lookup_seconds_count 1', 'ngsi_proxy_upstream_ttfb_seconds_count 1', 'ngsi_proxy_streaming_seconds_count 1'):
+            self.assertIn(name, output)
+
+    def test_request_metrics_closed(self):
+        metrics = ProxyMetrics()
+        closed = []
+
+        def body():
+            try:
+                yield '1234'
+                yield '56'
+            finally:
+                closed.append(True)
+
+        # The client disconnects after the first chunk
+        request = metrics.start()
+        tracked = request.track(body(), 200)
+        iterator = iter(tracked)
+        next(iterator)
+        tracked.close()
+        tracked.close()
+
+        self.assertEqual(closed, [True])
+        self.assertEqual(metrics.in_flight.get(), 0)
+        self.assertEqual(metrics.requests.samples(), [(('unknown', '', '200'), 1)])
+        self.assertEqual(metrics.response_bytes.get(('unknown',)), 4)
+
+        # The response is closed without being iterated
+        metrics.start().track(body(), 200).close()
+
+        self.assertEqual(metrics.in_flight.get(), 0)
+        self.assertEqual(metrics.requests.samples(), [(('unknown', '', '200'), 2)])
+
+    @parameterized.expand([
+        ('Bearer secret', True),
+        (u'Bearer secret', True),
+        ('Bearer other', False),
+        ('secret', False),
+        (None, False),
+    ])
+    def test_is_authorized(self, authorization, expected):
+        self.assertEqual(ProxyMetrics(token='secret').is_authorized(authorization), expected)
+
+    def test_render_stats(self):
+        output = render_stats({
+            'pool': {'hits': 3, 'misses': 1, 'size': 1},
+            'cache': {'hits': 5, 'stale_hits': 1, 'misses': 2, 'entries': 2, 'size': 1024},
+            'coalescing': {'leaders': 4, 'followers': 2},
+            'plans': {'hits': 8, 'misses': 1},
+            'prewarm': {'refreshes': 6, 'failures': 1},
+            'circuits': {'hosts': {'cb.example.org': {'state': 'open'}, 'other.example.org': {'state': 'closed'}}},
+        })
+
+        self.assertIn('ngsi_proxy_pool_requests_total{result="hit"} 3\n', output)
+        self.assertIn('ngsi_proxy_cache_requests_total{result="stale"} 1\n', output)
+        self.assertIn('ngsi_proxy_coalesced_requests_total{role="follower"} 2\n', output)
+        self.assertIn('ngsi_proxy_plan_requests_total{result="miss"} 1\n', output)
+        self.assertIn('ngsi_proxy_prewarm_refreshes_total{result="success"} 6\n', output)
+        self.assertIn('ngsi_proxy_circuit_open{host="cb.example.org"} 1\n', output)
+        self.assertIn('ngsi_proxy_circuit_open{host="other.example.org"} 0\n', output)
+
+    def test_configure(self):
+        metrics = ProxyMetrics()
+
+        metrics.configure({
+            'ckan.right_time_context.metrics': 'false',
+            'ckan.right_time_context.metrics_token': 'secret',
+        })
+
+        self.assertFalse(metrics.enabled)
+        self.assertEqual(metrics.token, 'secret')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import threading
+import time
+import unittest
+import urlparse
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+from requests import ConnectionError
+
+from ckanext.right_time_context.concurrency import ordered_map
+from ckanext.right_time_context.pagination import add_options, Paginator, PaginatedResponse, update_query
+from ckanext.right_time_context.streaming import TruncatedResponseError
+
+
+class PaginationTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", {"limit": "10"}, "http://cb.example.org/v2/entities?limit=10"),
+        ("http://cb.example.org/v2/entities?type=Room&limit=5", {"limit": "10"}, "http://cb.example.org/v2/entities?type=Room&limit=10"),
+        ("http://cb.example.org/v2/entities?type=Room&options=count", {"options": None}, "http://cb.example.org/v2/entities?type=Room"),
+        ("http://cb.example.org/v2/entities?georel=near;maxDistance:1000&q=a%3D1", {"limit": "10"}, "http://cb.example.org/v2/entities?georel=near%3BmaxDistance%3A1000&q=a%3D1&limit=10"),
+    ])
+    def test_update_query(self, url, params, expected):
+        self.assertEqual(update_query(url, params), expected)
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", "http://cb.example.org/v2/entities?options=count"),
+        ("http://cb.example.org/v2/entities?options=keyValues", "http://cb.example.org/v2/entities?options=keyValues%2Ccount"),
+        ("http://cb.example.org/v2/entities?options=count", "http://cb.example.org/v2/entities?options=count"),
+    ])
+    def test_add_options(self, url, expected):
+        self.assertEqual(add_options(url, "count"), expected)
+
+    @parameterized.expand([
+        ({}, "http://cb.example.org/v2/entities", False, False),
+        ({}, "http://cb.example.org/v2/entities", True, True),
+        ({'follow_pagination': 'true'}, "http://cb.example.org/v2/entities", False, True),
+        ({'follow_pagination': 'false'}, "http://cb.example.org/v2/entities", True, False),
+        ({'follow_pagination': ''}, "http://cb.example.org/v2/entities/", True, True),
+        ({'follow_pagination': 'true'}, "http://cb.example.org/v2/entities/Room1", False, False),
+        ({'follow_pagination': 'true'}, "http://cb.example.org/v1/queryContext", False, False),
+    ])
+    def test_is_enabled(self, resource, url, default, expected):
+        paginator = Paginator(enabled=default)
+        self.assertEqual(paginator.is_enabled(resource, urlparse.urlsplit(url)), expected)
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities?type=Room", 1000, 0, "limit=1000&offset=0&options=count", []),
+        ("http://cb.example.org/v2/entities?type=Room", 2500, 0, "limit=1000&offset=0&options=count", [(1000, 1000), (2000, 500)]),
+        ("http://cb.example.org/v2/entities?type=Room", 5000, 2500, "limit=1000&offset=0&options=count", [(1000, 1000), (2000, 500)]),
+        ("http://cb.example.org/v2/entities?type=Room&limit=1500", 5000, 0, "limit=1000&offset=0&options=count", [(1000, 500)]),
+        ("http://cb.example.org/v2/entities?type=Room&limit=10", 5000, 0, "limit=10&offset=0&options=count", []),
+        ("http://cb.example.org/v2/entities?type=Room&offset=500", 2000, 0, "limit=1000&offset=500&options=count", [(1500, 500)]),
+    ])
+    def test_page_urls(self, url, total_count, max_entities, first_query, pages):
+        paginator = Paginator(page_size=1000, max_entities=max_entities)
+
+        self.assertEqual(paginator.first_page_url(url), "http://cb.example.org/v2/entities?type=Room&" + first_query)
+
+        expected_urls = ["http://cb.example.org/v2/entities?type=Room&limit=%d&offset=%d" % (page[1], page[0]) for page in pages]
+        self.assertEqual(paginator.page_urls(url, total_count), expected_urls)
+
+    def test_paginated_response(self):
+        paginator = Paginator(page_size=2, concurrency=2)
+        response = MagicMock(headers={'Fiware-Total-Count': '5', 'Content-Length': '10', 'Content-Type': 'application/json'}, content='[{"id": 1}, {"id": 2}]')
+        pages = {
+            "http://cb.example.org/v2/entities?limit=2&offset=2": '[{"id": 3}, {"id": 4}]',
+            "http://cb.example.org/v2/entities?limit=1&offset=4": '[{"id": 5}]',
+        }
+
+        paginated = paginator.paginate(response, "http://cb.example.org/v2/entities", pages.get)
+
+        self.assertIsInstance(paginated, PaginatedResponse)
+        self.assertNotIn('Content-Length', paginated.headers)
+        self.assertEqual(paginated.headers['content-type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(paginated.iter_content())), [{"id": index} for index in range(1, 6)])
+
+    def test_paginated_response_empty_pages(self):
+        response = MagicMock(content='[]')
+        paginated = PaginatedResponse(response, ["page"], lambda url: ' [ ] ')
+
+        self.assertEqual(b''.join(paginated.iter_content()), '[]')
+
+    @patch("ckanext.right_time_context.pagination.circuit_breaker")
+    def test_paginated_response_page_error(self, circuit_breaker):
+        response = MagicMock(content='[{"id": 1}]', url="http://cb.example.org/v2/entities?limit=1&offset=0")
+        paginated = PaginatedResponse(response, ["page"], MagicMock(side_effect=ConnectionError))
+
+        # The response is truncated and the failure recorded
+        body = paginated.iter_content()
+        self.assertEqual(b''.join([next(body), next(body)]), '[{"id": 1}')
+        with self.assertRaises(TruncatedResponseError):
+            next(body)
+        circuit_breaker.record.assert_called_once_with('cb.example.org', False)
+
+    @parameterized.expand([
+        ({},),
+        ({'Fiware-Total-Count': '2'},),
+    ])
+    def test_single_page(self, headers):
+        paginator = Paginator(page_size=2)
+        response = MagicMock(headers=headers)
+
+        self.assertIs(paginator.paginate(response, "http://cb.example.org/v2/entities", None), response)
+
+    def test_ordered_map(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fn(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01 * (5 - item))
+            with lock:
+                running[0] -= 1
+            return item * 2
+
+        self.assertEqual(list(ordered_map(fn, range(5), 2)), [0, 2, 4, 6, 8])
+        self.assertLessEqual(running[1], 2)
+
+    def test_ordered_map_error(self):
+        def fn(item):
+            if item == 1:
+                raise ValueError()
+            return item
+
+        results = ordered_map(fn, range(3), 2)
+        self.assertEqual(next(results), 0)
+        self.assertRaises(ValueError, next, results)
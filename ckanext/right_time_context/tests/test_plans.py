@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import time
+import unittest
+
+from mock import DEFAULT, MagicMock, patch
+
+from ckanext.right_time_context.plans import PlanCache
+
+
+class PlanCacheTestCase(unittest.TestCase):
+
+    def _plan(self):
+        return MagicMock(created=time.time())
+
+    def test_get_missing(self):
+        cache = PlanCache()
+
+        self.assertIsNone(cache.get('resource_id'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    @patch.multiple('ckanext.right_time_context.plans', time=DEFAULT)
+    def test_get(self, time):
+        time.time.return_value = 100
+        cache = PlanCache(ttl=60)
+        plan = MagicMock(created=100)
+
+        cache.set('resource_id', plan)
+        time.time.return_value = 159
+
+        self.assertIs(cache.get('resource_id'), plan)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    @patch.multiple('ckanext.right_time_context.plans', time=DEFAULT)
+    def test_get_expired(self, time):
+        time.time.return_value = 160
+        cache = PlanCache(ttl=60)
+
+        cache.set('resource_id', MagicMock(created=100))
+
+        self.assertIsNone(cache.get('resource_id'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalidate(self):
+        cache = PlanCache()
+        cache.set('resource_id', self._plan())
+        cache.set('other_id', self._plan())
+
+        cache.invalidate('resource_id')
+
+        self.assertIsNone(cache.get('resource_id'))
+        self.assertIsNotNone(cache.get('other_id'))
+
+    def test_lru_eviction(self):
+        cache = PlanCache(max_plans=2)
+        cache.set('a', self._plan())
+        cache.set('b', self._plan())
+        cache.get('a')
+
+        cache.set('c', self._plan())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+    def test_disabled(self):
+        cache = PlanCache(ttl=0)
+
+        cache.set('resource_id', self._plan())
+
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_configure(self):
+        cache = PlanCache()
+        cache.set('resource_id', self._plan())
+
+        cache.configure({
+            'ckan.right_time_context.plan_cache_size': '10',
+            'ckan.right_time_context.plan_cache_ttl': '30',
+        })
+
+        self.assertEqual(cache.max_plans, 10)
+        self.assertEqual(cache.ttl, 30)
+        self.assertEqual(cache.stats()['size'], 0)
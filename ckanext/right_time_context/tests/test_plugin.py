@@ -25,6 +25,7 @@ from parameterized import parameterized
 
 from ckan.plugins.toolkit import ValidationError
 
+from ckanext.right_time_context.entities import encode_entities, LazyEntities
 import ckanext.right_time_context.plugin as plugin
 
 
@@ -50,9 +51,17 @@ class NgsiViewPluginTest(unittest.TestCase):
 
     @parameterized.expand([
         ({'format': 'fiware-ngsi-registry', 'entity': [{'id': '.*', 'value': 'Room', 'isPattern': 'on'}, {'id': 'vehicle1', 'value': 'Vehicle'}]},
-            {'format': 'fiware-ngsi-registry', 'entity__0__id': '.*', 'entity__0__value': 'Room', 'entity__0__isPattern': 'on',
-                'entity__1__id': 'vehicle1', 'entity__1__value': 'Vehicle'}),
-        ({'format': 'fiware-ngsi'}, {'format': 'fiware-ngsi'})
+            {'format': 'fiware-ngsi-registry', 'compressed_entities': encode_entities([{'id': '.*', 'value': 'Room', 'isPattern': 'on'}, {'id': 'vehicle1', 'value': 'Vehicle'}]),
+                'registry_query': '{"attrs": [], "entities": [{"idPattern": ".*", "type": "Room"}, {"id": "vehicle1", "type": "Vehicle"}]}'}),
+        ({'format': 'fiware-ngsi-registry', 'entity': [{'id': 'vehicle1', 'value': 'Vehicle'}], 'attrs_str': 'speed', 'expression': 'georel=near;maxDistance:100&geometry=point&coords=40,-3'},
+            {'format': 'fiware-ngsi-registry', 'compressed_entities': encode_entities([{'id': 'vehicle1', 'value': 'Vehicle'}]), 'attrs_str': 'speed',
+                'expression': 'georel=near;maxDistance:100&geometry=point&coords=40,-3',
+                'registry_query': '{"attrs": ["speed"], "entities": [{"id": "vehicle1", "type": "Vehicle"}], "expression": {"coords": "40,-3", "geometry": "point", "georel": "near;maxDistance:100"}}'}),
+        ({'format': 'fiware-ngsi'}, {'format': 'fiware-ngsi'}),
+        ({'format': 'fiware-ngsi', 'url': 'http://cb.example.org/v1/queryContext', 'payload': '{"entities": []}'},
+            {'format': 'fiware-ngsi', 'url': 'http://cb.example.org/v1/queryContext', 'payload': '{"entities": []}'}),
+        ({'format': 'fiware-ngsi', 'cache_ttl': '30'}, {'format': 'fiware-ngsi', 'cache_ttl': '30'}),
+        ({'format': 'fiware-ngsi', 'cache_ttl': ''}, {'format': 'fiware-ngsi', 'cache_ttl': ''}),
     ])
     def test_before_create(self, resource, serialized):
         instance = plugin.NgsiView()
@@ -66,10 +75,53 @@ class NgsiViewPluginTest(unittest.TestCase):
         with self.assertRaises(ValidationError):
             instance.before_create({}, {'format': 'fiware-ngsi-registry'})
 
+    def test_before_create_invalid_expression(self):
+        instance = plugin.NgsiView()
+
+        with self.assertRaises(ValidationError) as cm:
+            instance.before_create({}, {'format': 'fiware-ngsi-registry', 'entity': [{'id': 'vehicle1', 'value': 'Vehicle'}], 'expression': 'invalid=near'})
+
+        self.assertIn('expression', cm.exception.error_dict)
+
+    def test_before_create_invalid_payload(self):
+        instance = plugin.NgsiView()
+
+        with self.assertRaises(ValidationError) as cm:
+            instance.before_create({}, {'format': 'fiware-ngsi', 'url': 'http://cb.example.org/v1/queryContext', 'payload': '{invalid'})
+
+        self.assertIn('payload', cm.exception.error_dict)
+
+    @parameterized.expand([
+        ('-1',),
+        ('abc',),
+        ('1.5',),
+    ])
+    def test_before_create_invalid_cache_ttl(self, cache_ttl):
+        instance = plugin.NgsiView()
+
+        with self.assertRaises(ValidationError):
+            instance.before_create({}, {'format': 'fiware-ngsi', 'cache_ttl': cache_ttl})
+
+    @parameterized.expand([
+        ('-1',),
+        ('abc',),
+    ])
+    def test_before_create_invalid_preview_limit(self, preview_limit):
+        instance = plugin.NgsiView()
+
+        with self.assertRaises(ValidationError) as cm:
+            instance.before_create({}, {'format': 'fiware-ngsi', 'preview_limit': preview_limit})
+
+        self.assertIn('preview_limit', cm.exception.error_dict)
+
     @parameterized.expand([
         ({'format': 'fiware-ngsi-registry', 'entity': [{'id': '.*', 'value': 'Room', 'isPattern': 'on', 'delete': 'on'}, {'id': 'vehicle5', 'value': 'Vehicle'}],
             'entity__0__id': '.*', 'entity__0__value': 'Room', 'entity__0__isPattern': 'on', 'entity__1__id': 'vehicle1', 'entity__1__value': 'Vehicle'},
-            {'format': 'fiware-ngsi-registry', 'entity__0__id': 'vehicle5', 'entity__0__value': 'Vehicle'})
+            {'format': 'fiware-ngsi-registry', 'compressed_entities': encode_entities([{'id': 'vehicle5', 'value': 'Vehicle'}]),
+                'registry_query': '{"attrs": [], "entities": [{"id": "vehicle5", "type": "Vehicle"}]}'}),
+        ({'format': 'fiware-ngsi-registry', 'entity': [{'id': 'vehicle5', 'value': 'Vehicle'}], 'compressed_entities': encode_entities([{'id': 'vehicle1', 'value': 'Vehicle'}])},
+            {'format': 'fiware-ngsi-registry', 'compressed_entities': encode_entities([{'id': 'vehicle5', 'value': 'Vehicle'}]),
+                'registry_query': '{"attrs": [], "entities": [{"id": "vehicle5", "type": "Vehicle"}]}'}),
     ])
     def test_before_update(self, resource, serialized):
         instance = plugin.NgsiView()
@@ -77,6 +129,41 @@ class NgsiViewPluginTest(unittest.TestCase):
         result = instance.before_update({}, {}, resource)
         self.assertEquals(serialized, result)
 
+    @patch('ckanext.right_time_context.plugin.entity_store.storage', 'flat')
+    def test_before_update_flat_storage(self):
+        instance = plugin.NgsiView()
+        resource = {'format': 'fiware-ngsi-registry', 'entity': [{'id': '.*', 'value': 'Room', 'isPattern': 'on'}],
+                    'compressed_entities': encode_entities([{'id': 'vehicle1', 'value': 'Vehicle'}])}
+
+        result = instance.before_update({}, {}, resource)
+
+        self.assertEquals({'format': 'fiware-ngsi-registry', 'entity__0__id': '.*', 'entity__0__value': 'Room', 'entity__0__isPattern': 'on',
+                           'registry_query': '{"attrs": [], "entities": [{"idPattern": ".*", "type": "Room"}]}'}, result)
+
+    @parameterized.expand([
+        ('after_create', ({}, {'id': 'resource_id'})),
+        ('after_update', ({}, {'id': 'resource_id'})),
+        ('before_delete', ({}, {'id': 'resource_id'}, [])),
+    ])
+    @patch.multiple('ckanext.right_time_context.plugin', proxy_plans=DEFAULT, prewarm_scheduler=DEFAULT)
+    def test_invalidate_plan(self, method, args, proxy_plans, prewarm_scheduler):
+        instance = plugin.NgsiView()
+
+        getattr(instance, method)(*args)
+
+        proxy_plans.invalidate.assert_called_once_with('resource_id')
+        prewarm_scheduler.forget.assert_called_once_with('resource_id')
+
+    @patch.multiple('ckanext.right_time_context.plugin', proxy_plans=DEFAULT, materialized_store=DEFAULT)
+    def test_materialized_store_update(self, proxy_plans, materialized_store):
+        instance = plugin.NgsiView()
+
+        instance.after_update({}, {'id': 'resource_id', 'url': 'http://cb.example.org/v2/entities'})
+        materialized_store.update.assert_called_once_with('resource_id', {'id': 'resource_id', 'url': 'http://cb.example.org/v2/entities'})
+
+        instance.before_delete({}, {'id': 'resource_id'}, [])
+        materialized_store.remove.assert_called_once_with('resource_id')
+
     @parameterized.expand([
         ({'format': 'fiware-ngsi-registry', 'entity__0__id': '.*', 'entity__0__value': 'Room', 'entity__0__isPattern': 'on',
                 'entity__1__id': 'vehicle1', 'entity__1__value': 'Vehicle'},
@@ -90,6 +177,61 @@ class NgsiViewPluginTest(unittest.TestCase):
         instance.before_show(resource)
         self.assertEquals(deserialized, resource)
 
+    def test_before_show_compact(self):
+        instance = plugin.NgsiView()
+        entities = [{'id': '.*', 'value': 'Room', 'isPattern': 'on'}, {'id': 'vehicle1', 'value': 'Vehicle'}]
+        resource = {'format': 'fiware-ngsi-registry', 'compressed_entities': encode_entities(entities)}
+
+        instance.before_show(resource)
+
+        # Entities are decoded when accessed
+        self.assertIsInstance(resource['entity'], LazyEntities)
+        self.assertFalse(resource['entity'].loaded)
+        self.assertEquals(entities, resource['entity'])
+        self.assertTrue(resource['entity'].loaded)
+
+    @parameterized.expand([
+        (False, {}),
+        (True, {'preview': 'true'}),
+    ])
+    @patch.multiple('ckanext.right_time_context.plugin', h=DEFAULT)
+    def test_get_proxified_ngsi_url(self, preview, params, h):
+        instance = plugin.NgsiView()
+
+        url = instance.get_proxified_ngsi_url({'package': {'name': 'dataset'}, 'resource': {'id': 'resource_id'}}, preview=preview)
+
+        self.assertEqual(url, h.url_for.return_value)
+        h.url_for.assert_called_once_with(action='proxy_ngsi_resource', controller=ANY, id='dataset', resource_id='resource_id', **params)
+
+    @patch.multiple('ckanext.right_time_context.plugin', p=DEFAULT, h=DEFAULT, live_updates=DEFAULT)
+    def test_setup_template_variables_live(self, p, h, live_updates):
+        instance = plugin.NgsiView()
+        instance.proxy_is_enabled = True
+        live_updates.enabled = True
+        data_dict = {
+            "package": {"name": "dataset"},
+            "resource": {"id": "resource_id", "format": "fiware-ngsi", "url": "https://cb.example.org/v2/entities"},
+        }
+
+        result = instance.setup_template_variables(None, data_dict)
+
+        self.assertEqual(result['live_url'], h.url_for.return_value)
+        h.url_for.assert_called_with(action='live_ngsi_resource', controller=ANY, id='dataset', resource_id='resource_id', preview='true')
+
+    @patch.multiple('ckanext.right_time_context.plugin', p=DEFAULT, h=DEFAULT)
+    def test_setup_template_variables_chart(self, p, h):
+        instance = plugin.NgsiView()
+        instance.proxy_is_enabled = True
+        data_dict = {
+            "package": {"name": "dataset"},
+            "resource": {"id": "resource_id", "format": "fiware-ngsi", "url": "https://ql.example.org/v2/entities/Room1", "chart_attrs": "temperature"},
+        }
+
+        result = instance.setup_template_variables(None, data_dict)
+
+        self.assertEqual(result['chart_url'], h.url_for.return_value)
+        h.url_for.assert_called_with(action='chart_ngsi_resource', controller=ANY, id='dataset', resource_id='resource_id')
+
     @parameterized.expand([
         ["fiware-ngsi",          "https://context.example.org/v2/entities",               "none",   None],
         ["fiware-ngsi",          "https://context.example.org/v1/queryContext",           "none",   None],
@@ -118,15 +260,19 @@ class NgsiViewPluginTest(unittest.TestCase):
         instance.oauth2_is_enabled = error != "nooauth2"
         p.toolkit.c.user = error != "nologged"
 
-        with patch.object(instance, "get_proxified_ngsi_url", return_value="proxied_url"):
+        with patch.object(instance, "get_proxified_ngsi_url", return_value="proxied_url") as get_proxified_ngsi_url:
             result = instance.setup_template_variables(None, data_dict)
 
         view_enable = json.loads(result['view_enable'])
         self.assertEqual(result['resource_json'], json.dumps(data_dict['resource']))
 
+        self.assertEqual(result['chart_url'], '')
+        self.assertEqual(result['live_url'], '')
         if error is None:
             self.assertEqual(view_enable, [True, 'OK'])
             self.assertEqual(result['resource_url'], '"proxied_url"')
+            preview = resource_format == 'fiware-ngsi' and '/v2/entities' in url
+            get_proxified_ngsi_url.assert_called_once_with(data_dict, preview=preview)
         else:
             h.flash_error.assert_called_with(ANY, allow_html=False)
             self.assertFalse(view_enable[0])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from mock import patch
+from parameterized import parameterized
+
+from ckanext.right_time_context.pool import SessionPool
+
+
+class SessionPoolTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", "http://cb.example.org/v2/entities?type=Room", True, True, True),
+        ("http://cb.example.org/v2/entities", "http://CB.example.org/v1/queryContext", True, True, True),
+        ("http://cb.example.org/v2/entities", "https://cb.example.org/v2/entities", True, True, False),
+        ("http://cb.example.org/v2/entities", "http://cb.example.org:1026/v2/entities", True, True, False),
+        ("https://cb.example.org/v2/entities", "https://cb.example.org/v2/entities", True, False, False),
+        ("https://cb.example.org/v2/entities", "https://cb.example.org/v2/entities", "/path", "/path", True),
+    ])
+    def test_session_reuse(self, url1, url2, verify1, verify2, same):
+        pool = SessionPool()
+
+        session1 = pool.get_session(url1, verify=verify1)
+        session2 = pool.get_session(url2, verify=verify2)
+
+        self.assertEqual(session1 is session2, same)
+        self.assertEqual(session2.verify, verify2)
+
+        stats = pool.stats()
+        self.assertEqual(stats['hits'], 1 if same else 0)
+        self.assertEqual(stats['misses'], 1 if same else 2)
+
+    @patch("ckanext.right_time_context.pool.time")
+    def test_idle_eviction(self, time):
+        pool = SessionPool(idle_timeout=60)
+        time.time.return_value = 1000
+
+        session = pool.get_session("http://cb.example.org/v2/entities")
+        with patch.object(session, "close") as close_mock:
+            time.time.return_value = 1059
+            self.assertIs(pool.get_session("http://cb.example.org/v2/entities"), session)
+            close_mock.assert_not_called()
+
+            time.time.return_value = 1120
+            self.assertIsNot(pool.get_session("http://cb.example.org/v2/entities"), session)
+            # A long response could still be streamed using the session
+            close_mock.assert_not_called()
+
+        self.assertEqual(pool.stats()['evictions'], 1)
+
+    def test_max_sessions(self):
+        pool = SessionPool(max_sessions=2)
+
+        session1 = pool.get_session("http://cb1.example.org/v2/entities")
+        session2 = pool.get_session("http://cb2.example.org/v2/entities")
+        pool.get_session("http://cb1.example.org/v2/entities")
+        with patch.object(session2, "close") as close_mock:
+            pool.get_session("http://cb3.example.org/v2/entities")
+
+        # The evicted session could still be used by another thread
+        close_mock.assert_not_called()
+        hosts = set(session['host'] for session in pool.stats()['sessions'])
+        self.assertEqual(hosts, set(["cb1.example.org", "cb3.example.org"]))
+        self.assertIs(pool.get_session("http://cb1.example.org/v2/entities"), session1)
+        self.assertEqual(pool.stats()['evictions'], 1)
+
+    def test_clear(self):
+        pool = SessionPool()
+        session = pool.get_session("http://cb.example.org/v2/entities")
+
+        with patch.object(session, "close") as close_mock:
+            pool.configure({})
+
+        close_mock.assert_not_called()
+        self.assertIsNot(pool.get_session("http://cb.example.org/v2/entities"), session)
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", 50),
+        ("http://cb.example.org:1026/v2/entities", 5),
+        ("http://other.example.org/v2/entities", 10),
+    ])
+    def test_host_maxsize(self, url, expected_maxsize):
+        pool = SessionPool()
+        pool.configure({
+            'ckan.right_time_context.pool_maxsize': '10',
+            'ckan.right_time_context.pool_host_maxsize': 'cb.example.org=50 cb.example.org:1026=5',
+        })
+
+        session = pool.get_session(url)
+
+        self.assertEqual(pool.stats()['sessions'][0]['maxsize'], expected_maxsize)
+        self.assertEqual(session.get_adapter(url)._pool_maxsize, expected_maxsize)
+
+    @parameterized.expand([
+        ({}, (5, 30)),
+        ({'ckan.right_time_context.connect_timeout': '2', 'ckan.right_time_context.read_timeout': '10.5'}, (2, 10.5)),
+        ({'ckan.right_time_context.connect_timeout': '0', 'ckan.right_time_context.read_timeout': '0'}, (None, None)),
+    ])
+    def test_timeouts(self, config, expected):
+        pool = SessionPool()
+        pool.configure(config)
+
+        adapter = pool.get_session("http://cb.example.org/v2/entities").get_adapter("http://cb.example.org/v2/entities")
+
+        self.assertEqual(adapter.timeout, expected)
+        with patch("requests.adapters.HTTPAdapter.send") as send_mock:
+            adapter.send("request")
+            send_mock.assert_called_once_with("request", timeout=expected)
+
+            adapter.send("request", timeout=1)
+            send_mock.assert_called_with("request", timeout=1)
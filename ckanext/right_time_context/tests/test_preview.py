@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+import urlparse
+
+from parameterized import parameterized
+
+from ckanext.right_time_context.preview import PreviewRewriter
+
+
+class PreviewRewriterTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        ("http://cb.example.org/v2/entities", True),
+        ("http://cb.example.org/v2/entities/Room1/attrs", True),
+        ("http://cb.example.org/v1/queryContext", False),
+        ("http://cb.example.org/v1/contextEntities/Room1", False),
+    ])
+    def test_is_enabled(self, url, expected):
+        self.assertEqual(PreviewRewriter().is_enabled(urlparse.urlsplit(url)), expected)
+        self.assertFalse(PreviewRewriter(enabled=False).is_enabled(urlparse.urlsplit(url)))
+
+    @parameterized.expand([
+        ({}, "http://cb.example.org/v2/entities?type=Room", "http://cb.example.org/v2/entities?type=Room&limit=20&options=keyValues"),
+        ({}, "http://cb.example.org/v2/entities?limit=5", "http://cb.example.org/v2/entities?limit=5&options=keyValues"),
+        ({}, "http://cb.example.org/v2/entities?limit=500&options=count", "http://cb.example.org/v2/entities?limit=20&options=count%2CkeyValues"),
+        ({}, "http://cb.example.org/v2/entities?options=values&attrs=temperature", "http://cb.example.org/v2/entities?options=values&attrs=temperature&limit=20"),
+        ({}, "http://cb.example.org/v2/entities/Room1", "http://cb.example.org/v2/entities/Room1?options=keyValues"),
+        ({'preview_limit': '0', 'preview_key_values': 'false'}, "http://cb.example.org/v2/entities?type=Room", "http://cb.example.org/v2/entities?type=Room"),
+        ({'preview_limit': '3', 'preview_key_values': 'false'}, "http://cb.example.org/v2/entities", "http://cb.example.org/v2/entities?limit=3"),
+        ({'preview_limit': 'abc', 'preview_key_values': 'false'}, "http://cb.example.org/v2/entities", "http://cb.example.org/v2/entities?limit=20"),
+        ({'preview_attrs': 'temperature, pressure', 'preview_limit': '0'}, "http://cb.example.org/v2/entities", "http://cb.example.org/v2/entities?attrs=temperature%2Cpressure&options=keyValues"),
+        ({'preview_attrs': 'temperature,pressure', 'preview_limit': '0'}, "http://cb.example.org/v2/entities?attrs=pressure,humidity", "http://cb.example.org/v2/entities?attrs=pressure&options=keyValues"),
+        ({'preview_attrs': 'temperature', 'preview_limit': '0'}, "http://cb.example.org/v2/entities?attrs=humidity", "http://cb.example.org/v2/entities?attrs=humidity&options=keyValues"),
+    ])
+    def test_rewrite(self, settings, url, expected):
+        resource = dict(settings, url=url)
+        self.assertEqual(PreviewRewriter().rewrite(resource, urlparse.urlsplit(url)), expected)
+
+    def test_configure(self):
+        rewriter = PreviewRewriter()
+
+        rewriter.configure({
+            'ckan.right_time_context.preview_limit': '5',
+            'ckan.right_time_context.preview_key_values': 'false',
+            'ckan.right_time_context.preview_attrs': 'temperature',
+        })
+
+        url = "http://cb.example.org/v2/entities"
+        self.assertTrue(rewriter.enabled)
+        self.assertEqual(rewriter.rewrite({'url': url}, urlparse.urlsplit(url)), url + "?attrs=temperature&limit=5")
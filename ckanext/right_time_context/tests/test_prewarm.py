@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import unittest
+
+from mock import MagicMock, patch
+
+from ckanext.right_time_context.cache import CacheEntry, ResponseCache
+from ckanext.right_time_context.pagination import PaginatedResponse
+from ckanext.right_time_context.prewarm import PrewarmScheduler
+
+
+class PrewarmSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(ttl=60)
+        patcher = patch("ckanext.right_time_context.prewarm.response_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _scheduler(self, **kwargs):
+        scheduler = PrewarmScheduler(jitter=0, **kwargs)
+        scheduler._last_decay = 1000
+        # Refreshes are triggered by the tests
+        scheduler._ensure_running = MagicMock()
+        return scheduler
+
+    def _entry(self, ttl, created=1000):
+        entry = CacheEntry('{"old": "body"}', "application/json", "utf-8", {'ETag': '"a"'}, ttl)
+        entry.created = created
+        entry.fresh_until = created + ttl
+        return entry
+
+    def test_disabled(self):
+        scheduler = PrewarmScheduler()
+
+        self.assertFalse(scheduler.record("resource_id", "key", {}, MagicMock()))
+        self.assertEqual(scheduler.stats()['tracked'], 0)
+
+    def test_auth_type(self):
+        scheduler = self._scheduler(top=1)
+
+        self.assertFalse(scheduler.record("resource_id", "key", {'auth_type': 'oauth2'}, MagicMock()))
+        self.assertTrue(scheduler.record("resource_id", "key", {'auth_type': 'none'}, MagicMock()))
+        self.assertTrue(scheduler.record("resource_id", "key", {}, MagicMock()))
+        self.assertEqual(scheduler.stats()['tracked'], 1)
+
+    @patch("ckanext.right_time_context.prewarm.time")
+    def test_select_top(self, time):
+        time.time.return_value = 1000
+        scheduler = self._scheduler(top=2, lead=10)
+        for key, hits, ttl in (("a", 1, 5), ("b", 3, 5), ("c", 2, 5), ("d", 4, 60)):
+            self.cache.set(key, self._entry(ttl))
+            for i in range(hits):
+                scheduler.record(key, key, {}, MagicMock())
+
+        # d is not expiring yet, a is not one of the most requested ones
+        self.assertEqual([key for key, tracked in scheduler.select(1000)], ["b"])
+
+    def test_select_missing_entry(self):
+        scheduler = self._scheduler(top=2)
+        scheduler.record("resource_id", "key", {}, MagicMock())
+
+        self.assertEqual(scheduler.select(1000), [])
+
+    def test_decay(self):
+        scheduler = self._scheduler(top=2, half_life=10)
+        scheduler.record("a", "a", {}, MagicMock())
+        scheduler.record("a", "a", {}, MagicMock())
+
+        scheduler.select(1000)
+        self.assertEqual(scheduler._tracked["a"].score, 2)
+
+        scheduler.select(1010)
+        self.assertEqual(scheduler._tracked["a"].score, 1)
+
+        # Forgotten once the score is low enough
+        scheduler.select(1100)
+        self.assertEqual(scheduler.stats()['tracked'], 0)
+
+    def test_max_tracked(self):
+        scheduler = self._scheduler(top=2, max_tracked=2)
+        scheduler.record("a", "a", {}, MagicMock())
+        scheduler.record("a", "a", {}, MagicMock())
+        scheduler.record("b", "b", {}, MagicMock())
+        scheduler.record("c", "c", {}, MagicMock())
+
+        self.assertEqual(sorted(scheduler._tracked), ["a", "c"])
+
+    def test_forget(self):
+        scheduler = self._scheduler(top=2)
+        scheduler.record("a", "a1", {}, MagicMock())
+        scheduler.record("a", "a2", {}, MagicMock())
+        scheduler.record("b", "b1", {}, MagicMock())
+
+        scheduler.forget("a")
+
+        self.assertEqual(list(scheduler._tracked), ["b1"])
+
+    @patch("ckanext.right_time_context.prewarm.time")
+    def test_run_once(self, time):
+        time.time.return_value = 1000
+        scheduler = self._scheduler(top=3, lead=10)
+        entry = self._entry(5)
+        self.cache.set("a", entry)
+        self.cache.set("b", self._entry(5))
+        response = MagicMock(status_code=200, headers={'content-type': 'application/json'}, iter_content=MagicMock(return_value=['{"new": "body"}']), encoding='utf-8')
+        fetch = MagicMock(return_value=response)
+        failing_fetch = MagicMock(side_effect=ValueError)
+        scheduler.record("a", "a", {}, fetch)
+        scheduler.record("b", "b", {}, failing_fetch)
+
+        scheduler.run_once()
+
+        fetch.assert_called_once_with(entry)
+        self.assertEqual(self.cache.peek("a").body, '{"new": "body"}')
+        self.assertEqual(self.cache.peek("b").body, '{"old": "body"}')
+        self.assertEqual(scheduler.stats()['refreshes'], 1)
+        self.assertEqual(scheduler.stats()['failures'], 1)
+
+    @patch("ckanext.right_time_context.prewarm.time")
+    def test_run_once_paginated(self, time):
+        time.time.return_value = 1000
+        scheduler = self._scheduler(top=1, lead=10)
+        self.cache.set("a", self._entry(5))
+        first_page = MagicMock(status_code=200, headers={'content-type': 'application/json'}, content=b'[{"id": "1"}]', encoding='utf-8')
+        fetch = MagicMock(return_value=PaginatedResponse(first_page, ["page2"], lambda url: b'[{"id": "2"}]'))
+        scheduler.record("a", "a", {}, fetch)
+
+        scheduler.run_once()
+
+        self.assertEqual(self.cache.peek("a").body, b'[{"id": "1"},{"id": "2"}]')
+        self.assertEqual(scheduler.stats()['refreshes'], 1)
+        self.assertEqual(scheduler.stats()['failures'], 0)
+
+    @patch("ckanext.right_time_context.prewarm.time")
+    def test_run_once_refreshed_meanwhile(self, time):
+        time.time.return_value = 1000
+        scheduler = self._scheduler(top=1, lead=10)
+        self.cache.set("a", self._entry(5))
+        fetch = MagicMock()
+        scheduler.record("a", "a", {}, fetch)
+
+        # A visitor refreshes the entry while waiting for the jitter delay
+        time.sleep.side_effect = lambda delay: self.cache.set("a", self._entry(60))
+        scheduler.run_once()
+
+        fetch.assert_not_called()
+        self.assertEqual(scheduler.stats()['refreshes'], 0)
+
+    @patch("ckanext.right_time_context.prewarm.os")
+    def test_thread(self, os):
+        threading = MagicMock()
+        with patch("ckanext.right_time_context.prewarm.threading", threading):
+            scheduler = PrewarmScheduler(top=1)
+            os.getpid.return_value = 1
+            scheduler.record("a", "a", {}, MagicMock())
+            scheduler.record("a", "a", {}, MagicMock())
+            self.assertEqual(threading.Thread.call_count, 1)
+
+            # Forked processes start their own thread
+            os.getpid.return_value = 2
+            scheduler.record("a", "a", {}, MagicMock())
+            self.assertEqual(threading.Thread.call_count, 2)
+
+    def test_configure(self):
+        scheduler = PrewarmScheduler()
+
+        scheduler.configure({
+            'ckan.right_time_context.prewarm_top': '10',
+            'ckan.right_time_context.prewarm_interval': '2.5',
+            'ckan.right_time_context.prewarm_lead': '20',
+            'ckan.right_time_context.prewarm_concurrency': '4',
+            'ckan.right_time_context.prewarm_jitter': '1',
+        })
+
+        self.assertTrue(scheduler.enabled)
+        self.assertEqual(scheduler.top, 10)
+        self.assertEqual(scheduler.interval, 2.5)
+        self.assertEqual(scheduler.lead, 20)
+        self.assertEqual(scheduler.concurrency, 4)
+        self.assertEqual(scheduler.jitter, 1)
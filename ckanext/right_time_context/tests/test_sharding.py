@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import json
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+from requests import HTTPError
+
+from ckanext.right_time_context.pagination import Paginator
+from ckanext.right_time_context.sharding import RegistrySharder
+from ckanext.right_time_context.streaming import TruncatedResponseError
+
+
+def build_query(count):
+    return json.dumps({'entities': [{'id': str(i), 'type': 'Room'} for i in range(count)], 'attrs': ['temperature']}, sort_keys=True)
+
+
+class RegistrySharderTestCase(unittest.TestCase):
+
+    @parameterized.expand([
+        (0, 10, 1),
+        (10, 10, 1),
+        (4, 10, 3),
+        (1, 3, 3),
+    ])
+    def test_shard(self, shard_size, entities, expected):
+        body = build_query(entities)
+
+        shards = RegistrySharder(shard_size=shard_size).shard(body)
+
+        self.assertEqual(len(shards), expected)
+        queries = [json.loads(shard) for shard in shards]
+        self.assertEqual([entity for query in queries for entity in query['entities']], json.loads(body)['entities'])
+        self.assertTrue(all(query['attrs'] == ['temperature'] for query in queries))
+
+    @patch("ckanext.right_time_context.sharding.paginator", Paginator(page_size=2))
+    def test_fetch_shard(self):
+        fetch_page = MagicMock(side_effect=[
+            MagicMock(headers={'Fiware-Total-Count': '3'}, content=b'[{"id": "1"}, {"id": "2"}]'),
+            MagicMock(headers={}, content=b'[{"id": "3"}]'),
+        ])
+
+        body = RegistrySharder().fetch_shard("http://cb.example.org/v2/op/query", "shard", fetch_page)
+
+        self.assertEqual(json.loads(body), [{"id": "1"}, {"id": "2"}, {"id": "3"}])
+        fetch_page.assert_any_call("http://cb.example.org/v2/op/query?limit=2&offset=0&options=count", "shard")
+        fetch_page.assert_called_with("http://cb.example.org/v2/op/query?limit=1&offset=2", "shard")
+
+    @patch("ckanext.right_time_context.sharding.paginator", Paginator(page_size=2))
+    def test_merge(self):
+        first_page = MagicMock(headers={'content-type': 'application/json', 'Fiware-Total-Count': '1'}, content=b'[{"id": "1"}]')
+        responses = {
+            'b': MagicMock(headers={'Fiware-Total-Count': '0'}, content=b'[]'),
+            'c': MagicMock(headers={'Fiware-Total-Count': '1'}, content=b'[{"id": "3"}]'),
+        }
+
+        response = RegistrySharder().merge(first_page, "http://cb.example.org/v2/op/query", ['a', 'b', 'c'], lambda url, body: responses[body])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(json.loads(b''.join(response.iter_content())), key=lambda e: e['id']), [{"id": "1"}, {"id": "3"}])
+
+    @parameterized.expand([
+        (0, ['1', '2', '3']),
+        (2, ['1', '2']),
+    ])
+    def test_merge_duplicates(self, max_entities, expected):
+        first_page = MagicMock(headers={'content-type': 'application/json', 'Fiware-Total-Count': '2'}, content=b'[{"id": "1", "type": "Room"}, {"id": "2", "type": "Room"}]')
+        responses = {
+            'b': MagicMock(headers={'Fiware-Total-Count': '2'}, content=b'[{"id": "2", "type": "Room"}, {"id": "3", "type": "Room"}]'),
+        }
+
+        with patch("ckanext.right_time_context.sharding.paginator", Paginator(max_entities=max_entities)):
+            response = RegistrySharder(concurrency=1).merge(first_page, "http://cb.example.org/v2/op/query", ['a', 'b'], lambda url, body: responses[body])
+
+        # Entities matched by several shards are returned once, and the
+        # maximum number of entities applies to the merged response
+        entities = json.loads(b''.join(response.iter_content()))
+        self.assertEqual([entity['id'] for entity in entities], expected)
+
+    @patch("ckanext.right_time_context.pagination.circuit_breaker")
+    def test_merge_shard_error(self, circuit_breaker):
+        first_page = MagicMock(headers={'Fiware-Total-Count': '1'}, content=b'[{"id": "1"}]', url="http://cb.example.org/v2/op/query?limit=1000&offset=0&options=count")
+
+        response = RegistrySharder(concurrency=1).merge(first_page, "http://cb.example.org/v2/op/query", ['a', 'b'], MagicMock(side_effect=HTTPError))
+
+        with self.assertRaises(TruncatedResponseError):
+            b''.join(response.iter_content())
+        circuit_breaker.record.assert_called_once_with('cb.example.org', False)
+
+    def test_configure(self):
+        sharder = RegistrySharder()
+
+        sharder.configure({
+            'ckan.right_time_context.registry_shard_size': '50',
+            'ckan.right_time_context.registry_shard_concurrency': '2',
+        })
+
+        self.assertEqual(sharder.shard_size, 50)
+        self.assertEqual(sharder.concurrency, 2)
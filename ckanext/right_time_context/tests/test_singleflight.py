@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+
+from ckanext.right_time_context.singleflight import buffer_response, BufferedResponse, ReplayedResponse, SingleFlight
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def _run_concurrently(self, singleflight, fn, callers=5, share=None):
+        results = [None] * callers
+        errors = [None] * callers
+
+        def run(index):
+            try:
+                results[index] = singleflight.do("key", fn, share=share)
+            except Exception as e:
+                errors[index] = e
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(callers)]
+        for thread in threads:
+            thread.start()
+
+        # Wait until all the callers are waiting for the leader
+        while singleflight.stats()['leaders'] + singleflight.stats()['followers'] < callers:
+            time.sleep(0.001)
+
+        return threads, results, errors
+
+    def test_coalesced_calls(self):
+        singleflight = SingleFlight()
+        release = threading.Event()
+        fn = MagicMock(side_effect=lambda: release.wait() and "result")
+
+        threads, results, errors = self._run_concurrently(singleflight, fn)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        fn.assert_called_once_with()
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(singleflight.stats()['followers'], 4)
+        self.assertEqual(singleflight.stats()['in_flight'], 0)
+
+    def test_coalesced_errors(self):
+        singleflight = SingleFlight()
+        release = threading.Event()
+        error = ValueError("broker down")
+
+        def fn():
+            release.wait()
+            raise error
+
+        threads, results, errors = self._run_concurrently(singleflight, fn)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [error] * 5)
+
+    def test_unshared_results(self):
+        singleflight = SingleFlight()
+        release = threading.Event()
+        fn = MagicMock(side_effect=lambda: release.wait() and "result")
+
+        threads, results, errors = self._run_concurrently(singleflight, fn, share=lambda result: False)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results), [None] * 4 + ["result"])
+
+    def test_detached_call(self):
+        singleflight = SingleFlight()
+        started, detach, release = threading.Event(), threading.Event(), threading.Event()
+        results = {}
+
+        def fn():
+            started.set()
+            detach.wait()
+            singleflight.detach("key")
+            release.wait()
+            return "result"
+
+        def run(name, fn):
+            results[name] = singleflight.do("key", fn)
+
+        leader = threading.Thread(target=run, args=("leader", fn))
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=run, args=("follower", MagicMock()))
+        follower.start()
+        while singleflight.stats()['followers'] < 1:
+            time.sleep(0.001)
+
+        # Waiting callers are released before the call finishes
+        detach.set()
+        follower.join(5)
+        self.assertFalse(follower.is_alive())
+        self.assertIsNone(results["follower"])
+
+        # New callers don't wait either
+        self.assertEqual(singleflight.do("key", MagicMock(return_value="other")), "other")
+
+        release.set()
+        leader.join()
+        self.assertEqual(results["leader"], "result")
+        self.assertEqual(singleflight.stats()['in_flight'], 0)
+
+    def test_disabled(self):
+        singleflight = SingleFlight(enabled=False)
+        fn = MagicMock(return_value="result")
+
+        self.assertEqual(singleflight.do("key", fn), "result")
+        self.assertEqual(singleflight.do("key", fn), "result")
+        self.assertEqual(fn.call_count, 2)
+
+    def test_buffered_response(self):
+        response = MagicMock(status_code=200, headers={'content-type': 'application/json'}, encoding='utf-8')
+        response.iter_content.return_value = iter(['{"a": ', '"b"}'])
+
+        buffered = BufferedResponse(response)
+
+        response.close.assert_called_once_with()
+        self.assertEqual(buffered.content, '{"a": "b"}')
+        self.assertEqual(list(buffered.iter_content(chunk_size=4)), ['{"a"', ': "b', '"}'])
+        self.assertEqual(buffered.json(), {"a": "b"})
+
+    def test_buffer_response(self):
+        response = MagicMock(status_code=200, headers={}, encoding='utf-8')
+        response.iter_content.return_value = iter(['{"a": ', '"b"}'])
+        on_exceeded = MagicMock()
+
+        buffered = buffer_response(response, 10, on_exceeded)
+
+        # Responses are buffered even if they don't declare their size
+        self.assertIsInstance(buffered, BufferedResponse)
+        self.assertEqual(buffered.content, '{"a": "b"}')
+        response.close.assert_called_once_with()
+        on_exceeded.assert_not_called()
+
+    def test_buffer_response_exceeded(self):
+        response = MagicMock(status_code=200, headers={}, encoding='utf-8')
+        response.iter_content.return_value = iter(['{"a": ', '"b"', ', "c": "d"}'])
+        on_exceeded = MagicMock()
+
+        replayed = buffer_response(response, 8, on_exceeded)
+
+        self.assertIsInstance(replayed, ReplayedResponse)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(''.join(replayed.iter_content(chunk_size=4)), '{"a": "b", "c": "d"}')
+        on_exceeded.assert_called_once_with()
+        response.close.assert_not_called()
+
+    def test_buffer_response_error(self):
+        response = MagicMock(status_code=200, headers={}, encoding='utf-8')
+        error = ValueError("connection reset")
+
+        def iter_content(chunk_size):
+            yield '{"a": '
+            raise error
+
+        response.iter_content.side_effect = iter_content
+        on_exceeded = MagicMock()
+
+        replayed = buffer_response(response, 100, on_exceeded)
+
+        # Read errors are raised while streaming the response
+        body = replayed.iter_content(chunk_size=4)
+        self.assertEqual(next(body), '{"a": ')
+        with self.assertRaises(ValueError):
+            next(body)
+        on_exceeded.assert_called_once_with()
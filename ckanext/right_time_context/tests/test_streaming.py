@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+from ckanext.right_time_context.streaming import ResponseStreamer, TruncatedResponseError
+
+
+class ResponseStreamerTestCase(unittest.TestCase):
+
+    def _mock_response(self, chunks, headers=None):
+        response = MagicMock(headers=headers or {}, url="http://cb.example.org/v2/entities")
+        response.iter_content.return_value = iter(chunks)
+        return response
+
+    @parameterized.expand([
+        (None, {}, 64 * 1024),
+        (None, {'content-length': '100'}, 8 * 1024),
+        (None, {'content-length': str(1024 * 1024)}, 64 * 1024),
+        (None, {'content-length': str(100 * 1024 * 1024)}, 256 * 1024),
+        (None, {'content-length': 'invalid'}, 64 * 1024),
+        (1024, {'content-length': str(1024 * 1024)}, 1024),
+    ])
+    def test_chunk_size(self, configured, headers, expected):
+        streamer = ResponseStreamer(chunk_size=configured)
+        self.assertEqual(streamer.get_chunk_size(self._mock_response([], headers)), expected)
+
+    @parameterized.expand([
+        (0, {'content-length': '100'}, False),
+        (100, {'content-length': '100'}, False),
+        (100, {'content-length': '101'}, True),
+        (100, {}, False),
+    ])
+    def test_exceeds_max_size(self, max_size, headers, expected):
+        streamer = ResponseStreamer(max_size=max_size)
+        self.assertEqual(streamer.exceeds_max_size(self._mock_response([], headers)), expected)
+
+    def test_stream(self):
+        streamer = ResponseStreamer()
+        response = self._mock_response(['{"a"', ': "b"}'])
+        on_complete = MagicMock()
+
+        stream = streamer.stream(response, collect_limit=100, on_complete=on_complete)
+        self.assertEqual(next(stream), '{"a"')
+        response.close.assert_not_called()
+
+        self.assertEqual(list(stream), [': "b"}'])
+        response.close.assert_called_once_with()
+        on_complete.assert_called_once_with('{"a": "b"}')
+
+    def test_stream_collect_limit(self):
+        streamer = ResponseStreamer()
+        on_complete = MagicMock()
+
+        self.assertEqual(list(streamer.stream(self._mock_response(['1234', '5678']), collect_limit=6, on_complete=on_complete)), ['1234', '5678'])
+        on_complete.assert_not_called()
+
+    def test_stream_max_size(self):
+        streamer = ResponseStreamer(max_size=6)
+        response = self._mock_response(['1234', '5678'])
+
+        # The stream is aborted, so the client can tell it is incomplete
+        stream = streamer.stream(response)
+        self.assertEqual(next(stream), '1234')
+        with self.assertRaises(TruncatedResponseError):
+            next(stream)
+        response.close.assert_called_once_with()
+
+    def test_stream_closed_by_client(self):
+        streamer = ResponseStreamer()
+        response = self._mock_response(['1234', '5678'])
+
+        stream = streamer.stream(response)
+        next(stream)
+        stream.close()
+
+        response.close.assert_called_once_with()
+
+    def test_stream_raw(self):
+        streamer = ResponseStreamer()
+        response = self._mock_response([])
+        response.raw.stream.return_value = iter(['compressed'])
+
+        self.assertEqual(list(streamer.stream(response, raw=True)), ['compressed'])
+        response.raw.stream.assert_called_once_with(64 * 1024, decode_content=False)
+        response.iter_content.assert_not_called()
+
+    @patch("ckanext.right_time_context.streaming.time")
+    def test_stream_timeout(self, time):
+        time.time.side_effect = [0, 5, 11]
+        streamer = ResponseStreamer(timeout=10)
+        response = self._mock_response(['1234', '5678', '9'])
+
+        stream = streamer.stream(response)
+        self.assertEqual(next(stream), '1234')
+        with self.assertRaises(TruncatedResponseError):
+            next(stream)
+        response.close.assert_called_once_with()
+
+    @patch("ckanext.right_time_context.streaming.time")
+    def test_read_timeout(self, time):
+        time.time.side_effect = [0, 11]
+        streamer = ResponseStreamer(timeout=10)
+        response = self._mock_response(['1234', '5678'])
+
+        self.assertRaises(ValueError, streamer.read, response)
+        response.close.assert_called_once_with()
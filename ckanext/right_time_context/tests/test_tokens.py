@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+
+import base64
+import json
+import threading
+import unittest
+
+from mock import MagicMock
+from parameterized import parameterized
+
+from ckanext.right_time_context.tokens import get_expiry, TokenRefresher
+
+
+def build_jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims)).rstrip('=')
+    return 'eyJhbGciOiJIUzI1NiJ9.{0}.signature'.format(payload)
+
+
+class TokenRefresherTestCase(unittest.TestCase):
+
+    def test_configure(self):
+        refresher = TokenRefresher()
+        refresher.configure({
+            'ckan.right_time_context.token_refresh_margin': '30',
+            'ckan.right_time_context.token_retry': 'false',
+        })
+
+        self.assertEqual(refresher.margin, 30)
+        self.assertFalse(refresher.retry)
+
+    @parameterized.expand([
+        ({'access_token': 'token', 'expires_at': 1000}, 1000),
+        ({'access_token': 'token', 'expires_at': 1000.5}, 1000.5),
+        ({'access_token': build_jwt({'exp': 2000})}, 2000),
+        ({'access_token': build_jwt({'sub': 'user'})}, None),
+        ({'access_token': 'invalid.jwt.token'}, None),
+        ({'access_token': 'token', 'expires_in': 3600}, None),
+        (None, None),
+        (MagicMock(), None),
+    ])
+    def test_get_expiry(self, token, expected):
+        self.assertEqual(get_expiry(token), expected)
+
+    @parameterized.expand([
+        (60, 1000, 900, False),
+        (60, 1000, 950, True),
+        (60, 1000, 1100, True),
+        (0, 1000, 1100, False),
+        (60, None, 1100, False),
+    ])
+    def test_needs_refresh(self, margin, expires_at, now, expected):
+        token = {'access_token': 'token'}
+        if expires_at is not None:
+            token['expires_at'] = expires_at
+
+        self.assertEqual(TokenRefresher(margin=margin).needs_refresh(token, now), expected)
+
+    def test_refresh(self):
+        refresher = TokenRefresher()
+        refresh = MagicMock(return_value={'access_token': 'new'})
+
+        self.assertEqual(refresher.refresh({'access_token': 'old'}, refresh, 'retry'), {'access_token': 'new'})
+        self.assertEqual(refresher.stats()['retry_refreshes'], 1)
+
+    def test_refresh_reuses_new_token(self):
+        refresher = TokenRefresher()
+        refresh = MagicMock(return_value={'access_token': 'new'})
+        refresher.refresh({'access_token': 'old'}, refresh, 'proactive')
+
+        # Requests still using the old token receive the new one
+        self.assertEqual(refresher.refresh({'access_token': 'old'}, refresh, 'proactive'), {'access_token': 'new'})
+        refresh.assert_called_once_with()
+        self.assertEqual(refresher.stats()['reused'], 1)
+        self.assertEqual(refresher.stats()['proactive_refreshes'], 1)
+
+    def test_refresh_concurrent(self):
+        refresher = TokenRefresher()
+        started = threading.Event()
+        release = threading.Event()
+        results = []
+
+        def refresh():
+            started.set()
+            release.wait(5)
+            return {'access_token': 'new'}
+
+        leader = threading.Thread(target=lambda: results.append(refresher.refresh({'access_token': 'old'}, refresh, 'retry')))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(refresher.refresh({'access_token': 'old'}, MagicMock(), 'retry')))
+        follower.start()
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEqual(results, [{'access_token': 'new'}] * 2)
+        self.assertEqual(refresher.stats()['retry_refreshes'], 1)
+
+    @parameterized.expand([
+        (Exception('invalid_grant'), None),
+        (None, None),
+    ])
+    def test_refresh_failure(self, error, result):
+        refresher = TokenRefresher()
+        refresh = MagicMock(side_effect=error, return_value=result)
+
+        self.assertIsNone(refresher.refresh({'access_token': 'old'}, refresh, 'retry'))
+        self.assertEqual(refresher.stats()['failures'], 1)
+
+        # Failed refreshes are not reused
+        refresher.refresh({'access_token': 'old'}, refresh, 'retry')
+        self.assertEqual(refresh.call_count, 2)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import base64
+from collections import OrderedDict
+import hashlib
+import json
+from logging import getLogger
+import threading
+import time
+
+import six
+
+from .singleflight import SingleFlight
+from .utils import get_bool_setting, get_int_setting
+
+log = getLogger(__name__)
+
+DEFAULT_MARGIN = 60
+# Refreshed tokens remembered for the requests still using the old ones
+MAX_RECENT = 1000
+
+PROACTIVE = 'proactive'
+RETRY = 'retry'
+
+
+def get_token_key(token):
+    return hashlib.sha256(six.text_type(token.get('access_token')).encode('utf-8')).hexdigest()
+
+
+def get_expiry(token):
+    # Returns the time (seconds since the epoch) at which the token expires,
+    # using the expires_at field provided by requests-oauthlib or the exp
+    # claim of JWT access tokens, or None if unknown
+    if not isinstance(token, dict):
+        return None
+
+    expires_at = token.get('expires_at')
+    if isinstance(expires_at, (int, float) + six.integer_types) and not isinstance(expires_at, bool):
+        return float(expires_at)
+
+    access_token = token.get('access_token')
+    if not isinstance(access_token, six.string_types) or access_token.count('.') != 2:
+        return None
+
+    payload = access_token.split('.')[1]
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(str(payload) + '=' * (-len(payload) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+    exp = claims.get('exp') if isinstance(claims, dict) else None
+    if isinstance(exp, (int, float) + six.integer_types) and not isinstance(exp, bool):
+        return float(exp)
+
+    return None
+
+
+class TokenRefresher(object):
+    """Refreshes the OAuth2 tokens used for accessing the Context Broker.
+
+    Tokens are refreshed ``margin`` seconds before they expire and, if
+    ``retry`` is enabled, when the Context Broker rejects them, in which case
+    the request is repeated once using the new token. Concurrent requests
+    sharing a token refresh it only once, and requests still using a token
+    that was just refreshed receive the new one.
+    """
+
+    def __init__(self, margin=DEFAULT_MARGIN, retry=True):
+        self.margin = margin
+        self.retry = retry
+
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._recent = OrderedDict()
+        self._refreshes = {PROACTIVE: 0, RETRY: 0}
+        self._reused = 0
+        self._failures = 0
+
+    def configure(self, config):
+        self.margin = get_int_setting(config, 'token_refresh_margin', DEFAULT_MARGIN)
+        self.retry = get_bool_setting(config, 'token_retry', True)
+
+    def needs_refresh(self, token, now=None):
+        if self.margin <= 0:
+            return False
+
+        expiry = get_expiry(token)
+        if expiry is None:
+            return False
+
+        return (time.time() if now is None else now) >= expiry - self.margin
+
+    def refresh(self, token, refresh, reason):
+        # Returns the new token, or None if it could not be refreshed.
+        # refresh is called with no arguments and returns the new token
+        key = get_token_key(token)
+        with self._lock:
+            recent = self._recent.get(key)
+            if recent is not None:
+                self._reused += 1
+                return recent
+
+        def fetch():
+            try:
+                new_token = refresh()
+            except Exception:
+                log.warning('Could not refresh the access token', exc_info=True)
+                new_token = None
+
+            with self._lock:
+                if new_token is None:
+                    self._failures += 1
+                else:
+                    self._refreshes[reason] += 1
+                    self._recent[key] = new_token
+                    while len(self._recent) > MAX_RECENT:
+                        self._recent.popitem(last=False)
+
+            return new_token
+
+        return self._flights.do(key, fetch)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'proactive_refreshes': self._refreshes[PROACTIVE],
+                'retry_refreshes': self._refreshes[RETRY],
+                'reused': self._reused,
+                'failures': self._failures,
+                'margin': self.margin,
+            }
+
+
+token_refresher = TokenRefresher()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Future Internet Consulting and Development Solutions S.L.
+#
+# This file is part of ckanext-right_time_context.
+#
+# Ckanext-right_time_context is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Ckanext-right_time_context is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with ckanext-right_time_context. If not, see http://www.gnu.org/licenses/.
+
+import os
+
+import six
+
+SETTINGS_PREFIX = 'ckan.right_time_context.'
+ENV_PREFIX = 'CKAN_RIGHT_TIME_CONTEXT_'
+
+
+def get_setting(config, name, default=None):
+    # Environment variables take precedence over the config file, e.g.
+    # CKAN_RIGHT_TIME_CONTEXT_POOL_MAXSIZE overrides
+    # ckan.right_time_context.pool_maxsize
+    value = os.environ.get(ENV_PREFIX + name.upper().replace('.', '_'))
+    if value is None or value.strip() == "":
+        value = config.get(SETTINGS_PREFIX + name)
+
+    if value is None or (isinstance(value, six.string_types) and value.strip() == ""):
+        return default
+
+    return value
+
+
+def get_int_setting(config, name, default=None):
+    value = get_setting(config, name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_float_setting(config, name, default=None):
+    value = get_setting(config, name)
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def get_bool_setting(config, name, default=False):
+    value = get_setting(config, name)
+    if value is None:
+        return default
+    elif isinstance(value, bool):
+        return value
+
+    return six.text_type(value).lower().strip() in ("true", "1", "on", "yes")
+
+
+def parse_host_sizes(value):
+    # Parses "host[:port]=size" pairs separated by spaces or commas
+    sizes = {}
+    if not value:
+        return sizes
+
+    for entry in value.replace(',', ' ').split():
+        host, sep, size = entry.rpartition('=')
+        if sep == "" or host == "":
+            continue
+
+        try:
+            sizes[host.lower()] = int(size)
+        except ValueError:
+            continue
+
+    return sizes
@@ -53,5 +53,8 @@ setup(
     entry_points='''
         [ckan.plugins]
         right_time_context=ckanext.right_time_context.plugin:NgsiView
+
+        [paste.paster_command]
+        right_time_context=ckanext.right_time_context.commands:RightTimeContextCommand
     ''',
 )